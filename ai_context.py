@@ -0,0 +1,253 @@
+# ai_context.py
+# AI 对话的上下文组装：在每个模型的 token 预算内拼出 系统提示 + 知识库 + 历史 + 本次提问。
+#
+# - estimate_tokens() 按 DeepSeek 公布的经验比例估算 token 数 (中文字符约 0.6，其它字符约 0.3)，不需要分词器。
+# - 知识库块：整个知识库不超过 CONTEXT_KB_FULL_MAX_TOKENS 时全部放入 (按服务器缓存渲染结果，直到知识库变化)；
+#   更大的知识库按本次提问用 BM25 检索 (kb_retrieval) 只放入最相关的几条。两种情况都不超过预算的 CONTEXT_KB_MAX_SHARE。
+# - 历史按整轮 (用户 + AI) 从最新往回保留，放不下时先丢最旧的轮次；
+#   被丢弃的轮次压缩为一段 "早先对话摘要" (本地抽取每轮的开头，不额外调用 API) 放进系统提示。
+
+import math
+import re
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from kb_retrieval import KnowledgeRetriever
+
+# --- 配置 ---
+CONTEXT_TOKEN_BUDGETS: Dict[str, int] = { # 每个模型的提示 token 预算 (不含回复)
+    "deepseek-chat": 12000,
+    "deepseek-coder": 12000,
+    "deepseek-reasoner": 12000,
+}
+CONTEXT_DEFAULT_TOKEN_BUDGET = 8000
+CONTEXT_KB_MAX_SHARE = 0.5            # 知识库块最多占预算的比例
+CONTEXT_KB_FULL_MAX_TOKENS = 1000     # 知识库整体不超过该大小时全部放入，否则按问题检索
+CONTEXT_SUMMARY_MAX_TOKENS = 400      # 早先对话摘要的上限
+CONTEXT_SUMMARY_SNIPPET_CHARS = 80    # 摘要中每条发言保留的字符数
+CONTEXT_MESSAGE_OVERHEAD_TOKENS = 4   # 每条消息的角色 / 分隔符开销
+
+KB_BLOCK_HEADER = "\n\n--- 服务器知识库信息 (请优先参考以下内容回答服务器特定问题) ---\n"
+KB_BLOCK_FOOTER = "--- 服务器知识库信息结束 ---\n"
+SUMMARY_HEADER = "\n\n--- 早先对话摘要 (较早的对话因长度限制已省略，以下为要点) ---\n"
+SUMMARY_FOOTER = "--- 早先对话摘要结束 ---\n"
+
+_CJK_PATTERN = re.compile(r"[　-〿぀-ヿ㐀-䶿一-鿿가-힯豈-﫿＀-￯]")
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的 token 数：中日韩字符按 0.6，其余字符按 0.3 计算 (向上取整)。"""
+    if not text:
+        return 0
+    cjk_chars = len(_CJK_PATTERN.findall(text))
+    return math.ceil(cjk_chars * 0.6 + (len(text) - cjk_chars) * 0.3)
+
+
+def estimate_message_tokens(message: Dict[str, Any]) -> int:
+    return estimate_tokens(message.get("content") or "") + CONTEXT_MESSAGE_OVERHEAD_TOKENS
+
+
+def render_knowledge_block(entries: Sequence[str], max_tokens: int, numbers: Optional[Sequence[int]] = None) -> Tuple[str, int]:
+    """渲染知识库块 (与原来的格式相同)，超出 max_tokens 的条目不再加入。返回 (文本, 收录条数)。
+    numbers 为各条目显示的序号 (默认 1, 2, 3...)，检索选取部分条目时用来保留原序号。"""
+    if not entries:
+        return "", 0
+    used = estimate_tokens(KB_BLOCK_HEADER) + estimate_tokens(KB_BLOCK_FOOTER)
+    lines = []
+    for position, entry in enumerate(entries):
+        line = f"{numbers[position] if numbers else position + 1}. {entry}\n"
+        line_tokens = estimate_tokens(line)
+        if used + line_tokens > max_tokens:
+            break
+        lines.append(line)
+        used += line_tokens
+    included = len(lines)
+    if not included:
+        return "", 0
+    if included < len(entries) and not numbers:
+        lines.append(f"(另有 {len(entries) - included} 条知识因长度限制未包含)\n")
+    return KB_BLOCK_HEADER + "".join(lines) + KB_BLOCK_FOOTER, included
+
+
+def summarize_turns(messages: Sequence[Dict[str, Any]], max_tokens: int = CONTEXT_SUMMARY_MAX_TOKENS) -> str:
+    """把被丢弃的历史压缩成要点：每条发言只保留开头，优先保留较新的发言。"""
+    if not messages:
+        return ""
+    budget = max_tokens - estimate_tokens(SUMMARY_HEADER) - estimate_tokens(SUMMARY_FOOTER)
+    lines: List[str] = []
+    for message in reversed(messages):
+        content = " ".join((message.get("content") or "").split())
+        if not content:
+            continue
+        if len(content) > CONTEXT_SUMMARY_SNIPPET_CHARS:
+            content = content[:CONTEXT_SUMMARY_SNIPPET_CHARS] + "…"
+        speaker = "用户" if message.get("role") == "user" else "AI"
+        line = f"- {speaker}: {content}\n"
+        line_tokens = estimate_tokens(line)
+        if line_tokens > budget:
+            break
+        lines.append(line)
+        budget -= line_tokens
+    if not lines:
+        return ""
+    return SUMMARY_HEADER + "".join(reversed(lines)) + SUMMARY_FOOTER
+
+
+class DialogueContext(NamedTuple):
+    messages: List[Dict[str, str]]
+    prompt_tokens: int       # 估算的提示 token 数
+    budget: int
+    kept_messages: int       # 保留的历史消息数
+    dropped_messages: int    # 因预算丢弃 (并进入摘要) 的历史消息数
+    summarized: bool
+
+
+class DialogueContextBuilder:
+    """按模型预算组装对话上下文；缓存各服务器渲染好的知识库块，大知识库按问题检索。"""
+
+    def __init__(self, budgets: Optional[Dict[str, int]] = None, kb_max_share: float = CONTEXT_KB_MAX_SHARE,
+                 summary_max_tokens: int = CONTEXT_SUMMARY_MAX_TOKENS, kb_full_max_tokens: int = CONTEXT_KB_FULL_MAX_TOKENS):
+        self.budgets = budgets if budgets is not None else CONTEXT_TOKEN_BUDGETS
+        self.kb_max_share = kb_max_share
+        self.summary_max_tokens = summary_max_tokens
+        self.kb_full_max_tokens = kb_full_max_tokens
+        self.retriever = KnowledgeRetriever()
+        self._kb_blocks: Dict[Tuple[int, int, int], Optional[str]] = {} # (guild_id, 知识库 token 上限, 版本) -> 全量渲染结果 (None: 太大，需检索)
+        self._stats: Dict[str, float] = {"builds": 0, "prompt_tokens": 0, "max_prompt_tokens": 0,
+                                         "dropped_messages": 0, "summaries": 0, "kb_hits": 0, "kb_renders": 0,
+                                         "kb_retrievals": 0, "build_seconds": 0.0}
+
+    def get_budget(self, model: str) -> int:
+        return self.budgets.get(model, CONTEXT_DEFAULT_TOKEN_BUDGET)
+
+    def knowledge_block(self, guild_id: int, entries: Sequence[str], model: str, query: str = "", version: int = 0) -> str:
+        """返回某服务器本次提问使用的知识库块。小知识库整体放入 (缓存到知识库变化为止)，大知识库按 query 检索。
+        version 为知识库的版本号 (knowledge_base 快照)，版本不同的缓存不会被使用。"""
+        if not entries:
+            return ""
+        max_tokens = int(self.get_budget(model) * self.kb_max_share)
+        key = (guild_id, max_tokens, version)
+        if key in self._kb_blocks:
+            self._stats["kb_hits"] += 1
+        else:
+            block, included = render_knowledge_block(entries, max_tokens)
+            fits = included == len(entries) and estimate_tokens(block) <= self.kb_full_max_tokens
+            self._kb_blocks[key] = block if fits else None
+            self._stats["kb_renders"] += 1
+        block = self._kb_blocks[key]
+        if block is not None:
+            return block
+        self._stats["kb_retrievals"] += 1
+        positions = sorted(self.retriever.select(guild_id, entries, query)) # 按原顺序排列，保留原序号
+        block, _ = render_knowledge_block([entries[p] for p in positions], max_tokens, [p + 1 for p in positions])
+        return block
+
+    def _drop_rendered_blocks(self, guild_id: int):
+        for key in [key for key in self._kb_blocks if key[0] == guild_id]:
+            del self._kb_blocks[key]
+
+    def knowledge_added(self, guild_id: int, entry: str):
+        """知识库末尾新增一条后调用：增量更新检索索引，丢弃缓存的渲染结果。"""
+        self.retriever.entry_added(guild_id, entry)
+        self._drop_rendered_blocks(guild_id)
+
+    def knowledge_removed(self, guild_id: int, position: int):
+        """知识库移除第 position 条 (从 0 开始) 后调用。"""
+        self.retriever.entry_removed(guild_id, position)
+        self._drop_rendered_blocks(guild_id)
+
+    def invalidate_knowledge(self, guild_id: int):
+        """知识库整体变化 (例如清空) 后调用，下次请求时重新渲染并重建索引。"""
+        self.retriever.forget(guild_id)
+        self._drop_rendered_blocks(guild_id)
+
+    def build(self, model: str, system_prompt: str, history: Sequence[Dict[str, Any]], user_prompt: str) -> DialogueContext:
+        """组装发送给 API 的消息列表。系统提示 (含知识库) 与本次提问总是保留；历史在剩余预算内从新到旧按整轮保留。"""
+        started = time.perf_counter()
+        budget = self.get_budget(model)
+        usable = [{"role": m["role"], "content": m["content"]} for m in history
+                  if m.get("role") in ("user", "assistant") and m.get("content") is not None]
+        fixed_tokens = estimate_tokens(user_prompt) + CONTEXT_MESSAGE_OVERHEAD_TOKENS
+        if system_prompt:
+            fixed_tokens += estimate_tokens(system_prompt) + CONTEXT_MESSAGE_OVERHEAD_TOKENS
+        if not system_prompt and usable: # 可能需要为摘要单独加一条系统消息
+            fixed_tokens += CONTEXT_MESSAGE_OVERHEAD_TOKENS
+
+        # 先假设全部历史都放得下；放不下时预留摘要空间后从最新一轮往回装
+        history_tokens = sum(estimate_message_tokens(m) for m in usable)
+        kept_start = 0
+        summary = ""
+        if fixed_tokens + history_tokens > budget:
+            remaining = budget - fixed_tokens - self.summary_max_tokens
+            kept_start = len(usable)
+            index = len(usable)
+            while index > 0:
+                # 以 "用户 + AI" 为一轮，避免只保留半轮对话
+                turn_start = index - 1
+                if usable[turn_start]["role"] == "assistant" and turn_start > 0 and usable[turn_start - 1]["role"] == "user":
+                    turn_start -= 1
+                turn_tokens = sum(estimate_message_tokens(m) for m in usable[turn_start:index])
+                if turn_tokens > remaining:
+                    break
+                remaining -= turn_tokens
+                kept_start = index = turn_start
+            summary = summarize_turns(usable[:kept_start], self.summary_max_tokens)
+
+        system_content = system_prompt + summary if system_prompt else summary.strip()
+        messages: List[Dict[str, str]] = []
+        if system_content:
+            messages.append({"role": "system", "content": system_content})
+        messages.extend(usable[kept_start:])
+        messages.append({"role": "user", "content": user_prompt})
+
+        prompt_tokens = sum(estimate_message_tokens(m) for m in messages)
+        self._stats["builds"] += 1
+        self._stats["prompt_tokens"] += prompt_tokens
+        self._stats["max_prompt_tokens"] = max(self._stats["max_prompt_tokens"], prompt_tokens)
+        self._stats["dropped_messages"] += kept_start
+        self._stats["summaries"] += 1 if summary else 0
+        self._stats["build_seconds"] += time.perf_counter() - started
+        return DialogueContext(messages, prompt_tokens, budget, len(usable) - kept_start, kept_start, bool(summary))
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = dict(self._stats)
+        builds = stats["builds"]
+        stats["avg_prompt_tokens"] = stats["prompt_tokens"] / builds if builds else 0.0
+        stats["avg_build_ms"] = stats["build_seconds"] / builds * 1000 if builds else 0.0
+        stats["cached_kb_blocks"] = sum(1 for block in self._kb_blocks.values() if block is not None)
+        stats["retrieval"] = self.retriever.get_stats()
+        return stats
+
+
+# =========================================
+# == 上下文大小对比 (python ai_context.py demo)
+# =========================================
+def _run_context_demo() -> Dict[str, Dict[str, int]]:
+    """最坏情况：50 条 × 1000 字的知识库 + 10 轮长对话，比较原来的全量拼接与按预算组装的提示大小。"""
+    entries = [f"第 {i} 条规则：" + "服务器规则说明文字" * 110 for i in range(50)]
+    history: List[Dict[str, str]] = []
+    for turn in range(10):
+        history.append({"role": "user", "content": f"第 {turn} 个问题：" + "请详细解释一下这个问题 " * 20})
+        history.append({"role": "assistant", "content": f"第 {turn} 个回答：" + "这是一个很长的回答内容。" * 120})
+    user_prompt = "第 3 条规则说的是什么？"
+
+    legacy_kb = KB_BLOCK_HEADER + "".join(f"{i + 1}. {entry}\n" for i, entry in enumerate(entries)) + KB_BLOCK_FOOTER
+    legacy_messages = [{"role": "system", "content": legacy_kb.strip()}] + history + [{"role": "user", "content": user_prompt}]
+    report = {"legacy": {"messages": len(legacy_messages),
+                         "prompt_tokens": sum(estimate_message_tokens(m) for m in legacy_messages)}}
+
+    builder = DialogueContextBuilder()
+    model = "deepseek-chat"
+    context = builder.build(model, builder.knowledge_block(1, entries, model, user_prompt).strip(), history, user_prompt)
+    report["budgeted"] = {"messages": len(context.messages), "prompt_tokens": context.prompt_tokens, "budget": context.budget,
+                          "kept_messages": context.kept_messages, "dropped_messages": context.dropped_messages}
+    return report
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "demo":
+        for demo_mode, demo_values in _run_context_demo().items():
+            print(f"{demo_mode:>15}: " + ", ".join(f"{key}={value:,}" for key, value in demo_values.items()))
+    else:
+        print("用法: python ai_context.py demo")
@@ -0,0 +1,161 @@
+# ai_dialogue_queue.py
+# AI 对话的排队与合并：同一对话 (history_key) 的回合逐个执行，同一用户连续发送的消息合并为一个回合。
+#
+# - 合并 (去抖)：对话空闲时，消息立即开始生成 (不增加首字延迟)。对话已有回合在执行或排队时，新消息进入队尾回合，
+#   同一用户的后续消息并入该回合 (按换行拼接，最多 max_merged_messages 条 / max_merged_chars 字符)；
+#   这样的回合轮到执行时，若最后一条消息距今不足 debounce_seconds 会再等到安静为止 (通常前一回合执行期间早已满足)。
+#   代价：空闲对话中紧接着发出的第二条消息不会并入第一条，而是在第一条回复完成后作为下一回合合并处理。
+# - 串行：每个对话一个 worker，按顺序执行回合，后一个回合读到的历史一定包含前一个回合的问答；
+#   对话没有待处理回合时 worker 退出。每个对话最多排队 max_pending_turns 个回合，超出时 submit() 返回 False。
+# - 限流：同一服务器同时生成的回合最多 guild_concurrency 个 (整段流式回复期间都占用)。
+# - 指标：queue_wait 记录从第一条消息到回合开始执行的等待时间 (含去抖、对话内排队与服务器并发等待)。
+#
+# 与 Discord 无关：消息对象原样放在回合的 items 中，由 handler(turn) 处理。
+
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+from ai_moderation import LatencyHistogram
+from bot_logging import get_logger
+
+log = get_logger("ai.dialogue")
+
+DIALOGUE_DEBOUNCE_SECONDS = 0.8      # 合并窗口：对话忙碌时排队的回合，最后一条消息后安静多久才开始生成
+DIALOGUE_MAX_MERGED_MESSAGES = 5     # 一个回合最多合并的消息数
+DIALOGUE_MAX_MERGED_CHARS = 4000     # 一个回合合并后的最大字符数
+DIALOGUE_MAX_PENDING_TURNS = 5       # 每个对话最多排队的回合数
+DIALOGUE_GUILD_CONCURRENCY = 2       # 每个服务器同时生成的回合数上限
+
+
+class DialogueTurn:
+    """一个待执行的回合：同一用户的一条或多条连续消息。"""
+    __slots__ = ("key", "guild_id", "user_id", "texts", "items", "first_at", "last_at", "debounce")
+
+    def __init__(self, key: str, guild_id: Optional[int], user_id: int, text: str, item: Any, now: float, debounce: bool = False):
+        self.key = key
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.texts: List[str] = [text]
+        self.items: List[Any] = [item]
+        self.first_at = now
+        self.last_at = now
+        self.debounce = debounce # 创建时对话正忙 (有回合在执行或排队)，开始前需等待消息安静下来
+
+    @property
+    def text(self) -> str:
+        return "\n".join(self.texts)
+
+    @property
+    def latest(self) -> Any:
+        return self.items[-1]
+
+
+class DialogueScheduler:
+    """按对话串行执行 AI 回合，合并连续消息，并限制每个服务器的并发生成数。"""
+
+    def __init__(self, handler: Callable[[DialogueTurn], Awaitable[None]],
+                 debounce_seconds: float = DIALOGUE_DEBOUNCE_SECONDS,
+                 max_merged_messages: int = DIALOGUE_MAX_MERGED_MESSAGES,
+                 max_merged_chars: int = DIALOGUE_MAX_MERGED_CHARS,
+                 max_pending_turns: int = DIALOGUE_MAX_PENDING_TURNS,
+                 guild_concurrency: int = DIALOGUE_GUILD_CONCURRENCY):
+        self.handler = handler
+        self.debounce_seconds = debounce_seconds
+        self.max_merged_messages = max_merged_messages
+        self.max_merged_chars = max_merged_chars
+        self.max_pending_turns = max_pending_turns
+        self.guild_concurrency = guild_concurrency
+        self._pending: Dict[str, Deque[DialogueTurn]] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        self._guild_slots: Dict[Optional[int], asyncio.Semaphore] = {}
+        self._running = 0
+        self.queue_wait = LatencyHistogram("ai_dialogue_queue_wait", (500, 1000, 2000, 5000, 10000, 30000, 60000, 120000))
+        self._stats: Dict[str, int] = {"messages": 0, "turns": 0, "merged": 0, "debounced": 0, "rejected": 0,
+                                       "completed": 0, "errors": 0}
+
+    def submit(self, key: str, guild_id: Optional[int], user_id: int, text: str, item: Any) -> bool:
+        """加入一条消息。返回 False 表示该对话排队已满，消息被丢弃。"""
+        now = time.monotonic()
+        self._stats["messages"] += 1
+        queue = self._pending.setdefault(key, deque())
+        last = queue[-1] if queue else None
+        # 只并入队尾的回合，保证不同用户的发言顺序不变
+        if (last is not None and last.user_id == user_id and len(last.texts) < self.max_merged_messages
+                and sum(map(len, last.texts)) + len(text) <= self.max_merged_chars):
+            last.texts.append(text)
+            last.items.append(item)
+            last.last_at = now
+            self._stats["merged"] += 1
+            return True
+        if len(queue) >= self.max_pending_turns:
+            self._stats["rejected"] += 1
+            log.debug("对话 %s 排队已满 (%s 个回合)，丢弃用户 %s 的消息。", key, len(queue), user_id)
+            return False
+        busy = key in self._workers
+        queue.append(DialogueTurn(key, guild_id, user_id, text, item, now, debounce=busy))
+        self._stats["turns"] += 1
+        if busy:
+            self._stats["debounced"] += 1
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._run(key))
+        return True
+
+    def _guild_slot(self, guild_id: Optional[int]) -> asyncio.Semaphore:
+        slot = self._guild_slots.get(guild_id)
+        if slot is None:
+            slot = self._guild_slots[guild_id] = asyncio.Semaphore(self.guild_concurrency)
+        return slot
+
+    async def _run(self, key: str):
+        queue = self._pending[key]
+        try:
+            while queue:
+                turn = queue[0]
+                # 去抖：只对对话忙碌时排队的回合生效，等到最后一条消息之后安静 debounce_seconds (等待期间仍可并入新消息)
+                while turn.debounce:
+                    remaining = turn.last_at + self.debounce_seconds - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    await asyncio.sleep(remaining)
+                queue.popleft() # 出队后不再合并，之后的消息进入新回合
+                async with self._guild_slot(turn.guild_id):
+                    self.queue_wait.observe(time.monotonic() - turn.first_at)
+                    self._running += 1
+                    try:
+                        await self.handler(turn)
+                        self._stats["completed"] += 1
+                    except Exception:
+                        self._stats["errors"] += 1
+                        log.exception("AI 对话回合执行出错 (对话 %s，用户 %s)。", key, turn.user_id)
+                    finally:
+                        self._running -= 1
+        finally:
+            self._workers.pop(key, None)
+            if not queue:
+                self._pending.pop(key, None)
+
+    async def stop(self) -> int:
+        """取消所有 worker，返回被丢弃的排队回合数。"""
+        workers = list(self._workers.values())
+        for task in workers:
+            task.cancel()
+        if workers:
+            await asyncio.gather(*workers, return_exceptions=True)
+        discarded = sum(len(queue) for queue in self._pending.values())
+        self._pending.clear()
+        self._workers.clear()
+        return discarded
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = dict(self._stats)
+        wait = self.queue_wait.snapshot()
+        stats.update({
+            "active_conversations": len(self._workers),
+            "queued_turns": sum(len(queue) for queue in self._pending.values()),
+            "running": self._running,
+            "guild_concurrency": self.guild_concurrency,
+            "wait_avg_ms": wait["avg_ms"], "wait_p50_ms": wait["p50_ms"], "wait_p99_ms": wait["p99_ms"], "wait_max_ms": wait["max_ms"],
+        })
+        return stats
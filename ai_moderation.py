@@ -0,0 +1,757 @@
+# ai_moderation.py
+# DeepSeek AI 内容审核：构造审核请求、解析中文判定，并记录每次调用的延迟分布。
+#
+# - HTTP 请求通过调用方传入的共享 aiohttp.ClientSession 发出 (http_client.get_session())，
+#   复用连接池里的 keep-alive 连接，不再为每条消息占用一个线程并重新握手 TCP + TLS。
+# - 请求经过 DeepSeekGateway (并发上限 / 限速 / 重试 / 熔断)；熔断时不发请求，视为审核不可用 (放行)。
+# - moderation_latency 记录每次调用的耗时直方图与结果分类，/管理 性能统计 中可以查看。
+# - ModerationBatcher 把几百毫秒内到达的消息合并成一次请求 (模型返回判定数组)，减少请求数与重复的 Prompt 开销。
+# - VerdictCache 缓存相同 (规范化后) 内容的判定，并让并发的相同内容共享一次请求。
+# - ModerationPrefilter 在本地先处理明确的情况 (违禁词命中、极短文本、纯表情、白名单链接)，
+#   只有无法判断的文本才交给远端模型。
+# - ModerationQueue 是有界的后台审核队列：on_message 入队后立即返回，刷屏检测与聊天奖励不再等待 API。
+
+import asyncio
+import bisect
+import hashlib
+import json
+import re
+import threading
+import unicodedata
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, Union
+from urllib.parse import urlsplit
+
+from bot_logging import get_logger
+from deepseek_gateway import DeepSeekGateway, GatewayUnavailable
+from word_filter import BadWordFilter
+
+try:
+    import aiohttp
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    AIOHTTP_AVAILABLE = False
+
+log = get_logger("moderation")
+
+# --- 配置 ---
+MODERATION_TIMEOUT_SECONDS = 8   # 单次审核请求的总超时
+MODERATION_MAX_TOKENS = 30       # 只需要返回分类名称
+MODERATION_TEMPERATURE = 0.1     # 较低的温度，追求更确定的分类
+# 批量审核：一次请求审核多条消息 (ModerationBatcher)
+MODERATION_BATCH_MAX_SIZE = 10            # 每批最多消息数，1 表示不攒批
+MODERATION_BATCH_MAX_WAIT_SECONDS = 0.3   # 第一条消息最多等待多久就发出本批
+MODERATION_BATCH_MAX_CHARS = 6000         # 每批消息的累计字符上限，避免单个 Prompt 过长
+MODERATION_BATCH_TOKENS_PER_ITEM = 12     # 批量请求中每条判定预留的输出 token
+# 判定缓存：刷屏 / 复制粘贴 / 纯表情等重复内容不再重复请求 (VerdictCache)
+MODERATION_CACHE_MAX_ENTRIES = 5000
+MODERATION_CACHE_TTL_SECONDS = 600
+# 后台审核队列 (ModerationQueue)
+MODERATION_QUEUE_WORKERS = 20            # 同时等待判定的消息数；应不小于批大小，否则攒不满一批
+MODERATION_QUEUE_MAX_SIZE = 1000         # 排队上限，已满时丢弃最旧的消息 (不审核)
+MODERATION_QUEUE_MAX_AGE_SECONDS = 60    # 排队超过此时间的消息不再审核 (过载时优先处理新消息)
+# 本地预过滤 (ModerationPrefilter)
+PREFILTER_MAX_TRIVIAL_CHARS = 2  # 去掉表情 / 标点 / 空白 / 提及 / 白名单链接后，不超过此长度的纯 ASCII 文本直接放行
+                                 # (汉字、全角字符等不适用："去死"、"ｓｂ" 这样的两个字就足以构成辱骂)
+PREFILTER_SAFE_LINK_DOMAINS = (  # 只包含这些域名 (及其子域名) 的链接、且没有其他文字时视为安全
+    "discord.com", "discordapp.com", "discordapp.net", "tenor.com", "giphy.com",
+    "youtube.com", "youtu.be", "bilibili.com", "b23.tv", "github.com",
+)  # 不包含邀请链接 (discord.gg、discord.com/invite) 与用户内容平台 (x.com / twitter.com)
+
+VERDICT_SAFE = "安全"
+VERDICT_MINOR = "轻微违规"
+
+# !!! --- 重要：设计和优化你的 Prompt --- !!!
+# --- V2: 要求返回中文分类 ---
+MODERATION_PROMPT_TEMPLATE = """
+    请分析以下 Discord 消息内容是否包含严重的违规行为。
+    严重违规分类包括：仇恨言论、骚扰/欺凌、露骨的 NSFW 内容、严重威胁。
+    - 如果检测到明确的严重违规，请【仅】返回对应的中文分类名称（例如：“仇恨言论”）。
+    - 如果内容包含一些轻微问题（如刷屏、普通脏话）但【不构成】上述严重违规，请【仅】返回：“轻微违规”。
+    - 如果内容安全，没有任何违规，请【仅】返回：“安全”。
+
+    消息内容：“{message_content}”
+    分析结果："""
+
+MODERATION_BATCH_PROMPT_TEMPLATE = """
+    请逐条分析以下 {count} 条 Discord 消息是否包含严重的违规行为。
+    严重违规分类包括：仇恨言论、骚扰/欺凌、露骨的 NSFW 内容、严重威胁。
+    对每条消息给出一个判定：
+    - 检测到明确的严重违规：对应的中文分类名称（例如：“仇恨言论”）。
+    - 有轻微问题（如刷屏、普通脏话）但【不构成】上述严重违规：“轻微违规”。
+    - 安全，没有任何违规：“安全”。
+    请【仅】返回一个按消息编号顺序排列、长度为 {count} 的 JSON 字符串数组，例如：["安全", "仇恨言论"]。
+
+    消息列表 (每条消息是一个 JSON 字符串)：
+{numbered_messages}
+    分析结果："""
+# !!! --- Prompt 结束 --- !!!
+
+
+class ModerationUnavailable(Exception):
+    """审核请求失败 (超时、网络或解析错误等)，没有得到判定。"""
+
+
+class LatencyHistogram:
+    """固定分桶的延迟直方图 (毫秒)，同时按结果 (ok / timeout / http_error ...) 计数。线程安全。"""
+
+    DEFAULT_BUCKETS_MS = (50, 100, 250, 500, 1000, 2000, 4000, 8000)
+
+    def __init__(self, name: str, buckets_ms: Tuple[float, ...] = DEFAULT_BUCKETS_MS):
+        self.name = name
+        self.buckets_ms = tuple(sorted(buckets_ms))
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self._counts = [0] * (len(self.buckets_ms) + 1) # 最后一个桶是 "大于最大边界"
+        self._outcomes: Dict[str, int] = {}
+        self._total = 0
+        self._sum_ms = 0.0
+        self._max_ms = 0.0
+
+    def reset(self):
+        with self._lock:
+            self._clear()
+
+    def observe(self, seconds: float, outcome: str = "ok"):
+        elapsed_ms = seconds * 1000
+        index = bisect.bisect_left(self.buckets_ms, elapsed_ms)
+        with self._lock:
+            self._counts[index] += 1
+            self._outcomes[outcome] = self._outcomes.get(outcome, 0) + 1
+            self._total += 1
+            self._sum_ms += elapsed_ms
+            self._max_ms = max(self._max_ms, elapsed_ms)
+
+    def _percentile_ms(self, counts: List[int], total: int, fraction: float) -> float:
+        # 返回包含该分位的桶的上边界 (落在最后一个桶时返回观测到的最大值)
+        threshold = fraction * total
+        running = 0
+        for index, count in enumerate(counts):
+            running += count
+            if running >= threshold and count:
+                return float(self.buckets_ms[index]) if index < len(self.buckets_ms) else self._max_ms
+        return 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = list(self._counts)
+            total = self._total
+            snapshot = {
+                "count": total,
+                "avg_ms": self._sum_ms / total if total else 0.0,
+                "max_ms": self._max_ms,
+                "outcomes": dict(self._outcomes),
+            }
+            labels = [f"<={bound:g}ms" for bound in self.buckets_ms] + [f">{self.buckets_ms[-1]:g}ms"]
+            snapshot["buckets"] = dict(zip(labels, counts))
+            for name, fraction in (("p50_ms", 0.50), ("p90_ms", 0.90), ("p99_ms", 0.99)):
+                snapshot[name] = self._percentile_ms(counts, total, fraction) if total else 0.0
+        return snapshot
+
+
+moderation_latency = LatencyHistogram("deepseek_moderation")
+
+
+def build_moderation_payload(model: str, message_content: str) -> Dict[str, Any]:
+    return {
+        "model": model,
+        "messages": [{"role": "user", "content": MODERATION_PROMPT_TEMPLATE.format(message_content=message_content)}],
+        "max_tokens": MODERATION_MAX_TOKENS,
+        "temperature": MODERATION_TEMPERATURE,
+        "stream": False
+    }
+
+
+def build_batch_moderation_payload(model: str, message_contents: List[str]) -> Dict[str, Any]:
+    # 每条消息用 JSON 字符串表示，消息中的换行 / 引号不会打乱编号格式
+    numbered_messages = "\n".join(f"    [{index}] {json.dumps(content, ensure_ascii=False)}"
+                                  for index, content in enumerate(message_contents, start=1))
+    prompt = MODERATION_BATCH_PROMPT_TEMPLATE.format(count=len(message_contents), numbered_messages=numbered_messages)
+    return {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": MODERATION_BATCH_TOKENS_PER_ITEM * len(message_contents) + MODERATION_MAX_TOKENS,
+        "temperature": MODERATION_TEMPERATURE,
+        "stream": False
+    }
+
+
+def parse_moderation_verdict(api_response_text: str) -> Optional[str]:
+    """把模型返回的文本转换为严重违规类型；安全 / 轻微违规 / 空响应返回 None。"""
+    api_response_text = (api_response_text or "").strip()
+    if not api_response_text or api_response_text in (VERDICT_SAFE, VERDICT_MINOR):
+        # 对于轻微违规，我们目前也视为不需要机器人直接干预（交给刷屏或本地违禁词处理）
+        return None
+    # 否则假定返回的是中文的严重违规类型 (例如 “仇恨言论”, “骚扰/欺凌” 等)
+    return api_response_text
+
+
+def parse_batch_moderation_verdicts(api_response_text: str, expected_count: int) -> Optional[List[Optional[str]]]:
+    """解析批量审核返回的 JSON 数组。格式不对或数量不符时返回 None (调用方应逐条重试)。"""
+    text = (api_response_text or "").strip()
+    start, end = text.find("["), text.rfind("]") # 兼容 ```json ... ``` 包裹
+    if start == -1 or end <= start:
+        return None
+    try:
+        verdicts = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(verdicts, list) or len(verdicts) != expected_count or not all(isinstance(v, str) for v in verdicts):
+        return None
+    return [parse_moderation_verdict(verdict) for verdict in verdicts]
+
+
+async def _post_moderation_request(gateway: DeepSeekGateway, session: "aiohttp.ClientSession",
+                                   payload: Dict[str, Any], timeout: Union[float, "aiohttp.ClientTimeout"]) -> Optional[str]:
+    """经网关发送一次审核请求并返回模型输出文本；出错时记录日志并返回 None。每次调用都计入 moderation_latency。"""
+    outcome = "ok"
+    started = time.perf_counter()
+    try:
+        response = await gateway.post(session, payload, timeout, purpose="moderation")
+        if response.status != 200:
+            outcome = "http_error"
+            log.error("❌ DeepSeek 审核 API 返回错误状态 %s: %s", response.status, response.text[:200])
+            return None
+        result = json.loads(response.text)
+        return result.get("choices", [{}])[0].get("message", {}).get("content", "")
+    except GatewayUnavailable as e:
+        outcome = "gateway_rejected"
+        log.debug("DeepSeek 审核请求未发出: %s", e)
+        return None
+    except asyncio.TimeoutError:
+        outcome = "timeout"
+        log.error("❌ 调用 DeepSeek API 超时 (%ss)", getattr(timeout, "total", timeout))
+        return None
+    except aiohttp.ClientError as e:
+        outcome = "network_error"
+        log.error("❌ 调用 DeepSeek API 时发生网络错误: %s", e)
+        return None
+    except (json.JSONDecodeError, AttributeError, IndexError) as e:
+        outcome = "parse_error"
+        log.error("❌ 解析 DeepSeek API 响应失败: %s", e)
+        return None
+    except Exception as e:
+        outcome = "error"
+        log.error("❌ DeepSeek 检查期间发生意外错误: %s", e)
+        return None
+    finally:
+        moderation_latency.observe(time.perf_counter() - started, outcome)
+
+
+async def classify_message(gateway: DeepSeekGateway, session: "aiohttp.ClientSession", model: str,
+                           message_content: str, timeout: Union[float, "aiohttp.ClientTimeout"] = MODERATION_TIMEOUT_SECONDS,
+                           raise_on_error: bool = False) -> Optional[str]:
+    """通过共享会话调用 DeepSeek 审核单条消息。返回中文违规类型或 None (安全时返回 None)。
+
+    请求失败时默认同样返回 None (放行)；raise_on_error=True 时改为抛出 ModerationUnavailable，
+    以便调用方区分“安全”与“没有审核结果” (例如不把失败结果写入缓存)。
+    """
+    api_response_text = await _post_moderation_request(gateway, session,
+                                                       build_moderation_payload(model, message_content), timeout)
+    if api_response_text is None:
+        if raise_on_error:
+            raise ModerationUnavailable("DeepSeek 审核请求失败")
+        return None
+    log.debug("DeepSeek 对 '%.30s...' 的响应: %s", message_content, api_response_text)
+    return parse_moderation_verdict(api_response_text)
+
+
+async def classify_messages(gateway: DeepSeekGateway, session: "aiohttp.ClientSession", model: str,
+                            message_contents: List[str], timeout: Union[float, "aiohttp.ClientTimeout"] = MODERATION_TIMEOUT_SECONDS,
+                            raise_on_error: bool = False) -> List[Optional[str]]:
+    """一次请求审核多条消息，返回与输入顺序一致的判定列表。模型返回的数组无法解析时退回逐条审核。"""
+    if len(message_contents) == 1:
+        return [await classify_message(gateway, session, model, message_contents[0], timeout, raise_on_error)]
+    api_response_text = await _post_moderation_request(gateway, session,
+                                                       build_batch_moderation_payload(model, message_contents), timeout)
+    if api_response_text is None:
+        if raise_on_error:
+            raise ModerationUnavailable(f"DeepSeek 批量审核请求失败 ({len(message_contents)} 条)")
+        return [None] * len(message_contents) # 请求本身失败：与单条审核一致，按安全处理
+    verdicts = parse_batch_moderation_verdicts(api_response_text, len(message_contents))
+    if verdicts is not None:
+        return verdicts
+    log.warning("⚠️ 批量审核返回格式无效 (%s 条)，改为逐条审核: %.200s", len(message_contents), api_response_text)
+    return list(await asyncio.gather(*[
+        classify_message(gateway, session, model, content, timeout, raise_on_error) for content in message_contents
+    ]))
+
+
+class ModerationBatcher:
+    """把短时间内到达的审核请求攒成一批，一次调用 classify_batch，再把每条判定交回各自的等待者。
+
+    满足任一条件即发出一批：攒够 max_batch_size 条、累计字符数达到 max_batch_chars、
+    或第一条消息已等待 max_wait_seconds。max_batch_size <= 1 时不攒批，直接逐条调用。
+    classify_batch 抛出异常时，本批所有等待者都会收到 ModerationUnavailable。
+    """
+
+    def __init__(self, classify_batch: Callable[[List[str]], Awaitable[List[Optional[str]]]],
+                 max_batch_size: int = MODERATION_BATCH_MAX_SIZE,
+                 max_wait_seconds: float = MODERATION_BATCH_MAX_WAIT_SECONDS,
+                 max_batch_chars: int = MODERATION_BATCH_MAX_CHARS):
+        self.classify_batch = classify_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.max_batch_chars = max_batch_chars
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._pending_chars = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._batch_tasks: Set[asyncio.Task] = set()
+        self.stats = {"messages": 0, "batches": 0, "max_batch": 0, "by_size": 0, "by_timer": 0, "failed_batches": 0}
+
+    async def classify(self, message_content: str) -> Optional[str]:
+        """排队等待所在批次的结果，返回中文违规类型或 None；本批审核失败时抛出 ModerationUnavailable。"""
+        self.stats["messages"] += 1
+        if self.max_batch_size <= 1:
+            return (await self._call_classify_batch([message_content]))[0]
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((message_content, future))
+        self._pending_chars += len(message_content)
+        if len(self._pending) >= self.max_batch_size or self._pending_chars >= self.max_batch_chars:
+            self.stats["by_size"] += 1
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait_seconds, self._dispatch_by_timer)
+        return await future
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def _dispatch_by_timer(self):
+        self._timer = None
+        if self._pending:
+            self.stats["by_timer"] += 1
+            self._dispatch()
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending, self._pending_chars = self._pending, [], 0
+        task = asyncio.get_running_loop().create_task(self._run_batch(batch))
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+
+    async def _call_classify_batch(self, message_contents: List[str]) -> List[Optional[str]]:
+        self.stats["batches"] += 1
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(message_contents))
+        try:
+            verdicts = await self.classify_batch(message_contents)
+            if len(verdicts) != len(message_contents):
+                raise ValueError(f"判定数量 {len(verdicts)} 与消息数量 {len(message_contents)} 不符")
+            return verdicts
+        except ModerationUnavailable:
+            self.stats["failed_batches"] += 1
+            raise
+        except Exception as e:
+            self.stats["failed_batches"] += 1
+            log.error("❌ 批量审核失败 (%s 条): %s", len(message_contents), e)
+            raise ModerationUnavailable(str(e)) from e
+
+    async def _run_batch(self, batch: List[Tuple[str, asyncio.Future]]):
+        try:
+            verdicts = await self._call_classify_batch([content for content, _ in batch])
+        except ModerationUnavailable as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), verdict in zip(batch, verdicts):
+            if not future.done(): # 等待者可能已被取消
+                future.set_result(verdict)
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = dict(self.stats)
+        stats["pending"] = len(self._pending)
+        stats["avg_batch"] = stats["messages"] / stats["batches"] if stats["batches"] else 0.0
+        return stats
+
+
+class VerdictCache:
+    """按规范化内容 (大小写折叠、合并空白) 的哈希缓存审核判定，LRU + TTL；同一内容的并发请求合并为一次调用。
+
+    只在事件循环线程中使用。审核失败 (ModerationUnavailable) 的结果不会被缓存。
+    """
+
+    def __init__(self, max_entries: int = MODERATION_CACHE_MAX_ENTRIES, ttl_seconds: float = MODERATION_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[bytes, Tuple[float, Optional[str]]]" = OrderedDict()
+        self._in_flight: Dict[bytes, asyncio.Task] = {}
+        self.stats = {"lookups": 0, "hits": 0, "coalesced": 0, "misses": 0, "evictions": 0, "failures": 0}
+
+    @staticmethod
+    def normalize(message_content: str) -> str:
+        return " ".join(message_content.casefold().split())
+
+    @classmethod
+    def cache_key(cls, message_content: str) -> bytes:
+        # 只保存 16 字节摘要，不在内存中保留消息原文
+        return hashlib.blake2b(cls.normalize(message_content).encode("utf-8"), digest_size=16).digest()
+
+    async def get_or_classify(self, message_content: str, classify: Callable[[str], Awaitable[Optional[str]]]) -> Optional[str]:
+        """命中缓存直接返回；相同内容正在审核时等待那一次的结果；否则调用 classify(message_content) 并缓存。"""
+        key = self.cache_key(message_content)
+        self.stats["lookups"] += 1
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, verdict = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return verdict
+            del self._entries[key]
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+            # 审核放在独立任务中执行：发起者被取消时，其它等待同一内容的协程仍能拿到结果
+            task = asyncio.get_running_loop().create_task(self._classify_and_store(key, message_content, classify))
+            self._in_flight[key] = task
+            task.add_done_callback(_consume_task_exception)
+        return await asyncio.shield(task)
+
+    async def _classify_and_store(self, key: bytes, message_content: str,
+                                  classify: Callable[[str], Awaitable[Optional[str]]]) -> Optional[str]:
+        try:
+            verdict = await classify(message_content)
+        except ModerationUnavailable:
+            self.stats["failures"] += 1
+            raise
+        finally:
+            self._in_flight.pop(key, None)
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, verdict)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+        return verdict
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = dict(self.stats)
+        saved_calls = stats["hits"] + stats["coalesced"]
+        stats["saved_calls"] = saved_calls
+        stats["hit_rate"] = saved_calls / stats["lookups"] if stats["lookups"] else 0.0
+        stats["size"] = len(self._entries)
+        stats["max_entries"] = self.max_entries
+        stats["in_flight"] = len(self._in_flight)
+        return stats
+
+
+def _consume_task_exception(task: asyncio.Task):
+    # 所有等待者都已离开时，避免 "Task exception was never retrieved" 警告
+    if not task.cancelled():
+        task.exception()
+
+
+class ModerationQueue:
+    """有界的后台审核工作队列：submit() 只入队并立即返回，固定数量的 worker 依次调用 handler(item)。
+
+    过载策略：队列已满时丢弃最旧的一项；worker 取出时已排队超过 max_age_seconds 的项直接丢弃。
+    worker 在第一次 submit() 时启动 (需要运行中的事件循环)，stop() 取消 worker 并丢弃剩余项。
+    """
+
+    def __init__(self, handler: Callable[[Any], Awaitable[None]], workers: int = MODERATION_QUEUE_WORKERS,
+                 max_size: int = MODERATION_QUEUE_MAX_SIZE, max_age_seconds: float = MODERATION_QUEUE_MAX_AGE_SECONDS):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.max_size = max(1, max_size)
+        self.max_age_seconds = max_age_seconds
+        self.wait_latency = LatencyHistogram("moderation_queue_wait")
+        self._items: Deque[Tuple[float, Any]] = deque() # (入队时间, 项)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self._busy = 0
+        self._stats: Dict[str, int] = {"enqueued": 0, "processed": 0, "errors": 0,
+                                       "dropped_full": 0, "dropped_stale": 0, "max_depth": 0}
+
+    def _ensure_workers(self):
+        self._worker_tasks = [task for task in self._worker_tasks if not task.done()]
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        while len(self._worker_tasks) < self.workers:
+            self._worker_tasks.append(asyncio.create_task(self._worker()))
+
+    def submit(self, item: Any) -> bool:
+        """入队并立即返回；返回 False 表示队列已满，丢弃了最旧的一项。"""
+        self._ensure_workers()
+        accepted = True
+        if len(self._items) >= self.max_size:
+            self._items.popleft()
+            self._stats["dropped_full"] += 1
+            accepted = False
+            if self._stats["dropped_full"] % 100 == 1:
+                log.warning("⚠️ 审核队列已满 (%s)，丢弃最旧的消息 (累计 %s 条)。", self.max_size, self._stats["dropped_full"])
+        self._items.append((time.monotonic(), item))
+        self._stats["enqueued"] += 1
+        self._stats["max_depth"] = max(self._stats["max_depth"], len(self._items))
+        self._wakeup.set()
+        return accepted
+
+    async def _worker(self):
+        while True:
+            if not self._items:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            enqueued_at, item = self._items.popleft()
+            waited = time.monotonic() - enqueued_at
+            self.wait_latency.observe(waited)
+            if self.max_age_seconds and waited > self.max_age_seconds:
+                self._stats["dropped_stale"] += 1
+                continue
+            self._busy += 1
+            try:
+                await self.handler(item)
+                self._stats["processed"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._stats["errors"] += 1
+                log.error("❌ 后台审核处理失败: %s", e, exc_info=True)
+            finally:
+                self._busy -= 1
+
+    async def stop(self) -> int:
+        """取消所有 worker，返回被丢弃的排队项数量。"""
+        for task in self._worker_tasks:
+            task.cancel()
+        if self._worker_tasks:
+            await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        discarded = len(self._items)
+        self._items.clear()
+        return discarded
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = dict(self._stats)
+        wait = self.wait_latency.snapshot()
+        stats.update({
+            "depth": len(self._items),
+            "oldest_age_seconds": time.monotonic() - self._items[0][0] if self._items else 0.0,
+            "busy_workers": self._busy,
+            "workers": self.workers,
+            "wait_p50_ms": wait["p50_ms"], "wait_p99_ms": wait["p99_ms"], "wait_max_ms": wait["max_ms"],
+        })
+        return stats
+
+
+# --- 本地预过滤 ---
+PREFILTER_SAFE = "safe"          # 本地判定安全，不调用 API
+PREFILTER_BAD_WORD = "bad_word"  # 命中违禁词，由调用方执行提醒 / 警告 / 踢出逻辑，不调用 API
+PREFILTER_ESCALATE = "escalate"  # 无法在本地判断，交给远端模型
+
+class PrefilterResult(NamedTuple):
+    tier: str
+    reason: str                          # empty / short / repeated / emoji_only / allowed_links / bad_word / text
+    matched_word: Optional[str] = None   # 第一个命中的违禁词
+    matched_words: Tuple[str, ...] = ()  # 全部命中的违禁词
+
+
+_DISCORD_TOKEN_PATTERN = re.compile(r"<a?:\w+:\d+>|<@[!&]?\d+>|<#\d+>") # 自定义表情、用户 / 身份组 / 频道提及
+_URL_PATTERN = re.compile(r"https?://\S+", re.IGNORECASE)
+
+
+class ModerationPrefilter:
+    """审核的本地第一层：命中违禁词或明显安全的消息在本地结束，其余消息才升级到 DeepSeek。"""
+
+    def __init__(self, bad_word_filter: BadWordFilter, safe_link_domains: Iterable[str] = PREFILTER_SAFE_LINK_DOMAINS,
+                 max_trivial_chars: int = PREFILTER_MAX_TRIVIAL_CHARS):
+        self.bad_word_filter = bad_word_filter
+        self.safe_link_domains = tuple(domain.lower() for domain in safe_link_domains)
+        self.max_trivial_chars = max_trivial_chars
+        self.stats: Dict[str, int] = {}
+
+    def _is_safe_link(self, url: str) -> bool:
+        try:
+            parts = urlsplit(url)
+            host = (parts.hostname or "").lower()
+        except ValueError:
+            return False
+        if parts.path.lower().startswith("/invite"): # discord.com/invite/... 与 discord.gg 一样是服务器邀请
+            return False
+        return any(host == domain or host.endswith("." + domain) for domain in self.safe_link_domains)
+
+    def _classify(self, content: str, guild_id: Optional[int]) -> PrefilterResult:
+        matched_words = self.bad_word_filter.find_all(content, guild_id)
+        if matched_words:
+            return PrefilterResult(PREFILTER_BAD_WORD, "bad_word", matched_words[0], tuple(matched_words))
+        if not content.strip():
+            return PrefilterResult(PREFILTER_SAFE, "empty")
+
+        remaining = _DISCORD_TOKEN_PATTERN.sub(" ", content)
+        had_links = False
+        for url in _URL_PATTERN.findall(remaining):
+            if not self._is_safe_link(url):
+                return PrefilterResult(PREFILTER_ESCALATE, "text") # 未知链接交给模型判断
+            had_links = True
+        remaining = _URL_PATTERN.sub(" ", remaining)
+        # 只保留字母、数字、汉字等“有意义”的字符 (去掉表情符号、标点、空白、组合字符)
+        meaningful = [char for char in remaining if unicodedata.category(char)[0] in ("L", "N")]
+        if not meaningful:
+            return PrefilterResult(PREFILTER_SAFE, "allowed_links" if had_links else "emoji_only")
+        if had_links:
+            return PrefilterResult(PREFILTER_ESCALATE, "text") # 链接附带文字时交给模型判断
+        if not all(char.isascii() for char in meaningful):
+            return PrefilterResult(PREFILTER_ESCALATE, "text") # 汉字、全角等字符信息量大，短文本与重复字也交给模型
+        if len(meaningful) <= self.max_trivial_chars:
+            return PrefilterResult(PREFILTER_SAFE, "short")
+        if len(set(char.casefold() for char in meaningful)) == 1:
+            return PrefilterResult(PREFILTER_SAFE, "repeated") # 例如 "66666"、"hhhhh"
+        return PrefilterResult(PREFILTER_ESCALATE, "text")
+
+    def classify(self, content: str, guild_id: Optional[int] = None) -> PrefilterResult:
+        result = self._classify(content or "", guild_id)
+        self.stats[result.reason] = self.stats.get(result.reason, 0) + 1
+        return result
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = sum(self.stats.values())
+        escalated = self.stats.get("text", 0)
+        return {"total": total, "escalated": escalated, "local_rate": (total - escalated) / total if total else 0.0,
+                "reasons": dict(self.stats)}
+
+
+def replay_prefilter(prefilter: ModerationPrefilter, labelled: Iterable[Tuple[str, str]]) -> Dict[str, Any]:
+    """用带标签的消息 (内容, "safe" / "violation") 回放预过滤，统计本地处理比例以及与标签不一致的本地判定。
+
+    升级到模型的消息不计入不一致 (最终判定仍由模型给出)；本地判定安全但标签为违规、
+    或命中违禁词但标签为安全的消息会列在 disagreements 中。
+    """
+    report: Dict[str, Any] = {"messages": 0, "escalated": 0, "local_safe": 0, "local_bad_word": 0, "disagreements": []}
+    for content, label in labelled:
+        report["messages"] += 1
+        result = prefilter.classify(content)
+        if result.tier == PREFILTER_ESCALATE:
+            report["escalated"] += 1
+            continue
+        local_label = "violation" if result.tier == PREFILTER_BAD_WORD else "safe"
+        report["local_bad_word" if result.tier == PREFILTER_BAD_WORD else "local_safe"] += 1
+        if local_label != label:
+            report["disagreements"].append({"content": content, "label": label, "local": result.reason})
+    report["api_call_reduction"] = 1 - report["escalated"] / report["messages"] if report["messages"] else 0.0
+    return report
+
+
+_SAMPLE_REPLAY_SET = (
+    ("ok", "safe"), ("好", "safe"), ("哈哈哈哈哈哈", "safe"), ("66666", "safe"), ("😂😂😂", "safe"),
+    ("<:pepe_laugh:123456789012345678>", "safe"), ("https://www.youtube.com/watch?v=dQw4w9WgXcQ", "safe"),
+    ("<@123456789012345678> ??", "safe"), ("", "safe"), ("今天晚上一起打游戏吗", "safe"),
+    ("你这个傻逼", "violation"), ("nmsl", "violation"), ("fuck this", "violation"),
+    ("我要找到你住哪然后让你好看", "violation"), ("看看这个 https://example.com/free-nitro", "violation"),
+    ("去死", "violation"), ("杀你", "violation"), ("<@123456789012345678> 去死", "violation"), ("傻 逼", "violation"),
+    ("ｓｂ", "violation"), ("死死死死死死", "violation"),
+    ("https://discord.gg/freenitro", "violation"), ("https://discord.com/invite/abcdef", "violation"),
+    ("ok https://www.youtube.com/watch?v=dQw4w9WgXcQ", "safe"),
+)
+
+
+# =========================================
+# == 批量审核基准 (python ai_moderation.py bench [消息数] [模拟API延迟ms])
+# =========================================
+async def _run_batch_benchmark(messages: int = 300, api_latency_ms: float = 200, arrival_seconds: float = 2.0) -> Dict[str, Dict[str, float]]:
+    """启动本地模拟 API，分别以逐条请求与攒批请求审核同一组消息 (均匀到达)，比较请求数、Prompt 长度与延迟。"""
+    from aiohttp import web
+
+    counters = {"requests": 0, "prompt_chars": 0}
+
+    async def handle_completion(request: "web.Request") -> "web.Response":
+        prompt = (await request.json())["messages"][0]["content"]
+        counters["requests"] += 1
+        counters["prompt_chars"] += len(prompt)
+        await asyncio.sleep(api_latency_ms / 1000)
+        items = [json.loads(item) for item in re.findall(r'^\s*\[\d+\] (".*")$', prompt, re.M)]
+        if items:
+            content = json.dumps(["仇恨言论" if "[违规]" in item else VERDICT_SAFE for item in items], ensure_ascii=False)
+        else:
+            content = "仇恨言论" if "[违规]" in prompt else VERDICT_SAFE
+        return web.json_response({"choices": [{"message": {"content": content}}]})
+
+    app = web.Application()
+    app.router.add_post("/chat/completions", handle_completion)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0) # 端口 0：由系统分配空闲端口，启动后从 runner.addresses 读取
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    api_url = f"http://{host}:{port}/chat/completions"
+
+    # 基准只比较攒批效果，网关的并发与限速放宽到不影响结果
+    gateway = DeepSeekGateway(api_url, "mock-key", global_concurrency=20, rate_per_second=1e6, burst=1e6)
+    contents = [f"第 {i} 条消息 {'[违规]' if i % 10 == 0 else '今天天气不错'}" for i in range(messages)]
+    expected = ["仇恨言论" if "[违规]" in content else None for content in contents]
+    report: Dict[str, Dict[str, float]] = {}
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=20)) as session:
+            for mode, batch_size in (("per_message", 1), ("batched", MODERATION_BATCH_MAX_SIZE)):
+                batcher = ModerationBatcher(
+                    lambda batch: classify_messages(gateway, session, "mock-model", batch), max_batch_size=batch_size)
+                counters.update(requests=0, prompt_chars=0)
+                latencies: List[float] = []
+
+                async def submit(index: int) -> Optional[str]:
+                    await asyncio.sleep(index * arrival_seconds / messages)
+                    submitted = time.perf_counter()
+                    verdict = await batcher.classify(contents[index])
+                    latencies.append(time.perf_counter() - submitted)
+                    return verdict
+
+                started = time.perf_counter()
+                verdicts = await asyncio.gather(*[submit(i) for i in range(messages)])
+                elapsed = time.perf_counter() - started
+                latencies.sort()
+                report[mode] = {
+                    "api_requests": counters["requests"],
+                    "prompt_chars": counters["prompt_chars"],
+                    "seconds": elapsed,
+                    "p50_ms": latencies[len(latencies) // 2] * 1000,
+                    "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+                    "wrong_verdicts": sum(1 for got, want in zip(verdicts, expected) if got != want),
+                }
+    finally:
+        await runner.cleanup()
+    return report
+
+
+def _load_replay_file(path: str) -> List[Tuple[str, str]]:
+    """每行一个 JSON 对象：{"content": "...", "label": "safe" | "violation"}。"""
+    with open(path, encoding="utf-8") as replay_file:
+        return [(record["content"], record["label"]) for record in map(json.loads, filter(str.strip, replay_file))]
+
+
+if __name__ == "__main__":
+    import sys
+    from bot_logging import setup_logging, shutdown_logging
+    setup_logging()
+    if len(sys.argv) > 1 and sys.argv[1] == "replay":
+        # python ai_moderation.py replay [labelled.jsonl] [违禁词文件，每行一个]
+        replay_set = _load_replay_file(sys.argv[2]) if len(sys.argv) > 2 else list(_SAMPLE_REPLAY_SET)
+        if len(sys.argv) > 3:
+            with open(sys.argv[3], encoding="utf-8") as words_file:
+                replay_words = [line.strip() for line in words_file if line.strip()]
+        else:
+            replay_words = ["傻逼", "nmsl", "fuck", "sb", "去死"]
+        replay_report = replay_prefilter(ModerationPrefilter(BadWordFilter(replay_words)), replay_set)
+        for report_key, report_value in replay_report.items():
+            print(f"{report_key:>20}: {report_value}")
+        shutdown_logging()
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        bench_messages = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+        bench_latency_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 200
+        bench_report = asyncio.run(_run_batch_benchmark(bench_messages, bench_latency_ms))
+        for bench_mode, bench_values in bench_report.items():
+            print(f"{bench_mode:>12}: " + ", ".join(f"{key}={value:,.1f}" if isinstance(value, float) else f"{key}={value:,}"
+                                                    for key, value in bench_values.items()))
+        shutdown_logging()
+    else:
+        print("用法: python ai_moderation.py bench [消息数] [模拟API延迟ms]\n"
+              "      python ai_moderation.py replay [labelled.jsonl] [违禁词文件]")
@@ -0,0 +1,104 @@
+# ai_streaming.py
+# AI 对话的流式输出：解析 DeepSeek SSE 增量，并把不断增长的文本节流地渲染到若干条消息上。
+#
+# - parse_stream_chunk() 从一个 SSE data 块中取出思考过程 (reasoning_content) 与回答 (content) 的增量。
+# - StreamingReply 按段 (思考过程 / 最终回答) 累积文本，每段按 page_chars 分页：
+#   新页调用 send_page 发送新消息，已有页内容变化时调用 edit_page 编辑。
+#   两次刷新之间至少间隔 min_edit_interval 秒 (Discord 对同一消息的编辑有速率限制)，第一段文字到达时立即刷新。
+# - 与 Discord 无关：发送 / 编辑由调用方提供的协程完成，页句柄 (例如 discord.Message) 原样交回。
+
+import json
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+SECTION_REASONING = "reasoning"
+SECTION_ANSWER = "answer"
+SECTION_ORDER = (SECTION_REASONING, SECTION_ANSWER)
+
+STREAM_MIN_EDIT_INTERVAL_SECONDS = 1.2  # 同一回复两次刷新的最小间隔
+STREAM_PAGE_CHARS = 3800                # 每页字符数 (Embed 描述上限 4096，预留代码块等格式字符)
+
+SendPage = Callable[[str, int, str, bool], Awaitable[Any]]       # (段, 页号, 文本, 是否完成) -> 页句柄
+EditPage = Callable[[Any, str, int, str, bool], Awaitable[None]]  # (页句柄, 段, 页号, 文本, 是否完成)
+
+
+def parse_stream_chunk(data: str) -> Tuple[str, str, Optional[Dict[str, Any]]]:
+    """解析一个 SSE data 块，返回 (思考过程增量, 回答增量, usage)。无法解析的块返回空增量。"""
+    try:
+        chunk = json.loads(data)
+    except json.JSONDecodeError:
+        return "", "", None
+    choices = chunk.get("choices") or [{}]
+    delta = choices[0].get("delta") or {}
+    return delta.get("reasoning_content") or "", delta.get("content") or "", chunk.get("usage")
+
+
+def split_pages(text: str, page_chars: int) -> List[str]:
+    """按 page_chars 分页，尽量在换行处断开。已写满的页不会因为后续追加的文本而改变。"""
+    pages = []
+    start = 0
+    while len(text) - start > page_chars:
+        cut = text.rfind("\n", start + page_chars // 2, start + page_chars)
+        end = cut + 1 if cut != -1 else start + page_chars
+        pages.append(text[start:end])
+        start = end
+    pages.append(text[start:])
+    return pages
+
+
+class StreamingReply:
+    """把流式文本节流地渲染为分页消息。按 feed() → ... → finish() 的顺序使用。"""
+
+    def __init__(self, send_page: SendPage, edit_page: EditPage,
+                 min_edit_interval: float = STREAM_MIN_EDIT_INTERVAL_SECONDS, page_chars: int = STREAM_PAGE_CHARS):
+        self.send_page = send_page
+        self.edit_page = edit_page
+        self.min_edit_interval = min_edit_interval
+        self.page_chars = page_chars
+        self.text: Dict[str, str] = {section: "" for section in SECTION_ORDER}
+        self._pages: Dict[str, List[Any]] = {section: [] for section in SECTION_ORDER}    # 已发送的页句柄
+        self._rendered: Dict[str, List[Tuple[str, bool]]] = {section: [] for section in SECTION_ORDER} # 每页最后一次渲染的 (文本, 是否完成)
+        self._last_flush = 0.0
+        self.started_at = time.monotonic()
+        self.first_output_seconds: Optional[float] = None # 第一页发出的耗时 (首字延迟)
+        self.sends = 0
+        self.edits = 0
+
+    @property
+    def has_output(self) -> bool:
+        return any(self._pages.values())
+
+    async def feed(self, section: str, delta: str):
+        if not delta:
+            return
+        self.text[section] += delta
+        if not self.has_output or time.monotonic() - self._last_flush >= self.min_edit_interval:
+            await self.flush()
+
+    async def flush(self, final: bool = False):
+        self._last_flush = time.monotonic()
+        for position, section in enumerate(SECTION_ORDER):
+            text = self.text[section]
+            if not text.strip():
+                continue
+            # 后面的段已经开始输出 (例如回答开始) 时，前面的段不会再增长
+            section_final = final or any(self.text[later].strip() for later in SECTION_ORDER[position + 1:])
+            pages = split_pages(text, self.page_chars)
+            handles, rendered = self._pages[section], self._rendered[section]
+            for index, page_text in enumerate(pages):
+                page_final = section_final or index < len(pages) - 1
+                if index >= len(handles):
+                    handles.append(await self.send_page(section, index, page_text, page_final))
+                    rendered.append((page_text, page_final))
+                    self.sends += 1
+                    if self.first_output_seconds is None:
+                        self.first_output_seconds = time.monotonic() - self.started_at
+                elif rendered[index] != (page_text, page_final):
+                    await self.edit_page(handles[index], section, index, page_text, page_final)
+                    rendered[index] = (page_text, page_final)
+                    self.edits += 1
+        self._last_flush = time.monotonic()
+
+    async def finish(self):
+        """流结束：渲染剩余文本，并把每段的最后一页标记为完成。"""
+        await self.flush(final=True)
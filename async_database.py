@@ -0,0 +1,280 @@
+# async_database.py
+# database.py 的异步外观层：让事件循环中的协程不再直接执行阻塞的 SQLite 调用。
+#
+# - 所有写操作进入一个单线程写入执行器 (single writer)，天然串行，避免 "database is locked"。
+# - 读操作进入一个多线程读取执行器；WAL 模式下读者不会阻塞写者。
+# - 每个线程使用 database.get_db_connection() 提供的线程长连接。
+# - 在途请求数有上限 (ASYNC_DB_MAX_PENDING)，超过上限的协程会在信号量上等待 (背压)，
+#   等待次数与时间都记录在 get_stats() 中。
+#
+# 函数名与 database.py 保持一致，只是变成了 awaitable：
+#     balance = await async_database.db_get_user_balance(guild_id, user_id, default_balance)
+
+import asyncio
+import functools
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+import database
+
+# --- 配置 ---
+ASYNC_DB_READER_THREADS = 4  # 读取线程数量
+ASYNC_DB_MAX_PENDING = 256   # 同时在途 (排队 + 执行中) 的数据库请求上限
+
+
+class AsyncDatabase:
+    """单写者 + 多读者的线程池执行器，带有界在途深度和背压统计。"""
+
+    def __init__(self, reader_threads: int = ASYNC_DB_READER_THREADS, max_pending: int = ASYNC_DB_MAX_PENDING):
+        self.reader_threads = reader_threads
+        self.max_pending = max_pending
+        self._writer: Optional[ThreadPoolExecutor] = None
+        self._readers: Optional[ThreadPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._slots_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stats_lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {
+            "read": self._empty_stats(),
+            "write": self._empty_stats(),
+        }
+        self._in_flight = 0
+        self._max_in_flight = 0
+
+    @staticmethod
+    def _empty_stats() -> Dict[str, float]:
+        return {
+            "submitted": 0, "completed": 0, "failed": 0,
+            "backpressure_waits": 0, "wait_seconds": 0.0, "exec_seconds": 0.0,
+        }
+
+    def _ensure_executors(self):
+        if self._writer is None:
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gjteam-db-writer")
+        if self._readers is None:
+            self._readers = ThreadPoolExecutor(max_workers=self.reader_threads, thread_name_prefix="gjteam-db-reader")
+
+    def _get_slots(self) -> asyncio.Semaphore:
+        # 信号量必须属于当前运行的事件循环 (重启 asyncio.run 后需要重新创建)
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._slots_loop is not loop:
+            self._slots = asyncio.Semaphore(self.max_pending)
+            self._slots_loop = loop
+        return self._slots
+
+    def _timed_call(self, kind: str, func: Callable, args: tuple, kwargs: dict) -> Any:
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._stats_lock:
+                self._stats[kind]["exec_seconds"] += time.perf_counter() - started
+
+    async def _submit(self, kind: str, func: Callable, *args, **kwargs) -> Any:
+        self._ensure_executors()
+        executor = self._writer if kind == "write" else self._readers
+        slots = self._get_slots()
+
+        with self._stats_lock:
+            self._stats[kind]["submitted"] += 1
+        if slots.locked():
+            wait_started = time.perf_counter()
+            await slots.acquire()
+            with self._stats_lock:
+                self._stats[kind]["backpressure_waits"] += 1
+                self._stats[kind]["wait_seconds"] += time.perf_counter() - wait_started
+        else:
+            await slots.acquire()
+
+        with self._stats_lock:
+            self._in_flight += 1
+            self._max_in_flight = max(self._max_in_flight, self._in_flight)
+        try:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(executor, self._timed_call, kind, func, args, kwargs)
+            with self._stats_lock:
+                self._stats[kind]["completed"] += 1
+            return result
+        except Exception:
+            with self._stats_lock:
+                self._stats[kind]["failed"] += 1
+            raise
+        finally:
+            with self._stats_lock:
+                self._in_flight -= 1
+            slots.release()
+
+    async def run_read(self, func: Callable, *args, **kwargs) -> Any:
+        """在读取线程池中执行一个同步数据库函数。"""
+        return await self._submit("read", func, *args, **kwargs)
+
+    async def run_write(self, func: Callable, *args, **kwargs) -> Any:
+        """在单写者线程中执行一个同步数据库函数 (需要多条语句的事务也应通过这里执行)。"""
+        return await self._submit("write", func, *args, **kwargs)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """返回队列深度与各类操作计数的快照。"""
+        with self._stats_lock:
+            snapshot: Dict[str, Any] = {kind: dict(values) for kind, values in self._stats.items()}
+            snapshot["in_flight"] = self._in_flight
+            snapshot["max_in_flight"] = self._max_in_flight
+        snapshot["max_pending"] = self.max_pending
+        snapshot["reader_threads"] = self.reader_threads
+        return snapshot
+
+    def shutdown(self):
+        """等待已提交的操作完成，停止线程池并关闭所有数据库连接。"""
+        for executor in (self._writer, self._readers):
+            if executor is not None:
+                executor.shutdown(wait=True)
+        self._writer = None
+        self._readers = None
+        database.close_db_connections()
+
+
+_default_db = AsyncDatabase()
+
+
+def _read_op(func: Callable) -> Callable:
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await _default_db.run_read(func, *args, **kwargs)
+    return wrapper
+
+
+def _write_op(func: Callable) -> Callable:
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await _default_db.run_write(func, *args, **kwargs)
+    return wrapper
+
+
+# --- 通用入口 ---
+run_read = _default_db.run_read
+run_write = _default_db.run_write
+get_stats = _default_db.get_stats
+shutdown = _default_db.shutdown
+
+# --- 初始化 (DDL 属于写操作) ---
+initialize_database = _write_op(database.initialize_database)
+
+# --- 经济系统 ---
+db_get_user_balance = _read_op(database.db_get_user_balance)
+db_update_user_balance = _write_op(database.db_update_user_balance)
+db_apply_balance_delta = _write_op(database.db_apply_balance_delta)
+db_apply_balance_deltas = _write_op(database.db_apply_balance_deltas)
+db_bulk_add_balances = _write_op(database.db_bulk_add_balances)
+db_get_leaderboard = _read_op(database.db_get_leaderboard)
+db_get_user_rank = _read_op(database.db_get_user_rank)
+db_get_guild_chat_earn_config = _read_op(database.db_get_guild_chat_earn_config)
+db_set_guild_chat_earn_config = _write_op(database.db_set_guild_chat_earn_config)
+db_seed_guild_chat_earn_configs = _write_op(database.db_seed_guild_chat_earn_configs)
+
+# --- 商店 ---
+db_get_shop_items = _read_op(database.db_get_shop_items)
+db_get_shop_item = _read_op(database.db_get_shop_item)
+db_add_shop_item = _write_op(database.db_add_shop_item)
+db_remove_shop_item = _write_op(database.db_remove_shop_item)
+db_update_shop_item_stock = _write_op(database.db_update_shop_item_stock)
+db_edit_shop_item = _write_op(database.db_edit_shop_item)
+db_purchase_item = _write_op(database.db_purchase_item)
+
+# --- 知识库 ---
+db_get_knowledge_base = _read_op(database.db_get_knowledge_base)
+db_get_knowledge_base_entries = _read_op(database.db_get_knowledge_base_entries)
+db_add_knowledge_base_entry = _write_op(database.db_add_knowledge_base_entry)
+db_insert_knowledge_base_entry = _write_op(database.db_insert_knowledge_base_entry)
+db_move_knowledge_base_entry = _write_op(database.db_move_knowledge_base_entry)
+db_remove_knowledge_base_entry = _write_op(database.db_remove_knowledge_base_entry)
+db_remove_knowledge_base_entry_by_order = _write_op(database.db_remove_knowledge_base_entry_by_order)
+db_clear_knowledge_base = _write_op(database.db_clear_knowledge_base)
+
+# --- 审核 / AI / 票据 / 临时语音状态 ---
+db_load_bot_state = _read_op(database.db_load_bot_state)
+db_set_ai_dep_channel = _write_op(database.db_set_ai_dep_channel)
+db_set_private_ai_chat = _write_op(database.db_set_private_ai_chat)
+db_remove_private_ai_chat = _write_op(database.db_remove_private_ai_chat)
+db_set_faq = _write_op(database.db_set_faq)
+db_remove_faq = _write_op(database.db_remove_faq)
+db_set_ai_check_exemption = _write_op(database.db_set_ai_check_exemption)
+db_set_guild_feature_setting = _write_op(database.db_set_guild_feature_setting)
+db_set_open_ticket = _write_op(database.db_set_open_ticket)
+db_set_temp_voice_channel = _write_op(database.db_set_temp_voice_channel)
+db_remove_temp_voice_channel = _write_op(database.db_remove_temp_voice_channel)
+db_set_user_warning_count = _write_op(database.db_set_user_warning_count)
+db_get_conversation_history = _read_op(database.db_get_conversation_history)
+db_set_conversation_history = _write_op(database.db_set_conversation_history)
+db_prune_conversation_histories = _write_op(database.db_prune_conversation_histories)
+
+
+# =========================================
+# == 并发购买压力测试 (python async_database.py stress [协程数] [库存])
+# =========================================
+async def _run_purchase_stress(buyers: int, stock: int, price: int = 10) -> Dict[str, Any]:
+    """大量协程同时抢购同一个限量物品，检查库存、余额与购买记录是否一致。"""
+    guild_id, item_slug = 1, "limited_item"
+    user_count = max(1, buyers // 4) # 每个用户平均发起 4 次购买 (模拟连点按钮)
+    starting_balance = price * 2     # 每个用户最多买得起 2 件
+
+    await initialize_database()
+    await db_add_shop_item(guild_id, item_slug, "Limited Item", price, None, None, stock, None)
+    await db_apply_balance_deltas([(guild_id, uid, starting_balance) for uid in range(user_count)])
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[
+        db_purchase_item(guild_id, i % user_count, item_slug, price) for i in range(buyers)
+    ])
+    elapsed = time.perf_counter() - started
+
+    status_counts: Dict[str, int] = {}
+    for result in results:
+        status_counts[result.status] = status_counts.get(result.status, 0) + 1
+    sold = status_counts.get(database.PURCHASE_OK, 0)
+
+    def _verify() -> Dict[str, Any]:
+        conn = database.get_db_connection()
+        remaining = conn.execute(f"SELECT stock FROM {database.TABLE_SHOP_ITEMS} WHERE guild_id = ? AND item_slug = ?",
+                                 (guild_id, item_slug)).fetchone()[0]
+        recorded = conn.execute(f"SELECT COUNT(*) FROM {database.TABLE_SHOP_PURCHASES} WHERE guild_id = ? AND item_slug = ?",
+                                (guild_id, item_slug)).fetchone()[0]
+        total_balance, min_balance = conn.execute(
+            f"SELECT SUM(balance), MIN(balance) FROM {database.TABLE_USER_BALANCES} WHERE guild_id = ?", (guild_id,)).fetchone()
+        return {"remaining_stock": remaining, "recorded_purchases": recorded,
+                "total_balance": total_balance, "min_balance": min_balance}
+
+    report = await run_read(_verify)
+    report.update({"buyers": buyers, "sold": sold, "statuses": status_counts, "seconds": elapsed})
+    expected_sold = min(stock, user_count * 2)
+    report["consistent"] = (
+        sold == expected_sold
+        and report["remaining_stock"] == stock - sold
+        and report["recorded_purchases"] == sold
+        and report["total_balance"] == user_count * starting_balance - sold * price
+        and report["min_balance"] >= 0
+    )
+    return report
+
+
+if __name__ == "__main__":
+    import bot_logging
+    bot_logging.setup_logging()
+    if len(sys.argv) > 1 and sys.argv[1] == "stress":
+        import os
+        import tempfile
+        stress_buyers = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+        stress_stock = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database.DATABASE_FILE = os.path.join(tmp_dir, "stress.db")
+            try:
+                stress_report = asyncio.run(_run_purchase_stress(stress_buyers, stress_stock))
+            finally:
+                shutdown()
+        for report_key, report_value in stress_report.items():
+            print(f"{report_key:>20}: {report_value}")
+        print(f"{'queue':>20}: {get_stats()}")
+        bot_logging.shutdown_logging()
+        sys.exit(0 if stress_report["consistent"] else 1)
+    else:
+        print("用法: python async_database.py stress [协程数] [库存]")
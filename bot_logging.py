@@ -0,0 +1,98 @@
+# bot_logging.py
+# 机器人的统一日志：所有模块通过 get_logger() 获取 "gjteam.*" 下的分级 logger。
+#
+# - 日志记录只是把 LogRecord 放进内存队列 (QueueHandler)，真正写 stdout 的是后台 QueueListener 线程，
+#   所以事件循环 / 数据库线程不会因为日志管道 (Procfile worker 的 stdout) 变慢而被阻塞。
+# - 请使用惰性格式化：log.debug("用户 %s 余额 %s", user_id, balance)，不要写 f-string。
+#   级别未开启时 logger 直接返回，参数不会被格式化。
+# - 级别可以在运行时调整：set_log_level("DEBUG") 或 set_log_level("WARNING", "db")。
+#   启动时的默认级别来自环境变量 GJTEAM_LOG_LEVEL (默认 INFO)。
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from typing import Dict, Optional
+
+LOGGER_ROOT_NAME = "gjteam"
+LOG_FORMAT = "%(asctime)s %(levelname)-7s [%(name)s] %(message)s"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+LOG_LEVEL_ENV_VAR = "GJTEAM_LOG_LEVEL"
+LOG_QUEUE_MAX_SIZE = 10000 # 队列满时丢弃新记录而不是阻塞调用方
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """队列已满时丢弃记录并计数，保证记录日志永远不会阻塞。"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def get_logger(name: str) -> logging.Logger:
+    """返回 "gjteam.<name>" logger，例如 get_logger("db")。"""
+    return logging.getLogger(f"{LOGGER_ROOT_NAME}.{name}")
+
+
+def setup_logging(level: Optional[str] = None) -> logging.Logger:
+    """配置根 logger "gjteam" 的队列输出 (重复调用只会调整级别)。返回根 logger。"""
+    global _listener
+    root_logger = logging.getLogger(LOGGER_ROOT_NAME)
+    root_logger.setLevel(_parse_level(level or os.environ.get(LOG_LEVEL_ENV_VAR, "INFO")))
+    if _listener is not None:
+        return root_logger
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_MAX_SIZE)
+    root_logger.addHandler(_DroppingQueueHandler(log_queue))
+    root_logger.propagate = False # 不再交给 Python 根 logger，避免重复输出
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    # 写日志的线程是守护线程：进程退出 (包括 sys.exit() 与启动失败) 前先写完队列中剩余的记录
+    atexit.register(shutdown_logging)
+    return root_logger
+
+
+def shutdown_logging():
+    """停止后台写日志线程 (会先写完队列中剩余的记录)。"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _parse_level(level: str) -> int:
+    level_value = logging.getLevelName(str(level).upper())
+    if not isinstance(level_value, int):
+        raise ValueError(f"未知的日志级别: {level}")
+    return level_value
+
+
+def set_log_level(level: str, logger_name: Optional[str] = None) -> str:
+    """运行时调整级别。logger_name 为空时调整整个 "gjteam"，否则只调整 "gjteam.<logger_name>"。"""
+    target = logging.getLogger(LOGGER_ROOT_NAME) if not logger_name else get_logger(logger_name)
+    target.setLevel(_parse_level(level))
+    return logging.getLevelName(target.getEffectiveLevel())
+
+
+def get_log_levels() -> Dict[str, str]:
+    """返回根 logger 及所有已创建的 "gjteam.*" logger 的有效级别。"""
+    prefix = f"{LOGGER_ROOT_NAME}."
+    names = [LOGGER_ROOT_NAME] + sorted(name for name in logging.root.manager.loggerDict if name.startswith(prefix))
+    return {name: logging.getLevelName(logging.getLogger(name).getEffectiveLevel()) for name in names}
+
+
+def get_dropped_count() -> int:
+    """因队列已满而被丢弃的日志条数。"""
+    return sum(getattr(handler, "dropped", 0) for handler in logging.getLogger(LOGGER_ROOT_NAME).handlers)
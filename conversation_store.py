@@ -0,0 +1,144 @@
+# conversation_store.py
+# AI 对话历史 (AI 频道与 AI 私聊共用)：有上限的内存缓存 + 可选的 SQLite 持久化。
+#
+# - 每个对话 (history_key) 最多保留 max_messages 条消息 (用户与 AI 各算一条)。
+# - 内存按最近使用排序 (LRU)：超过 idle_ttl_seconds 未使用的对话会被移出内存；
+#   对话数超过 max_conversations 或总字符数超过 max_total_chars 时，移出最久未使用的对话。
+# - 持久化：每轮对话结束后把最近 persist_messages 条写入数据库 (每个对话一行)。被移出内存或重启后，
+#   下次访问时从数据库读回，所以长期运行的 AI 频道能接上之前的上下文，而进程内存不会无限增长。
+#   超过 CONVERSATION_PERSIST_MAX_AGE_SECONDS 未更新的记录由 prune_persisted() 删除。
+
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional
+
+import async_database
+from bot_logging import get_logger
+
+log = get_logger("ai.history")
+
+CONVERSATION_IDLE_TTL_SECONDS = 6 * 3600          # 对话闲置多久后移出内存
+CONVERSATION_MAX_CONVERSATIONS = 500              # 内存中最多保留的对话数
+CONVERSATION_MAX_TOTAL_CHARS = 4_000_000          # 内存中所有对话的字符总数上限 (约数 MB)
+CONVERSATION_PERSIST_MESSAGES = 10                # 每个对话持久化的最近消息数 (0 表示不持久化)
+CONVERSATION_PERSIST_MAX_AGE_SECONDS = 14 * 86400 # 数据库中的对话超过多久未更新即删除
+
+Message = Dict[str, str]
+
+
+class _Conversation:
+    __slots__ = ("messages", "chars", "last_active")
+
+    def __init__(self, messages: Deque[Message]):
+        self.messages = messages
+        self.chars = sum(len(message.get("content") or "") for message in messages)
+        self.last_active = time.monotonic()
+
+
+class ConversationStore:
+    """按 history_key 保存对话历史，带闲置过期、全局 LRU 上限与可选持久化。"""
+
+    def __init__(self, max_messages: int, idle_ttl_seconds: float = CONVERSATION_IDLE_TTL_SECONDS,
+                 max_conversations: int = CONVERSATION_MAX_CONVERSATIONS, max_total_chars: int = CONVERSATION_MAX_TOTAL_CHARS,
+                 persist_messages: int = CONVERSATION_PERSIST_MESSAGES):
+        self.max_messages = max_messages
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_conversations = max_conversations
+        self.max_total_chars = max_total_chars
+        self.persist_messages = min(persist_messages, max_messages)
+        self._conversations: "OrderedDict[str, _Conversation]" = OrderedDict() # 最久未使用的在前
+        self._total_chars = 0
+        self._stats: Dict[str, int] = {"hits": 0, "misses": 0, "loaded": 0, "evicted_idle": 0, "evicted_lru": 0,
+                                       "persist_writes": 0, "persist_failures": 0}
+
+    def _evict(self, key: str, reason: str):
+        conversation = self._conversations.pop(key)
+        self._total_chars -= conversation.chars
+        self._stats[reason] += 1
+
+    def _enforce_limits(self, keep: Optional[str] = None):
+        """移出闲置过期的对话，再按 LRU 移出超出上限的对话 (keep 为正在使用的对话，不会被移出)。"""
+        deadline = time.monotonic() - self.idle_ttl_seconds
+        while self._conversations:
+            key, conversation = next(iter(self._conversations.items()))
+            if key == keep or conversation.last_active > deadline:
+                break
+            self._evict(key, "evicted_idle")
+        while len(self._conversations) > 1 and (len(self._conversations) > self.max_conversations
+                                                or self._total_chars > self.max_total_chars):
+            key = next(iter(self._conversations))
+            if key == keep:
+                break
+            self._evict(key, "evicted_lru")
+
+    def _touch(self, key: str) -> _Conversation:
+        conversation = self._conversations[key]
+        conversation.last_active = time.monotonic()
+        self._conversations.move_to_end(key)
+        return conversation
+
+    async def _get_or_load(self, key: str) -> _Conversation:
+        if key in self._conversations:
+            self._stats["hits"] += 1
+            return self._touch(key)
+        self._stats["misses"] += 1
+        saved: Optional[List[Message]] = None
+        if self.persist_messages:
+            saved = await async_database.db_get_conversation_history(key)
+        if key not in self._conversations: # 等待数据库期间可能已被另一条消息创建
+            conversation = _Conversation(deque(saved or (), maxlen=self.max_messages))
+            self._conversations[key] = conversation
+            self._total_chars += conversation.chars
+            if saved:
+                self._stats["loaded"] += 1
+        conversation = self._touch(key)
+        self._enforce_limits(keep=key)
+        return conversation
+
+    async def get_history(self, key: str) -> List[Message]:
+        """返回该对话当前历史的副本 (从旧到新)。"""
+        return list((await self._get_or_load(key)).messages)
+
+    async def append_turn(self, key: str, user_content: str, assistant_content: Optional[str]):
+        """追加一轮对话 (assistant_content 为 None 时只记录用户发言)，并持久化最近的消息。"""
+        conversation = await self._get_or_load(key)
+        conversation.messages.append({"role": "user", "content": user_content})
+        if assistant_content is not None:
+            conversation.messages.append({"role": "assistant", "content": assistant_content})
+        chars = sum(len(message.get("content") or "") for message in conversation.messages)
+        self._total_chars += chars - conversation.chars
+        conversation.chars = chars
+        self._enforce_limits(keep=key)
+        if self.persist_messages:
+            recent = list(conversation.messages)[-self.persist_messages:]
+            if await async_database.db_set_conversation_history(key, recent):
+                self._stats["persist_writes"] += 1
+            else:
+                self._stats["persist_failures"] += 1
+
+    async def clear(self, key: str) -> bool:
+        """清除对话历史 (内存与数据库)。返回内存中是否有该对话的记录。"""
+        existed = key in self._conversations
+        if existed:
+            conversation = self._conversations.pop(key)
+            self._total_chars -= conversation.chars
+        if self.persist_messages:
+            await async_database.db_set_conversation_history(key, [])
+        return existed
+
+    async def prune_persisted(self) -> int:
+        """删除数据库中长期未更新的对话历史。"""
+        if not self.persist_messages:
+            return 0
+        removed = await async_database.db_prune_conversation_histories(CONVERSATION_PERSIST_MAX_AGE_SECONDS)
+        if removed:
+            log.info("已删除 %s 个长期未更新的 AI 对话历史。", removed)
+        return removed
+
+    def get_stats(self) -> Dict[str, int]:
+        stats = dict(self._stats)
+        stats["conversations"] = len(self._conversations)
+        stats["total_chars"] = self._total_chars
+        stats["max_conversations"] = self.max_conversations
+        stats["max_total_chars"] = self.max_total_chars
+        return stats
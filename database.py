@@ -1,7 +1,17 @@
 # database.py
 import sqlite3
+import json
 import os
-from typing import Dict, Any, Optional, List, Tuple # 确保从 typing 导入这些
+import sys
+import threading
+import time
+import bisect
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List, Tuple, NamedTuple # 确保从 typing 导入这些
+
+from bot_logging import get_logger, setup_logging, shutdown_logging
+
+log = get_logger("db")
 
 # 数据库文件名，将与 role_manager_bot.py 在同一目录或指定路径
 # 如果你想放在特定数据文件夹，可以修改，例如：
@@ -15,188 +25,704 @@ TABLE_USER_BALANCES = "user_balances"
 TABLE_SHOP_ITEMS = "shop_items"
 TABLE_GUILD_ECONOMY_SETTINGS = "guild_economy_settings"
 TABLE_GUILD_KNOWLEDGE_BASE = "guild_knowledge_base"
+TABLE_SHOP_PURCHASES = "shop_purchases"
+# 审核 / AI / 票据 / 临时语音状态 (以前只保存在 role_manager_bot.py 的内存字典中)
+TABLE_AI_DEP_CHANNELS = "ai_dep_channels"
+TABLE_PRIVATE_AI_CHATS = "private_ai_chats"
+TABLE_GUILD_FAQS = "guild_faqs"
+TABLE_AI_CHECK_EXEMPTIONS = "ai_check_exemptions"
+TABLE_GUILD_FEATURE_SETTINGS = "guild_feature_settings"
+TABLE_OPEN_TICKETS = "open_tickets"
+TABLE_USER_WARNINGS = "user_warnings"
+TABLE_AI_CONVERSATION_HISTORY = "ai_conversation_history"
+TABLE_TEMP_VOICE_CHANNELS = "temp_voice_channels"
 # 你可以为其他需要持久化的数据添加更多表名常量
 
-def get_db_connection() -> sqlite3.Connection:
-    """获取并返回一个数据库连接对象。"""
+# --- 连接管理 ---
+# 每个线程持有一个长连接（首次使用时打开，之后一直复用），避免每次查询都重新 connect/close。
+# sqlite3 会按 SQL 文本在连接上缓存预编译语句，所以热点查询使用下面的模块级常量字符串。
+DB_CONNECT_TIMEOUT_SECONDS = 10
+DB_STATEMENT_CACHE_SIZE = 256 # 每个连接缓存的预编译语句数量
+DB_PRAGMAS = (
+    ("journal_mode", "WAL"),      # WAL 模式：读写互不阻塞
+    ("synchronous", "NORMAL"),    # WAL 下 NORMAL 已足够安全，且比 FULL 少很多 fsync
+    ("cache_size", -16000),       # 负数单位为 KiB，约 16MB 页缓存
+    ("mmap_size", 268435456),     # 256MB 内存映射读取
+    ("temp_store", "MEMORY"),
+    ("busy_timeout", DB_CONNECT_TIMEOUT_SECONDS * 1000),
+)
+
+_thread_local = threading.local()
+_open_connections: List[sqlite3.Connection] = []
+_connections_lock = threading.Lock()
+_connections_generation = 0 # close_db_connections() 后递增，让各线程重新打开连接
+_db_dir_checked = False
+
+def _ensure_db_directory():
+    """确保数据库文件所在目录存在（每个进程只检查一次）。"""
+    global _db_dir_checked
+    if _db_dir_checked:
+        return
     # 检查数据库文件所在目录是否存在，如果不存在则创建
     db_dir = os.path.dirname(os.path.abspath(DATABASE_FILE))
     if db_dir and not os.path.exists(db_dir): # 检查 db_dir 是否为空（如果DATABASE_FILE只是文件名）
         try:
             os.makedirs(db_dir)
-            print(f"[Database] Created directory for database: {db_dir}")
+            log.info("Created directory for database: %s", db_dir)
         except OSError as e:
-            print(f"[Database Error] Could not create directory {db_dir}: {e}")
+            log.error("Could not create directory %s: %s", db_dir, e)
             # 如果目录创建失败，连接到当前目录的数据库文件可能仍会工作，或者会报错
+    _db_dir_checked = True
 
-    conn = sqlite3.connect(DATABASE_FILE, timeout=10) # 添加超时
+def _open_db_connection() -> sqlite3.Connection:
+    """打开一个新连接并应用性能相关的 PRAGMA。"""
+    _ensure_db_directory()
+    conn = sqlite3.connect(
+        DATABASE_FILE,
+        timeout=DB_CONNECT_TIMEOUT_SECONDS,
+        cached_statements=DB_STATEMENT_CACHE_SIZE,
+        check_same_thread=False, # 只由所属线程使用；关闭时可能由主线程统一关闭
+    )
     conn.row_factory = sqlite3.Row # 允许通过列名访问数据
+    for pragma_name, pragma_value in DB_PRAGMAS:
+        conn.execute(f"PRAGMA {pragma_name} = {pragma_value}")
     # 启用外键约束 (如果你的表之间有外键关系)
     # conn.execute("PRAGMA foreign_keys = ON")
     return conn
 
-def initialize_database():
-    """初始化数据库，创建所有必要的表（如果它们尚不存在）。"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def get_db_connection() -> sqlite3.Connection:
+    """返回当前线程复用的长连接（首次调用时打开）。调用方不要关闭它。"""
+    conn = getattr(_thread_local, "conn", None)
+    if conn is None or getattr(_thread_local, "generation", -1) != _connections_generation:
+        conn = _open_db_connection()
+        _thread_local.conn = conn
+        _thread_local.generation = _connections_generation
+        with _connections_lock:
+            _open_connections.append(conn)
+    return conn
 
-    # --- 用户余额表 ---
-    cursor.execute(f"""
-    CREATE TABLE IF NOT EXISTS {TABLE_USER_BALANCES} (
-        guild_id INTEGER NOT NULL,
-        user_id INTEGER NOT NULL,
-        balance INTEGER NOT NULL DEFAULT 0,
-        PRIMARY KEY (guild_id, user_id)
-    )
-    """)
+def close_db_connections():
+    """关闭所有线程的长连接（在机器人关闭时调用）。"""
+    global _connections_generation
+    with _connections_lock:
+        _connections_generation += 1
+        connections_to_close = list(_open_connections)
+        _open_connections.clear()
+    for conn in connections_to_close:
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            log.error("关闭数据库连接失败: %s", e)
+    _thread_local.conn = None
+    # 连接关闭后数据库文件可能被替换，读缓存一并清空
+    _chat_earn_config_cache.clear()
+    _shop_items_cache.clear()
+    _leaderboard_top_k.clear()
+    if connections_to_close:
+        log.info("已关闭 %s 个数据库连接。", len(connections_to_close))
 
-    # --- 商店物品表 ---
-    cursor.execute(f"""
-    CREATE TABLE IF NOT EXISTS {TABLE_SHOP_ITEMS} (
-        guild_id INTEGER NOT NULL,
-        item_slug TEXT NOT NULL,
-        name TEXT NOT NULL,
-        price INTEGER NOT NULL,
-        description TEXT,
-        role_id INTEGER,
-        stock INTEGER DEFAULT -1, -- -1 for infinite
-        purchase_message TEXT,
-        PRIMARY KEY (guild_id, item_slug)
-    )
-    """)
+# --- 读缓存 ---
+# 服务器配置和商店目录读多写少：按 guild_id 缓存，LRU 限制条目数，TTL 兜底过期。
+# 所有写函数在提交后显式失效对应 guild 的缓存。
+CACHE_MAX_GUILDS = 1024
+CACHE_TTL_SECONDS = 300
 
-    # --- 服务器经济设置表 ---
-    cursor.execute(f"""
-    CREATE TABLE IF NOT EXISTS {TABLE_GUILD_ECONOMY_SETTINGS} (
-        guild_id INTEGER PRIMARY KEY,
-        chat_earn_amount INTEGER,
-        chat_earn_cooldown INTEGER
-    )
-    """)
+class TTLCache:
+    """线程安全的 LRU + TTL 缓存，带命中/未命中计数。读线程池和写线程会同时访问。"""
+
+    def __init__(self, name: str, max_entries: int, ttl_seconds: float):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._generations: Dict[Any, int] = {} # invalidate() 时递增，防止过期的加载结果回填
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def peek(self, key: Any, count_miss: bool = True) -> Tuple[bool, Any]:
+        """只查缓存不加载，返回 (是否命中, 值)。"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._entries[key]
+            if count_miss:
+                self.misses += 1
+            return False, None
+
+    def get_or_load(self, key: Any, loader) -> Any:
+        """命中则直接返回，否则调用 loader() 读取并写入缓存。"""
+        found, value = self.peek(key)
+        if found:
+            return value
+        with self._lock:
+            generation = self._generations.get(key, 0)
+        value = loader()
+        with self._lock:
+            # 加载期间若被失效 (有写入)，这次读到的可能是旧数据，不回填
+            if self._generations.get(key, 0) == generation:
+                self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, key: Any):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            for key in self._entries:
+                self._generations[key] = self._generations.get(key, 0) + 1
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries), "max_entries": self.max_entries,
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "evictions": self.evictions, "invalidations": self.invalidations,
+            }
+
+_chat_earn_config_cache = TTLCache("chat_earn_config", CACHE_MAX_GUILDS, CACHE_TTL_SECONDS)
+_shop_items_cache = TTLCache("shop_items", CACHE_MAX_GUILDS, CACHE_TTL_SECONDS)
+
+# --- 排行榜前 K 名 ---
+LEADERBOARD_TOP_K = 50 # 每个服务器在内存中维护的名次数量，应不小于排行榜展示的人数
+
+class LeaderboardTopK:
+    """
+    每个服务器在内存中维护余额前 K 名，排序与 _SQL_GET_LEADERBOARD 一致 (余额降序，user_id 升序)。
+    余额写入路径调用 on_balance_changed() 增量维护；无法确定新的第 K 名时 (前 K 名中有人掉出) 直接丢弃，
+    下次读取时再通过索引重新加载 K 行。
+    """
+
+    def __init__(self, name: str, k: int):
+        self.name = name
+        self.k = k
+        self._boards: Dict[int, List[Tuple[int, int]]] = {} # guild_id -> 有序的 (-balance, user_id)
+        self._complete: Dict[int, bool] = {}                # True 表示该服务器用户数不足 K，列表即全部用户
+        self._generations: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, guild_id: int, limit: int, loader) -> List[Tuple[int, int]]:
+        """返回前 limit 名 [(user_id, balance), ...]。loader(k) 负责从数据库读取前 k 名。"""
+        if limit > self.k:
+            return loader(limit)
+        with self._lock:
+            board = self._boards.get(guild_id)
+            if board is not None:
+                self.hits += 1
+                return [(user_id, -neg_balance) for neg_balance, user_id in board[:limit]]
+            self.misses += 1
+            generation = self._generations.get(guild_id, 0)
+        rows = loader(self.k)
+        with self._lock:
+            if self._generations.get(guild_id, 0) == generation:
+                self._boards[guild_id] = sorted((-balance, user_id) for user_id, balance in rows)
+                self._complete[guild_id] = len(rows) < self.k
+        return rows[:limit]
+
+    def rank_of(self, guild_id: int, user_id: int) -> Optional[Tuple[int, int]]:
+        """用户在前 K 名中时返回 (名次, 余额)，否则返回 None。"""
+        with self._lock:
+            for index, (neg_balance, entry_user_id) in enumerate(self._boards.get(guild_id, ())):
+                if entry_user_id == user_id:
+                    return index + 1, -neg_balance
+        return None
+
+    def on_balance_changed(self, guild_id: int, user_id: int, new_balance: int):
+        with self._lock:
+            self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+            board = self._boards.get(guild_id)
+            if board is None:
+                return
+            new_entry = (-new_balance, user_id)
+            removed = False
+            for index, (_, entry_user_id) in enumerate(board):
+                if entry_user_id == user_id:
+                    del board[index]
+                    removed = True
+                    break
 
-    # --- 服务器 AI 知识库表 ---
-    cursor.execute(f"""
-    CREATE TABLE IF NOT EXISTS {TABLE_GUILD_KNOWLEDGE_BASE} (
-        guild_id INTEGER NOT NULL,
-        entry_order INTEGER NOT NULL, 
-        entry_text TEXT NOT NULL,
-        PRIMARY KEY (guild_id, entry_order) 
+            if self._complete[guild_id]:
+                bisect.insort(board, new_entry)
+                if len(board) > self.k:
+                    board.pop()
+                    self._complete[guild_id] = False
+            elif removed:
+                # 原本在前 K 名：只要新位置仍在已知范围内就可以直接插回，否则第 K 名未知
+                if board and new_entry < board[-1]:
+                    bisect.insort(board, new_entry)
+                else:
+                    self._drop(guild_id)
+            elif board and new_entry < board[-1]:
+                bisect.insort(board, new_entry)
+                board.pop()
+
+    def _drop(self, guild_id: int):
+        self._boards.pop(guild_id, None)
+        self._complete.pop(guild_id, None)
+        self.invalidations += 1
+
+    def invalidate(self, guild_id: int):
+        with self._lock:
+            self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+            self._drop(guild_id)
+
+    def clear(self):
+        with self._lock:
+            for guild_id in list(self._boards):
+                self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+                self._drop(guild_id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._boards), "max_entries": self.k,
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "evictions": 0, "invalidations": self.invalidations,
+            }
+
+_leaderboard_top_k = LeaderboardTopK("leaderboard_top_k", LEADERBOARD_TOP_K)
+
+def get_cache_stats() -> Dict[str, Dict[str, Any]]:
+    """返回所有读缓存的统计信息。"""
+    return {cache.name: cache.stats() for cache in (_chat_earn_config_cache, _shop_items_cache, _leaderboard_top_k)}
+
+# =========================================
+# == 数据库结构迁移
+# =========================================
+# 数据库当前的结构版本保存在 PRAGMA user_version 中。启动时按版本号顺序执行尚未应用的迁移，
+# 每个迁移在自己的事务中执行 (成功则同时更新 user_version，失败则整体回滚)，并记录耗时。
+#
+# 新增表 / 列 / 索引时：在 MIGRATIONS 末尾追加一个版本号 +1 的 Migration，不要修改已发布的迁移。
+# 索引请单独作为一个迁移：WAL 模式下建索引期间读线程照常工作，只有写入需要等待该短事务完成。
+TABLE_SCHEMA_MIGRATIONS = "schema_migrations"
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    statements: Tuple[str, ...]
+
+_SQL_CREATE_LEADERBOARD_INDEX = f"""
+    CREATE INDEX IF NOT EXISTS idx_{TABLE_USER_BALANCES}_leaderboard
+    ON {TABLE_USER_BALANCES} (guild_id, balance DESC, user_id)
+    """
+
+MIGRATIONS: Tuple[Migration, ...] = (
+    # 版本 1 与引入迁移之前的 initialize_database 建表语句相同 (IF NOT EXISTS)，已有数据库可以直接升级
+    Migration(1, "核心表：余额、商店、经济设置、知识库", (
+        f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_USER_BALANCES} (
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            balance INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, user_id)
+        )
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_SHOP_ITEMS} (
+            guild_id INTEGER NOT NULL,
+            item_slug TEXT NOT NULL,
+            name TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            description TEXT,
+            role_id INTEGER,
+            stock INTEGER DEFAULT -1, -- -1 for infinite
+            purchase_message TEXT,
+            PRIMARY KEY (guild_id, item_slug)
+        )
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_GUILD_ECONOMY_SETTINGS} (
+            guild_id INTEGER PRIMARY KEY,
+            chat_earn_amount INTEGER,
+            chat_earn_cooldown INTEGER
+        )
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_GUILD_KNOWLEDGE_BASE} (
+            guild_id INTEGER NOT NULL,
+            entry_order INTEGER NOT NULL,
+            entry_text TEXT NOT NULL,
+            PRIMARY KEY (guild_id, entry_order)
+        )
+        """,
+    )),
+    Migration(2, "商店购买记录表", (
+        f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_SHOP_PURCHASES} (
+            purchase_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            item_slug TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            purchased_at REAL NOT NULL
+        )
+        """,
+    )),
+    # 排行榜覆盖索引：ORDER BY balance DESC 直接按索引顺序读取，无需排序整个服务器
+    Migration(3, "排行榜覆盖索引 (guild_id, balance DESC, user_id)", (_SQL_CREATE_LEADERBOARD_INDEX,)),
+    Migration(4, "审核 / AI / 票据 / 临时语音状态表", (
+        f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_AI_DEP_CHANNELS} (
+            channel_id INTEGER PRIMARY KEY,
+            model TEXT NOT NULL,
+            system_prompt TEXT,
+            history_key TEXT NOT NULL
+        )
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_PRIVATE_AI_CHATS} (
+            channel_id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            history_key TEXT NOT NULL
+        )
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_GUILD_FAQS} (
+            guild_id INTEGER NOT NULL,
+            keyword TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            PRIMARY KEY (guild_id, keyword)
+        )
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_AI_CHECK_EXEMPTIONS} (
+            target_type TEXT NOT NULL CHECK (target_type IN ('user', 'channel')),
+            target_id INTEGER NOT NULL,
+            PRIMARY KEY (target_type, target_id)
+        )
+        """,
+        # 票据 / 临时语音等按服务器保存的键值设置，值以 JSON 文本保存 (例如 staff_role_ids 是列表)
+        f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_GUILD_FEATURE_SETTINGS} (
+            feature TEXT NOT NULL,
+            guild_id INTEGER NOT NULL,
+            setting_key TEXT NOT NULL,
+            value_json TEXT NOT NULL,
+            PRIMARY KEY (feature, guild_id, setting_key)
+        )
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_OPEN_TICKETS} (
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, user_id)
+        )
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_USER_WARNINGS} (
+            user_id INTEGER PRIMARY KEY,
+            warning_count INTEGER NOT NULL
+        )
+        """,
+    )),
+    # 原表以连续的 entry_order 为主键，删除一条要把后面所有条目的序号减一。
+    # 新表每条有固定的 entry_id，顺序由可在任意两键之间插入的 sort_key 决定 (见 "AI 知识库操作")，显示序号在读取时计算。
+    # 旧序号转换为 'V' + 四位序号 + 'V'：等长、按原顺序排列，且不以 '0' 结尾。
+    Migration(5, "知识库使用固定条目 ID 与分数排序键", (
+        f"""
+        CREATE TABLE {TABLE_GUILD_KNOWLEDGE_BASE}_v5 (
+            entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            sort_key TEXT NOT NULL,
+            entry_text TEXT NOT NULL
+        )
+        """,
+        f"""
+        INSERT INTO {TABLE_GUILD_KNOWLEDGE_BASE}_v5 (guild_id, sort_key, entry_text)
+        SELECT guild_id, 'V' || printf('%04d', entry_order) || 'V', entry_text
+        FROM {TABLE_GUILD_KNOWLEDGE_BASE} ORDER BY guild_id, entry_order
+        """,
+        f"DROP TABLE {TABLE_GUILD_KNOWLEDGE_BASE}",
+        f"ALTER TABLE {TABLE_GUILD_KNOWLEDGE_BASE}_v5 RENAME TO {TABLE_GUILD_KNOWLEDGE_BASE}",
+        f"CREATE UNIQUE INDEX idx_{TABLE_GUILD_KNOWLEDGE_BASE}_order ON {TABLE_GUILD_KNOWLEDGE_BASE} (guild_id, sort_key)",
+    )),
+    # 每个对话 (history_key) 一行，只保存最近几轮 (JSON 列表)，重启后 AI 频道能接上之前的上下文
+    Migration(6, "AI 对话历史表", (
+        f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_AI_CONVERSATION_HISTORY} (
+            history_key TEXT PRIMARY KEY,
+            messages_json TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """,
+        f"CREATE INDEX IF NOT EXISTS idx_{TABLE_AI_CONVERSATION_HISTORY}_updated ON {TABLE_AI_CONVERSATION_HISTORY} (updated_at)",
+    )),
+    # 机器人创建的临时语音频道及其房主，重启后仍能在频道变空时删除它们、识别房主
+    Migration(7, "临时语音频道表", (
+        f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_TEMP_VOICE_CHANNELS} (
+            channel_id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL,
+            owner_id INTEGER NOT NULL
+        )
+        """,
+    )),
+)
+
+LATEST_SCHEMA_VERSION = MIGRATIONS[-1].version
+
+def get_schema_version() -> int:
+    return get_db_connection().execute("PRAGMA user_version").fetchone()[0]
+
+def run_migrations(target_version: Optional[int] = None) -> List[Tuple[int, str, float]]:
+    """应用所有版本号大于当前 user_version 的迁移，返回 [(版本, 描述, 耗时毫秒), ...]。"""
+    target_version = LATEST_SCHEMA_VERSION if target_version is None else target_version
+    conn = get_db_connection()
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_SCHEMA_MIGRATIONS} (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied_at REAL NOT NULL,
+        duration_ms REAL NOT NULL
     )
     """)
-    
-    # --- 你可以在这里为其他功能添加更多的 CREATE TABLE IF NOT EXISTS 语句 ---
-    # 例如: AI DEP 频道配置, FAQ, AI 豁免列表等
-
     conn.commit()
-    conn.close()
-    print("[Database] 数据库初始化完毕 (所有核心表已创建/确认存在)。")
+
+    current_version = get_schema_version()
+    if current_version > LATEST_SCHEMA_VERSION:
+        log.warning("警告：数据库结构版本 (%s) 高于代码已知的最新版本 (%s)，跳过迁移。", current_version, LATEST_SCHEMA_VERSION)
+        return []
+
+    applied: List[Tuple[int, str, float]] = []
+    for migration in MIGRATIONS:
+        if migration.version <= current_version or migration.version > target_version:
+            continue
+        started = time.perf_counter()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # 拿到写锁后再确认一次版本，防止另一个进程刚刚执行过同一迁移
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= migration.version:
+                conn.rollback()
+                continue
+            for statement in migration.statements:
+                conn.execute(statement)
+            duration_ms = (time.perf_counter() - started) * 1000
+            conn.execute(f"INSERT OR REPLACE INTO {TABLE_SCHEMA_MIGRATIONS} (version, description, applied_at, duration_ms) VALUES (?, ?, ?, ?)",
+                         (migration.version, migration.description, time.time(), duration_ms))
+            conn.execute(f"PRAGMA user_version = {int(migration.version)}")
+            conn.commit()
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.rollback()
+            log.error("迁移 v%s (%s) 失败，已回滚: %s", migration.version, migration.description, e)
+            raise
+        applied.append((migration.version, migration.description, duration_ms))
+        log.info("已应用迁移 v%s: %s (%.1f ms)", migration.version, migration.description, duration_ms)
+    return applied
+
+def initialize_database():
+    """初始化数据库：执行所有未应用的结构迁移。同时打开当前线程的长连接。"""
+    applied = run_migrations()
+    log.info("数据库初始化完毕 (结构版本 v%s，本次应用 %s 个迁移)。", get_schema_version(), len(applied))
 
 # =========================================
 # == 经济系统 - 余额操作
 # =========================================
+# 热点查询使用固定的 SQL 文本，便于连接上的预编译语句缓存命中
+_SQL_GET_USER_BALANCE = f"SELECT balance FROM {TABLE_USER_BALANCES} WHERE guild_id = ? AND user_id = ?"
+_SQL_UPSERT_USER_BALANCE = f"""
+        INSERT INTO {TABLE_USER_BALANCES} (guild_id, user_id, balance) VALUES (?, ?, ?)
+        ON CONFLICT(guild_id, user_id) DO UPDATE SET balance = excluded.balance
+        """
+_SQL_GET_LEADERBOARD = f"SELECT user_id, balance FROM {TABLE_USER_BALANCES} WHERE guild_id = ? ORDER BY balance DESC, user_id ASC LIMIT ?"
+# 名次 = 余额更高的人数 + 同余额但 user_id 更小的人数 + 1，两部分都是索引上的范围计数
+_SQL_GET_USER_RANK = f"""
+        SELECT 1
+            + (SELECT COUNT(*) FROM {TABLE_USER_BALANCES} WHERE guild_id = :guild_id AND balance > :balance)
+            + (SELECT COUNT(*) FROM {TABLE_USER_BALANCES} WHERE guild_id = :guild_id AND balance = :balance AND user_id < :user_id)
+        """
+
 def db_get_user_balance(guild_id: int, user_id: int, default_balance: int) -> int:
     conn = get_db_connection()
-    cursor = conn.cursor()
-    function_name = "db_get_user_balance" # 用于日志
-    print(f"[DB DEBUG] [{function_name}] Called for guild={guild_id}, user={user_id}, with default_balance_param={default_balance}")
-    balance_to_return = default_balance 
     try:
-        cursor.execute(f"SELECT balance FROM {TABLE_USER_BALANCES} WHERE guild_id = ? AND user_id = ?", (guild_id, user_id))
-        row = cursor.fetchone()
-        if row:
-            balance_to_return = row["balance"]
-            print(f"[DB DEBUG] [{function_name}] Found balance in DB: {balance_to_return} for user {user_id} in guild {guild_id}")
-        else:
-            print(f"[DB DEBUG] [{function_name}] No balance found in DB for user {user_id} in guild {guild_id}, will return default_balance_param: {default_balance}")
+        row = conn.execute(_SQL_GET_USER_BALANCE, (guild_id, user_id)).fetchone()
     except sqlite3.Error as e:
-        print(f"[DB Economy Error] [{function_name}] Error querying balance for user {user_id} in guild {guild_id}: {e}")
-    finally:
-        if conn:
-            conn.close()
-    print(f"[DB DEBUG] [{function_name}] Returning balance: {balance_to_return} for user {user_id} in guild {guild_id}")
-    return balance_to_return
+        log.error("[db_get_user_balance] Error querying balance for user %s in guild %s: %s", user_id, guild_id, e)
+        return default_balance
+    balance = row["balance"] if row else default_balance
+    log.debug("[db_get_user_balance] guild=%s user=%s balance=%s (from_db=%s)", guild_id, user_id, balance, row is not None)
+    return balance
 
-def db_update_user_balance(guild_id: int, user_id: int, amount: int, is_delta: bool = True, default_balance: int = 0) -> bool:
+# 单条语句完成“不存在则按默认余额插入 + 增量 + 非负检查”，返回新余额；被拒绝时不返回任何行。
+# 注意：SELECT 在记录已存在时必须产出一行，否则不会触发 ON CONFLICT 分支。
+_SQL_APPLY_BALANCE_DELTA = f"""
+        INSERT INTO {TABLE_USER_BALANCES} (guild_id, user_id, balance)
+        SELECT :guild_id, :user_id, :default_balance + :delta
+        WHERE :default_balance + :delta >= 0
+           OR EXISTS (SELECT 1 FROM {TABLE_USER_BALANCES} WHERE guild_id = :guild_id AND user_id = :user_id)
+        ON CONFLICT(guild_id, user_id) DO UPDATE SET balance = balance + :delta
+        WHERE balance + :delta >= 0
+        RETURNING balance
+        """
+
+def _execute_balance_delta(cursor: sqlite3.Cursor, guild_id: int, user_id: int, delta: int, default_balance: int) -> Optional[int]:
+    """在调用方的事务中执行一次条件增量。余额不足时返回 None。"""
+    cursor.execute(_SQL_APPLY_BALANCE_DELTA, {
+        "guild_id": guild_id, "user_id": user_id, "delta": delta, "default_balance": default_balance,
+    })
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def db_apply_balance_delta(guild_id: int, user_id: int, delta: int, default_balance: int = 0) -> Optional[int]:
+    """原子地给用户余额加上 delta（可为负）。成功返回新余额；会导致余额为负或出错时返回 None。"""
     conn = get_db_connection()
-    cursor = conn.cursor()
-    function_name = "db_update_user_balance" # 用于日志
-    print(f"[DB DEBUG] [{function_name}] Called with guild={guild_id}, user={user_id}, amount={amount}, is_delta={is_delta}, default_balance_for_get={default_balance}")
     try:
-        current_balance_for_delta_calc = 0
-        if is_delta:
-            current_balance_for_delta_calc = db_get_user_balance(guild_id, user_id, default_balance) 
-            print(f"[DB DEBUG] [{function_name}] (is_delta=True): current_balance_for_delta_calc from db_get_user_balance = {current_balance_for_delta_calc}")
-
-        new_balance = (current_balance_for_delta_calc + amount) if is_delta else amount
-        
-        if new_balance < 0:
-            print(f"[DB DEBUG] [{function_name}] Calculated new_balance ({new_balance}) is negative. Operation failed for user {user_id}.")
-            return False
+        new_balance = _execute_balance_delta(conn.cursor(), guild_id, user_id, delta, default_balance)
+        conn.commit()
+        if new_balance is not None:
+            _leaderboard_top_k.on_balance_changed(guild_id, user_id, new_balance)
+        return new_balance
+    except sqlite3.Error as e:
+        log.error("[db_apply_balance_delta] Error applying delta %s for user %s (guild: %s): %s", delta, user_id, guild_id, e)
+        conn.rollback()
+        return None
+
+def db_apply_balance_deltas(deltas: List[Tuple[int, int, int]], default_balance: int = 0,
+                            all_or_nothing: bool = False) -> List[Optional[int]]:
+    """
+    在一个事务中批量执行 (guild_id, user_id, delta)。返回与输入一一对应的新余额，被拒绝的条目为 None。
+    all_or_nothing=True 时只要有一条被拒绝就整体回滚（例如转账），此时返回全 None 列表。
+    """
+    if not deltas:
+        return []
+    conn = get_db_connection()
+    results: List[Optional[int]] = []
+    try:
+        cursor = conn.cursor()
+        conn.execute("BEGIN")
+        for guild_id, user_id, delta in deltas:
+            new_balance = _execute_balance_delta(cursor, guild_id, user_id, delta, default_balance)
+            if new_balance is None and all_or_nothing:
+                conn.rollback()
+                return [None] * len(deltas)
+            results.append(new_balance)
+        conn.commit()
+        for (guild_id, user_id, _), new_balance in zip(deltas, results):
+            if new_balance is not None:
+                _leaderboard_top_k.on_balance_changed(guild_id, user_id, new_balance)
+        return results
+    except sqlite3.Error as e:
+        log.error("[db_apply_balance_deltas] Error applying batch of %s deltas: %s", len(deltas), e)
+        if conn.in_transaction:
+            conn.rollback()
+        return [None] * len(deltas)
 
-        print(f"[DB DEBUG] [{function_name}] Attempting to execute UPSERT for guild={guild_id}, user={user_id} with new_balance={new_balance}")
+# 只用于非负增量 (例如聊天奖励)，因此不需要余额非负检查，可以直接 executemany
+_SQL_ADD_BALANCE = f"""
+        INSERT INTO {TABLE_USER_BALANCES} (guild_id, user_id, balance) VALUES (?, ?, ? + ?)
+        ON CONFLICT(guild_id, user_id) DO UPDATE SET balance = balance + ?
+        """
 
-        cursor.execute(f"""
-        INSERT INTO {TABLE_USER_BALANCES} (guild_id, user_id, balance) VALUES (?, ?, ?)
-        ON CONFLICT(guild_id, user_id) DO UPDATE SET balance = excluded.balance
-        """, (guild_id, user_id, new_balance))
-        
-        # 检查是否真的写入了
-        if cursor.rowcount > 0:
-            print(f"[DB DEBUG] [{function_name}] UPSERT execute successful. Rows affected (directly by execute): {cursor.rowcount} for user {user_id}")
-            conn.commit()
-            print(f"[DB DEBUG] [{function_name}] Balance update committed for user {user_id}.")
-            return True
-        else:
-            # 如果 rowcount 是 0，对于 UPSERT，可能意味着值没有改变，或者没有发生 INSERT/UPDATE
-            # 这种情况理论上不应该阻止我们认为操作“逻辑上”成功了（比如设置一个已经是该值的值）
-            # 但为了调试，我们先严格一点
-            print(f"[DB DEBUG] [{function_name}] UPSERT execute returned rowcount 0 for user {user_id}. Assuming value unchanged or no operation. Committing anyway.")
-            conn.commit() # 即使是0，也尝试提交，以防万一
-            # 我们可以再查询一次来验证值是否是我们期望的 new_balance
-            # verification_balance = db_get_user_balance(guild_id, user_id, -1) # 用一个特殊默认值
-            # if verification_balance == new_balance:
-            #     print(f"[DB DEBUG] [{function_name}] Verification query matches new_balance: {new_balance}")
-            #     return True
-            # else:
-            #     print(f"[DB DEBUG] [{function_name}] Verification query MISMATCH. DB has {verification_balance}, expected {new_balance}. Operation considered failed.")
-            #     return False
-            return True # 暂时假设 rowcount 0 且 commit 后是成功的，如果设置的值和原值一样
-            
+def db_bulk_add_balances(credits: List[Tuple[int, int, int]], default_balance: int = 0) -> bool:
+    """用一次 executemany 事务批量增加余额。credits 为 [(guild_id, user_id, amount >= 0), ...]。"""
+    if not credits:
+        return True
+    conn = get_db_connection()
+    try:
+        with conn: # 成功时提交，异常时回滚
+            conn.executemany(_SQL_ADD_BALANCE, [
+                (guild_id, user_id, default_balance, amount, amount) for guild_id, user_id, amount in credits
+            ])
+        # executemany 拿不到新余额，直接让相关服务器的排行榜重新加载
+        for guild_id in {credit[0] for credit in credits}:
+            _leaderboard_top_k.invalidate(guild_id)
+        return True
     except sqlite3.Error as e:
-        print(f"[DB Economy Error] [{function_name}] SQLite Error updating balance for user {user_id} (guild: {guild_id}): {e}")
-        if conn:
-            try:
-                conn.rollback()
-                print(f"[DB DEBUG] [{function_name}] Rollback attempted on error for user {user_id}.")
-            except sqlite3.Error as rb_e:
-                print(f"[DB Economy Error] [{function_name}] Error during rollback for user {user_id}: {rb_e}")
+        log.error("[db_bulk_add_balances] 批量写入 %s 条余额增量失败: %s", len(credits), e)
         return False
-    finally:
-        if conn:
-            conn.close()
+
+def db_update_user_balance(guild_id: int, user_id: int, amount: int, is_delta: bool = True, default_balance: int = 0) -> bool:
+    """兼容旧接口：is_delta=True 时走原子增量，否则直接设置余额。余额不能为负。"""
+    if is_delta:
+        return db_apply_balance_delta(guild_id, user_id, amount, default_balance) is not None
+
+    if amount < 0:
+        return False
+    conn = get_db_connection()
+    try:
+        conn.execute(_SQL_UPSERT_USER_BALANCE, (guild_id, user_id, amount))
+        conn.commit()
+        _leaderboard_top_k.on_balance_changed(guild_id, user_id, amount)
+        return True
+    except sqlite3.Error as e:
+        log.error("[db_update_user_balance] SQLite Error setting balance for user %s (guild: %s): %s", user_id, guild_id, e)
+        conn.rollback()
+        return False
+
+def _load_leaderboard(guild_id: int, limit: int) -> List[Tuple[int, int]]:
+    conn = get_db_connection()
+    return [(row["user_id"], row["balance"]) for row in conn.execute(_SQL_GET_LEADERBOARD, (guild_id, limit))]
 
 def db_get_leaderboard(guild_id: int, limit: int) -> List[Tuple[int, int]]:
+    """返回 [(user_id, balance), ...]。limit 不超过 LEADERBOARD_TOP_K 时由内存中的前 K 名直接提供。"""
+    return _leaderboard_top_k.get(guild_id, limit, lambda k: _load_leaderboard(guild_id, k))
+
+def db_get_user_rank(guild_id: int, user_id: int) -> Optional[Tuple[int, int]]:
+    """返回用户的 (名次, 余额)；用户没有余额记录时返回 None。"""
+    in_top_k = _leaderboard_top_k.rank_of(guild_id, user_id)
+    if in_top_k is not None:
+        return in_top_k
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT user_id, balance FROM {TABLE_USER_BALANCES} WHERE guild_id = ? ORDER BY balance DESC LIMIT ?", (guild_id, limit))
-    leaderboard = cursor.fetchall()
-    conn.close()
-    return leaderboard
+    row = conn.execute(_SQL_GET_USER_BALANCE, (guild_id, user_id)).fetchone()
+    if row is None:
+        return None
+    balance = row["balance"]
+    rank = conn.execute(_SQL_GET_USER_RANK, {"guild_id": guild_id, "balance": balance, "user_id": user_id}).fetchone()[0]
+    return rank, balance
 
 # =========================================
 # == 经济系统 - 服务器设置
 # =========================================
-def db_get_guild_chat_earn_config(guild_id: int, default_amount: int, default_cooldown: int) -> Dict[str, int]:
+_SQL_GET_CHAT_EARN_CONFIG = f"SELECT chat_earn_amount, chat_earn_cooldown FROM {TABLE_GUILD_ECONOMY_SETTINGS} WHERE guild_id = ?"
+
+def _load_guild_chat_earn_config(guild_id: int) -> Optional[Tuple[int, int]]:
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT chat_earn_amount, chat_earn_cooldown FROM {TABLE_GUILD_ECONOMY_SETTINGS} WHERE guild_id = ?", (guild_id,))
-    row = cursor.fetchone()
-    conn.close()
+    row = conn.execute(_SQL_GET_CHAT_EARN_CONFIG, (guild_id,)).fetchone()
     if row and row["chat_earn_amount"] is not None and row["chat_earn_cooldown"] is not None:
-        return {"amount": row["chat_earn_amount"], "cooldown": row["chat_earn_cooldown"]}
-    return {"amount": default_amount, "cooldown": default_cooldown}
+        return row["chat_earn_amount"], row["chat_earn_cooldown"]
+    return None # 缓存 None 表示“使用默认值”，避免未配置的服务器每次都查库
+
+def _chat_earn_config_dict(stored: Optional[Tuple[int, int]], default_amount: int, default_cooldown: int) -> Dict[str, int]:
+    if stored is None:
+        return {"amount": default_amount, "cooldown": default_cooldown}
+    return {"amount": stored[0], "cooldown": stored[1]}
+
+def db_get_guild_chat_earn_config(guild_id: int, default_amount: int, default_cooldown: int) -> Dict[str, int]:
+    stored = _chat_earn_config_cache.get_or_load(guild_id, lambda: _load_guild_chat_earn_config(guild_id))
+    return _chat_earn_config_dict(stored, default_amount, default_cooldown)
+
+def peek_guild_chat_earn_config(guild_id: int, default_amount: int, default_cooldown: int) -> Optional[Dict[str, int]]:
+    """只查缓存、不访问数据库 (可在事件循环中直接调用)。未命中时返回 None。"""
+    # 未命中时调用方会接着走 db_get_guild_chat_earn_config，那里再计一次未命中
+    found, stored = _chat_earn_config_cache.peek(guild_id, count_miss=False)
+    return _chat_earn_config_dict(stored, default_amount, default_cooldown) if found else None
 
-def db_set_guild_chat_earn_config(guild_id: int, amount: int, cooldown: int):
+def db_set_guild_chat_earn_config(guild_id: int, amount: int, cooldown: int) -> bool:
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
@@ -205,41 +731,59 @@ def db_set_guild_chat_earn_config(guild_id: int, amount: int, cooldown: int):
         ON CONFLICT(guild_id) DO UPDATE SET chat_earn_amount = excluded.chat_earn_amount, chat_earn_cooldown = excluded.chat_earn_cooldown
         """, (guild_id, amount, cooldown))
         conn.commit()
+        return True
+    except sqlite3.Error as e:
+        log.error("设置服务器聊天赚钱配置失败 (guild: %s): %s", guild_id, e)
+        conn.rollback()
+        return False
+    finally:
+        _chat_earn_config_cache.invalidate(guild_id)
+
+def db_seed_guild_chat_earn_configs(configs: List[Tuple[int, int, int]]) -> Optional[int]:
+    """只为尚未配置的服务器写入聊天赚钱配置 (已有配置保持不变)，返回新写入的行数；失败时返回 None。
+
+    configs 为 [(guild_id, amount, cooldown), ...]，用于从旧版 JSON 设置迁移，可重复执行。
+    """
+    if not configs:
+        return 0
+    conn = get_db_connection()
+    try:
+        changes_before = conn.total_changes
+        with conn: # 成功时提交，异常时回滚
+            conn.executemany(f"""
+            INSERT INTO {TABLE_GUILD_ECONOMY_SETTINGS} (guild_id, chat_earn_amount, chat_earn_cooldown) VALUES (?, ?, ?)
+            ON CONFLICT(guild_id) DO NOTHING
+            """, configs)
+        return conn.total_changes - changes_before
     except sqlite3.Error as e:
-        print(f"[DB Economy Error] 设置服务器聊天赚钱配置失败 (guild: {guild_id}): {e}")
+        log.error("迁移 %s 个服务器的聊天赚钱配置失败: %s", len(configs), e)
+        return None
     finally:
-        conn.close()
+        for guild_id, _, _ in configs:
+            _chat_earn_config_cache.invalidate(guild_id)
 
 # =========================================
 # == 经济系统 - 商店操作
 # =========================================
-def db_get_shop_items(guild_id: int) -> Dict[str, Dict[str, Any]]:
-    print(f"[DB DEBUG] Getting shop items for guild_id: {guild_id}") # 新增
+_SHOP_ITEM_COLUMNS = "item_slug, name, price, description, role_id, stock, purchase_message"
+_SQL_GET_SHOP_ITEMS = f"SELECT {_SHOP_ITEM_COLUMNS} FROM {TABLE_SHOP_ITEMS} WHERE guild_id = ?"
+_SQL_GET_SHOP_ITEM = f"SELECT {_SHOP_ITEM_COLUMNS} FROM {TABLE_SHOP_ITEMS} WHERE guild_id = ? AND item_slug = ?"
+
+def _load_shop_items(guild_id: int) -> Dict[str, Dict[str, Any]]:
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT item_slug, name, price, description, role_id, stock, purchase_message FROM {TABLE_SHOP_ITEMS} WHERE guild_id = ?", (guild_id,))
-    items = {}
-    fetched_rows = cursor.fetchall() # 先获取所有行
-    print(f"[DB DEBUG] Fetched {len(fetched_rows)} rows for shop items.") # 新增
-    for row in fetched_rows:
-        items[row["item_slug"]] = dict(row)
-        print(f"[DB DEBUG] Loaded item: {row['item_slug']} - {row['name']}") # 新增
-    conn.close()
-    if not items:
-        print(f"[DB DEBUG] No items found in DB for guild {guild_id}, returning empty dict.") # 新增
-    return items
+    return {row["item_slug"]: dict(row) for row in conn.execute(_SQL_GET_SHOP_ITEMS, (guild_id,))}
+
+def db_get_shop_items(guild_id: int) -> Dict[str, Dict[str, Any]]:
+    cached_items = _shop_items_cache.get_or_load(guild_id, lambda: _load_shop_items(guild_id))
+    return {slug: dict(item) for slug, item in cached_items.items()} # 返回副本，调用方修改不会污染缓存
 
 def db_get_shop_item(guild_id: int, item_slug: str) -> Optional[Dict[str, Any]]:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT item_slug, name, price, description, role_id, stock, purchase_message FROM {TABLE_SHOP_ITEMS} WHERE guild_id = ? AND item_slug = ?", (guild_id, item_slug))
-    row = cursor.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    cached_items = _shop_items_cache.get_or_load(guild_id, lambda: _load_shop_items(guild_id))
+    item = cached_items.get(item_slug)
+    return dict(item) if item else None
 
 def db_add_shop_item(guild_id: int, item_slug: str, name: str, price: int, description: Optional[str],
                        role_id: Optional[int], stock: int, purchase_message: Optional[str]) -> Tuple[bool, str]: # 修改类型提示
-    print(f"[DB DEBUG] db_add_shop_item: Attempting to add item: guild={guild_id}, slug='{item_slug}', name='{name}', price={price}, stock={stock}")
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
@@ -248,18 +792,19 @@ def db_add_shop_item(guild_id: int, item_slug: str, name: str, price: int, descr
         VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         """, (guild_id, item_slug, name, price, description, role_id, stock, purchase_message))
         conn.commit()
-        print(f"[DB DEBUG] db_add_shop_item: Item add committed. Rows affected: {cursor.rowcount} for slug '{item_slug}'")
+        _shop_items_cache.invalidate(guild_id)
+        log.debug("db_add_shop_item: guild=%s slug='%s' name='%s' price=%s stock=%s", guild_id, item_slug, name, price, stock)
         return True, "物品已成功添加到数据库。" # <--- 返回元组
     except sqlite3.IntegrityError:
         msg = f"可能物品ID '{item_slug}' 已存在。"
-        print(f"[DB Economy Error] db_add_shop_item: IntegrityError (guild: {guild_id}, slug: {item_slug}): {msg}")
+        log.error("db_add_shop_item: IntegrityError (guild: %s, slug: %s): %s", guild_id, item_slug, msg)
+        conn.rollback()
         return False, msg # <--- 返回元组
     except sqlite3.Error as e:
         msg = f"数据库错误: {e}"
-        print(f"[DB Economy Error] db_add_shop_item: SQLite Error (guild: {guild_id}, slug: {item_slug}): {msg}")
+        log.error("db_add_shop_item: SQLite Error (guild: %s, slug: %s): %s", guild_id, item_slug, msg)
+        conn.rollback()
         return False, msg # <--- 返回元组
-    finally:
-        conn.close()
 
 def db_remove_shop_item(guild_id: int, item_slug: str) -> bool:
     conn = get_db_connection()
@@ -267,12 +812,12 @@ def db_remove_shop_item(guild_id: int, item_slug: str) -> bool:
     try:
         cursor.execute(f"DELETE FROM {TABLE_SHOP_ITEMS} WHERE guild_id = ? AND item_slug = ?", (guild_id, item_slug))
         conn.commit()
+        _shop_items_cache.invalidate(guild_id)
         return cursor.rowcount > 0
     except sqlite3.Error as e:
-        print(f"[DB Economy Error] 移除商店物品失败 (guild: {guild_id}, slug: {item_slug}): {e}")
+        log.error("移除商店物品失败 (guild: %s, slug: %s): %s", guild_id, item_slug, e)
+        conn.rollback()
         return False
-    finally:
-        conn.close()
 
 def db_update_shop_item_stock(guild_id: int, item_slug: str, new_stock: int) -> bool:
     conn = get_db_connection()
@@ -282,12 +827,12 @@ def db_update_shop_item_stock(guild_id: int, item_slug: str, new_stock: int) ->
         if new_stock < -1: new_stock = 0 
         cursor.execute(f"UPDATE {TABLE_SHOP_ITEMS} SET stock = ? WHERE guild_id = ? AND item_slug = ?", (new_stock, guild_id, item_slug))
         conn.commit()
+        _shop_items_cache.invalidate(guild_id)
         return cursor.rowcount > 0
     except sqlite3.Error as e:
-        print(f"[DB Economy Error] 更新商店物品库存失败 (guild: {guild_id}, slug: {item_slug}): {e}")
+        log.error("更新商店物品库存失败 (guild: %s, slug: %s): %s", guild_id, item_slug, e)
+        conn.rollback()
         return False
-    finally:
-        conn.close()
 
 def db_edit_shop_item(guild_id: int, item_slug: str, updates: Dict[str, Any]) -> bool:
     if not updates: return False
@@ -303,68 +848,231 @@ def db_edit_shop_item(guild_id: int, item_slug: str, updates: Dict[str, Any]) ->
     try:
         cursor.execute(sql, tuple(values))
         conn.commit()
+        _shop_items_cache.invalidate(guild_id)
         return cursor.rowcount > 0
     except sqlite3.Error as e:
-        print(f"[DB Economy Error] 编辑商店物品失败 (guild: {guild_id}, slug: {item_slug}): {e}")
+        log.error("编辑商店物品失败 (guild: %s, slug: %s): %s", guild_id, item_slug, e)
+        conn.rollback()
         return False
-    finally:
-        conn.close()
+
+# --- 购买事务 ---
+PURCHASE_OK = "ok"
+PURCHASE_ITEM_NOT_FOUND = "item_not_found"
+PURCHASE_PRICE_CHANGED = "price_changed"
+PURCHASE_OUT_OF_STOCK = "out_of_stock"
+PURCHASE_INSUFFICIENT_FUNDS = "insufficient_funds"
+PURCHASE_DB_ERROR = "db_error"
+
+class PurchaseResult(NamedTuple):
+    success: bool
+    status: str                     # PURCHASE_* 常量之一
+    balance: Optional[int] = None   # 成功时为扣款后余额；余额不足时为当前余额
+    remaining_stock: Optional[int] = None # 成功时为剩余库存 (-1 表示无限)
+
+# 只有价格与调用方看到的一致、且库存为无限 (-1) 或大于 0 时才扣减库存
+_SQL_DECREMENT_SHOP_STOCK = f"""
+        UPDATE {TABLE_SHOP_ITEMS}
+        SET stock = CASE WHEN COALESCE(stock, -1) = -1 THEN -1 ELSE stock - 1 END
+        WHERE guild_id = ? AND item_slug = ? AND price = ? AND (COALESCE(stock, -1) = -1 OR stock > 0)
+        RETURNING stock
+        """
+_SQL_INSERT_PURCHASE = f"INSERT INTO {TABLE_SHOP_PURCHASES} (guild_id, user_id, item_slug, price, purchased_at) VALUES (?, ?, ?, ?, ?)"
+
+def db_purchase_item(guild_id: int, user_id: int, item_slug: str, price: int, default_balance: int = 0) -> PurchaseResult:
+    """
+    在同一连接、同一事务中完成：扣减库存、扣除余额、写入购买记录。任一步失败则整体回滚。
+    price 是调用方展示给用户的价格，若数据库中的价格已变化则拒绝购买。
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        # IMMEDIATE：开始时就拿到写锁，避免并发购买在事务中途才发现冲突
+        conn.execute("BEGIN IMMEDIATE")
+
+        cursor.execute(_SQL_DECREMENT_SHOP_STOCK, (guild_id, item_slug, price))
+        stock_row = cursor.fetchone()
+        if stock_row is None:
+            cursor.execute(_SQL_GET_SHOP_ITEM, (guild_id, item_slug))
+            item_row = cursor.fetchone()
+            conn.rollback()
+            if item_row is None:
+                return PurchaseResult(False, PURCHASE_ITEM_NOT_FOUND)
+            if item_row["price"] != price:
+                return PurchaseResult(False, PURCHASE_PRICE_CHANGED)
+            return PurchaseResult(False, PURCHASE_OUT_OF_STOCK, remaining_stock=item_row["stock"])
+
+        new_balance = _execute_balance_delta(cursor, guild_id, user_id, -price, default_balance)
+        if new_balance is None:
+            cursor.execute(_SQL_GET_USER_BALANCE, (guild_id, user_id))
+            balance_row = cursor.fetchone()
+            conn.rollback()
+            return PurchaseResult(False, PURCHASE_INSUFFICIENT_FUNDS,
+                                  balance=balance_row["balance"] if balance_row else default_balance)
+
+        cursor.execute(_SQL_INSERT_PURCHASE, (guild_id, user_id, item_slug, price, time.time()))
+        conn.commit()
+        if stock_row[0] != -1: # 有限库存已变化
+            _shop_items_cache.invalidate(guild_id)
+        _leaderboard_top_k.on_balance_changed(guild_id, user_id, new_balance)
+        return PurchaseResult(True, PURCHASE_OK, balance=new_balance, remaining_stock=stock_row[0])
+    except sqlite3.Error as e:
+        log.error("[db_purchase_item] 购买事务失败 (guild: %s, user: %s, slug: %s): %s", guild_id, user_id, item_slug, e)
+        if conn.in_transaction:
+            conn.rollback()
+        return PurchaseResult(False, PURCHASE_DB_ERROR)
 
 # =========================================
 # == AI 知识库操作
 # =========================================
-def db_get_knowledge_base(guild_id: int) -> List[str]:
+# 每个条目有固定的 entry_id；顺序由 sort_key (分数索引) 决定，显示序号 (从 1 开始) 在读取时按 sort_key 排序得到。
+# sort_key 是 62 进制数字串 (0-9A-Za-z，按字节比较即数值顺序)，且不以 '0' 结尾，所以任意两个键之间总能再生成一个键：
+# 删除、在指定位置插入、移动都只写一行，不再重新编号后面的条目。
+_ORDER_KEY_DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+_ORDER_KEY_BASE = len(_ORDER_KEY_DIGITS)
+_ORDER_KEY_APPEND_WIDTH = 4 # 追加时按 4 位精度递增，约 700 万次追加后键才变长
+
+class KnowledgeEntry(NamedTuple):
+    entry_id: int
+    sort_key: str
+    entry_text: str
+
+def _order_key_midpoint(low: str, high: Optional[str]) -> str:
+    """返回严格介于 low 与 high 之间的最短键 (low 可为 "" 表示开头，high 为 None 表示末尾)。"""
+    if high is not None:
+        prefix = 0
+        while prefix < len(high) and (low[prefix] if prefix < len(low) else "0") == high[prefix]:
+            prefix += 1
+        if prefix:
+            return high[:prefix] + _order_key_midpoint(low[prefix:], high[prefix:])
+    low_digit = _ORDER_KEY_DIGITS.index(low[0]) if low else 0
+    high_digit = _ORDER_KEY_DIGITS.index(high[0]) if high is not None else _ORDER_KEY_BASE
+    if high_digit - low_digit > 1:
+        return _ORDER_KEY_DIGITS[(low_digit + high_digit + 1) // 2]
+    if high is not None and len(high) > 1:
+        return high[:1]
+    return _ORDER_KEY_DIGITS[low_digit] + _order_key_midpoint(low[1:], None)
+
+def _order_key_after(low: Optional[str]) -> str:
+    """末尾追加用的键：按固定精度加一 (比取中点增长慢得多)。"""
+    if not low:
+        return _ORDER_KEY_DIGITS[_ORDER_KEY_BASE // 2]
+    digits = [_ORDER_KEY_DIGITS.index(char) for char in low.ljust(max(len(low), _ORDER_KEY_APPEND_WIDTH), "0")]
+    for position in range(len(digits) - 1, -1, -1):
+        if digits[position] + 1 < _ORDER_KEY_BASE:
+            digits[position] += 1
+            return "".join(_ORDER_KEY_DIGITS[digit] for digit in digits[:position + 1])
+        digits[position] = 0
+    return _order_key_midpoint(low, None) # 已是该精度下的最大值
+
+def _order_key_between(low: Optional[str], high: Optional[str]) -> str:
+    if high is None:
+        return _order_key_after(low)
+    return _order_key_midpoint(low or "", high)
+
+_SQL_KB_SELECT_ENTRIES = f"SELECT entry_id, sort_key, entry_text FROM {TABLE_GUILD_KNOWLEDGE_BASE} WHERE guild_id = ? ORDER BY sort_key"
+_SQL_KB_COUNT = f"SELECT COUNT(*) FROM {TABLE_GUILD_KNOWLEDGE_BASE} WHERE guild_id = ?"
+# 第 position 个条目 (从 0 开始) 及其后一个条目的排序键，可排除正在移动的条目
+_SQL_KB_NEIGHBOUR_KEYS = f"""
+        SELECT sort_key FROM {TABLE_GUILD_KNOWLEDGE_BASE} WHERE guild_id = ? AND entry_id != ?
+        ORDER BY sort_key LIMIT ? OFFSET ?
+        """
+
+def _kb_key_for_position(cursor: sqlite3.Cursor, guild_id: int, position: Optional[int], exclude_entry_id: int = -1) -> str:
+    """为插入到 position (从 0 开始；None 或超出末尾表示追加) 计算排序键。"""
+    if position is None or position < 0:
+        position = 1 << 62
+    if position == 0:
+        rows = cursor.execute(_SQL_KB_NEIGHBOUR_KEYS, (guild_id, exclude_entry_id, 1, 0)).fetchall()
+        return _order_key_between(None, rows[0][0] if rows else None)
+    rows = cursor.execute(_SQL_KB_NEIGHBOUR_KEYS, (guild_id, exclude_entry_id, 2, position - 1)).fetchall()
+    if not rows: # 超出末尾：接在最后一条之后
+        rows = cursor.execute(f"SELECT MAX(sort_key) FROM {TABLE_GUILD_KNOWLEDGE_BASE} WHERE guild_id = ? AND entry_id != ?",
+                              (guild_id, exclude_entry_id)).fetchall()
+        return _order_key_between(rows[0][0], None)
+    return _order_key_between(rows[0][0], rows[1][0] if len(rows) > 1 else None)
+
+def db_get_knowledge_base_entries(guild_id: int) -> List[KnowledgeEntry]:
+    """按显示顺序返回某服务器的全部知识条目。"""
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT entry_text FROM {TABLE_GUILD_KNOWLEDGE_BASE} WHERE guild_id = ? ORDER BY entry_order ASC", (guild_id,))
-    entries = [row["entry_text"] for row in cursor.fetchall()]
-    conn.close()
-    return entries
+    return [KnowledgeEntry(*row) for row in conn.execute(_SQL_KB_SELECT_ENTRIES, (guild_id,)).fetchall()]
 
-def db_add_knowledge_base_entry(guild_id: int, entry_text: str, max_entries: int) -> Tuple[bool, str]:
+def db_get_knowledge_base(guild_id: int) -> List[str]:
+    return [entry.entry_text for entry in db_get_knowledge_base_entries(guild_id)]
+
+def db_insert_knowledge_base_entry(guild_id: int, entry_text: str, max_entries: int, position: Optional[int] = None) -> Tuple[Optional[int], str]:
+    """在 position (从 0 开始；None 表示末尾) 插入一条，只写入新行。返回 (新条目 ID，失败时为 None, 说明)。"""
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
-        cursor.execute(f"SELECT COUNT(*) as count FROM {TABLE_GUILD_KNOWLEDGE_BASE} WHERE guild_id = ?", (guild_id,))
-        current_count = cursor.fetchone()["count"]
-        if current_count >= max_entries:
-            return False, "知识库已满。"
-
-        cursor.execute(f"SELECT MAX(entry_order) as max_order FROM {TABLE_GUILD_KNOWLEDGE_BASE} WHERE guild_id = ?", (guild_id,))
-        max_order_row = cursor.fetchone()
-        next_order = (max_order_row["max_order"] if max_order_row and max_order_row["max_order"] is not None else 0) + 1
-        
-        cursor.execute(f"INSERT INTO {TABLE_GUILD_KNOWLEDGE_BASE} (guild_id, entry_order, entry_text) VALUES (?, ?, ?)",
-                       (guild_id, next_order, entry_text))
+        conn.execute("BEGIN IMMEDIATE")
+        if cursor.execute(_SQL_KB_COUNT, (guild_id,)).fetchone()[0] >= max_entries:
+            conn.rollback()
+            return None, "知识库已满。"
+        sort_key = _kb_key_for_position(cursor, guild_id, position)
+        cursor.execute(f"INSERT INTO {TABLE_GUILD_KNOWLEDGE_BASE} (guild_id, sort_key, entry_text) VALUES (?, ?, ?)",
+                       (guild_id, sort_key, entry_text))
+        entry_id = cursor.lastrowid
         conn.commit()
-        return True, "添加成功。"
+        return entry_id, "添加成功。"
     except sqlite3.Error as e:
-        print(f"[DB KB Error] 添加知识库条目失败 (guild: {guild_id}): {e}")
-        conn.rollback()
-        return False, f"数据库错误: {e}"
-    finally:
-        conn.close()
+        log.error("添加知识库条目失败 (guild: %s): %s", guild_id, e)
+        if conn.in_transaction:
+            conn.rollback()
+        return None, f"数据库错误: {e}"
 
-def db_remove_knowledge_base_entry_by_order(guild_id: int, entry_order_to_remove: int) -> bool:
+def db_add_knowledge_base_entry(guild_id: int, entry_text: str, max_entries: int) -> Tuple[bool, str]:
+    entry_id, message = db_insert_knowledge_base_entry(guild_id, entry_text, max_entries)
+    return entry_id is not None, message
+
+def db_move_knowledge_base_entry(guild_id: int, entry_id: int, new_position: int) -> bool:
+    """把条目移到 new_position (从 0 开始，按移除该条目后的顺序计)，只更新这一行的排序键。"""
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
-        conn.execute("BEGIN")
-        cursor.execute(f"DELETE FROM {TABLE_GUILD_KNOWLEDGE_BASE} WHERE guild_id = ? AND entry_order = ?",
-                       (guild_id, entry_order_to_remove))
+        conn.execute("BEGIN IMMEDIATE")
+        sort_key = _kb_key_for_position(cursor, guild_id, new_position, exclude_entry_id=entry_id)
+        cursor.execute(f"UPDATE {TABLE_GUILD_KNOWLEDGE_BASE} SET sort_key = ? WHERE guild_id = ? AND entry_id = ?",
+                       (sort_key, guild_id, entry_id))
         if cursor.rowcount == 0:
             conn.rollback()
             return False
-        cursor.execute(f"UPDATE {TABLE_GUILD_KNOWLEDGE_BASE} SET entry_order = entry_order - 1 WHERE guild_id = ? AND entry_order > ?",
-                       (guild_id, entry_order_to_remove))
         conn.commit()
         return True
     except sqlite3.Error as e:
-        print(f"[DB KB Error] 按序号移除知识库条目失败 (guild: {guild_id}, order: {entry_order_to_remove}): {e}")
+        log.error("移动知识库条目失败 (guild: %s, entry: %s): %s", guild_id, entry_id, e)
+        if conn.in_transaction:
+            conn.rollback()
+        return False
+
+def db_remove_knowledge_base_entry(guild_id: int, entry_id: int) -> bool:
+    """按条目 ID 删除一行，其余条目不受影响。"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute(f"DELETE FROM {TABLE_GUILD_KNOWLEDGE_BASE} WHERE guild_id = ? AND entry_id = ?", (guild_id, entry_id))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        log.error("移除知识库条目失败 (guild: %s, entry: %s): %s", guild_id, entry_id, e)
+        conn.rollback()
+        return False
+
+def db_remove_knowledge_base_entry_by_order(guild_id: int, entry_order_to_remove: int) -> bool:
+    """按显示序号 (从 1 开始) 删除一行。"""
+    if entry_order_to_remove < 1:
+        return False
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute(f"""
+            DELETE FROM {TABLE_GUILD_KNOWLEDGE_BASE} WHERE entry_id = (
+                SELECT entry_id FROM {TABLE_GUILD_KNOWLEDGE_BASE} WHERE guild_id = ? ORDER BY sort_key LIMIT 1 OFFSET ?
+            )
+            """, (guild_id, entry_order_to_remove - 1))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        log.error("按序号移除知识库条目失败 (guild: %s, order: %s): %s", guild_id, entry_order_to_remove, e)
         conn.rollback()
         return False
-    finally:
-        conn.close()
 
 def db_clear_knowledge_base(guild_id: int) -> bool:
     conn = get_db_connection()
@@ -374,19 +1082,291 @@ def db_clear_knowledge_base(guild_id: int) -> bool:
         conn.commit()
         return True
     except sqlite3.Error as e:
-        print(f"[DB KB Error] 清空知识库失败 (guild: {guild_id}): {e}")
+        log.error("清空知识库失败 (guild: %s): %s", guild_id, e)
+        conn.rollback()
         return False
-    finally:
-        conn.close()
+
+# =========================================
+# == 审核 / AI / 票据 / 临时语音状态
+# =========================================
+# 机器人启动时用 db_load_bot_state() 一次性读入内存字典，之后内存字典仍是读取的唯一来源；
+# 每次修改内存字典时同步调用下面对应的 db_set_* / db_remove_* 写回 (write-through)。
+FEATURE_TICKET = "ticket"
+FEATURE_TEMP_VC = "temp_vc"
+FEATURE_BAD_WORDS = "bad_words" # 服务器附加违禁词，键 "words" 保存词列表
+AI_CHECK_EXEMPT_USER = "user"
+AI_CHECK_EXEMPT_CHANNEL = "channel"
+
+def _execute_state_write(sql: str, params: tuple, description: str) -> bool:
+    conn = get_db_connection()
+    try:
+        conn.execute(sql, params)
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        log.error("保存%s失败 %s: %s", description, params, e)
+        conn.rollback()
+        return False
+
+def db_load_bot_state() -> Dict[str, Any]:
+    """读取所有持久化的机器人状态，结构与 role_manager_bot.py 中对应的内存字典一致。"""
+    conn = get_db_connection()
+    state: Dict[str, Any] = {
+        "ai_dep_channels": {}, "private_ai_chats": {}, "faqs": {},
+        "exempt_users": set(), "exempt_channels": set(),
+        "feature_settings": {FEATURE_TICKET: {}, FEATURE_TEMP_VC: {}},
+        "open_tickets": {}, "user_warnings": {}, "temp_voice_channels": {},
+    }
+    for row in conn.execute(f"SELECT channel_id, model, system_prompt, history_key FROM {TABLE_AI_DEP_CHANNELS}"):
+        state["ai_dep_channels"][row["channel_id"]] = {
+            "model": row["model"], "system_prompt": row["system_prompt"], "history_key": row["history_key"]}
+    for row in conn.execute(f"SELECT channel_id, guild_id, user_id, model, history_key FROM {TABLE_PRIVATE_AI_CHATS}"):
+        state["private_ai_chats"][row["channel_id"]] = {
+            "user_id": row["user_id"], "model": row["model"], "history_key": row["history_key"],
+            "guild_id": row["guild_id"], "channel_id": row["channel_id"]}
+    for row in conn.execute(f"SELECT guild_id, keyword, answer FROM {TABLE_GUILD_FAQS} ORDER BY rowid"):
+        state["faqs"].setdefault(row["guild_id"], {})[row["keyword"]] = row["answer"]
+    for row in conn.execute(f"SELECT target_type, target_id FROM {TABLE_AI_CHECK_EXEMPTIONS}"):
+        target_set = state["exempt_users"] if row["target_type"] == AI_CHECK_EXEMPT_USER else state["exempt_channels"]
+        target_set.add(row["target_id"])
+    for row in conn.execute(f"SELECT feature, guild_id, setting_key, value_json FROM {TABLE_GUILD_FEATURE_SETTINGS}"):
+        feature_store = state["feature_settings"].setdefault(row["feature"], {})
+        feature_store.setdefault(row["guild_id"], {})[row["setting_key"]] = json.loads(row["value_json"])
+    for row in conn.execute(f"SELECT guild_id, user_id, channel_id FROM {TABLE_OPEN_TICKETS}"):
+        state["open_tickets"].setdefault(row["guild_id"], {})[row["user_id"]] = row["channel_id"]
+    for row in conn.execute(f"SELECT user_id, warning_count FROM {TABLE_USER_WARNINGS}"):
+        state["user_warnings"][row["user_id"]] = row["warning_count"]
+    for row in conn.execute(f"SELECT channel_id, guild_id, owner_id FROM {TABLE_TEMP_VOICE_CHANNELS}"):
+        state["temp_voice_channels"][row["channel_id"]] = {"guild_id": row["guild_id"], "owner_id": row["owner_id"]}
+    return state
+
+def db_set_ai_dep_channel(channel_id: int, model: str, system_prompt: Optional[str], history_key: str) -> bool:
+    return _execute_state_write(f"""
+        INSERT INTO {TABLE_AI_DEP_CHANNELS} (channel_id, model, system_prompt, history_key) VALUES (?, ?, ?, ?)
+        ON CONFLICT(channel_id) DO UPDATE SET model = excluded.model, system_prompt = excluded.system_prompt, history_key = excluded.history_key
+        """, (channel_id, model, system_prompt, history_key), "AI 对话频道配置")
+
+def db_set_private_ai_chat(channel_id: int, guild_id: int, user_id: int, model: str, history_key: str) -> bool:
+    return _execute_state_write(
+        f"INSERT OR REPLACE INTO {TABLE_PRIVATE_AI_CHATS} (channel_id, guild_id, user_id, model, history_key) VALUES (?, ?, ?, ?, ?)",
+        (channel_id, guild_id, user_id, model, history_key), "AI 私聊频道记录")
+
+def db_remove_private_ai_chat(channel_id: int) -> bool:
+    return _execute_state_write(f"DELETE FROM {TABLE_PRIVATE_AI_CHATS} WHERE channel_id = ?", (channel_id,), "AI 私聊频道记录 (删除)")
+
+def db_set_faq(guild_id: int, keyword: str, answer: str) -> bool:
+    return _execute_state_write(f"""
+        INSERT INTO {TABLE_GUILD_FAQS} (guild_id, keyword, answer) VALUES (?, ?, ?)
+        ON CONFLICT(guild_id, keyword) DO UPDATE SET answer = excluded.answer
+        """, (guild_id, keyword, answer), "FAQ 条目")
+
+def db_remove_faq(guild_id: int, keyword: str) -> bool:
+    return _execute_state_write(f"DELETE FROM {TABLE_GUILD_FAQS} WHERE guild_id = ? AND keyword = ?", (guild_id, keyword), "FAQ 条目 (删除)")
+
+def db_set_ai_check_exemption(target_type: str, target_id: int, exempt: bool) -> bool:
+    """target_type 为 AI_CHECK_EXEMPT_USER 或 AI_CHECK_EXEMPT_CHANNEL；exempt=False 时移除豁免。"""
+    if exempt:
+        sql = f"INSERT OR IGNORE INTO {TABLE_AI_CHECK_EXEMPTIONS} (target_type, target_id) VALUES (?, ?)"
+    else:
+        sql = f"DELETE FROM {TABLE_AI_CHECK_EXEMPTIONS} WHERE target_type = ? AND target_id = ?"
+    return _execute_state_write(sql, (target_type, target_id), "AI 检测豁免")
+
+def db_set_guild_feature_setting(feature: str, guild_id: int, key: str, value: Any) -> bool:
+    """保存 FEATURE_TICKET / FEATURE_TEMP_VC 等功能的单个服务器设置 (value 需可 JSON 序列化)。"""
+    return _execute_state_write(f"""
+        INSERT INTO {TABLE_GUILD_FEATURE_SETTINGS} (feature, guild_id, setting_key, value_json) VALUES (?, ?, ?, ?)
+        ON CONFLICT(feature, guild_id, setting_key) DO UPDATE SET value_json = excluded.value_json
+        """, (feature, guild_id, key, json.dumps(value)), "服务器功能设置")
+
+def db_set_open_ticket(guild_id: int, user_id: int, channel_id: Optional[int]) -> bool:
+    """记录用户当前打开的票据频道；channel_id 为 None 时删除记录。"""
+    if channel_id is None:
+        return _execute_state_write(f"DELETE FROM {TABLE_OPEN_TICKETS} WHERE guild_id = ? AND user_id = ?", (guild_id, user_id), "票据记录 (删除)")
+    return _execute_state_write(f"INSERT OR REPLACE INTO {TABLE_OPEN_TICKETS} (guild_id, user_id, channel_id) VALUES (?, ?, ?)",
+                                (guild_id, user_id, channel_id), "票据记录")
+
+def db_set_temp_voice_channel(channel_id: int, guild_id: int, owner_id: int) -> bool:
+    """记录机器人创建的临时语音频道及其房主 (转让房主时覆盖)。"""
+    return _execute_state_write(f"INSERT OR REPLACE INTO {TABLE_TEMP_VOICE_CHANNELS} (channel_id, guild_id, owner_id) VALUES (?, ?, ?)",
+                                (channel_id, guild_id, owner_id), "临时语音频道记录")
+
+def db_remove_temp_voice_channel(channel_id: int) -> bool:
+    return _execute_state_write(f"DELETE FROM {TABLE_TEMP_VOICE_CHANNELS} WHERE channel_id = ?", (channel_id,), "临时语音频道记录 (删除)")
+
+# --- AI 对话历史 (只保存最近几轮；过期记录由 db_prune_conversation_histories 清理) ---
+def db_get_conversation_history(history_key: str) -> Optional[List[Dict[str, str]]]:
+    """返回保存的消息列表 [{"role": ..., "content": ...}, ...]；没有记录时返回 None。"""
+    row = get_db_connection().execute(
+        f"SELECT messages_json FROM {TABLE_AI_CONVERSATION_HISTORY} WHERE history_key = ?", (history_key,)).fetchone()
+    return json.loads(row["messages_json"]) if row else None
+
+def db_set_conversation_history(history_key: str, messages: List[Dict[str, str]]) -> bool:
+    """保存对话最近的消息 (覆盖旧记录)；messages 为空时删除记录。"""
+    conn = get_db_connection()
+    try:
+        if messages:
+            conn.execute(f"""
+                INSERT INTO {TABLE_AI_CONVERSATION_HISTORY} (history_key, messages_json, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(history_key) DO UPDATE SET messages_json = excluded.messages_json, updated_at = excluded.updated_at
+                """, (history_key, json.dumps(messages, ensure_ascii=False), time.time()))
+        else:
+            conn.execute(f"DELETE FROM {TABLE_AI_CONVERSATION_HISTORY} WHERE history_key = ?", (history_key,))
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        log.error("保存 AI 对话历史失败 (key: %s): %s", history_key, e) # 不记录消息内容
+        conn.rollback()
+        return False
+
+def db_prune_conversation_histories(max_age_seconds: float) -> int:
+    """删除超过 max_age_seconds 未更新的对话历史，返回删除的条数。"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute(f"DELETE FROM {TABLE_AI_CONVERSATION_HISTORY} WHERE updated_at < ?", (time.time() - max_age_seconds,))
+        conn.commit()
+        return cursor.rowcount
+    except sqlite3.Error as e:
+        log.error("清理过期 AI 对话历史失败: %s", e)
+        conn.rollback()
+        return 0
+
+def db_set_user_warning_count(user_id: int, warning_count: int) -> bool:
+    """保存用户的警告次数；次数为 0 时删除记录。"""
+    if warning_count <= 0:
+        return _execute_state_write(f"DELETE FROM {TABLE_USER_WARNINGS} WHERE user_id = ?", (user_id,), "用户警告次数 (删除)")
+    return _execute_state_write(f"INSERT OR REPLACE INTO {TABLE_USER_WARNINGS} (user_id, warning_count) VALUES (?, ?)",
+                                (user_id, warning_count), "用户警告次数")
+
+# =========================================
+# == 性能基准
+# ==   python database.py bench [次数]              连接复用
+# ==   python database.py leaderboard-bench [用户数] 排行榜索引 / 前 K 名 / 名次查询
+# =========================================
+def _legacy_connect(db_file: str) -> sqlite3.Connection:
+    """模拟旧版 get_db_connection：每次调用都检查目录并新建连接。"""
+    db_dir = os.path.dirname(os.path.abspath(db_file))
+    if db_dir and not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+    conn = sqlite3.connect(db_file, timeout=DB_CONNECT_TIMEOUT_SECONDS)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def run_connection_benchmark(iterations: int = 2000) -> Dict[str, float]:
+    """对比“每次调用 connect/close”与线程长连接的余额读写吞吐量 (ops/sec)。"""
+    import tempfile
+    global DATABASE_FILE
+    original_db_file = DATABASE_FILE
+    guild_id, user_count = 1, 100
+    results: Dict[str, float] = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        try:
+            # --- 旧实现：每次操作都 connect / close ---
+            DATABASE_FILE = os.path.join(tmp_dir, "bench_per_call.db")
+            close_db_connections()
+            initialize_database()
+            close_db_connections()
+            started = time.perf_counter()
+            for i in range(iterations):
+                user_id = i % user_count
+                conn = _legacy_connect(DATABASE_FILE)
+                conn.execute(_SQL_GET_USER_BALANCE, (guild_id, user_id)).fetchone()
+                conn.close()
+                conn = _legacy_connect(DATABASE_FILE)
+                conn.execute(_SQL_UPSERT_USER_BALANCE, (guild_id, user_id, i))
+                conn.commit()
+                conn.close()
+            results["per_call_connect"] = (iterations * 2) / (time.perf_counter() - started)
+
+            # --- 新实现：线程长连接 + WAL + 预编译语句缓存 ---
+            DATABASE_FILE = os.path.join(tmp_dir, "bench_pooled.db")
+            initialize_database()
+            started = time.perf_counter()
+            for i in range(iterations):
+                user_id = i % user_count
+                conn = get_db_connection()
+                conn.execute(_SQL_GET_USER_BALANCE, (guild_id, user_id)).fetchone()
+                conn = get_db_connection()
+                conn.execute(_SQL_UPSERT_USER_BALANCE, (guild_id, user_id, i))
+                conn.commit()
+            results["pooled_connection"] = (iterations * 2) / (time.perf_counter() - started)
+        finally:
+            close_db_connections()
+            DATABASE_FILE = original_db_file
+    return results
+
+def _time_per_call_ms(func, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - started) * 1000 / rounds
+
+def run_leaderboard_benchmark(users: int = 100000, rounds: int = 200) -> Dict[str, float]:
+    """在单个服务器 users 个用户的规模下，对比无索引排序、覆盖索引、内存前 K 名与名次查询的耗时 (毫秒/次)。"""
+    import random
+    import tempfile
+    global DATABASE_FILE
+    original_db_file = DATABASE_FILE
+    guild_id, limit = 1, 10
+    index_name = f"idx_{TABLE_USER_BALANCES}_leaderboard"
+    results: Dict[str, float] = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        try:
+            DATABASE_FILE = os.path.join(tmp_dir, "bench_leaderboard.db")
+            close_db_connections()
+            initialize_database()
+            conn = get_db_connection()
+            conn.execute(f"DROP INDEX IF EXISTS {index_name}")
+            rng = random.Random(42)
+            with conn:
+                conn.executemany(_SQL_UPSERT_USER_BALANCE,
+                                 [(guild_id, user_id, rng.randint(0, 1000000)) for user_id in range(users)])
+            conn.execute("ANALYZE")
+            middle_user = users // 2
+
+            results["leaderboard_no_index"] = _time_per_call_ms(
+                lambda: conn.execute(_SQL_GET_LEADERBOARD, (guild_id, limit)).fetchall(), max(1, rounds // 10))
+
+            started = time.perf_counter()
+            with conn:
+                conn.execute(_SQL_CREATE_LEADERBOARD_INDEX)
+            results["create_index"] = (time.perf_counter() - started) * 1000
+            conn.execute("ANALYZE")
+
+            results["leaderboard_indexed"] = _time_per_call_ms(
+                lambda: conn.execute(_SQL_GET_LEADERBOARD, (guild_id, limit)).fetchall(), rounds)
+            db_get_leaderboard(guild_id, limit) # 预热前 K 名
+            results["leaderboard_top_k"] = _time_per_call_ms(lambda: db_get_leaderboard(guild_id, limit), rounds)
+            results["top_k_update"] = _time_per_call_ms(
+                lambda: _leaderboard_top_k.on_balance_changed(guild_id, rng.randrange(users), rng.randint(0, 1000000)), rounds)
+            _leaderboard_top_k.invalidate(guild_id)
+            results["user_rank_indexed"] = _time_per_call_ms(lambda: db_get_user_rank(guild_id, middle_user), rounds)
+        finally:
+            close_db_connections()
+            DATABASE_FILE = original_db_file
+    return results
 
 # --- 在文件末尾，可以添加一个初次运行时创建数据库文件的检查 ---
 if __name__ == "__main__":
     # 这个 __main__ 块只会在直接运行 database.py 时执行，
     # 而不是在被 role_manager_bot.py导入时执行。
     # 这对于测试数据库连接或手动初始化很有用。
-    print("database.py 被直接运行。正在尝试初始化数据库...")
-    initialize_database()
-    print("数据库初始化（如果需要）已完成。")
+    setup_logging()
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        bench_iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+        bench_results = run_connection_benchmark(bench_iterations)
+        for mode_name, ops_per_sec in bench_results.items():
+            print(f"{mode_name:>20}: {ops_per_sec:,.0f} ops/sec")
+        if bench_results.get("per_call_connect"):
+            print(f"{'speedup':>20}: {bench_results['pooled_connection'] / bench_results['per_call_connect']:.1f}x")
+    elif len(sys.argv) > 1 and sys.argv[1] == "leaderboard-bench":
+        bench_users = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        for step_name, elapsed_ms in run_leaderboard_benchmark(bench_users).items():
+            print(f"{step_name:>22}: {elapsed_ms:.4f} ms")
+    else:
+        print("database.py 被直接运行。正在尝试初始化数据库...")
+        initialize_database()
+        print("数据库初始化（如果需要）已完成。")
+    shutdown_logging()
 else:
     # 当被导入时，检查并初始化数据库（如果主程序还没做）
     # 更好的做法是在主程序的 on_ready 中调用 initialize_database()
@@ -0,0 +1,471 @@
+# deepseek_gateway.py
+# DeepSeek API 网关：所有对 DeepSeek 的请求 (内容审核与 AI 对话) 都经过同一个 DeepSeekGateway。
+#
+# - 并发上限：全局信号量 + 每个服务器的信号量，慢请求 (对话最长 300 秒) 不会无限占用连接。
+#   另外按用途 (purpose) 限制：对话最多占用 GATEWAY_PURPOSE_CONCURRENCY["dialogue"] 个名额，其余名额始终留给审核，
+#   长时间的流式对话不会让审核排队到过期。
+# - 速率限制：令牌桶平滑突发，避免短时间内把 DeepSeek 的限额用完。
+# - 重试：429 / 5xx / 连接错误按指数退避 + 随机抖动重试 (优先遵守 Retry-After)；超时不重试，避免放大延迟。
+# - 熔断：连续失败达到阈值后熔断一段时间，期间请求直接抛出 GatewayUnavailable，不再发出网络请求；
+#   冷却后放行一个探测请求 (半开)，成功则恢复。审核调用方据此放行消息 (fail open)，对话调用方立即提示用户 (fail fast)。
+# - 流式请求 (stream)：逐行产出 SSE 数据；只在收到响应头之前重试。
+# - 排队：等待名额的请求数有上限 (有用途上限的用途单独计数，对话积压不会挤掉审核)，超过上限同样抛出 GatewayUnavailable。get_stats() 返回熔断状态与排队深度。
+
+import asyncio
+import contextlib
+import random
+import time
+from typing import Any, AsyncIterator, Dict, NamedTuple, Optional, Tuple, Union
+
+from bot_logging import get_logger
+
+try:
+    import aiohttp
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    AIOHTTP_AVAILABLE = False
+
+log = get_logger("ai.gateway")
+
+# --- 配置 ---
+GATEWAY_GLOBAL_CONCURRENCY = 8      # 同时在途的 DeepSeek 请求上限
+GATEWAY_PER_GUILD_CONCURRENCY = 3   # 单个服务器同时在途的请求上限 (审核批次跨服务器，不受此限制)
+GATEWAY_PURPOSE_CONCURRENCY = {     # 各用途同时在途的请求上限 (未列出的用途只受全局上限限制)
+    "dialogue": 6,                  # 对话最多 6 个，为审核保留 8 - 6 = 2 个名额
+}
+GATEWAY_MAX_WAITING = 200           # 等待名额的请求上限，超过时直接拒绝 (有用途上限的用途单独计数)
+GATEWAY_RATE_PER_SECOND = 5.0       # 令牌桶：平均每秒请求数
+GATEWAY_BURST = 10                  # 令牌桶：允许的突发请求数
+GATEWAY_MAX_RETRIES = 2             # 429 / 5xx / 连接错误的最多重试次数
+GATEWAY_RETRY_BASE_SECONDS = 0.5    # 退避基数：第 n 次重试最多等待 base * 2^n 秒 (full jitter)
+GATEWAY_RETRY_MAX_SECONDS = 8.0     # 单次退避上限 (也用于截断 Retry-After)
+BREAKER_FAILURE_THRESHOLD = 5       # 连续失败多少次后熔断
+BREAKER_RESET_SECONDS = 30.0        # 熔断后多久放行探测请求
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+
+
+class GatewayUnavailable(Exception):
+    """熔断中或排队已满，请求没有发出。"""
+
+
+class GatewayStatusError(Exception):
+    """流式请求返回了非 200 状态 (重试用尽或不可重试)。"""
+
+    def __init__(self, status: int, text: str):
+        super().__init__(f"HTTP {status}: {text[:200]}")
+        self.status = status
+        self.text = text
+
+
+class GatewayResponse(NamedTuple):
+    status: int
+    text: str
+
+
+class TokenBucket:
+    """令牌桶限速：容量 capacity，每秒补充 rate 个令牌。"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self.throttled = 0 # 因令牌不足而等待的次数
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        waited = False
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            if not waited:
+                self.throttled += 1
+                waited = True
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    @property
+    def tokens(self) -> float:
+        self._refill()
+        return self._tokens
+
+
+class CircuitBreaker:
+    """连续失败计数熔断器：closed → (连续失败) → open → (冷却) → half_open (只放行一个探测) → closed / open。"""
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = BREAKER_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._probe_in_flight = False
+
+    def allow_request(self) -> bool:
+        if self.state == BREAKER_CLOSED:
+            return True
+        if self.state == BREAKER_OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+            self.state = BREAKER_HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == BREAKER_HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != BREAKER_CLOSED:
+            log.info("✅ DeepSeek 熔断器恢复 (探测请求成功)。")
+        self.state = BREAKER_CLOSED
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == BREAKER_HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != BREAKER_OPEN:
+                self.times_opened += 1
+                log.warning("⚠️ DeepSeek 熔断器打开：连续失败 %s 次，%ss 内请求将直接失败。",
+                            self.consecutive_failures, self.reset_seconds)
+            self.state = BREAKER_OPEN
+            self.opened_at = time.monotonic()
+        self._probe_in_flight = False
+
+    def release_probe(self):
+        """探测请求没有得到结果就结束了 (例如被取消)，允许下一个请求重新探测。"""
+        self._probe_in_flight = False
+
+    def retry_in_seconds(self) -> float:
+        if self.state != BREAKER_OPEN:
+            return 0.0
+        return max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at))
+
+
+class _GuildSlot:
+    __slots__ = ("semaphore", "users")
+
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.users = 0 # 持有或等待该信号量的请求数，为 0 时回收
+
+
+class DeepSeekGateway:
+    """带并发上限、令牌桶、重试与熔断的 DeepSeek 请求入口 (只应在事件循环中使用)。"""
+
+    def __init__(self, api_url: str, api_key: Optional[str],
+                 global_concurrency: int = GATEWAY_GLOBAL_CONCURRENCY,
+                 per_guild_concurrency: int = GATEWAY_PER_GUILD_CONCURRENCY,
+                 purpose_concurrency: Optional[Dict[str, int]] = None,
+                 max_waiting: int = GATEWAY_MAX_WAITING,
+                 rate_per_second: float = GATEWAY_RATE_PER_SECOND, burst: int = GATEWAY_BURST,
+                 max_retries: int = GATEWAY_MAX_RETRIES, breaker: Optional[CircuitBreaker] = None):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.global_concurrency = global_concurrency
+        self.per_guild_concurrency = per_guild_concurrency
+        self.purpose_concurrency = dict(GATEWAY_PURPOSE_CONCURRENCY if purpose_concurrency is None else purpose_concurrency)
+        self.max_waiting = max_waiting
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate_per_second, burst)
+        self.breaker = breaker or CircuitBreaker()
+        self._global_slots: Optional[asyncio.Semaphore] = None
+        self._guild_slots: Dict[int, _GuildSlot] = {}
+        self._purpose_slots: Dict[str, asyncio.Semaphore] = {}
+        self._waiting = 0
+        self._in_flight = 0
+        self._purpose_waiting: Dict[str, int] = {}
+        self._purpose_in_flight: Dict[str, int] = {}
+        self._stats: Dict[str, int] = {
+            "requests": 0, "attempts": 0, "retries": 0, "succeeded": 0, "failed": 0,
+            "rejected_open": 0, "rejected_queue_full": 0, "max_waiting_seen": 0,
+        }
+        self._purposes: Dict[str, int] = {}
+
+    def _get_global_slots(self) -> asyncio.Semaphore:
+        # 延迟创建：信号量需要在事件循环启动后创建
+        if self._global_slots is None:
+            self._global_slots = asyncio.Semaphore(self.global_concurrency)
+        return self._global_slots
+
+    def _get_purpose_slots(self, purpose: str) -> Optional[asyncio.Semaphore]:
+        limit = self.purpose_concurrency.get(purpose)
+        if limit is None:
+            return None
+        slots = self._purpose_slots.get(purpose)
+        if slots is None:
+            slots = self._purpose_slots[purpose] = asyncio.Semaphore(limit)
+        return slots
+
+    async def _acquire_slots(self, guild_id: Optional[int], purpose: str) -> Optional[_GuildSlot]:
+        # 有用途上限的请求 (对话) 在拿到用途名额前只计入该用途自己的排队数，
+        # 对话积压不会占满全局排队额度而导致审核请求被拒绝
+        purpose_slots = self._get_purpose_slots(purpose)
+        purpose_waiting = self._purpose_waiting.get(purpose, 0)
+        waiting = purpose_waiting if purpose_slots is not None else self._waiting
+        if waiting >= self.max_waiting:
+            self._stats["rejected_queue_full"] += 1
+            raise GatewayUnavailable(f"DeepSeek {purpose} 请求排队已满 ({waiting})")
+        guild_slot = None
+        if guild_id is not None:
+            guild_slot = self._guild_slots.get(guild_id)
+            if guild_slot is None:
+                guild_slot = self._guild_slots[guild_id] = _GuildSlot(self.per_guild_concurrency)
+            guild_slot.users += 1
+        self._purpose_waiting[purpose] = purpose_waiting + 1
+        counted_global = False
+        acquired_purpose = acquired_guild = acquired_global = False
+        try:
+            if purpose_slots is not None: # 先占用途名额，超出用途上限的请求不会占住全局名额
+                await purpose_slots.acquire()
+                acquired_purpose = True
+            self._waiting += 1 # 此后的等待 (服务器 / 全局名额与令牌) 才计入全局排队
+            counted_global = True
+            self._stats["max_waiting_seen"] = max(self._stats["max_waiting_seen"], self._waiting)
+            if guild_slot is not None:
+                await guild_slot.semaphore.acquire()
+                acquired_guild = True
+            await self._get_global_slots().acquire()
+            acquired_global = True
+            await self.bucket.acquire()
+        except BaseException:
+            if acquired_global:
+                self._get_global_slots().release()
+            if acquired_guild:
+                guild_slot.semaphore.release()
+            if acquired_purpose:
+                purpose_slots.release()
+            self._release_guild(guild_id, guild_slot)
+            raise
+        finally:
+            if counted_global:
+                self._waiting -= 1
+            self._purpose_waiting[purpose] -= 1
+        return guild_slot
+
+    def _release_slots(self, guild_id: Optional[int], guild_slot: Optional[_GuildSlot], purpose: str):
+        self._get_global_slots().release()
+        purpose_slots = self._get_purpose_slots(purpose)
+        if purpose_slots is not None:
+            purpose_slots.release()
+        if guild_slot is not None:
+            guild_slot.semaphore.release()
+            self._release_guild(guild_id, guild_slot)
+
+    def _release_guild(self, guild_id: Optional[int], guild_slot: Optional[_GuildSlot]):
+        if guild_slot is None:
+            return
+        guild_slot.users -= 1
+        if guild_slot.users == 0:
+            self._guild_slots.pop(guild_id, None)
+
+    def _headers(self) -> Dict[str, str]:
+        return {"Content-Type": "application/json", "Authorization": f"Bearer {self.api_key}"}
+
+    async def _send(self, session: "aiohttp.ClientSession", payload: Dict[str, Any],
+                    timeout: Union[float, "aiohttp.ClientTimeout"]) -> Tuple[GatewayResponse, Optional[float]]:
+        async with session.post(self.api_url, headers=self._headers(), json=payload,
+                                timeout=_as_client_timeout(timeout)) as response:
+            text = await response.text()
+            return GatewayResponse(response.status, text), _parse_retry_after(response.headers.get("Retry-After"))
+
+    def _backoff_seconds(self, attempt: int, retry_after: Optional[float]) -> float:
+        delay = random.uniform(0, min(GATEWAY_RETRY_MAX_SECONDS, GATEWAY_RETRY_BASE_SECONDS * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, GATEWAY_RETRY_MAX_SECONDS))
+        return delay
+
+    def _begin_request(self, purpose: str):
+        self._stats["requests"] += 1
+        self._purposes[purpose] = self._purposes.get(purpose, 0) + 1
+
+    def _check_breaker(self):
+        if not self.breaker.allow_request():
+            self._stats["rejected_open"] += 1
+            raise GatewayUnavailable(f"DeepSeek 熔断中，约 {self.breaker.retry_in_seconds():.0f}s 后重试")
+
+    @contextlib.asynccontextmanager
+    async def _attempt_slot(self, guild_id: Optional[int], purpose: str):
+        guild_slot = await self._acquire_slots(guild_id, purpose)
+        self._in_flight += 1
+        self._purpose_in_flight[purpose] = self._purpose_in_flight.get(purpose, 0) + 1
+        self._stats["attempts"] += 1
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+            self._purpose_in_flight[purpose] -= 1
+            self._release_slots(guild_id, guild_slot, purpose)
+
+    async def _retry_after_failure(self, purpose: str, attempt: int, reason: str, retry_after: Optional[float] = None) -> bool:
+        """一次尝试失败 (已计入熔断) 后决定是否重试；需要重试时先等待退避时间并返回 True。"""
+        if attempt < self.max_retries and self.breaker.state != BREAKER_OPEN:
+            self._stats["retries"] += 1
+            delay = self._backoff_seconds(attempt + 1, retry_after)
+            log.warning("DeepSeek %s 请求失败 (%s)，%.2fs 后第 %s 次重试。", purpose, reason, delay, attempt + 1)
+            await asyncio.sleep(delay)
+            return True
+        self._stats["failed"] += 1
+        return False
+
+    async def post(self, session: "aiohttp.ClientSession", payload: Dict[str, Any], timeout: Union[float, "aiohttp.ClientTimeout"],
+                   purpose: str, guild_id: Optional[int] = None) -> GatewayResponse:
+        """发送一个 chat/completions 请求并返回 (状态码, 响应文本)。
+
+        429 / 5xx 在重试用尽后照常返回给调用方；超时与网络错误照常抛出 (asyncio.TimeoutError / aiohttp.ClientError)。
+        熔断中或排队已满时抛出 GatewayUnavailable。
+        """
+        self._begin_request(purpose)
+        attempt = 0
+        while True:
+            self._check_breaker()
+            outcome_recorded = False
+            retry_after = None
+            try:
+                async with self._attempt_slot(guild_id, purpose):
+                    response, retry_after = await self._send(session, payload, timeout)
+            except asyncio.TimeoutError:
+                self.breaker.record_failure()
+                outcome_recorded = True
+                self._stats["failed"] += 1
+                raise
+            except Exception as e:
+                if _is_network_error(e):
+                    self.breaker.record_failure()
+                    outcome_recorded = True
+                    if await self._retry_after_failure(purpose, attempt, str(e)):
+                        attempt += 1
+                        continue
+                raise
+            finally:
+                if not outcome_recorded and self.breaker.state == BREAKER_HALF_OPEN:
+                    self.breaker.release_probe()
+
+            if response.status == 429 or response.status >= 500:
+                self.breaker.record_failure()
+                if await self._retry_after_failure(purpose, attempt, f"HTTP {response.status}", retry_after):
+                    attempt += 1
+                    continue
+                return response
+            # 其它 4xx 是请求本身的问题，说明 API 可达，不计入熔断
+            self.breaker.record_success()
+            self._stats["succeeded"] += 1
+            return response
+
+    async def stream(self, session: "aiohttp.ClientSession", payload: Dict[str, Any], timeout: Union[float, "aiohttp.ClientTimeout"],
+                     purpose: str, guild_id: Optional[int] = None) -> AsyncIterator[str]:
+        """流式请求 (payload 需包含 "stream": True)：逐个产出 SSE "data:" 行的内容，收到 [DONE] 时结束。
+
+        只在收到响应头之前重试 (已经产出的内容无法撤回)；重试用尽后的非 200 状态抛出 GatewayStatusError。
+        名额在整个流期间保持占用，调用方应使用 contextlib.aclosing() 确保提前退出时释放。
+        """
+        self._begin_request(purpose)
+        attempt = 0
+        while True:
+            self._check_breaker()
+            outcome_recorded = False
+            status_error = None
+            retry_after = None
+            try:
+                async with self._attempt_slot(guild_id, purpose):
+                    async with session.post(self.api_url, headers=self._headers(), json=payload,
+                                            timeout=_as_client_timeout(timeout)) as response:
+                        if response.status != 200:
+                            status_error = GatewayStatusError(response.status, await response.text())
+                            retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+                        else:
+                            self.breaker.record_success() # 响应头已到达：API 可达
+                            outcome_recorded = True
+                            async for data in _iter_sse_data(response.content):
+                                yield data
+                            self._stats["succeeded"] += 1
+                            return
+            except asyncio.TimeoutError:
+                if not outcome_recorded:
+                    self.breaker.record_failure()
+                    outcome_recorded = True
+                self._stats["failed"] += 1
+                raise
+            except Exception as e:
+                if _is_network_error(e):
+                    if outcome_recorded: # 流中途断开
+                        self._stats["failed"] += 1
+                        raise
+                    self.breaker.record_failure()
+                    outcome_recorded = True
+                    if await self._retry_after_failure(purpose, attempt, str(e)):
+                        attempt += 1
+                        continue
+                raise
+            finally:
+                if not outcome_recorded and self.breaker.state == BREAKER_HALF_OPEN:
+                    self.breaker.release_probe()
+
+            if status_error.status == 429 or status_error.status >= 500:
+                self.breaker.record_failure()
+                if await self._retry_after_failure(purpose, attempt, f"HTTP {status_error.status}", retry_after):
+                    attempt += 1
+                    continue
+                raise status_error
+            self.breaker.record_success()
+            self._stats["failed"] += 1
+            raise status_error
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = dict(self._stats)
+        stats.update({
+            "state": self.breaker.state,
+            "consecutive_failures": self.breaker.consecutive_failures,
+            "times_opened": self.breaker.times_opened,
+            "retry_in_seconds": self.breaker.retry_in_seconds(),
+            "waiting": self._waiting,
+            "in_flight": self._in_flight,
+            "global_concurrency": self.global_concurrency,
+            "active_guilds": len(self._guild_slots),
+            "tokens": self.bucket.tokens,
+            "throttled": self.bucket.throttled,
+            "purposes": dict(self._purposes),
+            "purpose_slots": {
+                purpose: {"in_flight": self._purpose_in_flight.get(purpose, 0), "waiting": self._purpose_waiting.get(purpose, 0),
+                          "limit": self.purpose_concurrency.get(purpose, self.global_concurrency)}
+                for purpose in sorted(set(self.purpose_concurrency) | set(self._purposes))
+            },
+        })
+        return stats
+
+
+def _as_client_timeout(timeout: Union[float, "aiohttp.ClientTimeout"]) -> "aiohttp.ClientTimeout":
+    # 调用方可以传秒数，也可以传 http_client.get_timeout(用途) 得到的完整超时设置
+    return timeout if isinstance(timeout, aiohttp.ClientTimeout) else aiohttp.ClientTimeout(total=timeout)
+
+
+def _is_network_error(error: BaseException) -> bool:
+    return AIOHTTP_AVAILABLE and isinstance(error, aiohttp.ClientError)
+
+
+async def _iter_sse_data(stream: "aiohttp.StreamReader") -> AsyncIterator[str]:
+    # 只关心 "data:" 行；": keep-alive" 之类的注释行与空行忽略
+    async for raw_line in stream:
+        line = raw_line.decode("utf-8", errors="replace").strip()
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return
+        yield data
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None # HTTP 日期格式的 Retry-After 不常见，按普通退避处理
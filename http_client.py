@@ -0,0 +1,109 @@
+# http_client.py
+# 共享的出站 HTTP 客户端：整个机器人 (AI 对话、内容审核、公告图片检查……) 共用一个 aiohttp.ClientSession。
+#
+# - 一个连接池：keep-alive 连接与 DNS 缓存在所有调用之间复用，不再为每条消息创建会话并重新握手 TCP + TLS。
+# - 按用途的超时：get_timeout("dialogue") 等，见 HTTP_TIMEOUTS；未知用途使用 "default"。
+# - 生命周期：会话在第一次 get_session() 时创建 (必须在事件循环中)，关闭机器人时调用 close()。
+#   关闭后再次 get_session() 会创建新会话 (例如重启 asyncio.run)。
+# - get_stats() 统计新建 / 复用的连接数与请求数 (基于 aiohttp.TraceConfig)。
+#
+#     session = http_client.get_session()
+#     async with session.get(url, timeout=http_client.get_timeout("image_check")) as response: ...
+
+import asyncio
+from typing import Any, Dict, Optional
+
+from bot_logging import get_logger
+
+try:
+    import aiohttp
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    AIOHTTP_AVAILABLE = False
+
+log = get_logger("http")
+
+# --- 连接池参数 ---
+HTTP_POOL_LIMIT = 100                # 所有主机合计的并发连接上限
+HTTP_POOL_LIMIT_PER_HOST = 20        # 单个主机 (如 DeepSeek API) 的并发连接上限
+HTTP_DNS_CACHE_TTL_SECONDS = 300     # DNS 解析结果缓存时间
+HTTP_KEEPALIVE_TIMEOUT_SECONDS = 60  # 空闲 keep-alive 连接的保留时间
+HTTP_CLOSE_GRACE_SECONDS = 0.25      # 关闭会话后等待 SSL 连接完成关闭的时间
+
+# --- 按用途的超时 (秒)：total 总时长，connect 建立连接 (含排队等待连接池)，sock_read 两次收到数据的最大间隔 ---
+HTTP_TIMEOUTS: Dict[str, Dict[str, float]] = {
+    "default": {"total": 30, "connect": 10},
+    "moderation": {"total": 8, "connect": 3},
+    "dialogue": {"total": 300, "connect": 10, "sock_read": 90}, # 推理模型可能很慢；流式回复 90 秒没有数据视为中断
+    "image_check": {"total": 5, "connect": 3},
+}
+
+
+class SharedHttpClient:
+    """懒创建的共享 aiohttp 会话，带连接池、按用途的超时与连接复用统计。"""
+
+    def __init__(self, pool_limit: int = HTTP_POOL_LIMIT, pool_limit_per_host: int = HTTP_POOL_LIMIT_PER_HOST,
+                 timeouts: Optional[Dict[str, Dict[str, float]]] = None):
+        self.pool_limit = pool_limit
+        self.pool_limit_per_host = pool_limit_per_host
+        self.timeouts = timeouts or HTTP_TIMEOUTS
+        self._session: Optional["aiohttp.ClientSession"] = None
+        self._stats: Dict[str, int] = {"sessions_created": 0, "requests": 0, "request_errors": 0,
+                                       "connections_created": 0, "connections_reused": 0}
+
+    def _count(self, key: str):
+        async def _on_trace_event(session, trace_context, params):
+            self._stats[key] += 1
+        return _on_trace_event
+
+    def _create_session(self) -> "aiohttp.ClientSession":
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_limit,
+            limit_per_host=self.pool_limit_per_host,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL_SECONDS,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT_SECONDS,
+        )
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._count("requests"))
+        trace_config.on_request_exception.append(self._count("request_errors"))
+        trace_config.on_connection_create_end.append(self._count("connections_created"))
+        trace_config.on_connection_reuseconn.append(self._count("connections_reused"))
+        self._stats["sessions_created"] += 1
+        log.info("已创建共享 aiohttp 会话 (连接上限 %s，单主机 %s)。", self.pool_limit, self.pool_limit_per_host)
+        return aiohttp.ClientSession(connector=connector, timeout=self.get_timeout("default"), trace_configs=[trace_config])
+
+    def get_session(self) -> Optional["aiohttp.ClientSession"]:
+        """返回共享会话 (必要时创建)。未安装 aiohttp 时返回 None。"""
+        if not AIOHTTP_AVAILABLE:
+            return None
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+        return self._session
+
+    def get_timeout(self, purpose: str) -> "aiohttp.ClientTimeout":
+        return aiohttp.ClientTimeout(**self.timeouts.get(purpose, self.timeouts["default"]))
+
+    async def close(self):
+        """关闭共享会话与连接池 (可重复调用)。"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            await asyncio.sleep(HTTP_CLOSE_GRACE_SECONDS) # 让 SSL 连接完成关闭握手，避免 "Unclosed connection" 警告
+            log.info("已关闭共享 aiohttp 会话。")
+        self._session = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = dict(self._stats)
+        opened = stats["connections_created"] + stats["connections_reused"]
+        stats["reuse_rate"] = stats["connections_reused"] / opened if opened else 0.0
+        stats["open"] = self._session is not None and not self._session.closed
+        stats["pool_limit"] = self.pool_limit
+        stats["pool_limit_per_host"] = self.pool_limit_per_host
+        return stats
+
+
+_default_client = SharedHttpClient()
+
+get_session = _default_client.get_session
+get_timeout = _default_client.get_timeout
+close = _default_client.close
+get_stats = _default_client.get_stats
@@ -0,0 +1,242 @@
+# kb_retrieval.py
+# 服务器知识库检索：为每个服务器的知识条目建立 BM25 倒排索引，每次提问只取最相关的几条放进提示。
+#
+# - 分词适配中文：文本先经 word_filter.normalize_text 规范化，连续的中日韩字符切成相邻二字组 (单字则保留单字)，
+#   字母数字按词切分，标点与空白丢弃。不需要额外的分词库。
+# - 索引可增量更新：add / remove(位置) / clear 只调整受影响条目的倒排表与文档频率，不重建整个索引。
+# - KnowledgeRetriever 按服务器懒建索引；若索引条数与传入的知识库对不上 (例如在别处修改了列表)，会自动重建。
+#
+# 基准: python kb_retrieval.py bench  (合成知识库上的召回率与提示 token 减少量)
+
+import math
+import re
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from word_filter import normalize_text
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+KB_RETRIEVAL_TOP_K = 5               # 每次最多选取的条目数
+KB_RETRIEVAL_MIN_SCORE_RATIO = 0.2   # 得分低于最高分该比例的条目视为不相关
+
+_TOKEN_PATTERN = re.compile(r"[　-〿぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]+|[0-9a-z_]+")
+_CJK_RUN_PATTERN = re.compile(r"[　-〿぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]")
+
+
+def tokenize(text: str) -> List[str]:
+    """切分为检索词：中文按相邻二字组，字母数字按词。"""
+    tokens: List[str] = []
+    for run in _TOKEN_PATTERN.findall(normalize_text(text)):
+        if _CJK_RUN_PATTERN.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+class BM25Index:
+    """可增量更新的 BM25 倒排索引。条目按位置 (与知识库列表下标一致) 访问。"""
+
+    def __init__(self, documents: Sequence[str] = (), k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self._order: List[int] = []                    # 位置 -> 条目 id
+        self._lengths: Dict[int, int] = {}             # 条目 id -> 词数
+        self._terms: Dict[int, Counter] = {}           # 条目 id -> 词频
+        self._postings: Dict[str, Dict[int, int]] = {} # 词 -> {条目 id: 词频}
+        self._total_length = 0
+        self._next_id = 0
+        self._positions: Optional[Dict[int, int]] = None # 条目 id -> 位置 (查询时按需计算)
+        for document in documents:
+            self.add(document)
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def add(self, document: str):
+        """在末尾追加一个条目。"""
+        doc_id = self._next_id
+        self._next_id += 1
+        terms = Counter(tokenize(document))
+        self._order.append(doc_id)
+        self._terms[doc_id] = terms
+        self._lengths[doc_id] = sum(terms.values())
+        self._total_length += self._lengths[doc_id]
+        for term, frequency in terms.items():
+            self._postings.setdefault(term, {})[doc_id] = frequency
+        self._positions = None
+
+    def remove(self, position: int):
+        """移除指定位置 (从 0 开始) 的条目，后面的条目位置前移。"""
+        doc_id = self._order.pop(position)
+        for term in self._terms.pop(doc_id):
+            postings = self._postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self._postings[term]
+        self._total_length -= self._lengths.pop(doc_id)
+        self._positions = None
+
+    def clear(self):
+        self.__init__(k1=self.k1, b=self.b)
+
+    def search(self, query: str, top_k: int = KB_RETRIEVAL_TOP_K) -> List[Tuple[int, float]]:
+        """返回得分最高的 top_k 个 (位置, 得分)，只包含与查询有共同词的条目。"""
+        if not self._order:
+            return []
+        count = len(self._order)
+        average_length = self._total_length / count or 1.0
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, frequency in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[doc_id] / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+        if self._positions is None:
+            self._positions = {doc_id: position for position, doc_id in enumerate(self._order)}
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], self._positions[item[0]]))[:top_k]
+        return [(self._positions[doc_id], score) for doc_id, score in ranked]
+
+
+class KnowledgeRetriever:
+    """各服务器知识库的检索索引 (懒建，随 /ai kb_* 命令增量更新)。"""
+
+    def __init__(self, top_k: int = KB_RETRIEVAL_TOP_K, min_score_ratio: float = KB_RETRIEVAL_MIN_SCORE_RATIO):
+        self.top_k = top_k
+        self.min_score_ratio = min_score_ratio
+        self._indexes: Dict[int, BM25Index] = {}
+        self._stats: Dict[str, float] = {"builds": 0, "queries": 0, "selected": 0, "query_seconds": 0.0}
+
+    def _index_for(self, guild_id: int, entries: Sequence[str]) -> BM25Index:
+        index = self._indexes.get(guild_id)
+        if index is None or len(index) != len(entries):
+            index = self._indexes[guild_id] = BM25Index(entries)
+            self._stats["builds"] += 1
+        return index
+
+    def entry_added(self, guild_id: int, entry: str):
+        index = self._indexes.get(guild_id)
+        if index is not None:
+            index.add(entry)
+
+    def entry_removed(self, guild_id: int, position: int):
+        index = self._indexes.get(guild_id)
+        if index is not None and 0 <= position < len(index):
+            index.remove(position)
+
+    def forget(self, guild_id: int):
+        """丢弃某服务器的索引 (清空知识库或内容整体变化时)，下次查询时重建。"""
+        self._indexes.pop(guild_id, None)
+
+    def select(self, guild_id: int, entries: Sequence[str], query: str) -> List[int]:
+        """返回与问题最相关的条目位置 (按得分从高到低)。"""
+        started = time.perf_counter()
+        results = self._index_for(guild_id, entries).search(query, self.top_k)
+        if results:
+            threshold = results[0][1] * self.min_score_ratio
+            results = [(position, score) for position, score in results if score >= threshold]
+        self._stats["queries"] += 1
+        self._stats["selected"] += len(results)
+        self._stats["query_seconds"] += time.perf_counter() - started
+        return [position for position, _ in results]
+
+    def get_stats(self) -> Dict[str, float]:
+        stats = dict(self._stats)
+        queries = stats["queries"]
+        stats["indexed_guilds"] = len(self._indexes)
+        stats["avg_selected"] = stats["selected"] / queries if queries else 0.0
+        stats["avg_query_ms"] = stats["query_seconds"] / queries * 1000 if queries else 0.0
+        return stats
+
+
+# =========================================
+# == 离线基准 (python kb_retrieval.py bench)
+# =========================================
+_BENCH_TOPICS = [
+    ("每日签到", "签到可以获得积分，每天零点重置，连续签到七天额外奖励"),
+    ("禁言规则", "刷屏、人身攻击会被禁言，首次十分钟，再次违规一天"),
+    ("举报流程", "发现违规内容请在举报频道提交截图和消息链接，管理员会在24小时内处理"),
+    ("音乐机器人", "在语音频道使用 /play 点歌，/skip 跳过，队列最多五十首"),
+    ("抽奖活动", "每周五晚上八点开奖，需要等级达到五级才能参与"),
+    ("等级系统", "发言获得经验，每分钟最多计算一次，升级后自动发放身份组"),
+    ("身份组申请", "在身份组频道点击按钮领取游戏身份组，管理身份组需要面试"),
+    ("工单系统", "遇到问题请在客服频道点击创建工单，工单会在关闭后归档"),
+    ("合作申请", "服务器合作请联系运营组，需要对方成员超过五百人"),
+    ("广告规定", "禁止在公共频道发布任何服务器邀请链接和广告，违者直接踢出"),
+    ("语音频道", "语音频道内禁止播放噪音和使用变声器，挂机超过一小时会被移出"),
+    ("昵称规范", "昵称不得包含辱骂内容或冒充管理员，否则会被强制修改"),
+    ("新人验证", "新成员需要在验证频道回答问题后才能看到全部频道"),
+    ("积分商店", "积分可以在商店兑换自定义颜色和专属头衔，每月刷新商品"),
+    ("管理员招募", "管理员招募每季度一次，要求加入服务器满三个月并且无违规记录"),
+    ("私信骚扰", "未经同意私信推广或骚扰其他成员将被永久封禁"),
+    ("赞助福利", "赞助者可获得专属频道访问权限和双倍经验加成"),
+    ("活动日历", "所有官方活动时间都公布在公告频道，时间均为北京时间"),
+    ("表情投稿", "可以在表情投稿频道提交自制表情，票数最高的会被加入服务器"),
+    ("机器人命令", "机器人命令只能在指令频道使用，输入 /help 查看全部命令"),
+]
+_BENCH_QUESTIONS = [
+    (0, "签到有什么奖励"), (1, "被禁言了多久能解除"), (2, "怎么举报违规的人"), (3, "音乐机器人怎么点歌"),
+    (4, "抽奖什么时候开奖"), (5, "等级怎么升得快"), (6, "怎么领取游戏身份组"), (7, "怎么开工单联系客服"),
+    (8, "我们服务器想和你们合作"), (9, "可以发邀请链接吗"), (10, "语音里能用变声器吗"), (11, "昵称有什么要求"),
+    (12, "新人验证要回答什么"), (13, "积分能兑换什么"), (14, "怎么申请当管理员"), (15, "有人私信骚扰我怎么办"),
+    (16, "赞助有什么福利"), (17, "活动时间在哪里看"), (18, "怎么投稿表情"), (19, "机器人命令在哪用"),
+]
+
+
+def run_retrieval_benchmark(filler_entries: int = 30, rounds: int = 200) -> Dict[str, float]:
+    """合成知识库 (20 条主题 + filler_entries 条干扰条目) 上比较全量注入与检索选取。"""
+    import random
+    from ai_context import estimate_tokens, render_knowledge_block
+
+    rng = random.Random(20240501)
+    vocabulary = "".join(description for _, description in _BENCH_TOPICS)
+    entries = [f"关于{topic}：{description}。" for topic, description in _BENCH_TOPICS]
+    for i in range(filler_entries):
+        start = rng.randrange(len(vocabulary) - 120)
+        entries.append(f"补充说明 {i}：" + vocabulary[start:start + rng.randint(60, 120)])
+    rng.shuffle(entries)
+    topic_positions = {topic_index: next(i for i, entry in enumerate(entries) if entry.startswith(f"关于{topic}："))
+                       for topic_index, (topic, _) in enumerate(_BENCH_TOPICS)}
+
+    full_tokens = estimate_tokens(render_knowledge_block(entries, 10 ** 9)[0])
+    retriever = KnowledgeRetriever()
+    hits = 0
+    selected_tokens = 0
+    for topic_index, question in _BENCH_QUESTIONS:
+        positions = retriever.select(1, entries, question)
+        hits += topic_positions[topic_index] in positions
+        selected_tokens += estimate_tokens(render_knowledge_block([entries[p] for p in positions], 10 ** 9)[0])
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for _, question in _BENCH_QUESTIONS:
+            retriever.select(1, entries, question)
+    query_us = (time.perf_counter() - started) / (rounds * len(_BENCH_QUESTIONS)) * 1e6
+    started = time.perf_counter()
+    for _ in range(rounds):
+        BM25Index(entries)
+    build_us = (time.perf_counter() - started) / rounds * 1e6
+
+    return {"entries": len(entries), "recall": hits / len(_BENCH_QUESTIONS), "full_tokens": full_tokens,
+            "avg_selected_tokens": selected_tokens / len(_BENCH_QUESTIONS),
+            "token_reduction": 1 - selected_tokens / len(_BENCH_QUESTIONS) / full_tokens,
+            "query_us": query_us, "build_us": build_us}
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        bench_fillers = tuple(int(arg) for arg in sys.argv[2:]) or (30, 200)
+        for bench_filler in bench_fillers:
+            bench_values = run_retrieval_benchmark(bench_filler)
+            print(f"{bench_filler:>5} 条干扰: " + ", ".join(f"{key}={value:,.2f}" for key, value in bench_values.items()))
+    else:
+        print("用法: python kb_retrieval.py bench [干扰条目数 ...]")
@@ -0,0 +1,175 @@
+# knowledge_base.py
+# 服务器 AI 知识库服务：SQLite 是唯一数据来源，内存中只保留按服务器懒加载的缓存。
+#
+# - get_snapshot(guild_id) 第一次访问某服务器时从数据库读取 (经 async_database)，之后直接返回缓存；
+#   启动时不预先加载任何服务器。快照不可变 (entries 为 tuple)，并带有版本号，内容每变化一次版本号递增。
+# - add_entry / remove_entry / clear 先写数据库，成功后再更新缓存，并通知变更监听器 (add_change_listener)，
+#   例如让渲染好的提示块与检索索引只在内容变化时重建。同一服务器的修改串行执行。
+# - 条目在数据库中有固定 ID (快照的 entry_ids 与 entries 一一对应)，位置 (从 0 开始) 只是显示顺序；
+#   删除、插入到指定位置、移动都只写一行。
+#
+#     snapshot = await knowledge_base.get_snapshot(guild.id)
+#     ok, message = await knowledge_base.add_entry(guild.id, text, MAX_KB_ENTRIES_PER_GUILD)
+
+import asyncio
+import itertools
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import async_database
+from bot_logging import get_logger
+
+log = get_logger("ai.kb")
+
+KB_CHANGE_ADDED = "added"     # detail: 新条目文本 (追加在末尾)
+KB_CHANGE_REMOVED = "removed" # detail: 被移除条目的位置 (从 0 开始)
+KB_CHANGE_CLEARED = "cleared" # detail: None
+KB_CHANGE_REORDERED = "reordered" # detail: None；插入到中间或移动了条目
+KB_CHANGE_RELOADED = "reloaded" # detail: None；缓存已丢弃 (写入失败后)，下次访问时从数据库重新加载
+
+ChangeListener = Callable[[int, str, object], None] # (guild_id, 变更类型, detail)
+
+
+class KnowledgeSnapshot(NamedTuple):
+    entries: Tuple[str, ...]
+    version: int
+    entry_ids: Tuple[int, ...] = ()
+
+
+class KnowledgeBaseService:
+    """以 SQLite 为准的知识库，带按服务器懒加载的缓存、版本号与变更通知。"""
+
+    def __init__(self):
+        self._cache: Dict[int, KnowledgeSnapshot] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._listeners: List[ChangeListener] = []
+        self._versions = itertools.count(1) # 全局递增，服务器缓存被丢弃后重新加载也不会复用旧版本号
+        self._stats: Dict[str, int] = {"hits": 0, "loads": 0, "writes": 0, "write_failures": 0}
+
+    def add_change_listener(self, listener: ChangeListener):
+        self._listeners.append(listener)
+
+    def _lock_for(self, guild_id: int) -> asyncio.Lock:
+        lock = self._locks.get(guild_id)
+        if lock is None:
+            lock = self._locks[guild_id] = asyncio.Lock()
+        return lock
+
+    async def _load(self, guild_id: int) -> KnowledgeSnapshot:
+        """调用方需持有该服务器的锁。"""
+        snapshot = self._cache.get(guild_id)
+        if snapshot is None:
+            rows = await async_database.db_get_knowledge_base_entries(guild_id)
+            entries = tuple(row.entry_text for row in rows)
+            snapshot = self._cache[guild_id] = KnowledgeSnapshot(entries, next(self._versions), tuple(row.entry_id for row in rows))
+            self._stats["loads"] += 1
+            log.debug("已加载服务器 %s 的知识库 (%s 条)。", guild_id, len(entries))
+        return snapshot
+
+    async def get_snapshot(self, guild_id: int) -> KnowledgeSnapshot:
+        snapshot = self._cache.get(guild_id)
+        if snapshot is not None:
+            self._stats["hits"] += 1
+            return snapshot
+        async with self._lock_for(guild_id): # 同一服务器的并发首次访问只读一次数据库
+            return await self._load(guild_id)
+
+    async def get_entries(self, guild_id: int) -> Tuple[str, ...]:
+        return (await self.get_snapshot(guild_id)).entries
+
+    def _notify(self, guild_id: int, change: str, detail: object):
+        for listener in self._listeners:
+            try:
+                listener(guild_id, change, detail)
+            except Exception:
+                log.exception("知识库变更监听器出错 (guild: %s, change: %s)。", guild_id, change)
+
+    def _commit(self, guild_id: int, entries: Tuple[str, ...], entry_ids: Tuple[int, ...], change: str, detail: object):
+        self._cache[guild_id] = KnowledgeSnapshot(entries, next(self._versions), entry_ids)
+        self._stats["writes"] += 1
+        self._notify(guild_id, change, detail)
+
+    def _discard(self, guild_id: int):
+        """写入失败后数据库与缓存可能不一致：丢弃缓存，下次访问时重新加载。"""
+        self._stats["write_failures"] += 1
+        self._cache.pop(guild_id, None)
+        self._notify(guild_id, KB_CHANGE_RELOADED, None)
+
+    async def add_entry(self, guild_id: int, entry_text: str, max_entries: int, position: Optional[int] = None) -> Tuple[bool, str]:
+        """插入到 position (从 0 开始；None 或超出末尾时追加)。返回 (是否成功, 说明)。"""
+        async with self._lock_for(guild_id):
+            snapshot = await self._load(guild_id)
+            if len(snapshot.entries) >= max_entries:
+                return False, "知识库已满。"
+            if position is None or position >= len(snapshot.entries):
+                position = len(snapshot.entries)
+            entry_id, message = await async_database.db_insert_knowledge_base_entry(guild_id, entry_text, max_entries, position)
+            if entry_id is None:
+                self._stats["write_failures"] += 1
+                return False, message
+            entries, entry_ids = snapshot.entries, snapshot.entry_ids
+            appended = position == len(entries)
+            self._commit(guild_id, entries[:position] + (entry_text,) + entries[position:],
+                         entry_ids[:position] + (entry_id,) + entry_ids[position:],
+                         KB_CHANGE_ADDED if appended else KB_CHANGE_REORDERED, entry_text if appended else None)
+            return True, message
+
+    async def move_entry(self, guild_id: int, position: int, new_position: int) -> bool:
+        """把第 position 条移到 new_position (都从 0 开始，new_position 按移动后的顺序计)。"""
+        async with self._lock_for(guild_id):
+            snapshot = await self._load(guild_id)
+            if not (0 <= position < len(snapshot.entries) and 0 <= new_position < len(snapshot.entries)):
+                return False
+            if position == new_position:
+                return True
+            if not await async_database.db_move_knowledge_base_entry(guild_id, snapshot.entry_ids[position], new_position):
+                self._discard(guild_id)
+                return False
+            entries, entry_ids = list(snapshot.entries), list(snapshot.entry_ids)
+            entries.insert(new_position, entries.pop(position))
+            entry_ids.insert(new_position, entry_ids.pop(position))
+            self._commit(guild_id, tuple(entries), tuple(entry_ids), KB_CHANGE_REORDERED, None)
+            return True
+
+    async def remove_entry(self, guild_id: int, position: int) -> Optional[str]:
+        """移除第 position 条 (从 0 开始)，返回被移除的文本；位置无效或写入失败时返回 None。"""
+        async with self._lock_for(guild_id):
+            snapshot = await self._load(guild_id)
+            if not 0 <= position < len(snapshot.entries):
+                return None
+            if not await async_database.db_remove_knowledge_base_entry(guild_id, snapshot.entry_ids[position]):
+                self._discard(guild_id)
+                return None
+            entries, entry_ids = snapshot.entries, snapshot.entry_ids
+            self._commit(guild_id, entries[:position] + entries[position + 1:], entry_ids[:position] + entry_ids[position + 1:],
+                         KB_CHANGE_REMOVED, position)
+            return entries[position]
+
+    async def clear(self, guild_id: int) -> Optional[int]:
+        """清空某服务器的知识库，返回清除的条数；写入失败时返回 None。"""
+        async with self._lock_for(guild_id):
+            snapshot = await self._load(guild_id)
+            if not snapshot.entries:
+                return 0
+            if not await async_database.db_clear_knowledge_base(guild_id):
+                self._discard(guild_id)
+                return None
+            self._commit(guild_id, (), (), KB_CHANGE_CLEARED, None)
+            return len(snapshot.entries)
+
+    def get_stats(self) -> Dict[str, int]:
+        stats = dict(self._stats)
+        stats["cached_guilds"] = len(self._cache)
+        stats["cached_entries"] = sum(len(snapshot.entries) for snapshot in self._cache.values())
+        return stats
+
+
+_default_service = KnowledgeBaseService()
+
+add_change_listener = _default_service.add_change_listener
+get_snapshot = _default_service.get_snapshot
+get_entries = _default_service.get_entries
+add_entry = _default_service.add_entry
+move_entry = _default_service.move_entry
+remove_entry = _default_service.remove_entry
+clear = _default_service.clear
+get_stats = _default_service.get_stats
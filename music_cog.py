@@ -9,6 +9,10 @@ import re
 from typing import Optional, List, Dict, Any, Union # Added more specific types
 import os # For checking cookie file existence
 
+from bot_logging import get_logger
+
+log = get_logger("music")
+
 # Suppress noise about console usage from errors
 # Updated lambda to accept arbitrary arguments
 yt_dlp.utils.bug_reports_message = lambda *args, **kwargs: ''
@@ -49,10 +53,10 @@ YTDL_FORMAT_OPTIONS = {
 
 # Check if cookie file exists and print a message
 if YTDL_FORMAT_OPTIONS['cookiefile']:
-    print(f"ℹ️ [MusicCog] Using cookies from: {COOKIE_FILE_PATH}")
+    log.info("ℹ️ [MusicCog] Using cookies from: %s", COOKIE_FILE_PATH)
 else:
-    print(f"⚠️ [MusicCog] Cookie file '{COOKIE_FILE_PATH}' not found. YouTube downloads may be restricted.")
-    print(f"   Please see instructions in music_cog.py for setting up YouTube cookies.")
+    log.warning("⚠️ [MusicCog] Cookie file '%s' not found. YouTube downloads may be restricted.", COOKIE_FILE_PATH)
+    log.warning("Please see instructions in music_cog.py for setting up YouTube cookies.")
 
 
 FFMPEG_OPTIONS = {
@@ -195,12 +199,12 @@ class YTDLSource(discord.PCMVolumeTransformer):
                 return None
             else: return None
         except yt_dlp.utils.DownloadError as e:
-            print(f"处理Spotify链接 '{url}' 时 yt-dlp 发生错误: {e}")
+            log.error("处理Spotify链接 '%s' 时 yt-dlp 发生错误: %s", url, e)
             if "This playlist is private or unavailable" in str(e): return "private_playlist"
-            print(f"Spotify解析失败 '{url}', 且未启用备用抓取。")
+            log.error("Spotify解析失败 '%s', 且未启用备用抓取。", url)
             return None
         except Exception as e:
-            print(f"处理Spotify链接 '{url}' 时发生未知错误: {e}")
+            log.error("处理Spotify链接 '%s' 时发生未知错误: %s", url, e)
             return None
         
         if search_query: return await cls.from_url(search_query, loop=loop, stream=True, search=True)
@@ -225,7 +229,7 @@ class GuildMusicState:
         if self.leave_task: self.leave_task.cancel()
         if self.voice_client and self.voice_client.is_connected():
             self.leave_task = self.bot_loop.create_task(self._auto_leave(delay))
-            print(f"[{self._get_guild_name_for_debug()}] 无人且队列为空，{delay}秒后自动离开。")
+            log.info("[%s] 无人且队列为空，%s秒后自动离开。", self._get_guild_name_for_debug(), delay)
 
     async def _auto_leave(self, delay: int):
         await asyncio.sleep(delay)
@@ -240,7 +244,7 @@ class GuildMusicState:
                 try: await self.now_playing_message.delete()
                 except: pass # Ignore errors if message already gone
                 self.now_playing_message = None
-            print(f"[{guild_name}] 自动离开语音频道。")
+            log.info("[%s] 自动离开语音频道。", guild_name)
 
             if last_text_channel_id and self.bot_loop: # Check if bot_loop is available (it's part of self)
                 bot_instance = getattr(self.bot_loop, '_bot_instance_for_music_cog', None) # Needs to be set
@@ -252,12 +256,12 @@ class GuildMusicState:
 
     def play_next_song_sync(self, error: Optional[Exception] = None):
         guild_name = self._get_guild_name_for_debug()
-        if error: print(f'[{guild_name}] 播放器错误: {error}')
+        if error: log.error("[%s] 播放器错误: %s", guild_name, error)
         if self.leave_task: self.leave_task.cancel(); self.leave_task = None
         fut = asyncio.run_coroutine_threadsafe(self.play_next_song_async(), self.bot_loop)
         try: fut.result(timeout=10)
-        except asyncio.TimeoutError: print(f"[{guild_name}] play_next_song_sync: fut.result timed out.")
-        except Exception as e: print(f'[{guild_name}] 安排下一首歌时出错: {e}')
+        except asyncio.TimeoutError: log.warning("[%s] play_next_song_sync: fut.result timed out.", guild_name)
+        except Exception as e: log.error("[%s] 安排下一首歌时出错: %s", guild_name, e)
 
     async def play_next_song_async(self, interaction_for_reply: Optional[discord.Interaction] = None):
         guild_name = self._get_guild_name_for_debug()
@@ -280,12 +284,12 @@ class GuildMusicState:
                     except: pass # Ignore errors
                     self.now_playing_message = None
                 if self.voice_client and not any(m for m in self.voice_client.channel.members if not m.bot): self._schedule_leave()
-                else: print(f"[{guild_name}] 队列播放完毕，但频道内尚有其他成员。")
+                else: log.info("[%s] 队列播放完毕，但频道内尚有其他成员。", guild_name)
                 return
             else: next_song_data_to_play = self.queue.popleft()
         
         if next_song_data_to_play is None:
-            print(f"[{guild_name}] 错误：next_song_data_to_play 为空，无法播放。")
+            log.error("[%s] 错误：next_song_data_to_play 为空，无法播放。", guild_name)
             if self.queue: await self.play_next_song_async(interaction_for_reply); return
         
         original_interaction_channel_id = self.last_interaction_channel_id # Use the stored channel ID
@@ -298,12 +302,12 @@ class GuildMusicState:
                 
                 if next_song_data_to_play.get('uploader') == "Spotify" and (not url_to_play or not url_to_play.startswith(('http://', 'https://'))):
                     if not title_for_search: raise ValueError("Spotify条目缺少标题无法搜索YouTube。")
-                    print(f"[{guild_name}] Spotify条目 '{title_for_search}' 需要二次搜索YouTube。")
+                    log.info("[%s] Spotify条目 '%s' 需要二次搜索YouTube。", guild_name, title_for_search)
                     self.current_song = await YTDLSource.from_url(f"ytsearch:{title_for_search}", loop=self.bot_loop, stream=True, search=True)
                 elif url_to_play: 
                     self.current_song = await YTDLSource.from_url(url_to_play, loop=self.bot_loop, stream=True)
                 elif title_for_search: # Fallback to search if no proper URL but title exists (e.g. from a malformed Spotify entry)
-                    print(f"[{guild_name}] 条目缺少URL但有标题'{title_for_search}', 尝试YouTube搜索。")
+                    log.info("[%s] 条目缺少URL但有标题'%s', 尝试YouTube搜索。", guild_name, title_for_search)
                     self.current_song = await YTDLSource.from_url(f"ytsearch:{title_for_search}", loop=self.bot_loop, stream=True, search=True)
                 else:
                     raise ValueError(f"队列中的歌曲数据格式无效: {next_song_data_to_play}")
@@ -314,7 +318,7 @@ class GuildMusicState:
 
             self.current_song.volume = self.volume
             self.voice_client.play(self.current_song, after=lambda e: self.play_next_song_sync(e))
-            print(f"[{guild_name}] 正在播放: {self.current_song.title}")
+            log.info("[%s] 正在播放: %s", guild_name, self.current_song.title)
 
             target_text_channel: Optional[discord.TextChannel] = None
             if interaction_for_reply and interaction_for_reply.channel: target_text_channel = interaction_for_reply.channel
@@ -337,7 +341,7 @@ class GuildMusicState:
             song_title_debug = getattr(self.current_song, 'title', None) or (next_song_data_to_play.get('title', '未知歌曲') if isinstance(next_song_data_to_play, dict) else "未知歌曲")
             error_type = "下载" if isinstance(e_play, yt_dlp.utils.DownloadError) else "值"
             error_message = f"❌ 播放时发生{error_type}错误 ({song_title_debug}): {str(e_play)[:300]}"
-            print(f"[{guild_name}] {error_message}")
+            log.error("[%s] %s", guild_name, error_message)
             
             channel_to_reply_id = (interaction_for_reply.channel.id if interaction_for_reply and interaction_for_reply.channel 
                                    else original_interaction_channel_id)
@@ -347,15 +351,14 @@ class GuildMusicState:
                     channel_to_reply_obj = bot_instance.get_channel(channel_to_reply_id)
                     if channel_to_reply_obj and isinstance(channel_to_reply_obj, discord.TextChannel):
                         try: await channel_to_reply_obj.send(error_message, delete_after=20)
-                        except Exception as send_err: print(f"[{guild_name}] 发送播放错误消息时出错: {send_err}")
+                        except Exception as send_err: log.error("[%s] 发送播放错误消息时出错: %s", guild_name, send_err)
             
             if self.queue: await self.play_next_song_async(None) # Try next song, pass None for interaction
             else: self._schedule_leave()
         except Exception as e_generic: # Catch-all for other unexpected errors
             song_title_debug = getattr(self.current_song, 'title', None) or (next_song_data_to_play.get('title', '未知歌曲') if isinstance(next_song_data_to_play, dict) else "未知歌曲")
             error_message = f"❌ 播放时发生未知错误 ({song_title_debug}): {type(e_generic).__name__} - {str(e_generic)[:200]}"
-            print(f"[{guild_name}] {error_message}")
-            import traceback; traceback.print_exc()
+            log.exception("[%s] %s", guild_name, error_message)
             channel_to_reply_id = (interaction_for_reply.channel.id if interaction_for_reply and interaction_for_reply.channel 
                                    else original_interaction_channel_id)
             if channel_to_reply_id and self.bot_loop:
@@ -364,7 +367,7 @@ class GuildMusicState:
                     channel_to_reply_obj = bot_instance.get_channel(channel_to_reply_id)
                     if channel_to_reply_obj and isinstance(channel_to_reply_obj, discord.TextChannel):
                         try: await channel_to_reply_obj.send(error_message, delete_after=20)
-                        except Exception as send_err: print(f"[{guild_name}] 发送通用播放错误消息时出错: {send_err}")
+                        except Exception as send_err: log.error("[%s] 发送通用播放错误消息时出错: %s", guild_name, send_err)
 
             if self.queue: await self.play_next_song_async(None)
             else: self._schedule_leave()
@@ -487,10 +490,10 @@ class MusicCog(commands.Cog, name="音乐播放"):
                     pass
                 except Exception as e_del_np_leave:
                     guild_name_debug = interaction.guild.name if interaction.guild else "未知服务器"
-                    print(f"[{guild_name_debug}] Leave命令删除NP消息时出错: {e_del_np_leave}")
+                    log.warning("[%s] Leave命令删除NP消息时出错: %s", guild_name_debug, e_del_np_leave)
                 state.now_playing_message = None
             await interaction.followup.send("👋 已离开语音频道并清空队列。", ephemeral=True)
-            print(f"[{guild_name_debug_leave}] 用户 {interaction.user.name} 执行 /leave。")
+            log.info("[%s] 用户 %s 执行 /leave。", guild_name_debug_leave, interaction.user.name)
         else: await interaction.followup.send(" 我当前不在任何语音频道。", ephemeral=True)
         if interaction.guild_id in MusicCog._guild_states_ref: del MusicCog._guild_states_ref[interaction.guild_id]
 
@@ -618,9 +621,7 @@ class MusicCog(commands.Cog, name="音乐播放"):
             elif not initial_feedback_sent: await interaction.followup.send(error_content, ephemeral=True) 
             return # 出错后不再继续
         except Exception as e_play_generic:
-            print(f"[{guild_name_debug_play}] /play 命令执行时发生严重错误: {type(e_play_generic).__name__} - {e_play_generic}")
-            import traceback
-            traceback.print_exc()
+            log.exception("[%s] /play 命令执行时发生严重错误: %s - %s", guild_name_debug_play, type(e_play_generic).__name__, e_play_generic)
             error_content_generic = f"❌ 处理您的请求时发生未知内部错误: {type(e_play_generic).__name__}。管理员请检查日志。"
             if pre_message: await pre_message.edit(content=error_content_generic)
             elif not initial_feedback_sent: await interaction.followup.send(error_content_generic, ephemeral=True)
@@ -668,7 +669,7 @@ class MusicCog(commands.Cog, name="音乐播放"):
                 except discord.NotFound:
                     pass 
                 except Exception as e_del_np_stop:
-                    print(f"[{guild_name_debug_stop}] stop_cmd 删除NP消息时出错: {e_del_np_stop}")
+                    log.warning("[%s] stop_cmd 删除NP消息时出错: %s", guild_name_debug_stop, e_del_np_stop)
                 finally: 
                     state.now_playing_message = None
             
@@ -676,7 +677,7 @@ class MusicCog(commands.Cog, name="音乐播放"):
             state.voice_client = None 
 
             await interaction.followup.send("⏹️ 播放已停止，队列已清空，机器人已离开频道。", ephemeral=True)
-            print(f"[{guild_name_debug_stop}] 用户 {interaction.user.name} 执行 /stop。")
+            log.info("[%s] 用户 %s 执行 /stop。", guild_name_debug_stop, interaction.user.name)
         else:
             await interaction.followup.send(" 我当前不在语音频道或没有在播放。", ephemeral=True)
         
@@ -755,11 +756,11 @@ class MusicCog(commands.Cog, name="音乐播放"):
                         except discord.NotFound:
                             pass 
                         except Exception as e_del_np_bot_disconnect:
-                            print(f"[{guild_name_listener}] on_voice_state_update (bot disconnect) 删除NP消息时出错: {e_del_np_bot_disconnect}")
+                            log.warning("[%s] on_voice_state_update (bot disconnect) 删除NP消息时出错: %s", guild_name_listener, e_del_np_bot_disconnect)
                     
                     if state.leave_task:
                         state.leave_task.cancel()
-                    print(f"机器人已从 {guild_name_listener} 的语音频道断开，音乐状态已清理。")
+                    log.info("机器人已从 %s 的语音频道断开，音乐状态已清理。", guild_name_listener)
             return 
         
         state = MusicCog._guild_states_ref.get(member.guild.id)
@@ -768,19 +769,19 @@ class MusicCog(commands.Cog, name="音乐播放"):
         if bot_vc != before.channel and bot_vc != after.channel: return 
         if before.channel == bot_vc and after.channel != bot_vc: 
             human_members_in_bot_vc = [m for m in bot_vc.members if not m.bot]
-            if not human_members_in_bot_vc: print(f"[{guild_name_listener}] 用户 {member.name} 离开后，机器人独自在频道 {bot_vc.name}。"); state._schedule_leave()
-            elif state.leave_task: state.leave_task.cancel(); state.leave_task = None; print(f"[{guild_name_listener}] 用户 {member.name} 离开，但频道内仍有其他用户，取消自动离开任务。")
+            if not human_members_in_bot_vc: log.info("[%s] 用户 %s 离开后，机器人独自在频道 %s。", guild_name_listener, member.name, bot_vc.name); state._schedule_leave()
+            elif state.leave_task: state.leave_task.cancel(); state.leave_task = None; log.info("[%s] 用户 %s 离开，但频道内仍有其他用户，取消自动离开任务。", guild_name_listener, member.name)
         elif after.channel == bot_vc and before.channel != bot_vc: 
-            if state.leave_task: state.leave_task.cancel(); state.leave_task = None; print(f"[{guild_name_listener}] 用户 {member.name} 加入，取消机器人自动离开任务。")
+            if state.leave_task: state.leave_task.cancel(); state.leave_task = None; log.info("[%s] 用户 %s 加入，取消机器人自动离开任务。", guild_name_listener, member.name)
 
 async def setup(bot: commands.Bot):
     music_cog_instance = MusicCog(bot)
     await bot.add_cog(music_cog_instance)
     if not any(cmd.name == music_cog_instance.music_group.name for cmd in bot.tree.get_commands()):
          bot.tree.add_command(music_cog_instance.music_group)
-         print("Music 指令组已显式添加到tree。")
+         log.info("Music 指令组已显式添加到tree。")
     else:
-        print("Music 指令组似乎已在tree中 (可能由Cog加载自动处理)。")
-    print("MusicCog 已加载。")
+        log.info("Music 指令组似乎已在tree中 (可能由Cog加载自动处理)。")
+    log.info("MusicCog 已加载。")
 
 # --- END OF FILE music_cog.py ---
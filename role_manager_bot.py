@@ -12,45 +12,71 @@ import asyncio
 from typing import Optional, Union, Any, Dict, List # 根据你的实际使用情况添加 List 等
 import requests # Required for DeepSeek API & Announce fallback
 import json     # Required for DeepSeek API
+import bot_logging # 统一的分级日志 (记录进入内存队列，由后台线程写出)
+
 try:
     import aiohttp # Preferred for async requests in announce
     AIOHTTP_AVAILABLE = True
 except ImportError:
     AIOHTTP_AVAILABLE = False
-    print("⚠️ 警告: 未安装 'aiohttp' 库。 /announce 中的图片URL验证将使用 'requests' (可能阻塞)。建议运行: pip install aiohttp")
 
 import io
 import html
 from collections import deque
 import sys
 import database
+import async_database # 异步数据库外观层：协程中的数据库调用都应经由此模块
+import ai_moderation # DeepSeek 内容审核请求与延迟统计
+import deepseek_gateway # DeepSeek 请求的并发上限 / 限速 / 重试 / 熔断
+import ai_streaming     # AI 对话流式输出 (SSE 增量解析与分页渲染)
+import ai_context       # AI 对话上下文组装 (按模型 token 预算裁剪历史 / 知识库块缓存)
+import contextlib
+import word_filter   # 违禁词 Aho-Corasick 匹配 (全局词表 + 服务器附加词表)
+import http_client   # 共享出站 HTTP 会话 (连接池 / 按用途超时 / 关闭)
+import knowledge_base # 服务器 AI 知识库 (SQLite 为准，按服务器懒加载缓存 + 变更通知)
+import conversation_store # AI 对话历史 (闲置过期 / LRU 内存上限 / 最近几轮持久化)
+import ai_dialogue_queue  # AI 对话回合排队 (按对话串行 / 合并连续消息 / 服务器并发上限)
 
 # 在尝试获取环境变量之前加载 .env 文件
 # 指定 .env 文件的路径
 dotenv_path = '/etc/discord-bot/gjteam.env' # 或者你可以创建一个在项目根目录的 .env 文件用于本地开发
 load_dotenv(dotenv_path=dotenv_path)
 
+# 日志级别可以在 .env 中通过 GJTEAM_LOG_LEVEL 设置，因此在加载 .env 之后再初始化
+bot_logging.setup_logging()
+log = bot_logging.get_logger("bot")
+ai_log = bot_logging.get_logger("ai")
+eco_log = bot_logging.get_logger("economy")
+mod_log = bot_logging.get_logger("moderation")
+if not AIOHTTP_AVAILABLE:
+    log.warning("⚠️ 警告: 未安装 'aiohttp' 库。 /announce 中的图片URL验证将使用 'requests' (可能阻塞)。建议运行: pip install aiohttp")
+
 # --- Configuration ---
 # !!! 重要：从环境变量加载 Bot Token !!!
 BOT_TOKEN = os.environ.get("DISCORD_BOT_TOKEN")
 if not BOT_TOKEN:
-    print("❌ 致命错误：未设置 DISCORD_BOT_TOKEN 环境变量。")
-    print("   请在你的托管环境（例如 Railway Variables）中设置此变量。")
-    exit()
+    log.error("❌ 致命错误：未设置 DISCORD_BOT_TOKEN 环境变量。")
+    log.info("请在你的托管环境（例如 Railway Variables）中设置此变量。")
+    sys.exit(1)
 
 # !!! 重要：从环境变量加载重启密码 !!!
 RESTART_PASSWORD = os.environ.get("BOT_RESTART_PASSWORD")
 if not RESTART_PASSWORD:
-    print("⚠️ 警告：未设置 BOT_RESTART_PASSWORD 环境变量。/管理 restart 指令将不可用。")
+    log.warning("⚠️ 警告：未设置 BOT_RESTART_PASSWORD 环境变量。/管理 restart 指令将不可用。")
 
 # !!! 重要：从环境变量加载 DeepSeek API Key !!!
 DEEPSEEK_API_KEY = os.environ.get("DEEPSEEK_API_KEY")
 if not DEEPSEEK_API_KEY:
-    print("⚠️ 警告：未设置 DEEPSEEK_API_KEY 环境变量。DeepSeek 内容审核功能将被禁用。")
+    log.warning("⚠️ 警告：未设置 DEEPSEEK_API_KEY 环境变量。DeepSeek 内容审核功能将被禁用。")
 
 # !!! 重要：确认 DeepSeek API 端点和模型名称 !!!
 DEEPSEEK_API_URL = "https://api.deepseek.com/chat/completions" # <--- 确认 DeepSeek API URL!
 DEEPSEEK_MODEL = "deepseek-chat" # <--- 替换为你希望使用的 DeepSeek 模型!
+# AI 内容审核攒批：几百毫秒内到达的消息合并为一次 DeepSeek 请求 (见 ai_moderation.ModerationBatcher)
+MODERATION_BATCH_MAX_SIZE = 10           # 每批最多消息数，设为 1 则逐条请求
+MODERATION_BATCH_MAX_WAIT_SECONDS = 0.3  # 每批最长等待时间 (也是单条消息额外增加的最大审核延迟)
+# 审核与 AI 对话共用一个网关：熔断时审核放行消息，对话立即提示用户稍后再试 (参数见 deepseek_gateway.py)
+deepseek_api_gateway = deepseek_gateway.DeepSeekGateway(DEEPSEEK_API_URL, DEEPSEEK_API_KEY)
 
 COMMAND_PREFIX = "!" # 旧版前缀（现在主要使用斜线指令）
 
@@ -59,9 +85,7 @@ COMMAND_PREFIX = "!" # 旧版前缀（现在主要使用斜线指令）
 # 结构: {channel_id: {"model": "model_id_str", "system_prompt": "optional_system_prompt_str", "history_key": "unique_history_key_for_channel"}}
 ai_dep_channels_config = {} 
 
-# 用于存储所有类型的对话历史 (包括公共 AI 频道、私聊等)
-# 结构: {history_key: deque_object}
-conversation_histories = {} # 注意：这个变量名可能与你之前代码中的不同，确保一致性
+# 所有类型的对话历史 (包括公共 AI 频道、私聊等)，按 history_key 保存；ai_conversations 在 AI 对话配置区创建
 
 # 定义可用于 AI 对话的模型
 AVAILABLE_AI_DIALOGUE_MODELS = {
@@ -71,6 +95,25 @@ AVAILABLE_AI_DIALOGUE_MODELS = {
 }
 DEFAULT_AI_DIALOGUE_MODEL = "deepseek-chat" 
 MAX_AI_HISTORY_TURNS = 10 # AI 对话功能的最大历史轮数 (每轮包含用户和AI的发言)
+# 对话历史：闲置过期与内存上限见 conversation_store.CONVERSATION_*，最近几轮会写入数据库，重启后仍可接续
+ai_conversations = conversation_store.ConversationStore(max_messages=MAX_AI_HISTORY_TURNS * 2)
+AI_DIALOGUE_STREAMING = True      # 流式输出：边生成边编辑消息 (False 则等待完整回复后一次发送)
+# 流式回复的首字延迟 (从发出请求到第一页消息发出)，/管理 性能统计 中查看
+ai_dialogue_first_output_latency = ai_moderation.LatencyHistogram(
+    "ai_dialogue_first_output", (250, 500, 1000, 2000, 5000, 10000, 30000, 60000))
+# 上下文组装：每个模型的提示 token 预算见 ai_context.CONTEXT_TOKEN_BUDGETS；超出时先丢最旧的轮次并生成摘要
+dialogue_context_builder = ai_context.DialogueContextBuilder()
+
+def on_knowledge_base_changed(guild_id: int, change: str, detail):
+    """知识库变化时增量更新检索索引，并丢弃该服务器渲染好的知识库块。"""
+    if change == knowledge_base.KB_CHANGE_ADDED:
+        dialogue_context_builder.knowledge_added(guild_id, detail)
+    elif change == knowledge_base.KB_CHANGE_REMOVED:
+        dialogue_context_builder.knowledge_removed(guild_id, detail)
+    else:
+        dialogue_context_builder.invalidate_knowledge(guild_id)
+
+knowledge_base.add_change_listener(on_knowledge_base_changed)
 
 # 用于追踪用户创建的私聊AI频道
 # 结构: {channel_id: {"user_id": user_id, "model": "model_id", "history_key": "unique_key", "guild_id": guild_id, "channel_id": channel_id}}
@@ -78,14 +121,13 @@ active_private_ai_chats = {}
 # --- AI 对话功能配置与存储结束 ---
 
 # --- 新增：服务器专属AI知识库 ---
-# 结构: {guild_id: List[str]}
-guild_knowledge_bases = {}
+# 内容保存在数据库中，经 knowledge_base 模块读写 (按服务器懒加载缓存)
 MAX_KB_ENTRIES_PER_GUILD = 50 
 MAX_KB_ENTRY_LENGTH = 1000   
 MAX_KB_DISPLAY_ENTRIES = 15 
 # --- 服务器专属AI知识库结束 ---
 
-# --- (在你的配置区域，可以放在 guild_knowledge_bases 附近) ---
+# --- (在你的配置区域，可以放在知识库配置附近) ---
 
 # --- 新增：服务器独立FAQ/帮助系统 ---
 # 结构: {guild_id: List[Dict[str, str]]}  每个字典包含 "keyword" 和 "answer"
@@ -138,19 +180,19 @@ class CloseTicketView(ui.View):
             if not interaction.response.is_done(): # Check if already responded/deferred
                 await interaction.response.defer(ephemeral=True)
         except discord.NotFound:
-            print(f"DEBUG: CloseTicket: Interaction {interaction.id} not found on defer, likely channel gone or interaction stale.")
+            log.debug("Interaction %s not found on defer, likely channel gone or interaction stale.", interaction.id)
             return # Cannot proceed if interaction is invalid
         except discord.HTTPException as e:
-            print(f"DEBUG: CloseTicket: HTTPException on defer for interaction {interaction.id}: {e}")
+            log.debug("HTTPException on defer for interaction %s: %s", interaction.id, e)
             # If defer fails, we might still be able to use followup if it was already deferred by a previous attempt.
             # However, if it's the first attempt and defer fails, followup will also likely fail.
             if not interaction.response.is_done(): # If defer truly failed and it wasn't already done
-                 print(f"DEBUG: CloseTicket: Deferral failed critically for interaction {interaction.id}. Aborting.")
+                 log.debug("Deferral failed critically for interaction %s. Aborting.", interaction.id)
                  return
         except Exception as e: # Catch any other deferral errors
-            print(f"DEBUG: CloseTicket: Generic error deferring interaction {interaction.id}: {e}")
+            log.debug("Generic error deferring interaction %s: %s", interaction.id, e)
             if not interaction.response.is_done():
-                print(f"DEBUG: CloseTicket: Deferral failed critically (generic) for interaction {interaction.id}. Aborting.")
+                log.debug("Deferral failed critically (generic) for interaction %s. Aborting.", interaction.id)
                 return
 
         guild = interaction.guild
@@ -159,18 +201,18 @@ class CloseTicketView(ui.View):
 
         if not guild or not isinstance(channel, discord.TextChannel):
             try: await interaction.followup.send("❌ 操作无法在此处完成。", ephemeral=True)
-            except Exception as fe: print(f"Debug: Followup error in initial check: {fe}")
+            except Exception as fe: log.warning("Followup error in initial check: %s", fe)
             return
 
         # Re-entry guard
         if channel.id in bot.closing_tickets_in_progress:
-            print(f"DEBUG: CloseTicket: Channel {channel.id} already in closing_tickets_in_progress. User: {user.id}")
+            log.debug("Channel %s already in closing_tickets_in_progress. User: %s", channel.id, user.id)
             try: await interaction.followup.send("⏳ 此票据已在关闭处理中，请稍候。", ephemeral=True)
-            except Exception as fe: print(f"Debug: Followup error for re-entry guard: {fe}")
+            except Exception as fe: log.warning("Followup error for re-entry guard: %s", fe)
             return
         
         bot.closing_tickets_in_progress.add(channel.id)
-        print(f"DEBUG: CloseTicket: Added channel {channel.id} to closing_tickets_in_progress by user {user.id}.")
+        log.debug("Added channel %s to closing_tickets_in_progress by user %s.", channel.id, user.id)
 
         try:
             # --- Original logic from here ---
@@ -181,7 +223,7 @@ class CloseTicketView(ui.View):
                     creator_id = uid
                     break
             
-            print(f"DEBUG: CloseTicket: Processing close for channel {channel.name} ({channel.id}), creator_id: {creator_id}")
+            log.debug("Processing close for channel %s (%s), creator_id: %s", channel.name, channel.id, creator_id)
 
             # --- 生成聊天记录 ---
             transcript_html_content = None
@@ -194,15 +236,15 @@ class CloseTicketView(ui.View):
             transcript_sent_to_admin_channel = False
 
             try:
-                print(f"DEBUG: CloseTicket: Generating transcript for {channel.id}")
+                log.debug("Generating transcript for %s", channel.id)
                 transcript_html_content = await generate_ticket_transcript_html(channel)
                 if transcript_html_content is None: 
                     transcript_generation_message_to_closer = "⚠️ 未能生成票据聊天记录副本 (可能读取错误或频道为空)。"
-                    print(f"DEBUG: CloseTicket: Transcript generation for {channel.id} returned None.")
+                    log.debug("Transcript generation for %s returned None.", channel.id)
                 else:
-                    print(f"DEBUG: CloseTicket: Transcript generated for {channel.id}, length approx {len(transcript_html_content)}")
+                    log.debug("Transcript generated for %s, length approx %s", channel.id, len(transcript_html_content))
             except Exception as e:
-                print(f"   - ❌ 生成频道 {channel.id} 的聊天记录时发生错误: {e}")
+                log.error("❌ 生成频道 %s 的聊天记录时发生错误: %s", channel.id, e)
                 transcript_generation_message_to_closer = "⚠️ 生成票据聊天记录副本时发生内部错误。"
 
             # 1. 尝试将聊天记录私信给关闭者
@@ -210,39 +252,39 @@ class CloseTicketView(ui.View):
                 try:
                     html_file_bytes = transcript_html_content.encode('utf-8')
                     transcript_file_obj = discord.File(io.BytesIO(html_file_bytes), filename=transcript_filename)
-                    print(f"DEBUG: CloseTicket: Attempting to DM transcript to user {user.id} for channel {channel.id}")
+                    log.debug("Attempting to DM transcript to user %s for channel %s", user.id, channel.id)
                     await user.send(
                         f"你好 {user.mention}，你关闭的票据 **#{channel.name}** (ID: {channel.id}) 的聊天记录副本如下：", 
                         file=transcript_file_obj
                     )
-                    print(f"   - ✅ 已将票据 {channel.name} 的聊天记录私信给关闭者 {user.name} ({user.id})")
+                    log.info("✅ 已将票据 %s 的聊天记录私信给关闭者 %s (%s)", channel.name, user.name, user.id)
                     transcript_generation_message_to_closer = "聊天记录副本已通过私信发送给你。"
                     transcript_dm_sent_to_closer = True
                 except discord.Forbidden:
-                    print(f"   - ⚠️ 无法将聊天记录私信给关闭者 {user.name} ({user.id})：用户可能关闭了私信或屏蔽了机器人。")
+                    log.warning("⚠️ 无法将聊天记录私信给关闭者 %s (%s)：用户可能关闭了私信或屏蔽了机器人。", user.name, user.id)
                     transcript_generation_message_to_closer = "⚠️ 无法将聊天记录私信给你 (可能关闭了私信)。文件已生成但未发送。"
                 except Exception as e:
-                    print(f"   - ❌ 发送聊天记录给关闭者 {user.name} ({user.id}) 时发生错误: {e}")
+                    log.error("❌ 发送聊天记录给关闭者 %s (%s) 时发生错误: %s", user.name, user.id, e)
                     transcript_generation_message_to_closer = f"⚠️ 尝试私信聊天记录副本时发生错误: {e}"
             elif not transcript_generation_message_to_closer: 
                 transcript_generation_message_to_closer = "⚠️ 未能生成票据聊天记录副本 (频道可能为空或读取错误)。"
             
-            print(f"DEBUG: CloseTicket: After DM attempt. transcript_dm_sent_to_closer={transcript_dm_sent_to_closer}")
+            log.debug("After DM attempt. transcript_dm_sent_to_closer=%s", transcript_dm_sent_to_closer)
 
             # 2. 尝试将聊天记录发送到管理员/日志频道
             admin_log_channel_id_for_transcript = PUBLIC_WARN_LOG_CHANNEL_ID
             admin_log_channel_object = None
-            print(f"DEBUG: CloseTicket: Attempting to send transcript to admin channel ID: {admin_log_channel_id_for_transcript}")
+            log.debug("Attempting to send transcript to admin channel ID: %s", admin_log_channel_id_for_transcript)
 
             if transcript_html_content and admin_log_channel_id_for_transcript and admin_log_channel_id_for_transcript != 1363523347169939578: 
-                print(f"DEBUG: CloseTicket: Condition for admin send is TRUE. Fetching admin channel.")
+                log.debug("Condition for admin send is TRUE. Fetching admin channel.")
                 admin_log_channel_object = guild.get_channel(admin_log_channel_id_for_transcript)
-                print(f"DEBUG: CloseTicket: Admin channel object: {admin_log_channel_object} (type: {type(admin_log_channel_object)})")
+                log.debug("Admin channel object: %s (type: %s)", admin_log_channel_object, type(admin_log_channel_object))
 
                 if admin_log_channel_object and isinstance(admin_log_channel_object, discord.TextChannel):
-                    print(f"DEBUG: CloseTicket: Admin channel is a valid TextChannel. Checking permissions.")
+                    log.debug("Admin channel is a valid TextChannel. Checking permissions.")
                     bot_perms = admin_log_channel_object.permissions_for(guild.me)
-                    print(f"DEBUG: CloseTicket: Bot perms in admin channel: attach_files={bot_perms.attach_files}, send_messages={bot_perms.send_messages}") # MODIFIED HERE
+                    log.debug("Bot perms in admin channel: attach_files=%s, send_messages=%s", bot_perms.attach_files, bot_perms.send_messages) # MODIFIED HERE
                     if bot_perms.attach_files and bot_perms.send_messages: # MODIFIED HERE
                         try:
                             html_file_bytes_for_admin = transcript_html_content.encode('utf-8')
@@ -254,7 +296,7 @@ class CloseTicketView(ui.View):
                                     creator_user_obj_temp = await bot.fetch_user(creator_id)
                                     creator_mention_log = f"{creator_user_obj_temp.mention} (`{creator_user_obj_temp}`)"
                             except Exception as fetch_exc: 
-                                print(f"DEBUG: CloseTicket: Failed to fetch creator_user_obj_temp: {fetch_exc}")
+                                log.debug("Failed to fetch creator_user_obj_temp: %s", fetch_exc)
                                 pass # Keep basic mention if fetch fails
 
                             admin_message_content = (
@@ -262,22 +304,22 @@ class CloseTicketView(ui.View):
                                 f"创建者: {creator_mention_log}.\n"
                                 f"聊天记录副本见附件。"
                             )
-                            print(f"DEBUG: CloseTicket: Sending transcript to admin channel {admin_log_channel_object.name}")
+                            log.debug("Sending transcript to admin channel %s", admin_log_channel_object.name)
                             await admin_log_channel_object.send(content=admin_message_content, file=transcript_file_obj_for_admin)
-                            print(f"   - ✅ 已将票据 {channel.name} 的聊天记录发送到管理频道 {admin_log_channel_object.name} ({admin_log_channel_id_for_transcript})")
+                            log.info("✅ 已将票据 %s 的聊天记录发送到管理频道 %s (%s)", channel.name, admin_log_channel_object.name, admin_log_channel_id_for_transcript)
                             transcript_sent_to_admin_channel = True
                         except discord.Forbidden:
-                            print(f"   - ❌ 发送聊天记录到管理频道 {admin_log_channel_id_for_transcript} 失败：机器人缺少发送文件/消息权限。")
+                            log.warning("❌ 发送聊天记录到管理频道 %s 失败：机器人缺少发送文件/消息权限。", admin_log_channel_id_for_transcript)
                         except Exception as log_send_e:
-                            print(f"   - ❌ 发送聊天记录到管理频道 {admin_log_channel_id_for_transcript} 时发生错误: {log_send_e}")
+                            log.error("❌ 发送聊天记录到管理频道 %s 时发生错误: %s", admin_log_channel_id_for_transcript, log_send_e)
                     else:
-                        print(f"   - ⚠️ 无法发送聊天记录到管理频道 {admin_log_channel_id_for_transcript}：机器人缺少发送文件/消息权限。")
+                        log.warning("⚠️ 无法发送聊天记录到管理频道 %s：机器人缺少发送文件/消息权限。", admin_log_channel_id_for_transcript)
                 elif admin_log_channel_id_for_transcript and admin_log_channel_id_for_transcript != 1363523347169939578 :
-                    print(f"   - ⚠️ 管理员日志频道ID ({admin_log_channel_id_for_transcript}) 无效或不是文本频道，无法发送聊天记录。")
+                    log.warning("⚠️ 管理员日志频道ID (%s) 无效或不是文本频道，无法发送聊天记录。", admin_log_channel_id_for_transcript)
             elif transcript_html_content and (not admin_log_channel_id_for_transcript or admin_log_channel_id_for_transcript == 1363523347169939578):
-                print(f"   - ℹ️ 未配置有效的公共日志频道ID (或为示例ID)，跳过发送聊天记录给管理员。")
+                log.info("ℹ️ 未配置有效的公共日志频道ID (或为示例ID)，跳过发送聊天记录给管理员。")
             else:
-                print(f"DEBUG: CloseTicket: Conditions for sending to admin channel not met. transcript_html_content: {transcript_html_content is not None}, admin_log_channel_id_for_transcript: {admin_log_channel_id_for_transcript}")
+                log.debug("Conditions for sending to admin channel not met. transcript_html_content: %s, admin_log_channel_id_for_transcript: %s", transcript_html_content is not None, admin_log_channel_id_for_transcript)
 
 
             # --- 在票据频道中宣布关闭 ---
@@ -295,17 +337,17 @@ class CloseTicketView(ui.View):
             final_public_close_message = "\n".join(public_close_message_parts)
             
             try:
-                print(f"DEBUG: CloseTicket: Sending close announcement to ticket channel {channel.id}")
+                log.debug("Sending close announcement to ticket channel %s", channel.id)
                 await channel.send(final_public_close_message)
             except discord.Forbidden:
-                print(f"   - ⚠️ 无法在票据频道 {channel.name} 发送关闭通知 (权限不足)。")
+                log.warning("⚠️ 无法在票据频道 %s 发送关闭通知 (权限不足)。", channel.name)
             except discord.NotFound:
-                print(f"   - ⚠️ 无法在票据频道 {channel.name} 发送关闭通知 (频道未找到 - 可能已被其他进程删除)。")
+                log.warning("⚠️ 无法在票据频道 %s 发送关闭通知 (频道未找到 - 可能已被其他进程删除)。", channel.name)
             except Exception as e:
-                print(f"   - ⚠️ 在票据频道 {channel.name} 发送关闭通知时出错: {e}")
+                log.error("⚠️ 在票据频道 %s 发送关闭通知时出错: %s", channel.name, e)
 
 
-            print(f"[票据] 用户 {user} ({user.id}) 关闭了票据频道 #{channel.name} ({channel.id})")
+            log.info("[票据] 用户 %s (%s) 关闭了票据频道 #%s (%s)", user, user.id, channel.name, channel.id)
 
             # --- 记录日志 (到公共日志频道) ---
             log_embed = discord.Embed(
@@ -323,7 +365,7 @@ class CloseTicketView(ui.View):
                     creator_user_obj = await bot.fetch_user(creator_id)
                     creator_display = f"{creator_user_obj.mention} (`{creator_user_obj}`)"
                 except Exception as fetch_creator_err: 
-                     print(f"DEBUG: CloseTicket: Failed to fetch creator user object for log: {fetch_creator_err}")
+                     log.debug("Failed to fetch creator user object for log: %s", fetch_creator_err)
                      pass 
                 log_embed.add_field(name="创建者", value=creator_display, inline=True)
             
@@ -341,38 +383,38 @@ class CloseTicketView(ui.View):
                 transcript_log_parts.append("未生成。")
             log_embed.add_field(name="聊天记录状态", value=" ".join(transcript_log_parts).strip(), inline=False)
             
-            print(f"DEBUG: CloseTicket: Sending 'Ticket Closed' log to public log channel for {channel.id}")
+            log.debug("Sending 'Ticket Closed' log to public log channel for %s", channel.id)
             await send_to_public_log(guild, log_embed, log_type="Ticket Closed")
 
 
             # 从 open_tickets 中移除记录
             if creator_id and guild.id in open_tickets and creator_id in open_tickets[guild.id]:
                 if open_tickets[guild.id].get(creator_id) == channel.id: # .get for safety
-                    del open_tickets[guild.id][creator_id]
-                    print(f"   - 已从 open_tickets 移除记录 (用户: {creator_id}, 频道: {channel.id})")
+                    set_open_ticket(guild.id, creator_id, None)
+                    log.info("已从 open_tickets 移除记录 (用户: %s, 频道: %s)", creator_id, channel.id)
                 else:
-                    print(f"DEBUG: CloseTicket: Mismatch or missing entry in open_tickets for creator {creator_id}, channel {channel.id}. Current: {open_tickets[guild.id].get(creator_id)}")
+                    log.debug("Mismatch or missing entry in open_tickets for creator %s, channel %s. Current: %s", creator_id, channel.id, open_tickets[guild.id].get(creator_id))
             elif creator_id:
-                 print(f"DEBUG: CloseTicket: Guild {guild.id} or creator {creator_id} not in open_tickets for channel {channel.id}. open_tickets[guild]: {open_tickets.get(guild.id)}")
+                 log.debug("Guild %s or creator %s not in open_tickets for channel %s. open_tickets[guild]: %s", guild.id, creator_id, channel.id, open_tickets.get(guild.id))
 
 
             # 延迟并删除频道
-            print(f"DEBUG: CloseTicket: Sleeping for 7 seconds before deleting channel {channel.id}")
+            log.debug("Sleeping for 7 seconds before deleting channel %s", channel.id)
             await asyncio.sleep(7) 
             delete_status_message = ""
             try:
-                print(f"DEBUG: CloseTicket: Attempting to delete channel {channel.name} ({channel.id})")
+                log.debug("Attempting to delete channel %s (%s)", channel.name, channel.id)
                 await channel.delete(reason=f"票据由 {user.name} 关闭")
-                print(f"   - 已成功删除票据频道 #{channel.name}")
+                log.info("已成功删除票据频道 #%s", channel.name)
                 delete_status_message = "✅ 票据频道已成功删除。"
             except discord.Forbidden:
-                print(f"   - 删除票据频道 #{channel.name} 失败：机器人缺少权限。")
+                log.warning("删除票据频道 #%s 失败：机器人缺少权限。", channel.name)
                 delete_status_message = "❌ 无法删除频道：机器人缺少权限。"
             except discord.NotFound:
-                print(f"   - 删除票据频道 #{channel.name} 失败：频道未找到 (可能已被删除)。")
+                log.warning("删除票据频道 #%s 失败：频道未找到 (可能已被删除)。", channel.name)
                 delete_status_message = "ℹ️ 票据频道似乎已被删除。" 
             except Exception as e:
-                print(f"   - 删除票据频道 #{channel.name} 时发生错误: {e}")
+                log.error("删除票据频道 #%s 时发生错误: %s", channel.name, e)
                 delete_status_message = f"❌ 删除频道时发生错误: {e}"
 
             # --- 给关闭者的最终反馈 ---
@@ -389,7 +431,7 @@ class CloseTicketView(ui.View):
                 final_followup_parts.append(admin_send_feedback_to_closer)
 
             final_followup_message_str = "\n".join(filter(None, final_followup_parts)).strip()
-            print(f"DEBUG: CloseTicket: Final followup message for {user.id}: '{final_followup_message_str}'")
+            log.debug("Final followup message for %s: '%s'", user.id, final_followup_message_str)
 
             try:
                 if final_followup_message_str: 
@@ -399,27 +441,23 @@ class CloseTicketView(ui.View):
                     else:
                         # This case should be rare if defer was successful.
                         # It implies the interaction might have expired or original message deleted.
-                        print(f"DEBUG: CloseTicket: Interaction {interaction.id} was not 'done' before final followup. Trying to send DM fallback.")
+                        log.debug("Interaction %s was not 'done' before final followup. Trying to send DM fallback.", interaction.id)
                         if not transcript_dm_sent_to_closer: # Avoid double DM if transcript already sent this info
                              await user.send(f"关于票据 **#{channel.name}** ({channel.id}) 的关闭状态：\n{final_followup_message_str}")
 
             except discord.NotFound:
-                 print(f"   - ⚠️ 无法发送最终关闭票据的 follow-up 给 {user.name}: Interaction or original message not found.")
+                 log.warning("⚠️ 无法发送最终关闭票据的 follow-up 给 %s: Interaction or original message not found.", user.name)
                  if not transcript_dm_sent_to_closer: # Fallback DM
                     try: await user.send(f"关于票据 **#{channel.name}** ({channel.id}) 的关闭状态：\n{final_followup_message_str}")
-                    except Exception as dm_fallback_err: print(f"   - ⚠️ 尝试通过私信发送最终状态给 {user.name} 也失败了: {dm_fallback_err}")
+                    except Exception as dm_fallback_err: log.warning("⚠️ 尝试通过私信发送最终状态给 %s 也失败了: %s", user.name, dm_fallback_err)
             except discord.HTTPException as e: 
-                print(f"   - ⚠️ 无法发送最终关闭票据的 follow-up 给 {user.name}: {e}. 消息是: '{final_followup_message_str}'")
+                log.warning("⚠️ 无法发送最终关闭票据的 follow-up 给 %s: %s. 消息是: '%s'", user.name, e, final_followup_message_str)
                 if not transcript_dm_sent_to_closer:
                     try: await user.send(f"关于票据 **#{channel.name}** ({channel.id}) 的关闭状态：\n{final_followup_message_str}")
-                    except Exception as dm_fallback_err: print(f"   - ⚠️ 尝试通过私信发送最终状态给 {user.name} 也失败了: {dm_fallback_err}")
+                    except Exception as dm_fallback_err: log.warning("⚠️ 尝试通过私信发送最终状态给 %s 也失败了: %s", user.name, dm_fallback_err)
 
         except Exception as e_outer:
-            print(f"!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-            print(f"CRITICAL ERROR in close_ticket_button for channel {channel.id if channel and hasattr(channel, 'id') else 'UnknownCh'}: {type(e_outer).__name__} - {str(e_outer)}")
-            import traceback
-            traceback.print_exc()
-            print(f"!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+            log.exception("Unexpected error in close_ticket_button for channel %s: %s - %s", channel.id if channel and hasattr(channel, 'id') else 'UnknownCh', type(e_outer).__name__, str(e_outer))
             try:
                 error_msg_to_user = f"❌ 关闭票据时发生严重内部错误 ({type(e_outer).__name__})。频道可能未被删除。请联系管理员。"
                 if interaction.response.is_done():
@@ -427,10 +465,10 @@ class CloseTicketView(ui.View):
                 # else: # If defer failed and it wasn't already done, this is tricky.
                 #    await interaction.response.send_message(error_msg_to_user, ephemeral=True)
             except Exception as e_followup_fail_critical:
-                print(f"DEBUG: CloseTicket: Failed to send CRITICAL ERROR followup to user: {e_followup_fail_critical}")
+                log.debug("Failed to send CRITICAL ERROR followup to user: %s", e_followup_fail_critical)
         finally:
             bot.closing_tickets_in_progress.discard(channel.id) # Ensure it's removed
-            print(f"DEBUG: CloseTicket: Removed channel {channel.id if channel and hasattr(channel, 'id') else 'UnknownCh'} from closing_tickets_in_progress.")
+            log.debug("Removed channel %s from closing_tickets_in_progress.", channel.id if channel and hasattr(channel, 'id') else 'UnknownCh')
 
             # View for the initial "Create Ticket" button (Persistent)
 class CreateTicketView(ui.View):
@@ -445,7 +483,7 @@ class CreateTicketView(ui.View):
         user = interaction.user
         if not guild: return 
 
-        print(f"[票据] 用户 {user} ({user.id}) 在服务器 {guild.id} 点击了创建票据按钮。")
+        log.info("[票据] 用户 %s (%s) 在服务器 %s 点击了创建票据按钮。", user, user.id, guild.id)
         await interaction.response.defer(ephemeral=True) 
 
         category_id = get_setting(ticket_settings, guild.id, "category_id")
@@ -453,20 +491,20 @@ class CreateTicketView(ui.View):
 
         if not category_id or not staff_role_ids:
             await interaction.followup.send("❌ 抱歉，票据系统尚未完全配置。请联系管理员使用 `/管理 票据设定` 进行设置。", ephemeral=True)
-            print(f"   - 票据创建失败：服务器 {guild.id} 未配置票据分类或员工身份组。")
+            log.warning("票据创建失败：服务器 %s 未配置票据分类或员工身份组。", guild.id)
             return
 
         ticket_category = guild.get_channel(category_id)
         if not ticket_category or not isinstance(ticket_category, discord.CategoryChannel):
             await interaction.followup.send("❌ 抱歉，配置的票据分类无效或已被删除。请联系管理员。", ephemeral=True)
-            print(f"   - 票据创建失败：服务器 {guild.id} 配置的票据分类 ({category_id}) 无效。")
+            log.warning("票据创建失败：服务器 %s 配置的票据分类 (%s) 无效。", guild.id, category_id)
             return
 
         staff_roles = [guild.get_role(role_id) for role_id in staff_role_ids]
         staff_roles = [role for role in staff_roles if role] 
         if not staff_roles:
              await interaction.followup.send("❌ 抱歉，配置的票据员工身份组无效或已被删除。请联系管理员。", ephemeral=True)
-             print(f"   - 票据创建失败：服务器 {guild.id} 配置的员工身份组 ({staff_role_ids}) 均无效。")
+             log.warning("票据创建失败：服务器 %s 配置的员工身份组 (%s) 均无效。", guild.id, staff_role_ids)
              return
 
         guild_tickets = open_tickets.setdefault(guild.id, {})
@@ -475,16 +513,16 @@ class CreateTicketView(ui.View):
             existing_channel = guild.get_channel(existing_channel_id)
             if existing_channel:
                  await interaction.followup.send(f"⚠️ 你已经有一个开启的票据：{existing_channel.mention}。请先处理完当前的票据。", ephemeral=True)
-                 print(f"   - 票据创建失败：用户 {user.id} 已有票据频道 {existing_channel_id}")
+                 log.info("票据创建失败：用户 %s 已有票据频道 %s", user.id, existing_channel_id)
                  return
             else:
-                 print(f"   - 清理无效票据记录：用户 {user.id} 的票据频道 {existing_channel_id} 不存在。")
-                 del guild_tickets[user.id]
+                 log.info("清理无效票据记录：用户 %s 的票据频道 %s 不存在。", user.id, existing_channel_id)
+                 set_open_ticket(guild.id, user.id, None)
 
         bot_perms = ticket_category.permissions_for(guild.me)
         if not bot_perms.manage_channels or not bot_perms.manage_permissions:
              await interaction.followup.send("❌ 创建票据失败：机器人缺少在票据分类中 '管理频道' 或 '管理权限' 的权限。", ephemeral=True)
-             print(f"   - 票据创建失败：机器人在分类 {ticket_category.id} 缺少权限。")
+             log.warning("票据创建失败：机器人在分类 %s 缺少权限。", ticket_category.id)
              return
 
         ticket_count = get_setting(ticket_settings, guild.id, "ticket_count") or 0
@@ -514,9 +552,9 @@ class CreateTicketView(ui.View):
                 topic=f"用户 {user.id} ({user}) 的认证票据 | 创建时间: {discord.utils.utcnow().strftime('%Y-%m-%d %H:%M:%S UTC')}",
                 reason=f"用户 {user.name} 创建认证票据"
             )
-            print(f"   - 已成功创建票据频道: #{new_channel.name} ({new_channel.id})")
+            log.info("已成功创建票据频道: #%s (%s)", new_channel.name, new_channel.id)
 
-            guild_tickets[user.id] = new_channel.id
+            set_open_ticket(guild.id, user.id, new_channel.id)
 
             welcome_embed = discord.Embed(
                 title="📝 欢迎进行认证！",
@@ -540,19 +578,19 @@ class CreateTicketView(ui.View):
 
         except discord.Forbidden:
              await interaction.followup.send("❌ 创建票据失败：机器人权限不足，无法创建频道或设置权限。", ephemeral=True)
-             print(f"   - 票据创建失败：机器人在创建频道时权限不足。")
+             log.warning("票据创建失败：机器人在创建频道时权限不足。")
              set_setting(ticket_settings, guild.id, "ticket_count", ticket_count - 1)
-             if user.id in guild_tickets: del guild_tickets[user.id]
+             if user.id in guild_tickets: set_open_ticket(guild.id, user.id, None)
         except discord.HTTPException as http_err:
              await interaction.followup.send(f"❌ 创建票据时发生网络错误: {http_err}", ephemeral=True)
-             print(f"   - 票据创建失败：网络错误 {http_err}")
+             log.error("票据创建失败：网络错误 %s", http_err)
              set_setting(ticket_settings, guild.id, "ticket_count", ticket_count - 1)
-             if user.id in guild_tickets: del guild_tickets[user.id]
+             if user.id in guild_tickets: set_open_ticket(guild.id, user.id, None)
         except Exception as e:
             await interaction.followup.send(f"❌ 创建票据时发生未知错误: {e}", ephemeral=True)
-            print(f"   - 票据创建失败：未知错误 {e}")
+            log.error("票据创建失败：未知错误 %s", e)
             set_setting(ticket_settings, guild.id, "ticket_count", ticket_count - 1)
-            if user.id in guild_tickets: del guild_tickets[user.id]
+            if user.id in guild_tickets: set_open_ticket(guild.id, user.id, None)
             if new_channel:
                 try: await new_channel.delete(reason="创建过程中出错")
                 except: pass
@@ -571,6 +609,8 @@ ECONOMY_MAX_SHOP_ITEMS_PER_PAGE = 5 # 减少以便更好地显示
 ECONOMY_MAX_LEADERBOARD_USERS = 10
 ECONOMY_TRANSFER_TAX_PERCENT = 1 # 示例: 转账收取 1% 手续费。设为 0 则无手续费。
 ECONOMY_MIN_TRANSFER_AMOUNT = 10 # 最低转账金额
+ECONOMY_CHAT_EARN_FLUSH_INTERVAL_SECONDS = 30 # 聊天奖励写回数据库的间隔
+ECONOMY_CHAT_EARN_FLUSH_MAX_ENTRIES = 200     # 待写回的 (服务器, 用户) 条目达到此数量时立即写回
 
 # --- 经济系统数据存储 (内存中，通过 JSON 持久化) ---
 # {guild_id: {user_id: balance}}
@@ -579,9 +619,6 @@ user_balances: Dict[int, Dict[int, int]] = {}
 # {guild_id: {item_slug: {"name": str, "price": int, "description": str, "role_id": Optional[int], "stock": int (-1 代表无限), "purchase_message": Optional[str]}}}
 shop_items: Dict[int, Dict[str, Dict[str, Any]]] = {}
 
-# {guild_id: {"chat_earn_amount": int, "chat_earn_cooldown": int}} # 存储覆盖默认值的设置
-guild_economy_settings: Dict[int, Dict[str, int]] = {}
-
 # {guild_id: {user_id: last_earn_timestamp_float}}
 last_chat_earn_times: Dict[int, Dict[int, float]] = {}
 
@@ -617,7 +654,10 @@ BAD_WORDS = [
     "他妈的", "他媽的", "tmd", "妈的", "媽的", "卧槽", "我肏", "我操", "我草", "靠北", "靠杯", "干你娘", "干您娘",
     "fuck", "shit", "cunt", "asshole", "鸡巴", "雞巴", "jb",
 ]
-BAD_WORDS_LOWER = [word.lower() for word in BAD_WORDS]
+# 启动时编译成自动机；各服务器的附加违禁词通过 /管理 违禁词 维护并保存在数据库中
+bad_word_filter = word_filter.BadWordFilter(BAD_WORDS)
+# 审核第一层 (本地)：命中违禁词或明显安全 (极短 / 纯表情 / 白名单链接) 的消息不再调用 DeepSeek
+moderation_prefilter = ai_moderation.ModerationPrefilter(bad_word_filter)
 
 # 记录用户首次触发提醒 {guild_id: {user_id: {lowercase_word}}}
 user_first_offense_reminders = {}
@@ -626,10 +666,12 @@ user_first_offense_reminders = {}
 # 用于存储各种非特定功能的设置，例如日志频道、公告频道等
 general_settings = {} # {guild_id: {"log_channel_id": int, "announce_channel_id": int}}
 
-# --- Temporary Voice Channel Config & Storage (In-Memory) ---
+# --- Temporary Voice Channel Config & Storage (持久化到数据库，启动时加载) ---
 temp_vc_settings = {}  # {guild_id: {"master_channel_id": id, "category_id": id, "member_count_channel_id": id, "member_count_template": str}}
-temp_vc_owners = {}    # {channel_id: owner_user_id}
+temp_vc_owners = {}    # {channel_id: owner_user_id} (经 set_temp_vc_owner / forget_temp_vc 修改)
 temp_vc_created = set()  # {channel_id1, channel_id2, ...}
+temp_vc_guilds = {}    # {channel_id: guild_id} (启动清理时判断服务器是否可用)
+_temp_vc_cleanup_done = False
 
 # --- Ticket Tool Config & Storage (In-Memory) ---
 # 使用 guild_id 作为键
@@ -641,25 +683,144 @@ user_message_timestamps = {} # {user_id: [timestamp1, timestamp2]}
 user_warnings = {}           # {user_id: warning_count}
 bot_message_timestamps = {}  # {bot_user_id: [timestamp1, timestamp2]}
 
-# --- AI Content Check Exemption Storage (In-Memory) ---
-# !!! 注意：这些列表在机器人重启后会丢失，除非使用数据库存储 !!!
+# --- AI Content Check Exemption Storage ---
 exempt_users_from_ai_check = set() # 存储用户 ID (int)
 exempt_channels_from_ai_check = set() # 存储频道 ID (int)
 
-# --- Helper Function to Get/Set Settings (Simulated DB) ---
-# 注意：这只是内存中的模拟，重启会丢失数据
+# --- 状态持久化 ---
+# ai_dep_channels_config / active_private_ai_chats / server_faqs / 豁免列表 / ticket_settings / open_tickets /
+# temp_vc_settings / user_warnings 保存在数据库中：启动时由 load_persistent_bot_state() 读入上面的内存字典，
+# 读取仍然只查内存；每次修改内存字典后调用 persist_in_background() 写回数据库 (write-through)。
+_pending_state_writes = set() # 尚未完成的写回任务 (保留引用，防止任务被垃圾回收)
+_bot_state_loaded = False
+
+def persist_in_background(coro, description: str):
+    """在后台执行一个 async_database 写操作，失败时记录日志。写操作按提交顺序由单写者线程执行。"""
+    task = asyncio.create_task(coro)
+    _pending_state_writes.add(task)
+
+    def _on_done(done_task: asyncio.Task):
+        _pending_state_writes.discard(done_task)
+        if done_task.cancelled():
+            return
+        error = done_task.exception()
+        if error is not None or done_task.result() is False:
+            log.error("[状态持久化] 写回失败 (%s): %s", description, error or "数据库返回失败")
+    task.add_done_callback(_on_done)
+
+async def wait_for_pending_state_writes():
+    """等待所有后台写回完成 (关闭前调用)。"""
+    if _pending_state_writes:
+        await asyncio.gather(*list(_pending_state_writes), return_exceptions=True)
+
+def _replace_contents(store, loaded):
+    # 原地替换，保持其它地方持有的字典 / 集合引用有效
+    store.clear()
+    store.update(loaded)
+
+async def load_persistent_bot_state():
+    """从数据库读取持久化的状态到内存字典。只在第一次 on_ready 时执行 (重连不会覆盖内存中的最新状态)。"""
+    global _bot_state_loaded
+    if _bot_state_loaded:
+        return
+    state = await async_database.db_load_bot_state()
+    _replace_contents(ai_dep_channels_config, state["ai_dep_channels"])
+    _replace_contents(active_private_ai_chats, state["private_ai_chats"])
+    _replace_contents(server_faqs, state["faqs"])
+    _replace_contents(exempt_users_from_ai_check, state["exempt_users"])
+    _replace_contents(exempt_channels_from_ai_check, state["exempt_channels"])
+    _replace_contents(ticket_settings, state["feature_settings"].get(database.FEATURE_TICKET, {}))
+    _replace_contents(temp_vc_settings, state["feature_settings"].get(database.FEATURE_TEMP_VC, {}))
+    _replace_contents(open_tickets, state["open_tickets"])
+    _replace_contents(user_warnings, state["user_warnings"])
+    _replace_contents(temp_vc_owners, {channel_id: vc["owner_id"] for channel_id, vc in state["temp_voice_channels"].items()})
+    _replace_contents(temp_vc_guilds, {channel_id: vc["guild_id"] for channel_id, vc in state["temp_voice_channels"].items()})
+    _replace_contents(temp_vc_created, state["temp_voice_channels"].keys())
+    for guild_id, bad_word_settings in state["feature_settings"].get(database.FEATURE_BAD_WORDS, {}).items():
+        bad_word_filter.set_guild_words(guild_id, bad_word_settings.get("words", []))
+    await ai_conversations.prune_persisted() # 对话历史本身在首次使用时按需读取
+    await migrate_legacy_chat_earn_settings()
+    _bot_state_loaded = True
+    log.info("[状态持久化] 已加载: AI 频道 %s 个，AI 私聊 %s 个，FAQ %s 个服务器，豁免 %s 用户 / %s 频道，"
+             "票据设置 %s 个服务器 (打开的票据 %s 个)，临时语音设置 %s 个服务器 (临时频道 %s 个)，警告记录 %s 个用户。",
+             len(ai_dep_channels_config), len(active_private_ai_chats), len(server_faqs),
+             len(exempt_users_from_ai_check), len(exempt_channels_from_ai_check), len(ticket_settings),
+             sum(len(tickets) for tickets in open_tickets.values()), len(temp_vc_settings), len(temp_vc_created), len(user_warnings))
+
+def set_open_ticket(guild_id: int, user_id: int, channel_id: Optional[int]):
+    """更新 open_tickets 并写回数据库；channel_id 为 None 时移除该用户的记录。"""
+    guild_tickets = open_tickets.setdefault(guild_id, {})
+    if channel_id is None:
+        guild_tickets.pop(user_id, None)
+    else:
+        guild_tickets[user_id] = channel_id
+    persist_in_background(async_database.db_set_open_ticket(guild_id, user_id, channel_id), f"票据 {guild_id}/{user_id}")
+
+def set_temp_vc_owner(guild_id: int, channel_id: int, owner_id: int):
+    """登记临时语音频道 (或更换房主) 并写回数据库。"""
+    temp_vc_owners[channel_id] = owner_id
+    temp_vc_guilds[channel_id] = guild_id
+    temp_vc_created.add(channel_id)
+    persist_in_background(async_database.db_set_temp_voice_channel(channel_id, guild_id, owner_id), f"临时语音频道 {channel_id}")
+
+def forget_temp_vc(channel_id: int):
+    """临时语音频道已删除 (或已不存在)：移除内存与数据库中的记录。"""
+    temp_vc_owners.pop(channel_id, None)
+    temp_vc_guilds.pop(channel_id, None)
+    if channel_id in temp_vc_created:
+        temp_vc_created.discard(channel_id)
+        persist_in_background(async_database.db_remove_temp_voice_channel(channel_id), f"临时语音频道 {channel_id}")
+
+async def cleanup_temp_voice_channels():
+    """启动时 (只在第一次 on_ready) 检查记录的临时语音频道：已不存在的移除记录，机器人离线期间变空的直接删除。
+
+    所在服务器暂时不可用时跳过 (频道不在缓存中不代表已被删除)，记录保留到之后正常的语音状态处理。
+    """
+    global _temp_vc_cleanup_done
+    if _temp_vc_cleanup_done:
+        return
+    _temp_vc_cleanup_done = True
+    for channel_id in list(temp_vc_created):
+        guild = bot.get_guild(temp_vc_guilds.get(channel_id, 0))
+        if guild is None or guild.unavailable:
+            continue
+        channel = guild.get_channel(channel_id)
+        if not isinstance(channel, discord.VoiceChannel):
+            forget_temp_vc(channel_id)
+            continue
+        if any(not m.bot for m in channel.members):
+            continue
+        try:
+            await channel.delete(reason="临时语音频道为空 (机器人离线期间)，自动删除")
+            log.info("✅ 已删除离线期间变空的临时频道 %s (%s)。", channel.name, channel_id)
+        except discord.NotFound:
+            pass
+        except discord.Forbidden:
+            log.warning("❌ 删除临时频道 %s 失败：机器人权限不足。", channel.name)
+            continue
+        except discord.HTTPException as e:
+            log.error("❌ 删除临时频道 %s 时发生错误: %s", channel.name, e)
+            continue
+        forget_temp_vc(channel_id)
+
+def persist_user_warnings(user_id: int):
+    """把 user_warnings 中该用户当前的警告次数写回数据库。"""
+    persist_in_background(async_database.db_set_user_warning_count(user_id, user_warnings.get(user_id, 0)), f"用户 {user_id} 的警告次数")
+
+# --- Helper Function to Get/Set Settings ---
 # 修改为接受一个字典作为存储目标
 def get_setting(store: dict, guild_id: int, key: str):
     """从指定的内存字典中获取服务器设置"""
     return store.get(guild_id, {}).get(key)
 
 def set_setting(store: dict, guild_id: int, key: str, value):
-    """设置服务器设置到指定的内存字典"""
+    """设置服务器设置到指定的内存字典 (ticket_settings / temp_vc_settings 会同时写回数据库)"""
     if guild_id not in store:
         store[guild_id] = {}
     store[guild_id][key] = value
-    # Less verbose logging for settings now
-    # print(f"[内存设置更新 @ {id(store)}] 服务器 {guild_id}: {key}={value}")
+    feature = database.FEATURE_TICKET if store is ticket_settings else database.FEATURE_TEMP_VC if store is temp_vc_settings else None
+    if feature:
+        persist_in_background(async_database.db_set_guild_feature_setting(feature, guild_id, key, value), f"{feature} 设置 {guild_id}.{key}")
 
 # --- Helper Function to Send to Public Log Channel ---
 async def send_to_public_log(guild: discord.Guild, embed: discord.Embed, log_type: str = "Generic"):
@@ -675,99 +836,51 @@ async def send_to_public_log(guild: discord.Guild, embed: discord.Embed, log_typ
         if bot_perms.send_messages and bot_perms.embed_links:
             try:
                 await log_channel.send(embed=embed)
-                print(f"   ✅ 已发送公共日志 ({log_type}) 到频道 {log_channel.name} ({log_channel.id})。")
+                log.info("✅ 已发送公共日志 (%s) 到频道 %s (%s)。", log_type, log_channel.name, log_channel.id)
                 return True
             except discord.Forbidden:
-                print(f"   ❌ 错误：机器人缺少在公共日志频道 {log_channel_id_for_public} 发送消息或嵌入链接的权限。")
+                log.warning("❌ 错误：机器人缺少在公共日志频道 %s 发送消息或嵌入链接的权限。", log_channel_id_for_public)
             except Exception as log_e:
-                print(f"   ❌ 发送公共日志时发生意外错误 ({log_type}): {log_e}")
+                log.error("❌ 发送公共日志时发生意外错误 (%s): %s", log_type, log_e)
         else:
-            print(f"   ❌ 错误：机器人在公共日志频道 {log_channel_id_for_public} 缺少发送消息或嵌入链接的权限。")
+            log.warning("❌ 错误：机器人在公共日志频道 %s 缺少发送消息或嵌入链接的权限。", log_channel_id_for_public)
     else:
          # Check if the ID is the default placeholder before printing warning
          if log_channel_id_for_public != 1363523347169939578:
-             print(f"⚠️ 在服务器 {guild.name} ({guild.id}) 中找不到公共日志频道 ID: {log_channel_id_for_public}。")
+             log.warning("⚠️ 在服务器 %s (%s) 中找不到公共日志频道 ID: %s。", guild.name, guild.id, log_channel_id_for_public)
     return False
 
 # --- Helper Function: DeepSeek API Content Check (Returns Chinese Violation Type) ---
+async def _classify_moderation_batch(message_contents: List[str]) -> List[Optional[str]]:
+    session = http_client.get_session()
+    if session is None:
+        mod_log.warning("⚠️ 共享 HTTP 会话不可用，跳过 DeepSeek 内容检查 (%s 条)。", len(message_contents))
+        raise ai_moderation.ModerationUnavailable("共享 HTTP 会话不可用")
+    # Prompt 与判定解析在 ai_moderation.py 中；请求复用共享会话的连接池，并经过 deepseek_api_gateway
+    return await ai_moderation.classify_messages(deepseek_api_gateway, session, DEEPSEEK_MODEL, message_contents,
+                                                 http_client.get_timeout("moderation"), raise_on_error=True)
+
+moderation_batcher = ai_moderation.ModerationBatcher(
+    _classify_moderation_batch,
+    max_batch_size=MODERATION_BATCH_MAX_SIZE,
+    max_wait_seconds=MODERATION_BATCH_MAX_WAIT_SECONDS,
+)
+moderation_verdict_cache = ai_moderation.VerdictCache() # 相同内容 (忽略大小写与空白差异) 直接复用判定
+
 async def check_message_with_deepseek(message_content: str) -> Optional[str]:
-    """使用 DeepSeek API 检查内容。返回中文违规类型或 None。"""
+    """使用 DeepSeek API 检查内容 (与同一时间窗口内的其它消息合并为一次请求)。返回中文违规类型或 None。"""
     if not DEEPSEEK_API_KEY:
-        # print("DEBUG: DeepSeek API Key 未设置，跳过检查。")
         return None # Skip if no key
-
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
-    }
-
-    # !!! --- 重要：设计和优化你的 Prompt --- !!!
-    # --- V2: 要求返回中文分类 ---
-    prompt = f"""
-    请分析以下 Discord 消息内容是否包含严重的违规行为。
-    严重违规分类包括：仇恨言论、骚扰/欺凌、露骨的 NSFW 内容、严重威胁。
-    - 如果检测到明确的严重违规，请【仅】返回对应的中文分类名称（例如：“仇恨言论”）。
-    - 如果内容包含一些轻微问题（如刷屏、普通脏话）但【不构成】上述严重违规，请【仅】返回：“轻微违规”。
-    - 如果内容安全，没有任何违规，请【仅】返回：“安全”。
-
-    消息内容：“{message_content}”
-    分析结果："""
-    # !!! --- Prompt 结束 --- !!!
-
-    data = {
-        "model": DEEPSEEK_MODEL,
-        "messages": [{"role": "user", "content": prompt}],
-        "max_tokens": 30, # 限制返回长度，只需要分类名称
-        "temperature": 0.1, # 较低的温度，追求更确定的分类
-        "stream": False
-    }
-
-    loop = asyncio.get_event_loop()
     try:
-        # 使用 run_in_executor 避免阻塞事件循环
-        response = await loop.run_in_executor(
-            None,
-            lambda: requests.post(DEEPSEEK_API_URL, headers=headers, json=data, timeout=8) # 设置超时
-        )
-        response.raise_for_status() # 检查 HTTP 错误
-        result = response.json()
-        api_response_text = result.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
-
-        # print(f"DEBUG: DeepSeek 对 '{message_content[:30]}...' 的响应: {api_response_text}") # Debug log
-
-        # --- 处理中文响应 ---
-        if not api_response_text: # 空响应视为安全
-             return None
-        if api_response_text == "安全":
-            return None
-        if api_response_text == "轻微违规":
-             # 对于轻微违规，我们目前也视为不需要机器人直接干预（交给刷屏或本地违禁词处理）
-             return None
-        # 如果不是 "安全" 或 "轻微违规"，则假定返回的是中文的严重违规类型
-        # （例如 “仇恨言论”, “骚扰/欺凌” 等）
-        return api_response_text
-
-    except requests.exceptions.Timeout:
-        print(f"❌ 调用 DeepSeek API 超时")
-        return None
-    except requests.exceptions.RequestException as e:
-        print(f"❌ 调用 DeepSeek API 时发生网络错误: {e}")
-        return None
-    except json.JSONDecodeError:
-        print(f"❌ 解析 DeepSeek API 响应失败 (非 JSON): {response.text}")
-        return None
-    except Exception as e:
-        print(f"❌ DeepSeek 检查期间发生意外错误: {e}")
-        return None
-
-
-    pass
+        return await moderation_verdict_cache.get_or_classify(message_content, moderation_batcher.classify)
+    except ai_moderation.ModerationUnavailable:
+        return None # 审核服务不可用时放行 (错误已记录)，失败结果不进入缓存
 
 # --- 新增：通用的 DeepSeek API 请求函数 (用于AI对话功能) ---
-async def get_deepseek_dialogue_response(session, api_key, model, messages_for_api, max_tokens_override=None):
-    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
-    
+def build_dialogue_payload(model, messages_for_api, max_tokens_override=None, stream=False):
     payload = {"model": model, "messages": messages_for_api}
+    if stream:
+        payload["stream"] = True
     if model == "deepseek-reasoner":
         if max_tokens_override and isinstance(max_tokens_override, int) and max_tokens_override > 0:
             payload["max_tokens"] = max_tokens_override 
@@ -782,145 +895,118 @@ async def get_deepseek_dialogue_response(session, api_key, model, messages_for_a
         cleaned_messages_for_api.append(cleaned_msg)
     payload["messages"] = cleaned_messages_for_api
 
-    print(f"[AI DIALOGUE] Requesting: model='{model}', msgs_count={len(cleaned_messages_for_api)}") 
-    if cleaned_messages_for_api: print(f"[AI DIALOGUE] First message for API: {cleaned_messages_for_api[0]}")
+    ai_log.debug("[AI DIALOGUE] Requesting: model='%s', msgs_count=%s, stream=%s", model, len(cleaned_messages_for_api), stream)
+    if cleaned_messages_for_api: ai_log.debug("[AI DIALOGUE] First message for API: %s", cleaned_messages_for_api[0])
+    return payload
+
+def format_dialogue_api_error(status, raw_response_text):
+    try: error_detail = json.loads(raw_response_text).get("error", {}).get("message", f"未知错误(状态{status})")
+    except (json.JSONDecodeError, AttributeError): error_detail = f"未知错误(状态{status})"
+    user_error_msg = f"API调用出错(状态{status}): {error_detail}"
+    if status == 400:
+        user_error_msg += "\n(提示:400通常因格式错误或在上下文中传入了`reasoning_content`)"
+    return user_error_msg
+
+async def get_deepseek_dialogue_response(session, model, messages_for_api, max_tokens_override=None, guild_id=None):
+    payload = build_dialogue_payload(model, messages_for_api, max_tokens_override)
 
     try:
-        async with session.post(DEEPSEEK_API_URL, headers=headers, json=payload, timeout=300) as response:
-            raw_response_text = await response.text()
-            try: response_data = json.loads(raw_response_text)
-            except json.JSONDecodeError:
-                print(f"[AI DIALOGUE] ERROR: Failed JSON decode. Status: {response.status}. Text: {raw_response_text[:200]}...")
-                return None, None, f"无法解析响应(状态{response.status})"
-
-            if response.status == 200:
-                if response_data.get("choices") and len(response_data["choices"]) > 0:
-                    message_data = response_data["choices"][0].get("message", {})
-                    usage = response_data.get("usage")
-                    
-                    reasoning_content_api = None
-                    final_content_api = message_data.get("content")
+        # 经网关发出：受全局 / 本服务器并发上限与限速约束，429 / 5xx 自动重试；熔断时直接失败
+        response = await deepseek_api_gateway.post(session, payload, http_client.get_timeout("dialogue"), purpose="dialogue", guild_id=guild_id)
+        raw_response_text = response.text
+        try: response_data = json.loads(raw_response_text)
+        except json.JSONDecodeError:
+            ai_log.error("[AI DIALOGUE] Failed JSON decode. Status: %s. Text: %s...", response.status, raw_response_text[:200])
+            return None, None, f"无法解析响应(状态{response.status})"
+
+        if response.status == 200:
+            if response_data.get("choices") and len(response_data["choices"]) > 0:
+                message_data = response_data["choices"][0].get("message", {})
+                usage = response_data.get("usage")
+                
+                reasoning_content_api = None
+                final_content_api = message_data.get("content")
 
-                    if model == "deepseek-reasoner":
-                        reasoning_content_api = message_data.get("reasoning_content")
-                        if reasoning_content_api is None: print(f"[AI DIALOGUE] DEBUG: Model '{model}' did not return 'reasoning_content'.")
-                    
-                    display_response = ""
-                    if reasoning_content_api:
-                        display_response += f"🤔 **思考过程:**\n```\n{reasoning_content_api.strip()}\n```\n\n"
-                    
-                    if final_content_api:
-                        prefix = "💬 **最终回答:**\n" if reasoning_content_api else "" 
-                        display_response += f"{prefix}{final_content_api.strip()}"
-                    elif reasoning_content_api and not final_content_api: 
-                        print(f"[AI DIALOGUE] WARNING: Model '{model}' returned reasoning but no final content.")
-                    elif not final_content_api and not reasoning_content_api:
-                        print(f"[AI DIALOGUE] ERROR: API for model '{model}' missing 'content' & 'reasoning_content'. Data: {message_data}")
-                        return None, None, "API返回数据不完整(内容和思考过程均缺失)"
-
-                    if not display_response.strip():
-                        print(f"[AI DIALOGUE] ERROR: Generated 'display_response' is empty for model '{model}'.")
-                        return None, None, "API生成的回复内容为空"
-
-                    print(f"[AI DIALOGUE] INFO: Success for model '{model}'. Usage: {usage}")
-                    return display_response.strip(), final_content_api, None 
-                else:
-                    print(f"[AI DIALOGUE] ERROR: API response missing 'choices' for model '{model}': {response_data}")
-                    return None, None, f"意外响应结构：{response_data}"
+                if model == "deepseek-reasoner":
+                    reasoning_content_api = message_data.get("reasoning_content")
+                    if reasoning_content_api is None: ai_log.debug("[AI DIALOGUE] Model '%s' did not return 'reasoning_content'.", model)
+                
+                display_response = ""
+                if reasoning_content_api:
+                    display_response += f"🤔 **思考过程:**\n```\n{reasoning_content_api.strip()}\n```\n\n"
+                
+                if final_content_api:
+                    prefix = "💬 **最终回答:**\n" if reasoning_content_api else "" 
+                    display_response += f"{prefix}{final_content_api.strip()}"
+                elif reasoning_content_api and not final_content_api: 
+                    ai_log.warning("[AI DIALOGUE] Model '%s' returned reasoning but no final content.", model)
+                elif not final_content_api and not reasoning_content_api:
+                    ai_log.error("[AI DIALOGUE] API for model '%s' missing 'content' & 'reasoning_content'. Data: %s", model, message_data)
+                    return None, None, "API返回数据不完整(内容和思考过程均缺失)"
+
+                if not display_response.strip():
+                    ai_log.error("[AI DIALOGUE] Generated 'display_response' is empty for model '%s'.", model)
+                    return None, None, "API生成的回复内容为空"
+
+                ai_log.info("[AI DIALOGUE] Success for model '%s'. Usage: %s", model, usage)
+                return display_response.strip(), final_content_api, None 
             else:
-                error_detail = response_data.get("error", {}).get("message", f"未知错误(状态{response.status})")
-                print(f"[AI DIALOGUE] ERROR: API error (Status {response.status}) for model '{model}': {error_detail}. Resp: {raw_response_text[:200]}")
-                user_error_msg = f"API调用出错(状态{response.status}): {error_detail}"
-                if response.status == 400:
-                    user_error_msg += "\n(提示:400通常因格式错误或在上下文中传入了`reasoning_content`)"
-                return None, None, user_error_msg
+                ai_log.error("[AI DIALOGUE] API response missing 'choices' for model '%s': %s", model, response_data)
+                return None, None, f"意外响应结构：{response_data}"
+        else:
+            ai_log.error("[AI DIALOGUE] API error (Status %s) for model '%s'. Resp: %s", response.status, model, raw_response_text[:200])
+            return None, None, format_dialogue_api_error(response.status, raw_response_text)
+    except deepseek_gateway.GatewayUnavailable as e:
+        ai_log.warning("[AI DIALOGUE] Gateway rejected request: %s", e)
+        return None, None, "AI 服务暂时繁忙或不可用，请稍后再试"
     except aiohttp.ClientConnectorError as e:
-        print(f"[AI DIALOGUE] ERROR: Network error: {e}")
+        ai_log.error("[AI DIALOGUE] Network error: %s", e)
         return None, None, "无法连接API"
     except asyncio.TimeoutError:
-        print("[AI DIALOGUE] ERROR: API request timed out.")
+        ai_log.error("[AI DIALOGUE] API request timed out.")
         return None, None, "API连接超时"
     except Exception as e:
-        print(f"[AI DIALOGUE] EXCEPTION: Unexpected API call error: {type(e).__name__} - {str(e)}")
-        import traceback
-        traceback.print_exc()
+        ai_log.exception("[AI DIALOGUE] Unexpected API call error: %s - %s", type(e).__name__, str(e))
         return None, None, f"未知API错误: {str(e)}"
 
 # --- (get_deepseek_dialogue_response 函数定义结束) ---
 
-# --- Helper Function: Generate HTML Transcript for Tickets ---
-# async def generate_ticket_transcript_html(channel: discord.TextChannel) -> Optional[str]:
-# ... (接下来的函数定义)
-    """使用 DeepSeek API 检查内容。返回中文违规类型或 None。"""
-    if not DEEPSEEK_API_KEY:
-        # print("DEBUG: DeepSeek API Key 未设置，跳过检查。")
-        return None # Skip if no key
-
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
-    }
-
-    # !!! --- 重要：设计和优化你的 Prompt --- !!!
-    # --- V2: 要求返回中文分类 ---
-    prompt = f"""
-    请分析以下 Discord 消息内容是否包含严重的违规行为。
-    严重违规分类包括：仇恨言论、骚扰/欺凌、露骨的 NSFW 内容、严重威胁。
-    - 如果检测到明确的严重违规，请【仅】返回对应的中文分类名称（例如：“仇恨言论”）。
-    - 如果内容包含一些轻微问题（如刷屏、普通脏话）但【不构成】上述严重违规，请【仅】返回：“轻微违规”。
-    - 如果内容安全，没有任何违规，请【仅】返回：“安全”。
-
-    消息内容：“{message_content}”
-    分析结果："""
-    # !!! --- Prompt 结束 --- !!!
-
-    data = {
-        "model": DEEPSEEK_MODEL,
-        "messages": [{"role": "user", "content": prompt}],
-        "max_tokens": 30, # 限制返回长度，只需要分类名称
-        "temperature": 0.1, # 较低的温度，追求更确定的分类
-        "stream": False
-    }
-
-    loop = asyncio.get_event_loop()
+async def stream_deepseek_dialogue_response(session, model, messages_for_api, reply: ai_streaming.StreamingReply, guild_id=None):
+    """流式请求 AI 对话：思考过程与回答的增量交给 reply 渲染。返回 (最终回答, 错误信息)；调用方负责 reply.finish()。"""
+    payload = build_dialogue_payload(model, messages_for_api, stream=True)
+    usage = None
     try:
-        # 使用 run_in_executor 避免阻塞事件循环
-        response = await loop.run_in_executor(
-            None,
-            lambda: requests.post(DEEPSEEK_API_URL, headers=headers, json=data, timeout=8) # 设置超时
-        )
-        response.raise_for_status() # 检查 HTTP 错误
-        result = response.json()
-        api_response_text = result.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
-
-        # print(f"DEBUG: DeepSeek 对 '{message_content[:30]}...' 的响应: {api_response_text}") # Debug log
-
-        # --- 处理中文响应 ---
-        if not api_response_text: # 空响应视为安全
-             return None
-        if api_response_text == "安全":
-            return None
-        if api_response_text == "轻微违规":
-             # 对于轻微违规，我们目前也视为不需要机器人直接干预（交给刷屏或本地违禁词处理）
-             return None
-        # 如果不是 "安全" 或 "轻微违规"，则假定返回的是中文的严重违规类型
-        # （例如 “仇恨言论”, “骚扰/欺凌” 等）
-        return api_response_text
-
-    except requests.exceptions.Timeout:
-        print(f"❌ 调用 DeepSeek API 超时")
-        return None
-    except requests.exceptions.RequestException as e:
-        print(f"❌ 调用 DeepSeek API 时发生网络错误: {e}")
-        return None
-    except json.JSONDecodeError:
-        print(f"❌ 解析 DeepSeek API 响应失败 (非 JSON): {response.text}")
-        return None
-    except Exception as e:
-        print(f"❌ DeepSeek 检查期间发生意外错误: {e}")
-        return None
+        async with contextlib.aclosing(deepseek_api_gateway.stream(
+                session, payload, http_client.get_timeout("dialogue"), purpose="dialogue", guild_id=guild_id)) as chunks:
+            async for data in chunks:
+                reasoning_delta, content_delta, chunk_usage = ai_streaming.parse_stream_chunk(data)
+                usage = chunk_usage or usage
+                await reply.feed(ai_streaming.SECTION_REASONING, reasoning_delta)
+                await reply.feed(ai_streaming.SECTION_ANSWER, content_delta)
+    except deepseek_gateway.GatewayUnavailable as e:
+        ai_log.warning("[AI DIALOGUE] Gateway rejected stream request: %s", e)
+        return None, "AI 服务暂时繁忙或不可用，请稍后再试"
+    except deepseek_gateway.GatewayStatusError as e:
+        ai_log.error("[AI DIALOGUE] API error (Status %s) for model '%s'. Resp: %s", e.status, model, e.text[:200])
+        return None, format_dialogue_api_error(e.status, e.text)
+    except asyncio.TimeoutError:
+        ai_log.error("[AI DIALOGUE] Streaming request timed out after %s chars.", len(reply.text[ai_streaming.SECTION_ANSWER]))
+        return None, "API连接超时"
+    except aiohttp.ClientError as e:
+        ai_log.error("[AI DIALOGUE] Network error during stream: %s", e)
+        return None, "无法连接API" if not reply.has_output else "与 API 的连接中断，回复不完整"
+
+    answer_text = reply.text[ai_streaming.SECTION_ANSWER].strip()
+    if not answer_text and not reply.text[ai_streaming.SECTION_REASONING].strip():
+        ai_log.error("[AI DIALOGUE] Stream for model '%s' produced no content.", model)
+        return None, "API生成的回复内容为空"
+    if not answer_text:
+        ai_log.warning("[AI DIALOGUE] Model '%s' returned reasoning but no final content.", model)
+    ai_log.info("[AI DIALOGUE] Stream finished for model '%s'. First output %.2fs, %s sends / %s edits. Usage: %s",
+                model, reply.first_output_seconds or 0.0, reply.sends, reply.edits, usage)
+    return answer_text or None, None
 
-        # --- Helper Function: Generate HTML Transcript for Tickets ---
+# --- Helper Function: Generate HTML Transcript for Tickets ---
 async def generate_ticket_transcript_html(channel: discord.TextChannel) -> Optional[str]:
     """Generates an HTML transcript for the given text channel."""
     if not isinstance(channel, discord.TextChannel):
@@ -1069,7 +1155,7 @@ async def generate_ticket_transcript_html(channel: discord.TextChannel) -> Optio
 
 # --- 经济系统：持久化 ---
 def load_economy_data():
-    global user_balances, shop_items, guild_economy_settings, last_chat_earn_times
+    global user_balances, shop_items, last_chat_earn_times
     if not ECONOMY_ENABLED:
         return
     try:
@@ -1079,13 +1165,12 @@ def load_economy_data():
                 # 将字符串键转换回整数类型的 guild_id 和 user_id
                 user_balances = {int(gid): {int(uid): bal for uid, bal in u_bals.items()} for gid, u_bals in data.get("user_balances", {}).items()}
                 shop_items = {int(gid): items for gid, items in data.get("shop_items", {}).items()} # item_slug 保持为字符串
-                guild_economy_settings = {int(gid): settings for gid, settings in data.get("guild_economy_settings", {}).items()}
                 last_chat_earn_times = {int(gid): {int(uid): ts for uid, ts in u_times.items()} for gid, u_times in data.get("last_chat_earn_times", {}).items()}
-                print(f"[经济系统] 成功从 {ECONOMY_DATA_FILE} 加载数据。")
+                eco_log.info("[经济系统] 成功从 %s 加载数据。", ECONOMY_DATA_FILE)
     except json.JSONDecodeError:
-        print(f"[经济系统错误] 解析 {ECONOMY_DATA_FILE} 的 JSON 失败。将以空数据启动。")
+        eco_log.error("[经济系统错误] 解析 %s 的 JSON 失败。将以空数据启动。", ECONOMY_DATA_FILE)
     except Exception as e:
-        print(f"[经济系统错误] 加载经济数据失败: {e}")
+        eco_log.error("[经济系统错误] 加载经济数据失败: %s", e)
 
 def save_economy_data():
     if not ECONOMY_ENABLED:
@@ -1095,14 +1180,13 @@ def save_economy_data():
         data_to_save = {
             "user_balances": {str(gid): {str(uid): bal for uid, bal in u_bals.items()} for gid, u_bals in user_balances.items()},
             "shop_items": {str(gid): items for gid, items in shop_items.items()},
-            "guild_economy_settings": {str(gid): settings for gid, settings in guild_economy_settings.items()},
             "last_chat_earn_times": {str(gid): {str(uid): ts for uid, ts in u_times.items()} for gid, u_times in last_chat_earn_times.items()}
         }
         with open(ECONOMY_DATA_FILE, 'w', encoding='utf-8') as f:
             json.dump(data_to_save, f, indent=4, ensure_ascii=False)
         # print(f"[经济系统] 成功保存数据到 {ECONOMY_DATA_FILE}") # 每次保存都打印可能过于频繁
     except Exception as e:
-        print(f"[经济系统错误] 保存经济数据失败: {e}")
+        eco_log.error("[经济系统错误] 保存经济数据失败: %s", e)
 
 # --- 经济系统：辅助函数 ---
 def get_user_balance(guild_id: int, user_id: int) -> int:
@@ -1133,18 +1217,140 @@ def update_user_balance(guild_id: int, user_id: int, amount: int, is_delta: bool
     # save_economy_data() # 每次余额更新都保存可能过于频繁，应在特定事件后保存。
     return True
 
-def get_guild_chat_earn_config(guild_id: int) -> Dict[str, int]:
-    defaults = {
-        "amount": ECONOMY_CHAT_EARN_DEFAULT_AMOUNT,
-        "cooldown": ECONOMY_CHAT_EARN_DEFAULT_COOLDOWN_SECONDS
-    }
-    if guild_id in guild_economy_settings:
-        config = guild_economy_settings[guild_id]
-        return {
-            "amount": config.get("chat_earn_amount", defaults["amount"]), # 确保键名匹配
-            "cooldown": config.get("chat_earn_cooldown", defaults["cooldown"]) # 确保键名匹配
-        }
-    return defaults
+def get_purchase_failure_message(result: database.PurchaseResult, item_data: Dict[str, Any]) -> str:
+    """把 db_purchase_item 的失败状态转换为给用户看的提示。"""
+    item_name = item_data.get("name", "未知物品")
+    if result.status == database.PURCHASE_INSUFFICIENT_FUNDS:
+        return f"❌ 你的{ECONOMY_CURRENCY_NAME}不足以购买 **{item_name}** (需要 {item_data.get('price')}，你有 {result.balance})。"
+    if result.status == database.PURCHASE_OUT_OF_STOCK:
+        return f"❌ 抱歉，物品 **{item_name}** 已售罄。"
+    if result.status == database.PURCHASE_PRICE_CHANGED:
+        return f"❌ 物品 **{item_name}** 的价格刚刚发生了变化，请重新打开商店查看最新价格。"
+    if result.status == database.PURCHASE_ITEM_NOT_FOUND:
+        return f"❌ 无法找到物品 **{item_name}**。可能已被移除。"
+    return f"❌ 购买失败，更新数据时发生错误。请重试。"
+
+async def get_guild_chat_earn_config(guild_id: int) -> Dict[str, int]:
+    # 先查 database 的读缓存 (纯内存，不阻塞)；未命中才交给数据库读线程
+    config = database.peek_guild_chat_earn_config(guild_id, ECONOMY_CHAT_EARN_DEFAULT_AMOUNT, ECONOMY_CHAT_EARN_DEFAULT_COOLDOWN_SECONDS)
+    if config is None:
+        config = await async_database.db_get_guild_chat_earn_config(
+            guild_id, ECONOMY_CHAT_EARN_DEFAULT_AMOUNT, ECONOMY_CHAT_EARN_DEFAULT_COOLDOWN_SECONDS
+        )
+    return config
+
+async def migrate_legacy_chat_earn_settings() -> int:
+    """把旧版 JSON 中的 guild_economy_settings 写入数据库 (只补充数据库中还没有配置的服务器)，返回迁移的服务器数。
+
+    聊天赚钱配置现在只保存在数据库中；save_economy_data 不再写出该字段，旧文件中的值在这里迁移一次即可。
+    """
+    if not ECONOMY_ENABLED or not os.path.exists(ECONOMY_DATA_FILE):
+        return 0
+    try:
+        with open(ECONOMY_DATA_FILE, 'r', encoding='utf-8') as f:
+            legacy_settings = json.load(f).get("guild_economy_settings") or {}
+        configs = [(int(gid), int(settings.get("chat_earn_amount", ECONOMY_CHAT_EARN_DEFAULT_AMOUNT)),
+                    int(settings.get("chat_earn_cooldown", ECONOMY_CHAT_EARN_DEFAULT_COOLDOWN_SECONDS)))
+                   for gid, settings in legacy_settings.items()]
+    except (OSError, ValueError, TypeError, AttributeError) as e:
+        eco_log.error("[经济系统错误] 读取 %s 中的旧版聊天赚钱配置失败: %s", ECONOMY_DATA_FILE, e)
+        return 0
+    migrated = await async_database.db_seed_guild_chat_earn_configs(configs)
+    if migrated:
+        eco_log.info("[经济系统] 已把 %s 个服务器的旧版聊天赚钱配置迁移到数据库。", migrated)
+    return migrated or 0
+
+# --- 经济系统：聊天奖励写回缓冲 ---
+class ChatEarnAccumulator:
+    """
+    按 (guild_id, user_id) 在内存中合并聊天奖励，每隔 flush_interval 秒或条目数达到 max_entries 时，
+    通过一次 executemany 事务写入数据库。关闭机器人前必须调用 stop() 以写回剩余的奖励。
+    """
+    def __init__(self, flush_interval: float, max_entries: int):
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        self._pending: Dict[tuple, int] = {}
+        self._in_flight: Dict[tuple, int] = {} # 正在写入数据库的一批 (写入完成前仍计入 pending_amount)
+        self._flush_lock = asyncio.Lock()      # 同一时间只有一批在写入
+        self._flush_task: Optional[asyncio.Task] = None
+        self._timer_task: Optional[asyncio.Task] = None
+        self.stats = {"credits": 0, "flushes": 0, "rows_written": 0, "failed_flushes": 0}
+
+    def add(self, guild_id: int, user_id: int, amount: int):
+        key = (guild_id, user_id)
+        self._pending[key] = self._pending.get(key, 0) + amount
+        self.stats["credits"] += 1
+        if self._timer_task is None or self._timer_task.done():
+            self._timer_task = asyncio.create_task(self._flush_periodically())
+        if len(self._pending) >= self.max_entries:
+            self._start_flush()
+
+    @property
+    def pending_entries(self) -> int:
+        return len(self._pending)
+
+    def pending_amount(self, guild_id: int, user_id: int) -> int:
+        """尚未写入数据库的奖励金额 (含正在写入的一批，用于余额展示)。"""
+        key = (guild_id, user_id)
+        return self._pending.get(key, 0) + self._in_flight.get(key, 0)
+
+    def _start_flush(self) -> asyncio.Task:
+        """在后台任务中写回 (已有写回任务在运行时直接返回它)。"""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self.flush())
+        return self._flush_task
+
+    async def flush(self) -> int:
+        """把当前缓冲的所有增量写入数据库，返回写入的条目数。写入失败时增量会放回缓冲区。"""
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+            self._in_flight = batch
+            written = False
+            try:
+                credits = [(guild_id, user_id, amount) for (guild_id, user_id), amount in batch.items()]
+                written = await async_database.db_bulk_add_balances(credits, default_balance=ECONOMY_DEFAULT_BALANCE)
+            finally:
+                self._in_flight = {}
+                if not written:
+                    for key, amount in batch.items(): # 放回缓冲区，下次再试
+                        self._pending[key] = self._pending.get(key, 0) + amount
+                    self.stats["failed_flushes"] += 1
+            if not written:
+                return 0
+            self.stats["flushes"] += 1
+            self.stats["rows_written"] += len(credits)
+            return len(credits)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                # shield：定时任务被 stop() 取消时，进行中的写回照常完成
+                await asyncio.shield(self._start_flush())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                eco_log.error("[经济系统错误] 聊天奖励写回失败: %s", e)
+
+    async def stop(self) -> int:
+        """停止定时任务，等待进行中的写回完成，再写回剩余的奖励，返回最后一次写回的条目数。"""
+        if self._timer_task and not self._timer_task.done():
+            self._timer_task.cancel()
+            try:
+                await self._timer_task
+            except asyncio.CancelledError:
+                pass
+        if self._flush_task and not self._flush_task.done():
+            try:
+                await self._flush_task # 不能取消：已交换出去的一批可能正在写入数据库
+            except Exception as e:
+                eco_log.error("[经济系统错误] 聊天奖励写回失败: %s", e)
+        return await self.flush()
+
+chat_earn_accumulator = ChatEarnAccumulator(ECONOMY_CHAT_EARN_FLUSH_INTERVAL_SECONDS, ECONOMY_CHAT_EARN_FLUSH_MAX_ENTRIES)
+
 # --- 辅助函数 (如果还没有，添加 get_item_slug) ---
 def get_item_slug(item_name: str) -> str:
     return "_".join(item_name.lower().split()).strip() # 简单的 slug：小写，空格转下划线
@@ -1193,7 +1399,7 @@ async def grant_item_purchase(interaction: discord.Interaction, user: discord.Me
                 # print(f"[经济系统] 用户 {user.name} 已拥有物品 '{item_data['name']}' 的身份组。")
         else:
             await interaction.followup.send(f"⚠️ 物品 **{item_data['name']}** 关联的身份组ID `{role_id}` 无效或已被删除，请联系管理员。", ephemeral=True)
-            print(f"[经济系统错误] 服务器 {guild.id} 的物品 '{item_data['name']}' 关联的身份组ID {role_id} 无效。")
+            eco_log.error("[经济系统错误] 服务器 %s 的物品 '%s' 关联的身份组ID %s 无效。", guild.id, item_data['name'], role_id)
 
     # 如果指定，则发送自定义购买消息
     purchase_message = item_data.get("purchase_message")
@@ -1205,7 +1411,7 @@ async def grant_item_purchase(interaction: discord.Interaction, user: discord.Me
         except discord.Forbidden:
             await interaction.followup.send(f"ℹ️ 你购买了 **{item_data['name']}**！但我无法私信你发送额外信息（可能关闭了私信）。", ephemeral=True)
         except Exception as e:
-            print(f"[经济系统错误] 发送物品 '{item_data['name']}' 的购买私信给用户 {user.id} 时出错: {e}")
+            eco_log.error("[经济系统错误] 发送物品 '%s' 的购买私信给用户 %s 时出错: %s", item_data['name'], user.id, e)
 # --- Ticket Tool UI Views ---
 
 @bot.event
@@ -1243,19 +1449,14 @@ async def on_interaction(interaction: discord.Interaction):
                     user = interaction.user # interaction.user 就是点击按钮的用户 (discord.Member)
 
                     # item_to_buy_data = shop_items.get(guild_id, {}).get(item_slug_to_buy) # 内存版本
-                    item_to_buy_data = database.db_get_shop_item(guild_id, item_slug_to_buy) # 数据库版本
+                    item_to_buy_data = await async_database.db_get_shop_item(guild_id, item_slug_to_buy) # 数据库版本
 
                     if not item_to_buy_data:
                         await interaction.followup.send(f"❌ 无法找到物品 `{item_slug_to_buy}`。可能已被移除。", ephemeral=True)
                         return
 
                     item_price = item_to_buy_data['price']
-                    # user_balance = get_user_balance(guild_id, user.id) # 内存版本
-                    user_balance = database.db_get_user_balance(guild_id, user.id, ECONOMY_DEFAULT_BALANCE) # 数据库版本
-
-                    if user_balance < item_price:
-                        await interaction.followup.send(f"❌ 你的{ECONOMY_CURRENCY_NAME}不足以购买 **{item_to_buy_data['name']}** (需要 {item_price}，你有 {user_balance})。", ephemeral=True)
-                        return
+                    # 余额是否足够由 db_purchase_item 在事务内检查，这里不再预先查询
 
                     item_stock = item_to_buy_data.get("stock", -1)
                     if item_stock == 0:
@@ -1268,47 +1469,26 @@ async def on_interaction(interaction: discord.Interaction):
                             await interaction.followup.send(f"ℹ️ 你已经拥有物品 **{item_to_buy_data['name']}** 关联的身份组了。", ephemeral=True)
                             return
                     
-                    # 使用数据库的事务进行购买
-                    conn = database.get_db_connection()
-                    purchase_successful = False
-                    try:
-                        conn.execute("BEGIN")
-                        balance_updated = database.db_update_user_balance(guild_id, user.id, -item_price, default_balance=ECONOMY_DEFAULT_BALANCE)
-                        
-                        stock_updated_or_not_needed = True
-                        if balance_updated and item_stock != -1:
-                            new_stock = item_to_buy_data.get("stock", 0) - 1
-                            if not database.db_update_shop_item_stock(guild_id, item_slug_to_buy, new_stock): # 这个函数在 database.py 中
-                                 stock_updated_or_not_needed = False
-                        
-                        if balance_updated and stock_updated_or_not_needed:
-                            conn.commit()
-                            purchase_successful = True
-                        else:
-                            conn.rollback()
-                    except Exception as db_exc:
-                        if conn: conn.rollback()
-                        print(f"[Shop Buy Button DB Error] {db_exc}")
-                        await interaction.followup.send(f"❌ 购买时发生数据库错误。", ephemeral=True)
-                        return # 退出，不继续
-                    finally:
-                        if conn: conn.close()
-
-                    if purchase_successful:
+                    # 扣库存、扣余额、写购买记录在同一个数据库事务中完成 (连点按钮也不会超卖)
+                    purchase_result = await async_database.db_purchase_item(
+                        guild_id, user.id, item_slug_to_buy, item_price, default_balance=ECONOMY_DEFAULT_BALANCE
+                    )
+
+                    if purchase_result.success:
                         await grant_item_purchase(interaction, user, item_to_buy_data) # 这个函数负责授予身份组和发送私信
                         await interaction.followup.send(f"🎉 恭喜！你已成功购买 **{item_to_buy_data['name']}**！", ephemeral=True)
-                        print(f"[Economy][Button Buy] User {user.id} bought '{item_to_buy_data['name']}' for {item_price} in guild {guild_id}.")
+                        log.info("[Economy][Button Buy] User %s bought '%s' for %s in guild %s.", user.id, item_to_buy_data['name'], item_price, guild_id)
                         
                         # 可选: 更新原始商店消息中的库存显示（如果适用且可行）
                         # 这比较复杂，因为需要找到原始消息并修改其 embed 或 view
                         # 简单的做法是让用户重新执行 /eco shop 查看最新库存
                     else:
-                        await interaction.followup.send(f"❌ 购买失败，更新数据时发生错误。请重试。", ephemeral=True)
+                        await interaction.followup.send(get_purchase_failure_message(purchase_result, item_to_buy_data), ephemeral=True)
 
                 except ValueError: # int(parts[2]) 转换失败
                     await interaction.response.send_message("❌ 按钮ID格式错误。",ephemeral=True)
                 except Exception as e_button:
-                    print(f"Error processing shop_buy button: {e_button}")
+                    log.error("Error processing shop_buy button: %s", e_button)
                     if not interaction.response.is_done():
                         await interaction.response.send_message("处理购买时发生未知错误。",ephemeral=True)
                     else:
@@ -1340,25 +1520,31 @@ async def on_interaction(interaction: discord.Interaction):
 # --- Event: Bot Ready ---
 @bot.event
 async def on_ready():
-    print(f'以 {bot.user.name} ({bot.user.id}) 身份登录')
-
-    if ECONOMY_ENABLED: # 添加此块
-        database.initialize_database() # <--- 确保是调用这个！
-        print("[经济系统] 数据库已初始化，经济系统准备就绪。")
+    log.info("以 %s (%s) 身份登录", bot.user.name, bot.user.id)
 
-    print('正在同步应用程序命令...')
+    # 数据库同时保存经济系统与审核 / AI / 票据等状态，因此无论经济系统是否启用都要初始化
+    try:
+        await async_database.initialize_database() # <--- 确保是调用这个！(会执行未应用的结构迁移)
+        if ECONOMY_ENABLED:
+            log.info("[经济系统] 数据库已初始化，经济系统准备就绪。")
+        await load_persistent_bot_state()
+        await cleanup_temp_voice_channels()
+    except Exception as e_db_init:
+        log.error("❌ 数据库初始化或状态加载失败，经济系统及已保存的设置可能不可用: %s", e_db_init)
+
+    log.info("正在同步应用程序命令...")
     try:
         synced = await bot.tree.sync()
-        print(f'已全局同步 {len(synced)} 个应用程序命令。')
+        log.info("已全局同步 %s 个应用程序命令。", len(synced))
     except Exception as e:
-        print(f'同步命令时出错: {e}')
+        log.error("同步命令时出错: %s", e)
 
     # --- 检查持久化视图注册状态 (由 setup_hook 处理) ---
     if hasattr(bot, 'persistent_views_added_in_setup') and bot.persistent_views_added_in_setup:
-        print("ℹ️ 持久化视图 (CreateTicketView, CloseTicketView) 已由 setup_hook 正确注册。")
+        log.info("ℹ️ 持久化视图 (CreateTicketView, CloseTicketView) 已由 setup_hook 正确注册。")
     else:
         # 这种情况理论上不应该发生，如果发生了，说明 setup_hook 可能有其他问题
-        print("⚠️ 警告：持久化视图似乎未在 setup_hook 中注册。请检查 setup_hook 的执行日志和逻辑。")
+        log.warning("⚠️ 警告：持久化视图似乎未在 setup_hook 中注册。请检查 setup_hook 的执行日志和逻辑。")
         # （可选）如果你非常担心，并且希望有一个备用方案，可以取消下面代码的注释，
         # 但这通常不推荐，因为它掩盖了 setup_hook 可能存在的问题。
         # print("尝试在 on_ready 中作为备用方案注册视图...")
@@ -1374,13 +1560,7 @@ async def on_ready():
         # except Exception as e_on_ready_view_add:
         #     print(f"❌ 在 on_ready 中备用注册视图时发生未知错误: {e_on_ready_view_add}")
 
-    # --- 初始化 aiohttp session ---
-    if AIOHTTP_AVAILABLE and not hasattr(bot, 'http_session'):
-         bot.http_session = aiohttp.ClientSession()
-         print("已创建 aiohttp 会话。")
-
-    print('机器人已准备就绪！')
-    print('------')
+    log.info("机器人已准备就绪！")
     # 设置机器人状态
     await bot.change_presence(activity=discord.Game(name="/help 显示帮助"))
 
@@ -1427,17 +1607,17 @@ async def on_ready():
                 embed.set_footer(text="请谨慎发言 | Behave yourselves!")
                 try:
                     await startup_channel.send(embed=embed)
-                    print(f"✅ 已成功发送启动通知到频道 #{startup_channel.name} ({startup_channel.id})")
+                    log.info("✅ 已成功发送启动通知到频道 #%s (%s)", startup_channel.name, startup_channel.id)
                 except discord.Forbidden:
-                    print(f"❌ 发送启动通知失败：机器人缺少在频道 {STARTUP_MESSAGE_CHANNEL_ID} 发送消息或嵌入链接的权限。")
+                    log.warning("❌ 发送启动通知失败：机器人缺少在频道 %s 发送消息或嵌入链接的权限。", STARTUP_MESSAGE_CHANNEL_ID)
                 except Exception as e:
-                    print(f"❌ 发送启动通知时发生错误: {e}")
+                    log.error("❌ 发送启动通知时发生错误: %s", e)
             else:
-                print(f"❌ 发送启动通知失败：机器人在频道 {STARTUP_MESSAGE_CHANNEL_ID} 缺少发送消息或嵌入链接的权限。")
+                log.warning("❌ 发送启动通知失败：机器人在频道 %s 缺少发送消息或嵌入链接的权限。", STARTUP_MESSAGE_CHANNEL_ID)
         else:
-            print(f"⚠️ 未找到用于发送启动通知的频道 ID: {STARTUP_MESSAGE_CHANNEL_ID}。请检查配置。")
+            log.warning("⚠️ 未找到用于发送启动通知的频道 ID: %s。请检查配置。", STARTUP_MESSAGE_CHANNEL_ID)
     elif STARTUP_MESSAGE_CHANNEL_ID == 0: # Explicitly 0 means don't send
-        print(f"ℹ️ STARTUP_MESSAGE_CHANNEL_ID 设置为0，跳过发送启动通知。")
+        log.info("ℹ️ STARTUP_MESSAGE_CHANNEL_ID 设置为0，跳过发送启动通知。")
     # --- 启动通知结束 ---
 
 # 初始化持久化视图标志
@@ -1445,20 +1625,18 @@ bot.persistent_views_added = False
 
 # 为加载 cogs 添加 setup_hook
 async def setup_hook_for_bot(): # 重命名以避免与 bot 实例上的属性冲突
-    print("正在运行 setup_hook...")
+    log.info("正在运行 setup_hook...")
     
     # 加载音乐 Cog
     try:
         await bot.load_extension("music_cog") # 假设 music_cog.py 在同一目录
-        print("MusicCog 扩展已通过 setup_hook 成功加载。")
+        log.info("MusicCog 扩展已通过 setup_hook 成功加载。")
     except commands.ExtensionAlreadyLoaded:
-        print("MusicCog 扩展已被加载过。")
+        log.info("MusicCog 扩展已被加载过。")
     except commands.ExtensionNotFound:
-        print("错误：找不到 music_cog 扩展文件 (music_cog.py)。请确保它在正确的位置。")
+        log.error("错误：找不到 music_cog 扩展文件 (music_cog.py)。请确保它在正确的位置。")
     except Exception as e:
-        print(f"加载 music_cog 扩展失败: {type(e).__name__} - {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("加载 music_cog 扩展失败: %s - %s", type(e).__name__, e)
 
     # 注册持久化视图 (例如你的票据系统按钮)
     # 确保 CreateTicketView 和 CloseTicketView 类定义在 setup_hook_for_bot 定义之前
@@ -1469,7 +1647,7 @@ async def setup_hook_for_bot(): # 重命名以避免与 bot 实例上的属性
         bot.add_view(CloseTicketView()) 
         # MusicCog 中的按钮是动态添加到消息上的，不需要在这里全局注册
         bot.persistent_views_added_in_setup = True
-        print("持久化视图 (CreateTicketView, CloseTicketView) 已在 setup_hook 中注册。")
+        log.info("持久化视图 (CreateTicketView, CloseTicketView) 已在 setup_hook 中注册。")
     
     # 注意：应用命令的同步 (bot.tree.sync()) 通常在 on_ready 中进行，
     # 或者在所有 cogs 加载完毕后进行一次。
@@ -1498,7 +1676,7 @@ async def on_command_error(ctx, error):
          except discord.Forbidden:
              pass
     else:
-        print(f"处理旧命令 '{ctx.command}' 时出错: {error}")
+        log.error("处理旧命令 '%s' 时出错: %s", ctx.command, error)
 
 
 # --- Event: App Command Error Handling (Slash Commands) ---
@@ -1521,7 +1699,7 @@ async def on_app_command_error(interaction: discord.Interaction, error: app_comm
          error_message = f"⏳ 指令冷却中，请在 {error.retry_after:.2f} 秒后重试。"
     elif isinstance(error, app_commands.CommandInvokeError):
         original = error.original # 获取原始错误
-        print(f"指令 '{interaction.command.name if interaction.command else '未知'}' 执行失败: {type(original).__name__} - {original}") # 在后台打印详细错误
+        log.error("指令 '%s' 执行失败: %s - %s", interaction.command.name if interaction.command else '未知', type(original).__name__, original) # 在后台打印详细错误
         if isinstance(original, discord.Forbidden):
             error_message = f"🚫 Discord权限错误：我无法执行此操作（通常是身份组层级问题或频道权限不足）。请检查机器人的权限和身份组位置。"
         elif isinstance(original, discord.HTTPException):
@@ -1532,7 +1710,7 @@ async def on_app_command_error(interaction: discord.Interaction, error: app_comm
             error_message = f"⚙️ 执行指令时发生内部错误。请联系管理员。错误类型: {type(original).__name__}" # 对用户显示通用错误
     else:
         # 其他未预料到的 AppCommandError
-        print(f'未处理的应用指令错误类型: {type(error).__name__} - {error}')
+        log.error("未处理的应用指令错误类型: %s - %s", type(error).__name__, error)
         error_message = f"🔧 处理指令时发生意外错误: {type(error).__name__}"
 
     try:
@@ -1543,10 +1721,10 @@ async def on_app_command_error(interaction: discord.Interaction, error: app_comm
             await interaction.response.send_message(error_message, ephemeral=ephemeral_response)
     except discord.NotFound:
         # If the interaction is gone (e.g., user dismissed), just log
-        print(f"无法发送错误消息，交互已失效: {error_message}")
+        log.info("无法发送错误消息，交互已失效: %s", error_message)
     except Exception as e:
         # 如果连发送错误消息都失败了，就在后台打印
-        print(f"发送错误消息时也发生错误: {e}")
+        log.error("发送错误消息时也发生错误: %s", e)
 
 # 将错误处理函数绑定到 bot 的指令树
 bot.tree.on_error = on_app_command_error
@@ -1555,7 +1733,7 @@ bot.tree.on_error = on_app_command_error
 @bot.event
 async def on_member_join(member: discord.Member):
     guild = member.guild
-    print(f'[+] 成员加入: {member.name} ({member.id}) 加入了服务器 {guild.name} ({guild.id})')
+    log.info("[+] 成员加入: %s (%s) 加入了服务器 %s (%s)", member.name, member.id, guild.name, guild.id)
 
     # --- 自动分配分隔线身份组 ---
     # !!! 重要：将下面的身份组名称替换为你服务器中实际的分隔线身份组名称 !!!
@@ -1583,19 +1761,19 @@ async def on_member_join(member: discord.Member):
         try:
             await member.add_roles(*roles_to_add, reason="新成员自动分配分隔线身份组")
             added_names = ', '.join([r.name for r in roles_to_add])
-            print(f"   ✅ 已为 {member.name} 分配身份组: {added_names}")
+            log.info("✅ 已为 %s 分配身份组: %s", member.name, added_names)
         except discord.Forbidden:
-            print(f"   ❌ 为 {member.name} 分配身份组失败：机器人缺少 '管理身份组' 权限。")
+            log.warning("❌ 为 %s 分配身份组失败：机器人缺少 '管理身份组' 权限。", member.name)
             roles_failed.extend([f"'{r.name}' (权限不足)" for r in roles_to_add])
         except discord.HTTPException as e:
-             print(f"   ❌ 为 {member.name} 分配身份组时发生网络错误: {e}")
+             log.error("❌ 为 %s 分配身份组时发生网络错误: %s", member.name, e)
              roles_failed.extend([f"'{r.name}' (网络错误)" for r in roles_to_add])
         except Exception as e:
-            print(f"   ❌ 为 {member.name} 分配身份组时发生未知错误: {e}")
+            log.error("❌ 为 %s 分配身份组时发生未知错误: %s", member.name, e)
             roles_failed.extend([f"'{r.name}' (未知错误)" for r in roles_to_add])
 
     if roles_failed:
-        print(f"   ‼️ 部分身份组未能成功分配给 {member.name}: {', '.join(roles_failed)}")
+        log.info("‼️ 部分身份组未能成功分配给 %s: %s", member.name, ', '.join(roles_failed))
 
     # --- (可选) 发送欢迎消息 ---
     # !!! 重要：将下面的频道 ID 替换为你服务器的实际频道 ID !!!
@@ -1639,17 +1817,17 @@ async def on_member_join(member: discord.Member):
                 embed.timestamp = datetime.datetime.now(datetime.timezone.utc) # 加入时间戳
 
                 await welcome_channel.send(embed=embed)
-                print(f"   ✅ 已在频道 {welcome_channel.name} 发送对 {member.name} 的欢迎消息。")
+                log.info("✅ 已在频道 %s 发送对 %s 的欢迎消息。", welcome_channel.name, member.name)
             except discord.Forbidden:
-                 print(f"   ❌ 发送欢迎消息失败：机器人缺少在欢迎频道 {welcome_channel_id} 发送消息或嵌入链接的权限。")
+                 log.warning("❌ 发送欢迎消息失败：机器人缺少在欢迎频道 %s 发送消息或嵌入链接的权限。", welcome_channel_id)
             except Exception as e:
-                print(f"   ❌ 发送欢迎消息时发生错误: {e}")
+                log.error("❌ 发送欢迎消息时发生错误: %s", e)
         else:
-            print(f"   ❌ 发送欢迎消息失败：机器人在欢迎频道 {welcome_channel_id} 缺少发送消息或嵌入链接的权限。")
+            log.warning("❌ 发送欢迎消息失败：机器人在欢迎频道 %s 缺少发送消息或嵌入链接的权限。", welcome_channel_id)
     else:
         # Check if the ID is the default placeholder before printing warning
         if welcome_channel_id != 1280014596765126669:
-             print(f"⚠️ 在服务器 {guild.name} 中找不到欢迎频道 ID: {welcome_channel_id}。")
+             log.warning("⚠️ 在服务器 %s 中找不到欢迎频道 ID: %s。", guild.name, welcome_channel_id)
 
 
 # --- Event: On Message - Handles Content Check, Spam ---
@@ -1659,7 +1837,7 @@ async def on_member_join(member: discord.Member):
         guild_whitelist = bot.approved_bot_whitelist.get(guild.id, set())
 
         if member.id not in guild_whitelist:
-            print(f"[Bot Control] 未经批准的机器人 {member.name} ({member.id}) 尝试加入服务器 {guild.name}。正在踢出...")
+            log.info("[Bot Control] 未经批准的机器人 %s (%s) 尝试加入服务器 %s。正在踢出...", member.name, member.id, guild.name)
             kick_reason = "未经授权的机器人自动踢出。请联系服务器所有者将其ID加入白名单后重试。"
             try:
                 if guild.me.guild_permissions.kick_members:
@@ -1676,14 +1854,14 @@ async def on_member_join(member: discord.Member):
                                 timestamp=discord.utils.utcnow()
                             )
                             await guild.owner.send(embed=owner_embed)
-                            print(f"  - 已通知服务器所有者 ({guild.owner.name}) 关于机器人 {member.name} 的自动踢出。")
+                            log.info("已通知服务器所有者 (%s) 关于机器人 %s 的自动踢出。", guild.owner.name, member.name)
                         except discord.Forbidden:
-                            print(f"  - 无法私信通知服务器所有者 ({guild.owner.name})：TA可能关闭了私信或屏蔽了机器人。")
+                            log.info("无法私信通知服务器所有者 (%s)：TA可能关闭了私信或屏蔽了机器人。", guild.owner.name)
                         except Exception as dm_e:
-                            print(f"  - 私信通知服务器所有者时发生错误: {dm_e}")
+                            log.warning("私信通知服务器所有者时发生错误: %s", dm_e)
 
                     await member.kick(reason=kick_reason)
-                    print(f"  - ✅ 成功踢出机器人 {member.name} ({member.id})。")
+                    log.info("✅ 成功踢出机器人 %s (%s)。", member.name, member.id)
 
                     log_embed = discord.Embed(title="🤖 未授权机器人被踢出", color=discord.Color.orange(), timestamp=discord.utils.utcnow())
                     log_embed.add_field(name="机器人", value=f"{member.mention} (`{member.id}`)", inline=False)
@@ -1691,16 +1869,16 @@ async def on_member_join(member: discord.Member):
                     log_embed.add_field(name="操作", value="自动踢出 (不在白名单)", inline=False)
                     await send_to_public_log(guild, log_embed, "Unauthorized Bot Kicked")
                 else:
-                    print(f"  - ❌ 无法踢出机器人 {member.name}：机器人缺少 '踢出成员' 权限。")
+                    log.warning("❌ 无法踢出机器人 %s：机器人缺少 '踢出成员' 权限。", member.name)
                     if guild.owner:
                         try: await guild.owner.send(f"⚠️ 警告：机器人 **{member.name}** (`{member.id}`) 尝试加入服务器 **{guild.name}** 但我缺少踢出它的权限！请手动处理或授予我 '踢出成员' 权限。")
                         except: pass
             except discord.Forbidden:
-                print(f"  - ❌ 无法踢出机器人 {member.name}：权限不足 (可能是层级问题)。")
+                log.warning("❌ 无法踢出机器人 %s：权限不足 (可能是层级问题)。", member.name)
             except Exception as e:
-                print(f"  - ❌ 踢出机器人 {member.name} 时发生未知错误: {e}")
+                log.error("❌ 踢出机器人 %s 时发生未知错误: %s", member.name, e)
         else:
-            print(f"[Bot Control] 已批准的机器人 {member.name} ({member.id}) 加入了服务器 {guild.name}。")
+            log.info("[Bot Control] 已批准的机器人 %s (%s) 加入了服务器 %s。", member.name, member.id, guild.name)
             if guild.owner:
                 try:
                     await guild.owner.send(f"ℹ️ 白名单中的机器人 **{member.name}** (`{member.id}`) 已加入你的服务器 **{guild.name}**。")
@@ -1718,20 +1896,22 @@ async def on_member_join(member: discord.Member):
 
 
 # --- 新增：处理 AI 对话的辅助函数 (你之前已经添加了这个，确保它在 on_message 之前) ---
-async def handle_ai_dialogue(message: discord.Message, is_private_chat: bool = False, dep_channel_config: Optional[dict] = None):
+async def handle_ai_dialogue(message: discord.Message, is_private_chat: bool = False, dep_channel_config: Optional[dict] = None,
+                             prompt_text: Optional[str] = None):
     """
     处理来自 AI DEP 频道或 AI 私聊频道的用户消息，并与 DeepSeek AI 交互。
     :param message: discord.Message 对象
     :param is_private_chat: bool, 是否为私聊频道
     :param dep_channel_config: dict, 如果是DEP频道，则传入其配置
+    :param prompt_text: str, 合并后的提问文本 (连续多条消息合并为一个回合时)，默认使用 message.content
     """
     user = message.author
     channel = message.channel
     guild = message.guild # guild is part of message object
 
-    user_prompt_text = message.content.strip()
+    user_prompt_text = (prompt_text if prompt_text is not None else message.content).strip()
     if not user_prompt_text:
-        if message.attachments: print(f"[AI DIALOGUE HANDLER] Message in {channel.id} from {user.id} has attachments but no text, ignoring.")
+        if message.attachments: ai_log.debug("[AI DIALOGUE HANDLER] Message in %s from %s has attachments but no text, ignoring.", channel.id, user.id)
         return
 
     history_key = None
@@ -1741,11 +1921,11 @@ async def handle_ai_dialogue(message: discord.Message, is_private_chat: bool = F
     if is_private_chat:
         chat_info = active_private_ai_chats.get(channel.id)
         if not chat_info :
-            print(f"[AI DIALOGUE HANDLER] Private chat {channel.id} - chat_info not found in active_private_ai_chats dict.")
+            ai_log.warning("[AI DIALOGUE HANDLER] Private chat %s - chat_info not found in active_private_ai_chats dict.", channel.id)
             return
         
         if chat_info.get("user_id") != user.id and user.id != bot.user.id:
-             print(f"[AI DIALOGUE HANDLER] Private chat {channel.id} - message from non-owner {user.id} (owner: {chat_info.get('user_id')}). Ignoring.")
+             ai_log.debug("[AI DIALOGUE HANDLER] Private chat %s - message from non-owner %s (owner: %s). Ignoring.", channel.id, user.id, chat_info.get('user_id'))
              return
 
         history_key = chat_info.get("history_key")
@@ -1756,29 +1936,24 @@ async def handle_ai_dialogue(message: discord.Message, is_private_chat: bool = F
         dialogue_model = dep_channel_config.get("model", DEFAULT_AI_DIALOGUE_MODEL)
         system_prompt_for_api = dep_channel_config.get("system_prompt") # 获取频道配置的系统提示
     else:
-        print(f"[AI DIALOGUE HANDLER ERROR] Called without private_chat flag or dep_channel_config for channel {channel.id}")
+        ai_log.error("[AI DIALOGUE HANDLER] Called without private_chat flag or dep_channel_config for channel %s", channel.id)
         return
 
     if not history_key or not dialogue_model:
-        print(f"[AI DIALOGUE HANDLER ERROR] Missing history_key or dialogue_model for channel {channel.id}. HK:{history_key}, DM:{dialogue_model}")
+        ai_log.error("[AI DIALOGUE HANDLER] Missing history_key or dialogue_model for channel %s. HK:%s, DM:%s", channel.id, history_key, dialogue_model)
         try: await channel.send("❌ AI 对话关键配置丢失，请联系管理员。", delete_after=10)
         except: pass
         return
     
-    if history_key not in conversation_histories:
-        conversation_histories[history_key] = deque(maxlen=MAX_AI_HISTORY_TURNS * 2)
-    history_deque = conversation_histories[history_key]
-
-    api_messages = []
+    history_messages = await ai_conversations.get_history(history_key)
 
     # --- 整合服务器知识库和频道系统提示 ---
     knowledge_base_content = ""
-    # 确保 guild_knowledge_bases 已在文件顶部定义
-    if guild and guild.id in guild_knowledge_bases and guild_knowledge_bases[guild.id]:
-        knowledge_base_content += "\n\n--- 服务器知识库信息 (请优先参考以下内容回答服务器特定问题) ---\n"
-        for i, entry in enumerate(guild_knowledge_bases[guild.id]):
-            knowledge_base_content += f"{i+1}. {entry}\n"
-        knowledge_base_content += "--- 服务器知识库信息结束 ---\n"
+    # 小知识库整体放入 (按服务器缓存，知识库变化时失效)；大知识库按本次提问检索最相关的条目
+    if guild:
+        kb_snapshot = await knowledge_base.get_snapshot(guild.id)
+        knowledge_base_content = dialogue_context_builder.knowledge_block(
+            guild.id, kb_snapshot.entries, dialogue_model, user_prompt_text, kb_snapshot.version)
 
     effective_system_prompt = ""
     if system_prompt_for_api: # 使用从DEP频道配置中获取的 system_prompt_for_api
@@ -1790,48 +1965,33 @@ async def handle_ai_dialogue(message: discord.Message, is_private_chat: bool = F
         else:
             effective_system_prompt = knowledge_base_content.strip()
 
-    if effective_system_prompt:
-        api_messages.append({"role": "system", "content": effective_system_prompt})
     # --- 服务器知识库与系统提示整合结束 ---
-    
-    for msg_entry in history_deque:
-        if msg_entry.get("role") in ["user", "assistant"] and "content" in msg_entry and msg_entry.get("content") is not None:
-            api_messages.append({"role": msg_entry["role"], "content": msg_entry["content"]})
-    
-    api_messages.append({"role": "user", "content": user_prompt_text})
 
-    # 更新的 print 语句
-    print(f"[AI DIALOGUE HANDLER] Processing for {('Private' if is_private_chat else 'DEP')} Channel {channel.id}, User {user.id}, Model {dialogue_model}, HistKey {history_key}, SysP: {effective_system_prompt != ''}")
+    # 在模型的 token 预算内组装消息：历史放不下时先丢最旧的轮次，被丢弃的部分压缩为摘要
+    dialogue_context = dialogue_context_builder.build(dialogue_model, effective_system_prompt, history_messages, user_prompt_text)
+    api_messages = dialogue_context.messages
 
-    try:
-        async with channel.typing():
-            # 确保 aiohttp 已导入
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300)) as session:
-                response_embed_text, final_content_hist, api_error = await get_deepseek_dialogue_response(
-                    session, DEEPSEEK_API_KEY, dialogue_model, api_messages
-                )
-        
-        if api_error:
-            try: await channel.send(f"🤖 处理您的请求时出现错误：\n`{api_error}`")
-            except: pass
-            return
+    ai_log.debug("[AI DIALOGUE HANDLER] Processing for %s Channel %s, User %s, Model %s, HistKey %s, SysP: %s, ~%s/%s tokens, history kept %s dropped %s",
+                 'Private' if is_private_chat else 'DEP', channel.id, user.id, dialogue_model, history_key, effective_system_prompt != '',
+                 dialogue_context.prompt_tokens, dialogue_context.budget, dialogue_context.kept_messages, dialogue_context.dropped_messages)
 
-        if response_embed_text:
-            history_deque.append({"role": "user", "content": user_prompt_text})
-            if final_content_hist is not None:
-                history_deque.append({"role": "assistant", "content": final_content_hist})
-            else:
-                 print(f"[AI DIALOGUE HANDLER] No 'final_content_hist' (was None) to add to history. HK: {history_key}")
+    model_display_name_parts = dialogue_model.split('-')
+    model_short_name = model_display_name_parts[-1].capitalize() if len(model_display_name_parts) > 1 else dialogue_model.capitalize()
+    footer_model_info = dialogue_model
+    # 更新的 footer 文本逻辑
+    if effective_system_prompt and not is_private_chat : # 如果存在有效的系统提示 (可能包含知识库)
+        footer_model_info += " (有系统提示/知识库)"
+    elif effective_system_prompt and is_private_chat : # 私聊也可能有知识库影响
+        footer_model_info += " (受知识库影响)"
 
-            embed = discord.Embed(
-                color=discord.Color.blue() if is_private_chat else discord.Color.green(),
-                timestamp=discord.utils.utcnow()
-            )
+    def make_dialogue_embed(footer_text: str, with_question: bool = True) -> discord.Embed:
+        embed = discord.Embed(
+            color=discord.Color.blue() if is_private_chat else discord.Color.green(),
+            timestamp=discord.utils.utcnow()
+        )
+        if with_question:
             author_name_prefix = f"{user.display_name} " if not is_private_chat else ""
-            model_display_name_parts = dialogue_model.split('-')
-            model_short_name = model_display_name_parts[-1].capitalize() if len(model_display_name_parts) > 1 else dialogue_model.capitalize()
             embed_author_name = f"{author_name_prefix}与 {model_short_name} 对话中"
-
             if user.avatar:
                 embed.set_author(name=embed_author_name, icon_url=user.display_avatar.url)
             else:
@@ -1839,48 +1999,156 @@ async def handle_ai_dialogue(message: discord.Message, is_private_chat: bool = F
 
             if not is_private_chat:
                  embed.add_field(name="👤 提问者", value=user.mention, inline=False)
-            
+
             q_display = user_prompt_text
             if len(q_display) > 1000 : q_display = q_display[:1000] + "..."
             embed.add_field(name=f"💬 {('你的' if is_private_chat else '')}问题:", value=f"```{q_display}```", inline=False)
-            
-            if len(response_embed_text) <= 4050:
-                embed.description = response_embed_text
-            else:
-                embed.add_field(name="🤖 AI 回复 (部分):", value=response_embed_text[:1020] + "...", inline=False)
-                print(f"[AI DIALOGUE HANDLER] WARN: AI response for {channel.id} was very long and truncated for Embed field.")
 
-            footer_model_info = dialogue_model
-            # 更新的 footer 文本逻辑
-            if effective_system_prompt and not is_private_chat : # 如果存在有效的系统提示 (可能包含知识库)
-                footer_model_info += " (有系统提示/知识库)"
-            elif effective_system_prompt and is_private_chat : # 私聊也可能有知识库影响
-                footer_model_info += " (受知识库影响)"
+        if bot.user.avatar:
+            embed.set_footer(text=footer_text, icon_url=bot.user.display_avatar.url)
+        else:
+            embed.set_footer(text=footer_text)
+        return embed
+
+    def render_stream_page(section: str, index: int, text: str, final: bool) -> discord.Embed:
+        # 思考过程与最终回答分开显示；超过一页的内容续写到新的消息中
+        if section == ai_streaming.SECTION_REASONING:
+            embed = discord.Embed(title="🤔 思考过程" if index == 0 else f"🤔 思考过程 (续 {index + 1})",
+                                  description=f"```\n{text.strip()}\n```", color=discord.Color.light_grey())
+            embed.set_footer(text="思考完成" if final else "思考中…")
+            return embed
+        footer_text = f"模型: {footer_model_info} | {bot.user.name}" if final else f"模型: {footer_model_info} | 生成中…"
+        embed = make_dialogue_embed(footer_text, with_question=index == 0)
+        if index > 0:
+            embed.title = f"💬 回答 (续 {index + 1})"
+        embed.description = text
+        return embed
+
+    async def send_stream_page(section: str, index: int, text: str, final: bool):
+        return await channel.send(embed=render_stream_page(section, index, text, final))
+
+    async def edit_stream_page(page_message: discord.Message, section: str, index: int, text: str, final: bool):
+        try: await page_message.edit(embed=render_stream_page(section, index, text, final))
+        except discord.NotFound: ai_log.debug("[AI DIALOGUE HANDLER] Streaming message in %s was deleted, skipping edit.", channel.id)
+
+    session = http_client.get_session() # 共享会话：复用连接池中的 keep-alive 连接
+    if session is None:
+        ai_log.error("[AI DIALOGUE HANDLER] aiohttp is not available, cannot call DeepSeek for channel %s.", channel.id)
+        try: await channel.send("❌ AI 对话功能不可用 (缺少 aiohttp)，请联系管理员。", delete_after=10)
+        except: pass
+        return
 
+    try:
+        if AI_DIALOGUE_STREAMING:
+            reply = ai_streaming.StreamingReply(send_stream_page, edit_stream_page)
+            async with channel.typing():
+                final_content_hist, api_error = await stream_deepseek_dialogue_response(
+                    session, dialogue_model, api_messages, reply, guild_id=guild.id if guild else None
+                )
+            if reply.has_output:
+                await reply.finish()
+                if reply.first_output_seconds is not None:
+                    ai_dialogue_first_output_latency.observe(reply.first_output_seconds)
+            if api_error:
+                try: await channel.send(f"🤖 处理您的请求时出现错误：\n`{api_error}`")
+                except: pass
+                return
+            await ai_conversations.append_turn(history_key, user_prompt_text, final_content_hist)
+            if final_content_hist is None:
+                 ai_log.debug("[AI DIALOGUE HANDLER] No 'final_content_hist' (was None) to add to history. HK: %s", history_key)
+            return
 
-            if bot.user.avatar:
-                embed.set_footer(text=f"模型: {footer_model_info} | {bot.user.name}", icon_url=bot.user.display_avatar.url)
+        async with channel.typing():
+            response_embed_text, final_content_hist, api_error = await get_deepseek_dialogue_response(
+                session, dialogue_model, api_messages, guild_id=guild.id if guild else None
+            )
+        
+        if api_error:
+            try: await channel.send(f"🤖 处理您的请求时出现错误：\n`{api_error}`")
+            except: pass
+            return
+
+        if response_embed_text:
+            await ai_conversations.append_turn(history_key, user_prompt_text, final_content_hist)
+            if final_content_hist is None:
+                 ai_log.debug("[AI DIALOGUE HANDLER] No 'final_content_hist' (was None) to add to history. HK: %s", history_key)
+
+            embed = make_dialogue_embed(f"模型: {footer_model_info} | {bot.user.name}")
+            if len(response_embed_text) <= 4050:
+                embed.description = response_embed_text
             else:
-                embed.set_footer(text=f"模型: {footer_model_info} | {bot.user.name}")
+                embed.add_field(name="🤖 AI 回复 (部分):", value=response_embed_text[:1020] + "...", inline=False)
+                ai_log.warning("[AI DIALOGUE HANDLER] AI response for %s was very long and truncated for Embed field.", channel.id)
             
             try: await channel.send(embed=embed)
-            except Exception as send_e: print(f"[AI DIALOGUE HANDLER] Error sending embed to {channel.id}: {send_e}")
+            except Exception as send_e: ai_log.error("[AI DIALOGUE HANDLER] Error sending embed to %s: %s", channel.id, send_e)
 
         else:
-            print(f"[AI DIALOGUE HANDLER ERROR] 'response_embed_text' was None/empty after no API error. HK: {history_key}")
+            ai_log.error("[AI DIALOGUE HANDLER] 'response_embed_text' was None/empty after no API error. HK: %s", history_key)
             try: await channel.send("🤖 抱歉，AI 未能生成有效的回复内容。")
             except: pass
 
     except Exception as e:
-        print(f"[AI DIALOGUE HANDLER EXCEPTION] Unexpected error in channel {channel.id}. User: {user.id}. Error: {type(e).__name__} - {str(e)}")
-        import traceback
-        traceback.print_exc()
+        ai_log.exception("[AI DIALOGUE HANDLER] Unexpected error in channel %s. User: %s. Error: %s - %s", channel.id, user.id, type(e).__name__, str(e))
         try:
             await channel.send(f"🤖 处理消息时发生内部错误 ({type(e).__name__})，请联系管理员。")
         except Exception as send_err:
-            print(f"[AI DIALOGUE HANDLER SEND ERROR] Could not send internal error to channel {channel.id}. Secondary: {send_err}")
+            ai_log.error("[AI DIALOGUE HANDLER] Could not send internal error to channel %s. Secondary: %s", channel.id, send_err)
 # --- (handle_ai_dialogue 函数定义结束) ---
 
+# --- AI 对话回合排队：同一对话的回合串行执行，同一用户的连续消息合并为一个回合 ---
+async def run_ai_dialogue_turn(turn: ai_dialogue_queue.DialogueTurn):
+    """由 ai_dialogue_scheduler 调用。执行时重新读取频道配置 (排队期间频道可能已被取消设置)。"""
+    message = turn.latest
+    channel_id = message.channel.id
+    if channel_id in ai_dep_channels_config:
+        await handle_ai_dialogue(message, is_private_chat=False, dep_channel_config=ai_dep_channels_config[channel_id], prompt_text=turn.text)
+    elif channel_id in active_private_ai_chats:
+        await handle_ai_dialogue(message, is_private_chat=True, prompt_text=turn.text)
+
+ai_dialogue_scheduler = ai_dialogue_queue.DialogueScheduler(run_ai_dialogue_turn)
+
+async def submit_ai_dialogue(message: discord.Message, history_key: Optional[str]):
+    """把 AI 频道中的消息交给排队器 (on_message 不等待生成完成)。"""
+    text = message.content.strip()
+    if not text:
+        if message.attachments: ai_log.debug("[AI DIALOGUE] Message in %s from %s has attachments but no text, ignoring.", message.channel.id, message.author.id)
+        return
+    key = history_key or f"ai_channel_{message.channel.id}"
+    if not ai_dialogue_scheduler.submit(key, message.guild.id if message.guild else None, message.author.id, text, message):
+        try: await message.channel.send(f"⏳ {message.author.mention} AI 还在处理之前的消息，请稍后再发送。", delete_after=8)
+        except discord.HTTPException: pass
+
+
+# --- 后台 AI 内容审核 (由 moderation_queue 的 worker 调用，on_message 不等待) ---
+async def moderate_message_in_background(message: discord.Message):
+    violation_type_from_api_check = await check_message_with_deepseek(message.content)
+    if not violation_type_from_api_check:
+        return
+    author, channel, guild = message.author, message.channel, message.guild
+    author_id = author.id
+    mod_log.info("[Moderation] VIOLATION (API Content Check): User %s in #%s. Type: %s", author_id, channel.name, violation_type_from_api_check)
+    delete_success = False
+    try:
+        if channel.permissions_for(guild.me).manage_messages:
+            await message.delete()
+            delete_success = True
+            mod_log.debug("Deleted message (API Violation) by %s", author_id)
+    except discord.NotFound: mod_log.debug("Message by %s was already deleted before the verdict arrived", author_id)
+    except Exception as del_e: mod_log.error("Error deleting message (API violation): %s", del_e)
+
+    mod_mentions = " ".join([f"<@&{role_id}>" for role_id in MOD_ALERT_ROLE_IDS])
+    log_embed_api = discord.Embed(title=f"🚨 自动内容审核 ({violation_type_from_api_check}) 🚨", color=discord.Color.dark_red(), timestamp=message.created_at)
+    log_embed_api.add_field(name="用户", value=f"{author.mention} ({author_id})", inline=False)
+    log_embed_api.add_field(name="频道", value=channel.mention, inline=False)
+    log_embed_api.add_field(name="内容摘要", value=f"```{message.content[:1000]}```", inline=False)
+    log_embed_api.add_field(name="消息状态", value="已删除" if delete_success else "删除失败/无权限", inline=True)
+    log_embed_api.add_field(name="消息链接", value=f"[原始链接]({message.jump_url}) (可能已删除)", inline=True)
+    log_embed_api.add_field(name="建议操作", value=f"{mod_mentions} 请管理员审核！", inline=False)
+    await send_to_public_log(guild, log_embed_api, log_type=f"API Violation ({violation_type_from_api_check})")
+
+moderation_queue = ai_moderation.ModerationQueue(moderate_message_in_background)
+
 
 # --- Event: On Message - Handles AI Dialogues, Content Check, Spam ---
 @bot.event
@@ -1901,12 +2169,12 @@ async def on_message(message: discord.Message):
 
                 guild = bot.get_guild(guild_id)
                 if not guild:
-                    print(f"[RelayMsg ERROR] Guild {guild_id} not found for session from DM {message.reference.message_id}")
+                    mod_log.warning("[RelayMsg] Guild %s not found for session from DM %s", guild_id, message.reference.message_id)
                     return
 
                 original_channel = guild.get_channel(original_channel_id)
                 if not original_channel or not isinstance(original_channel, discord.TextChannel): # 或 Thread
-                    print(f"[RelayMsg ERROR] Original channel {original_channel_id} not found or not text/thread for session.")
+                    mod_log.warning("[RelayMsg] Original channel %s not found or not text/thread for session.", original_channel_id)
                     # 可以考虑私信通知发起者，他的原始频道找不到了
                     return
 
@@ -1934,7 +2202,7 @@ async def on_message(message: discord.Message):
                         content=f"<@{initiator_id}>，你收到了对匿名消息的回复：", # Ping 发起者
                         embed=reply_embed
                     )
-                    print(f"[RelayMsg] Relayed reply from Target {target_id} (DM) to Initiator {initiator_id} in channel {original_channel_id}")
+                    mod_log.info("[RelayMsg] Relayed reply from Target %s (DM) to Initiator %s in channel %s", target_id, initiator_id, original_channel_id)
                     # 可选：私信用户B，告知他们的回复已成功转发
                     await message.author.send("✅ 你的回复已成功转发。", delete_after=30)
 
@@ -1943,10 +2211,10 @@ async def on_message(message: discord.Message):
                     # 如果要做更复杂的会话追踪，ANONYMOUS_RELAY_SESSIONS 结构需要调整
 
                 except discord.Forbidden:
-                    print(f"[RelayMsg ERROR] Bot lacks permission to send message in original channel {original_channel_id}")
+                    mod_log.warning("[RelayMsg] Bot lacks permission to send message in original channel %s", original_channel_id)
                     # 可以尝试私信通知发起者转发失败
                 except Exception as e:
-                    print(f"[RelayMsg ERROR] Relaying DM reply: {e}")
+                    mod_log.error("[RelayMsg] Relaying DM reply: %s", e)
                 return # 处理完这条DM回复后，不再进行后续的on_message逻辑
 
 
@@ -1972,16 +2240,15 @@ async def on_message(message: discord.Message):
     
     # --- 1. 检查是否为配置的 AI DEP 频道的消息 ---
     if channel.id in ai_dep_channels_config:
-        print(f"[OnMessage] Message in AI DEP Channel: {channel.id} from {author_id}")
+        mod_log.debug("[OnMessage] Message in AI DEP Channel: %s from %s", channel.id, author_id)
         dep_config = ai_dep_channels_config[channel.id]
-        # 确保 handle_ai_dialogue 定义在 on_message 之前
-        await handle_ai_dialogue(message, is_private_chat=False, dep_channel_config=dep_config)
+        await submit_ai_dialogue(message, dep_config.get("history_key"))
         return # 处理完AI DEP频道消息后，不再进行后续的语言审查或刷屏检测
 
     # --- 2. 检查是否为用户创建的 AI 私聊频道的消息 ---
     if channel.id in active_private_ai_chats:
-        print(f"[OnMessage] Message in Private AI Chat: {channel.id} from {author_id}")
-        await handle_ai_dialogue(message, is_private_chat=True)
+        mod_log.debug("[OnMessage] Message in Private AI Chat: %s from %s", channel.id, author_id)
+        await submit_ai_dialogue(message, active_private_ai_chats[channel.id].get("history_key"))
         return # 处理完AI私聊消息后，不再进行后续的语言审查或刷屏检测
 
     # --- 3. 原有的语言违规检测、本地违禁词、刷屏检测等逻辑 ---
@@ -2000,46 +2267,23 @@ async def on_message(message: discord.Message):
         elif channel.id in exempt_channels_from_ai_check: perform_content_check = False
         
         if perform_content_check:
-            # --- 3a. DeepSeek API 内容审查 (使用你原有的 check_message_with_deepseek) ---
-            # 这个函数使用全局的 DEEPSEEK_MODEL (你为审查配置的那个)
-            violation_type_from_api_check = await check_message_with_deepseek(message.content) # 重命名变量以避免冲突
-            if violation_type_from_api_check:
-                print(f"[OnMessage] VIOLATION (API Content Check): User {author_id} in #{channel.name}. Type: {violation_type_from_api_check}")
-                delete_success = False
-                try:
-                    if channel.permissions_for(guild.me).manage_messages:
-                        await message.delete()
-                        delete_success = True
-                        print(f"   - Deleted message (API Violation) by {author_id}")
-                except Exception as del_e: print(f"   - Error deleting message (API violation): {del_e}")
-                
-                mod_mentions = " ".join([f"<@&{role_id}>" for role_id in MOD_ALERT_ROLE_IDS])
-                log_embed_api = discord.Embed(title=f"🚨 自动内容审核 ({violation_type_from_api_check}) 🚨", color=discord.Color.dark_red(), timestamp=now)
-                log_embed_api.add_field(name="用户", value=f"{author.mention} ({author_id})", inline=False)
-                log_embed_api.add_field(name="频道", value=channel.mention, inline=False)
-                log_embed_api.add_field(name="内容摘要", value=f"```{message.content[:1000]}```", inline=False)
-                log_embed_api.add_field(name="消息状态", value="已删除" if delete_success else "删除失败/无权限", inline=True)
-                log_embed_api.add_field(name="消息链接", value=f"[原始链接]({message.jump_url}) (可能已删除)", inline=True)
-                log_embed_api.add_field(name="建议操作", value=f"{mod_mentions} 请管理员审核！", inline=False)
-                await send_to_public_log(guild, log_embed_api, log_type=f"API Violation ({violation_type_from_api_check})")
-                return 
-
-            # --- 3b. 本地违禁词检测 (如果API未检测到严重违规) ---
-            if not violation_type_from_api_check and BAD_WORDS_LOWER: 
-                content_lower = message.content.lower()
-                triggered_bad_word = None
-                for word_bw in BAD_WORDS_LOWER: # 避免与外层 word 冲突
-                    if word_bw in content_lower:
-                        triggered_bad_word = word_bw
-                        break
+            # --- 3a. 本地预过滤：违禁词命中 / 明显安全的消息在本地处理，其余交给后台审核队列 ---
+            prefilter_result = moderation_prefilter.classify(message.content, guild.id)
+            if prefilter_result.tier == ai_moderation.PREFILTER_ESCALATE and DEEPSEEK_API_KEY:
+                # 只入队不等待：刷屏检测与聊天奖励照常执行，违规由 moderate_message_in_background 删除并记录
+                moderation_queue.submit(message)
+
+            # --- 3b. 本地违禁词处理 (预过滤命中违禁词的消息不会调用 API) ---
+            if prefilter_result.tier == ai_moderation.PREFILTER_BAD_WORD:
+                triggered_bad_word = prefilter_result.matched_word
                 if triggered_bad_word:
-                    print(f"[OnMessage] VIOLATION (Local Bad Word): '{triggered_bad_word}' from {author_id} in #{channel.name}")
+                    mod_log.info("[OnMessage] VIOLATION (Local Bad Word): '%s' from %s in #%s", triggered_bad_word, author_id, channel.name)
                     guild_offenses = user_first_offense_reminders.setdefault(guild.id, {})
                     user_offenses = guild_offenses.setdefault(author_id, set())
 
                     if triggered_bad_word not in user_offenses: 
                         user_offenses.add(triggered_bad_word)
-                        print(f"   - '{triggered_bad_word}' is first offense for user {author_id}, sending reminder.")
+                        mod_log.debug("'%s' is first offense for user %s, sending reminder.", triggered_bad_word, author_id)
                         try:
                             rules_ch_id = 1280026139326283799 # 你定义的规则频道ID
                             rules_ch_mention = f"<#{rules_ch_id}>" if rules_ch_id and rules_ch_id != 1280026139326283799 else "#规则" # 修正ID比较
@@ -2047,19 +2291,20 @@ async def on_message(message: discord.Message):
                                 f"{author.mention}，请注意你的言辞并遵守服务器规则 ({rules_ch_mention})。本次仅为提醒，再犯将可能受到警告。",
                                 delete_after=25
                             )
-                        except Exception as remind_err: print(f"   - Error sending bad word reminder: {remind_err}")
+                        except Exception as remind_err: mod_log.error("Error sending bad word reminder: %s", remind_err)
                         try:
                             if channel.permissions_for(guild.me).manage_messages: await message.delete()
                         except Exception: pass 
                         return 
                     else: 
-                        print(f"   - '{triggered_bad_word}' is repeat offense for user {author_id}, issuing warning.")
+                        mod_log.debug("'%s' is repeat offense for user %s, issuing warning.", triggered_bad_word, author_id)
                         reason_bw_warn = f"自动警告：再次使用不当词语 '{triggered_bad_word}'"
                         
                         if author_id not in user_warnings: user_warnings[author_id] = 0 # 初始化
                         user_warnings[author_id] += 1
                         warning_count_bw = user_warnings[author_id]
-                        print(f"   - User {author_id} current warnings: {warning_count_bw}/{KICK_THRESHOLD}")
+                        persist_user_warnings(author_id)
+                        mod_log.debug("User %s current warnings: %s/%s", author_id, warning_count_bw, KICK_THRESHOLD)
 
                         warn_embed_bw = discord.Embed(color=discord.Color.orange(), timestamp=now)
                         # ... (构建你的 warn_embed_bw，包括踢出逻辑，与你原来代码一致) ...
@@ -2080,11 +2325,12 @@ async def on_message(message: discord.Message):
                                     await member.kick(reason=f"自动踢出: 不当言语警告达上限 ({triggered_bad_word})")
                                     kick_performed_bad_word = True
                                     user_warnings[author_id] = 0 # 重置警告
+                                    persist_user_warnings(author_id)
                                     warn_embed_bw.add_field(name="踢出状态",value="✅ 成功", inline=False)
-                                    print(f"   - User {author_id} kicked for bad words.")
+                                    mod_log.info("User %s kicked for bad words.", author_id)
                                 except Exception as kick_e_bw:
                                     warn_embed_bw.add_field(name="踢出状态",value=f"❌ 失败 ({kick_e_bw})", inline=False)
-                                    print(f"   - Failed to kick user {author_id} for bad words: {kick_e_bw}")
+                                    mod_log.error("Failed to kick user %s for bad words: %s", author_id, kick_e_bw)
                             else:
                                 warn_embed_bw.add_field(name="踢出状态",value="❌ 失败 (权限/层级不足)", inline=False)
 
@@ -2096,7 +2342,7 @@ async def on_message(message: discord.Message):
                         if not kick_performed_bad_word:
                             try:
                                 await channel.send(f"⚠️ {author.mention}，你的言论再次触发警告 (不当言语)。当前警告次数: {warning_count_bw}/{KICK_THRESHOLD}", delete_after=20)
-                            except Exception as e_chan_warn: print(f"   - Error sending channel warning for bad word: {e_chan_warn}")
+                            except Exception as e_chan_warn: mod_log.error("Error sending channel warning for bad word: %s", e_chan_warn)
                         return 
 
     # --- 4. 用户刷屏检测逻辑 ---
@@ -2113,10 +2359,11 @@ async def on_message(message: discord.Message):
         recent_messages_count = sum(1 for ts in user_message_timestamps[author_id] if ts > time_limit_user_spam)
 
         if recent_messages_count >= SPAM_COUNT_THRESHOLD:
-            print(f"[OnMessage] SPAM (User): {author_id} in #{channel.name}")
+            mod_log.info("[OnMessage] SPAM (User): %s in #%s", author_id, channel.name)
             user_warnings[author_id] += 1 
             warning_count_spam = user_warnings[author_id]
-            print(f"   - User {author_id} current warnings (spam): {warning_count_spam}/{KICK_THRESHOLD}")
+            persist_user_warnings(author_id)
+            mod_log.debug("User %s current warnings (spam): %s/%s", author_id, warning_count_spam, KICK_THRESHOLD)
             
             # 清空该用户的记录以避免连续触发，或者只移除最旧的几个
             user_message_timestamps[author_id].clear() # 简单粗暴清空
@@ -2135,11 +2382,12 @@ async def on_message(message: discord.Message):
                         await member.kick(reason="自动踢出: 刷屏警告达上限")
                         kick_performed_spam = True
                         user_warnings[author_id] = 0
+                        persist_user_warnings(author_id)
                         log_embed_user_spam.add_field(name="踢出状态", value="✅ 成功", inline=False)
-                        print(f"   - User {author_id} kicked for spam.")
+                        mod_log.info("User %s kicked for spam.", author_id)
                     except Exception as kick_e_spam:
                          log_embed_user_spam.add_field(name="踢出状态", value=f"❌ 失败 ({kick_e_spam})", inline=False)
-                         print(f"   - Failed to kick {author_id} for spam: {kick_e_spam}")
+                         mod_log.error("Failed to kick %s for spam: %s", author_id, kick_e_spam)
                 else:
                     log_embed_user_spam.add_field(name="踢出状态", value="❌ 失败 (权限/层级不足)", inline=False)
 
@@ -2148,7 +2396,7 @@ async def on_message(message: discord.Message):
             if not kick_performed_spam:
                 try:
                     await message.channel.send(f"⚠️ {author.mention}，检测到你发送消息过于频繁，请减缓速度！(警告 {warning_count_spam}/{KICK_THRESHOLD})", delete_after=15)
-                except Exception as warn_err_spam: print(f"   - Error sending user spam warning: {warn_err_spam}")
+                except Exception as warn_err_spam: mod_log.error("Error sending user spam warning: %s", warn_err_spam)
             return 
 
                 # --- 经济系统：聊天赚钱 (在末尾添加此部分) ---
@@ -2163,7 +2411,7 @@ async def on_message(message: discord.Message):
             guild_id = message.guild.id
             user_id = message.author.id
             
-            config = get_guild_chat_earn_config(guild_id)
+            config = await get_guild_chat_earn_config(guild_id)
             earn_amount = config["amount"]
             cooldown_seconds = config["cooldown"]
 
@@ -2176,12 +2424,12 @@ async def on_message(message: discord.Message):
                 last_earn = last_chat_earn_times[guild_id].get(user_id, 0)
 
                 if now - last_earn > cooldown_seconds:
-                    if update_user_balance(guild_id, user_id, earn_amount):
-                        last_chat_earn_times[guild_id][user_id] = now
-                        # print(f"[经济系统] 用户 {user_id} 在服务器 {guild_id} 通过聊天赚取了 {earn_amount} {ECONOMY_CURRENCY_NAME}。")
-                        # 可选：发送非常细微的确认或记录，但避免刷屏聊天
-                        # await message.add_reaction("🪙") # 示例：细微的反应 - 可能过多
-                        # save_economy_data() # 每次赚钱都保存可能导致 I/O 过于密集。
+                    # 写回缓冲：在内存中合并，由 chat_earn_accumulator 定时批量写入数据库
+                    chat_earn_accumulator.add(guild_id, user_id, earn_amount)
+                    last_chat_earn_times[guild_id][user_id] = now
+                    # print(f"[经济系统] 用户 {user_id} 在服务器 {guild_id} 通过聊天赚取了 {earn_amount} {ECONOMY_CURRENCY_NAME}。")
+                    # 可选：发送非常细微的确认或记录，但避免刷屏聊天
+                    # await message.add_reaction("🪙") # 示例：细微的反应 - 可能过多
     
     # --- (如果你在末尾有 bot.process_commands(message)，请保留它) ---
     # pass # 如果没有 process_commands
@@ -2227,7 +2475,7 @@ async def on_voice_state_update(member: discord.Member, before: discord.VoiceSta
 
     master_channel = guild.get_channel(master_vc_id)
     if not master_channel or not isinstance(master_channel, discord.VoiceChannel):
-        print(f"⚠️ 临时语音：服务器 {guild.name} 的母频道 ID ({master_vc_id}) 无效或不是语音频道。")
+        log.warning("⚠️ 临时语音：服务器 %s 的母频道 ID (%s) 无效或不是语音频道。", guild.name, master_vc_id)
         # set_setting(temp_vc_settings, guild.id, "master_channel_id", None) # Optional: Clear invalid setting
         return
 
@@ -2235,7 +2483,7 @@ async def on_voice_state_update(member: discord.Member, before: discord.VoiceSta
     if category_id:
         category = guild.get_channel(category_id)
         if not category or not isinstance(category, discord.CategoryChannel):
-            print(f"⚠️ 临时语音：服务器 {guild.name} 配置的分类 ID ({category_id}) 无效或不是分类频道，将尝试在母频道所在分类创建。")
+            log.warning("⚠️ 临时语音：服务器 %s 配置的分类 ID (%s) 无效或不是分类频道，将尝试在母频道所在分类创建。", guild.name, category_id)
             category = master_channel.category
     else: category = master_channel.category
 
@@ -2243,12 +2491,12 @@ async def on_voice_state_update(member: discord.Member, before: discord.VoiceSta
     if after.channel == master_channel:
         if not category or not category.permissions_for(guild.me).manage_channels or \
            not category.permissions_for(guild.me).move_members:
-            print(f"❌ 临时语音创建失败：机器人在分类 '{category.name if category else '未知'}' 中缺少 '管理频道' 或 '移动成员' 权限。 ({member.name})")
+            log.warning("❌ 临时语音创建失败：机器人在分类 '%s' 中缺少 '管理频道' 或 '移动成员' 权限。 (%s)", category.name if category else '未知', member.name)
             try: await member.send(f"抱歉，我在服务器 **{guild.name}** 中创建临时语音频道所需的权限不足，请联系管理员检查我在分类 '{category.name if category else '默认'}' 中的权限。")
             except: pass
             return
 
-        print(f"🔊 用户 {member.name} 加入了母频道 ({master_channel.name})，准备创建临时频道...")
+        log.info("🔊 用户 %s 加入了母频道 (%s)，准备创建临时频道...", member.name, master_channel.name)
         new_channel = None # Init before try
         try:
             owner_overwrites = discord.PermissionOverwrite(manage_channels=True, manage_permissions=True, move_members=True, connect=True, speak=True, stream=True, use_voice_activation=True, priority_speaker=True, mute_members=True, deafen_members=True, use_embedded_activities=True)
@@ -2261,20 +2509,19 @@ async def on_voice_state_update(member: discord.Member, before: discord.VoiceSta
                 overwrites={guild.default_role: everyone_overwrites, member: owner_overwrites, guild.me: bot_overwrites},
                 reason=f"由 {member.name} 加入母频道自动创建"
             )
-            print(f"   ✅ 已创建临时频道: {new_channel.name} ({new_channel.id})")
+            log.info("✅ 已创建临时频道: %s (%s)", new_channel.name, new_channel.id)
 
             try:
                 await member.move_to(new_channel, reason="移动到新创建的临时频道")
-                print(f"   ✅ 已将 {member.name} 移动到频道 {new_channel.name}。")
-                temp_vc_owners[new_channel.id] = member.id
-                temp_vc_created.add(new_channel.id)
+                log.info("✅ 已将 %s 移动到频道 %s。", member.name, new_channel.name)
+                set_temp_vc_owner(guild.id, new_channel.id, member.id)
             except Exception as move_e:
-                print(f"   ❌ 将 {member.name} 移动到新频道时发生错误: {move_e}")
+                log.error("❌ 将 %s 移动到新频道时发生错误: %s", member.name, move_e)
                 try: await new_channel.delete(reason="移动用户失败/错误，自动删除")
                 except: pass # Ignore deletion error if move failed
 
         except Exception as e:
-            print(f"   ❌ 创建/移动临时语音频道时发生错误: {e}")
+            log.error("❌ 创建/移动临时语音频道时发生错误: %s", e)
             if new_channel: # Clean up channel if created before error
                  try: await new_channel.delete(reason="创建/移动过程中出错")
                  except: pass
@@ -2287,22 +2534,19 @@ async def on_voice_state_update(member: discord.Member, before: discord.VoiceSta
         if channel_to_check and isinstance(channel_to_check, discord.VoiceChannel):
             is_empty = not any(m for m in channel_to_check.members if not m.bot)
             if is_empty:
-                print(f"🔊 临时频道 {channel_to_check.name} ({channel_to_check.id}) 已空，准备删除...")
+                log.info("🔊 临时频道 %s (%s) 已空，准备删除...", channel_to_check.name, channel_to_check.id)
                 try:
                     if channel_to_check.permissions_for(guild.me).manage_channels:
                         await channel_to_check.delete(reason="临时语音频道为空，自动删除")
-                        print(f"   ✅ 已成功删除频道 {channel_to_check.name}。")
-                    else: print(f"   ❌ 删除频道 {channel_to_check.name} 失败：机器人缺少 '管理频道' 权限。")
-                except discord.NotFound: print(f"   ℹ️ 尝试删除频道 {channel_to_check.name} 时未找到 (可能已被删)。")
-                except discord.Forbidden: print(f"   ❌ 删除频道 {channel_to_check.name} 失败：机器人权限不足。")
-                except Exception as e: print(f"   ❌ 删除频道 {channel_to_check.name} 时发生未知错误: {e}")
-                finally: # Clean up memory regardless of deletion success
-                    if channel_to_check.id in temp_vc_owners: del temp_vc_owners[channel_to_check.id]
-                    if channel_to_check.id in temp_vc_created: temp_vc_created.remove(channel_to_check.id)
-                    # print(f"   - 已清理频道 {channel_to_check.id} 的内存记录。") # Less verbose log
+                        log.info("✅ 已成功删除频道 %s。", channel_to_check.name)
+                    else: log.warning("❌ 删除频道 %s 失败：机器人缺少 '管理频道' 权限。", channel_to_check.name)
+                except discord.NotFound: log.warning("ℹ️ 尝试删除频道 %s 时未找到 (可能已被删)。", channel_to_check.name)
+                except discord.Forbidden: log.warning("❌ 删除频道 %s 失败：机器人权限不足。", channel_to_check.name)
+                except Exception as e: log.error("❌ 删除频道 %s 时发生未知错误: %s", channel_to_check.name, e)
+                finally: # Clean up records regardless of deletion success
+                    forget_temp_vc(channel_to_check.id)
         else: # Channel disappeared during delay or isn't a VC anymore
-            if before.channel.id in temp_vc_owners: del temp_vc_owners[before.channel.id]
-            if before.channel.id in temp_vc_created: temp_vc_created.remove(before.channel.id)
+            forget_temp_vc(before.channel.id)
 
 
 # --- Slash Command Definitions ---
@@ -2488,9 +2732,9 @@ async def slash_createrole(interaction: discord.Interaction, role_name: str):
     try:
         new_role = await guild.create_role(name=role_name, reason=f"由 {interaction.user} 创建")
         await interaction.followup.send(f"✅ 已成功创建身份组: {new_role.mention}", ephemeral=False)
-        print(f"[身份组操作] 用户 {interaction.user} 创建了身份组 '{new_role.name}' ({new_role.id})")
+        log.info("[身份组操作] 用户 %s 创建了身份组 '%s' (%s)", interaction.user, new_role.name, new_role.id)
     except discord.Forbidden: await interaction.followup.send(f"⚙️ 创建身份组 **{role_name}** 失败：机器人权限不足。", ephemeral=True)
-    except Exception as e: print(f"执行 /createrole 时出错: {e}"); await interaction.followup.send(f"⚙️ 创建身份组时发生未知错误: {e}", ephemeral=True)
+    except Exception as e: log.error("执行 /createrole 时出错: %s", e); await interaction.followup.send(f"⚙️ 创建身份组时发生未知错误: {e}", ephemeral=True)
 
 
 @bot.tree.command(name="deleterole", description="根据精确名称删除一个现有的身份组。")
@@ -2512,9 +2756,9 @@ async def slash_deleterole(interaction: discord.Interaction, role_name: str):
         deleted_role_name = role_to_delete.name
         await role_to_delete.delete(reason=f"由 {interaction.user} 删除")
         await interaction.followup.send(f"✅ 已成功删除身份组: **{deleted_role_name}**", ephemeral=False)
-        print(f"[身份组操作] 用户 {interaction.user} 删除了身份组 '{deleted_role_name}' ({role_to_delete.id})")
+        log.info("[身份组操作] 用户 %s 删除了身份组 '%s' (%s)", interaction.user, deleted_role_name, role_to_delete.id)
     except discord.Forbidden: await interaction.followup.send(f"⚙️ 删除身份组 **{role_name}** 失败：机器人权限不足。", ephemeral=True)
-    except Exception as e: print(f"执行 /deleterole 时出错: {e}"); await interaction.followup.send(f"⚙️ 删除身份组时发生未知错误: {e}", ephemeral=True)
+    except Exception as e: log.error("执行 /deleterole 时出错: %s", e); await interaction.followup.send(f"⚙️ 删除身份组时发生未知错误: {e}", ephemeral=True)
 
 
 @bot.tree.command(name="giverole", description="将一个现有的身份组分配给指定成员。")
@@ -2536,9 +2780,9 @@ async def slash_giverole(interaction: discord.Interaction, user: discord.Member,
     try:
         await user.add_roles(role_to_give, reason=f"由 {interaction.user} 赋予")
         await interaction.followup.send(f"✅ 已成功将身份组 {role_to_give.mention} 赋予给 {user.mention}。", ephemeral=False)
-        print(f"[身份组操作] 用户 {interaction.user} 将身份组 '{role_to_give.name}' ({role_to_give.id}) 赋予了用户 {user.name} ({user.id})")
+        log.info("[身份组操作] 用户 %s 将身份组 '%s' (%s) 赋予了用户 %s (%s)", interaction.user, role_to_give.name, role_to_give.id, user.name, user.id)
     except discord.Forbidden: await interaction.followup.send(f"⚙️ 赋予身份组 **{role_name}** 给 {user.mention} 失败：机器人权限不足。", ephemeral=True)
-    except Exception as e: print(f"执行 /giverole 时出错: {e}"); await interaction.followup.send(f"⚙️ 赋予身份组时发生未知错误: {e}", ephemeral=True)
+    except Exception as e: log.error("执行 /giverole 时出错: %s", e); await interaction.followup.send(f"⚙️ 赋予身份组时发生未知错误: {e}", ephemeral=True)
 
 
 @bot.tree.command(name="takerole", description="从指定成员移除一个特定的身份组。")
@@ -2562,9 +2806,9 @@ async def slash_takerole(interaction: discord.Interaction, user: discord.Member,
     try:
         await user.remove_roles(role_to_take, reason=f"由 {interaction.user} 移除")
         await interaction.followup.send(f"✅ 已成功从 {user.mention} 移除身份组 {role_to_take.mention}。", ephemeral=False)
-        print(f"[身份组操作] 用户 {interaction.user} 从用户 {user.name} ({user.id}) 移除了身份组 '{role_to_take.name}' ({role_to_take.id})")
+        log.info("[身份组操作] 用户 %s 从用户 %s (%s) 移除了身份组 '%s' (%s)", interaction.user, user.name, user.id, role_to_take.name, role_to_take.id)
     except discord.Forbidden: await interaction.followup.send(f"⚙️ 从 {user.mention} 移除身份组 **{role_name}** 失败：机器人权限不足。", ephemeral=True)
-    except Exception as e: print(f"执行 /takerole 时出错: {e}"); await interaction.followup.send(f"⚙️ 移除身份组时发生未知错误: {e}", ephemeral=True)
+    except Exception as e: log.error("执行 /takerole 时出错: %s", e); await interaction.followup.send(f"⚙️ 移除身份组时发生未知错误: {e}", ephemeral=True)
 
 
 @bot.tree.command(name="createseparator", description="创建一个用于视觉分隔的特殊身份组。")
@@ -2583,9 +2827,9 @@ async def slash_createseparator(interaction: discord.Interaction, label: str):
     try:
         new_role = await guild.create_role(name=separator_name, permissions=discord.Permissions.none(), color=discord.Color.default(), hoist=False, mentionable=False, reason=f"由 {interaction.user} 创建的分隔线")
         await interaction.followup.send(f"✅ 已成功创建分隔线身份组: **{new_role.name}**\n**重要提示:** 请前往 **服务器设置 -> 身份组**，手动将此身份组拖动到你希望的位置！", ephemeral=False)
-        print(f"[身份组操作] 用户 {interaction.user} 创建了分隔线 '{new_role.name}' ({new_role.id})")
+        log.info("[身份组操作] 用户 %s 创建了分隔线 '%s' (%s)", interaction.user, new_role.name, new_role.id)
     except discord.Forbidden: await interaction.followup.send(f"⚙️ 创建分隔线失败：机器人权限不足。", ephemeral=True)
-    except Exception as e: print(f"执行 /createseparator 时出错: {e}"); await interaction.followup.send(f"⚙️ 创建分隔线时发生未知错误: {e}", ephemeral=True)
+    except Exception as e: log.error("执行 /createseparator 时出错: %s", e); await interaction.followup.send(f"⚙️ 创建分隔线时发生未知错误: {e}", ephemeral=True)
 
 # --- Moderation Commands ---
 @bot.tree.command(name="clear", description="清除当前频道中指定数量的消息 (1-100)。")
@@ -2601,7 +2845,7 @@ async def slash_clear(interaction: discord.Interaction, amount: app_commands.Ran
         deleted_messages = await channel.purge(limit=amount)
         deleted_count = len(deleted_messages)
         await interaction.followup.send(f"✅ 已成功删除 {deleted_count} 条消息。", ephemeral=True)
-        print(f"[审核操作] 用户 {interaction.user} 在频道 #{channel.name} 清除了 {deleted_count} 条消息。")
+        log.info("[审核操作] 用户 %s 在频道 #%s 清除了 %s 条消息。", interaction.user, channel.name, deleted_count)
         log_embed = discord.Embed(title="🧹 消息清除操作", color=discord.Color.light_grey(), timestamp=discord.utils.utcnow())
         log_embed.add_field(name="执行者", value=interaction.user.mention, inline=True)
         log_embed.add_field(name="频道", value=channel.mention, inline=True)
@@ -2609,7 +2853,7 @@ async def slash_clear(interaction: discord.Interaction, amount: app_commands.Ran
         log_embed.set_footer(text=f"执行者 ID: {interaction.user.id}")
         await send_to_public_log(interaction.guild, log_embed, log_type="Clear Messages")
     except discord.Forbidden: await interaction.followup.send(f"⚙️ 清除消息失败：机器人缺少在频道 {channel.mention} 中删除消息的权限。", ephemeral=True)
-    except Exception as e: print(f"执行 /clear 时出错: {e}"); await interaction.followup.send(f"⚙️ 清除消息时发生未知错误: {e}", ephemeral=True)
+    except Exception as e: log.error("执行 /clear 时出错: %s", e); await interaction.followup.send(f"⚙️ 清除消息时发生未知错误: {e}", ephemeral=True)
 
 
 @bot.tree.command(name="warn", description="手动向用户发出一次警告 (累计达到阈值会被踢出)。")
@@ -2628,7 +2872,8 @@ async def slash_warn(interaction: discord.Interaction, user: discord.Member, rea
     user_id = user.id
     user_warnings[user_id] = user_warnings.get(user_id, 0) + 1
     warning_count = user_warnings[user_id]
-    print(f"[审核操作] 用户 {author} 手动警告了用户 {user}。原因: {reason}。新警告次数: {warning_count}/{KICK_THRESHOLD}")
+    persist_user_warnings(user_id)
+    mod_log.warning("[审核操作] 用户 %s 手动警告了用户 %s。原因: %s。新警告次数: %s/%s", author, user, reason, warning_count, KICK_THRESHOLD)
 
     embed = discord.Embed(color=discord.Color.orange(), timestamp=discord.utils.utcnow())
     embed.set_author(name=f"由 {author.display_name} 发出警告", icon_url=author.display_avatar.url)
@@ -2641,23 +2886,24 @@ async def slash_warn(interaction: discord.Interaction, user: discord.Member, rea
         embed.title = "🚨 警告已达上限 - 用户已被踢出 🚨"
         embed.color = discord.Color.red()
         embed.add_field(name="处理措施", value="已自动踢出服务器", inline=False)
-        print(f"   - 用户 {user.name} 因手动警告达到踢出阈值。")
+        mod_log.warning("用户 %s 因手动警告达到踢出阈值。", user.name)
         bot_member = guild.me
         can_kick = bot_member.guild_permissions.kick_members and (bot_member.top_role > user.top_role or bot_member == guild.owner)
         if can_kick:
             kick_reason_warn = f"自动踢出：因累计达到 {KICK_THRESHOLD} 次警告 (最后一次由 {author.display_name} 手动发出，原因：{reason})。"
             try:
                 try: await user.send(f"由于在服务器 **{guild.name}** 中累计达到 {KICK_THRESHOLD} 次警告（最后由 {author.display_name} 发出警告，原因：{reason}），你已被踢出。")
-                except Exception as dm_err: print(f"   - 无法向用户 {user.name} 发送踢出私信 (手动警告): {dm_err}")
+                except Exception as dm_err: mod_log.warning("无法向用户 %s 发送踢出私信 (手动警告): %s", user.name, dm_err)
                 await user.kick(reason=kick_reason_warn)
-                print(f"   - 已成功踢出用户 {user.name} (手动警告达到上限)。")
+                mod_log.warning("已成功踢出用户 %s (手动警告达到上限)。", user.name)
                 kick_performed = True
                 user_warnings[user_id] = 0
+                persist_user_warnings(user_id)
                 embed.add_field(name="踢出状态", value="✅ 成功", inline=False)
-            except discord.Forbidden: embed.add_field(name="踢出状态", value="❌ 失败 (权限不足)", inline=False); print(f"   - 踢出用户 {user.name} 失败：机器人权限不足。")
-            except Exception as kick_err: embed.add_field(name="踢出状态", value=f"❌ 失败 ({kick_err})", inline=False); print(f"   - 踢出用户 {user.name} 时发生未知错误: {kick_err}")
+            except discord.Forbidden: embed.add_field(name="踢出状态", value="❌ 失败 (权限不足)", inline=False); mod_log.warning("踢出用户 %s 失败：机器人权限不足。", user.name)
+            except Exception as kick_err: embed.add_field(name="踢出状态", value=f"❌ 失败 ({kick_err})", inline=False); mod_log.error("踢出用户 %s 时发生未知错误: %s", user.name, kick_err)
         else:
-             embed.add_field(name="踢出状态", value="❌ 失败 (权限/层级不足)", inline=False); print(f"   - 无法踢出用户 {user.name}：机器人权限不足或层级不够。")
+             embed.add_field(name="踢出状态", value="❌ 失败 (权限/层级不足)", inline=False); mod_log.info("无法踢出用户 %s：机器人权限不足或层级不够。", user.name)
              if MOD_ALERT_ROLE_IDS: embed.add_field(name="提醒", value=f"<@&{MOD_ALERT_ROLE_IDS[0]}> 请手动处理！", inline=False) # Ping first mod role if available
 
     else:
@@ -2684,7 +2930,8 @@ async def slash_unwarn(interaction: discord.Interaction, user: discord.Member, r
 
     user_warnings[user_id] = current_warnings - 1
     new_warning_count = user_warnings[user_id]
-    print(f"[审核操作] 用户 {author} 移除了用户 {user} 的一次警告。原因: {reason}。新警告次数: {new_warning_count}/{KICK_THRESHOLD}")
+    persist_user_warnings(user_id)
+    mod_log.warning("[审核操作] 用户 %s 移除了用户 %s 的一次警告。原因: %s。新警告次数: %s/%s", author, user, reason, new_warning_count, KICK_THRESHOLD)
 
     embed = discord.Embed(title="✅ 警告已移除 ✅", color=discord.Color.green(), timestamp=discord.utils.utcnow())
     embed.set_author(name=f"由 {author.display_name} 操作", icon_url=author.display_avatar.url)
@@ -2733,8 +2980,8 @@ async def slash_announce(
         if image_url.startswith(('http://', 'https://')):
             valid_image_check = False
             try:
-                if AIOHTTP_AVAILABLE and hasattr(bot, 'http_session') and bot.http_session:
-                    async with bot.http_session.head(image_url, timeout=5, allow_redirects=True) as head_resp:
+                if AIOHTTP_AVAILABLE:
+                    async with http_client.get_session().head(image_url, timeout=http_client.get_timeout("image_check"), allow_redirects=True) as head_resp:
                         if head_resp.status == 200 and 'image' in head_resp.headers.get('Content-Type', '').lower(): valid_image_check = True
                         elif head_resp.status != 200: validation_warnings.append(f"⚠️ 图片URL无法访问({head_resp.status})")
                         else: validation_warnings.append(f"⚠️ URL内容非图片({head_resp.headers.get('Content-Type','')})")
@@ -2774,9 +3021,9 @@ async def slash_announce(
             return
         await channel.send(content=ping_content, embed=embed)
         await interaction.followup.send(f"✅ 公告已成功发送到频道 {channel.mention}！", ephemeral=True)
-        print(f"[公告] 用户 {author} 在频道 #{channel.name} 发布了公告: '{title}'")
+        log.info("[公告] 用户 %s 在频道 #%s 发布了公告: '%s'", author, channel.name, title)
     except discord.Forbidden: await interaction.followup.send(f"❌ 发送失败：机器人缺少在频道 {channel.mention} 发送消息或嵌入链接的权限。", ephemeral=True)
-    except Exception as e: print(f"执行 /announce 时出错: {e}"); await interaction.followup.send(f"❌ 发送公告时发生未知错误: {e}", ephemeral=True)
+    except Exception as e: log.error("执行 /announce 时出错: %s", e); await interaction.followup.send(f"❌ 发送公告时发生未知错误: {e}", ephemeral=True)
     # --- (在这里或类似位置添加以下代码) ---
 
 @bot.tree.command(name="notify_member", description="通过机器人向指定成员发送私信 (需要管理服务器权限)。")
@@ -2819,7 +3066,7 @@ async def slash_notify_member(interaction: discord.Interaction, member: discord.
     try:
         await member.send(embed=dm_embed)
         await interaction.followup.send(f"✅ 已成功向 {member.mention} 发送私信。", ephemeral=True)
-        print(f"[通知] 用户 {author} ({author.id}) 通过机器人向 {member.name} ({member.id}) 发送了私信。")
+        log.info("[通知] 用户 %s (%s) 通过机器人向 %s (%s) 发送了私信。", author, author.id, member.name, member.id)
 
         # （可选）在公共日志频道记录操作 (不记录具体内容，保护隐私)
         log_embed_public = discord.Embed(
@@ -2835,17 +3082,17 @@ async def slash_notify_member(interaction: discord.Interaction, member: discord.
 
     except discord.Forbidden:
         await interaction.followup.send(f"❌ 无法向 {member.mention} 发送私信。可能原因：该用户关闭了来自服务器成员的私信，或屏蔽了机器人。", ephemeral=True)
-        print(f"[通知失败] 无法向 {member.name} ({member.id}) 发送私信 (Forbidden)。")
+        log.warning("[通知失败] 无法向 %s (%s) 发送私信 (Forbidden)。", member.name, member.id)
     except discord.HTTPException as e:
         await interaction.followup.send(f"❌ 发送私信给 {member.mention} 时发生网络错误: {e}", ephemeral=True)
-        print(f"[通知失败] 发送私信给 {member.name} ({member.id}) 时发生HTTP错误: {e}")
+        log.error("[通知失败] 发送私信给 %s (%s) 时发生HTTP错误: %s", member.name, member.id, e)
     except Exception as e:
         await interaction.followup.send(f"❌ 发送私信时发生未知错误: {e}", ephemeral=True)
-        print(f"[通知失败] 发送私信给 {member.name} ({member.id}) 时发生未知错误: {e}")
+        log.error("[通知失败] 发送私信给 %s (%s) 时发生未知错误: %s", member.name, member.id, e)
         # ... (你现有的 slash_notify_member 指令的完整代码) ...
     except Exception as e:
         await interaction.followup.send(f"❌ 发送私信时发生未知错误: {e}", ephemeral=True)
-        print(f"[通知失败] 发送私信给 {member.name} ({member.id}) 时发生未知错误: {e}")
+        log.error("[通知失败] 发送私信给 %s (%s) 时发生未知错误: %s", member.name, member.id, e)
 
 
 # ↓↓↓↓ 在这里粘贴新的 ping 指令的完整代码 ↓↓↓↓
@@ -2883,7 +3130,7 @@ async def slash_ping(interaction: discord.Interaction):
     # 编辑之前的占位消息，显示完整的延迟信息
     await message_to_edit.edit(content=None, embed=embed)
 
-    print(f"[状态] 用户 {interaction.user} 执行了 /ping。WebSocket: {websocket_latency_ms}ms, API: {api_latency_ms}ms")
+    log.info("[状态] 用户 %s 执行了 /ping。WebSocket: %sms, API: %sms", interaction.user, websocket_latency_ms, api_latency_ms)
 # ↑↑↑↑ 新的 ping 指令代码结束 ↑↑↑↑
 
 # ... (在你现有的 /ping 命令或其他独立斜杠命令定义之后) ...
@@ -2919,10 +3166,10 @@ async def ai_setup_dep_channel(interaction: discord.Interaction,
         "system_prompt": system_prompt,
         "history_key": history_key_for_channel
     }
-    if history_key_for_channel not in conversation_histories:
-        conversation_histories[history_key_for_channel] = deque(maxlen=MAX_AI_HISTORY_TURNS * 2) 
+    persist_in_background(async_database.db_set_ai_dep_channel(target_channel.id, chosen_model_id, system_prompt, history_key_for_channel),
+                          f"AI 对话频道 {target_channel.id}")
 
-    print(f"[AI SETUP] Channel {target_channel.name} ({target_channel.id}) configured for AI. Model: {chosen_model_id}, SysPrompt: {system_prompt is not None}")
+    ai_log.info("[AI SETUP] Channel %s (%s) configured for AI. Model: %s, SysPrompt: %s", target_channel.name, target_channel.id, chosen_model_id, system_prompt is not None)
     await interaction.response.send_message(
         f"✅ 频道 {target_channel.mention} 已成功设置为 AI 直接对话频道！\n"
         f"- 使用模型: `{chosen_model_id}`\n"
@@ -2936,14 +3183,15 @@ async def ai_setup_dep_channel_error(interaction: discord.Interaction, error: ap
     if isinstance(error, app_commands.MissingPermissions):
         await interaction.response.send_message("🚫 你需要“管理服务器”权限才能设置AI频道。", ephemeral=True)
     else:
-        print(f"[AI SETUP ERROR] /ai setup_dep_channel: {error}")
+        ai_log.error("[AI SETUP] /ai setup_dep_channel: %s", error)
         await interaction.response.send_message(f"设置AI频道时发生错误: {type(error).__name__}", ephemeral=True)
 
 # --- Command: /ai kb_add ---
 @ai_group.command(name="kb_add", description="[管理员] 添加一条知识到服务器的AI知识库")
-@app_commands.describe(content="要添加的知识内容 (例如：服务器规则、常见问题解答)")
+@app_commands.describe(content="要添加的知识内容 (例如：服务器规则、常见问题解答)",
+                       position="插入为第几条 (可选，默认添加到末尾)")
 @app_commands.checks.has_permissions(manage_guild=True)
-async def ai_kb_add(interaction: discord.Interaction, content: str):
+async def ai_kb_add(interaction: discord.Interaction, content: str, position: Optional[app_commands.Range[int, 1, MAX_KB_ENTRIES_PER_GUILD]] = None):
     guild = interaction.guild
     if not guild:
         await interaction.response.send_message("此命令只能在服务器内使用。", ephemeral=True)
@@ -2956,14 +3204,17 @@ async def ai_kb_add(interaction: discord.Interaction, content: str):
         await interaction.response.send_message(f"❌ 内容过短，请输入有意义的知识条目 (至少10字符)。", ephemeral=True)
         return
 
-    # 确保 guild_knowledge_bases 已在文件顶部定义
-    guild_kb = guild_knowledge_bases.setdefault(guild.id, [])
-    if len(guild_kb) >= MAX_KB_ENTRIES_PER_GUILD: # 使用之前定义的常量
-        await interaction.response.send_message(f"❌ 服务器知识库已满 ({len(guild_kb)}/{MAX_KB_ENTRIES_PER_GUILD} 条)。请先移除一些旧条目。", ephemeral=True)
+    ok, message = await knowledge_base.add_entry(guild.id, content.strip(), MAX_KB_ENTRIES_PER_GUILD,
+                                                 position - 1 if position is not None else None)
+    guild_kb = await knowledge_base.get_entries(guild.id)
+    if not ok:
+        if len(guild_kb) >= MAX_KB_ENTRIES_PER_GUILD:
+            await interaction.response.send_message(f"❌ 服务器知识库已满 ({len(guild_kb)}/{MAX_KB_ENTRIES_PER_GUILD} 条)。请先移除一些旧条目。", ephemeral=True)
+        else:
+            await interaction.response.send_message(f"❌ 添加知识条目失败：{message}", ephemeral=True)
         return
 
-    guild_kb.append(content.strip())
-    print(f"[AI KB] Guild {guild.id}: User {interaction.user.id} added entry. New count: {len(guild_kb)}")
+    ai_log.info("[AI KB] Guild %s: User %s added entry. New count: %s", guild.id, interaction.user.id, len(guild_kb))
     await interaction.response.send_message(f"✅ 已成功添加知识条目到服务器AI知识库 (当前共 {len(guild_kb)} 条)。\n内容预览: ```{content[:150]}{'...' if len(content)>150 else ''}```", ephemeral=True)
 
 # --- Command: /ai kb_list ---
@@ -2975,7 +3226,7 @@ async def ai_kb_list(interaction: discord.Interaction):
         await interaction.response.send_message("此命令只能在服务器内使用。", ephemeral=True)
         return
 
-    guild_kb = guild_knowledge_bases.get(guild.id, [])
+    guild_kb = await knowledge_base.get_entries(guild.id)
     if not guild_kb:
         await interaction.response.send_message("ℹ️ 当前服务器的AI知识库是空的。", ephemeral=True)
         return
@@ -3004,7 +3255,7 @@ async def ai_kb_remove(interaction: discord.Interaction, index: int):
         await interaction.response.send_message("此命令只能在服务器内使用。", ephemeral=True)
         return
 
-    guild_kb = guild_knowledge_bases.get(guild.id, [])
+    guild_kb = await knowledge_base.get_entries(guild.id)
     if not guild_kb:
         await interaction.response.send_message("ℹ️ 当前服务器的AI知识库是空的，无法移除。", ephemeral=True)
         return
@@ -3013,10 +3264,34 @@ async def ai_kb_remove(interaction: discord.Interaction, index: int):
         await interaction.response.send_message(f"❌ 无效的序号。请输入 1 到 {len(guild_kb)} 之间的数字。", ephemeral=True)
         return
 
-    removed_entry = guild_kb.pop(index - 1) 
-    print(f"[AI KB] Guild {guild.id}: User {interaction.user.id} removed entry #{index}. New count: {len(guild_kb)}")
+    removed_entry = await knowledge_base.remove_entry(guild.id, index - 1)
+    if removed_entry is None:
+        await interaction.response.send_message("❌ 移除失败 (知识库可能刚被修改或数据库出错)，请用 /ai kb_list 确认后重试。", ephemeral=True)
+        return
+    ai_log.info("[AI KB] Guild %s: User %s removed entry #%s. New count: %s", guild.id, interaction.user.id, index, len(guild_kb) - 1)
     await interaction.response.send_message(f"✅ 已成功从知识库中移除第 **{index}** 条知识。\n被移除内容预览: ```{removed_entry[:150]}{'...' if len(removed_entry)>150 else ''}```", ephemeral=True)
 
+# --- Command: /ai kb_move ---
+@ai_group.command(name="kb_move", description="[管理员] 调整服务器AI知识库中条目的顺序")
+@app_commands.describe(index="要移动的知识条目的序号 (从 /ai kb_list 中获取)", new_index="移动后的序号")
+@app_commands.checks.has_permissions(manage_guild=True)
+async def ai_kb_move(interaction: discord.Interaction, index: int, new_index: int):
+    guild = interaction.guild
+    if not guild:
+        await interaction.response.send_message("此命令只能在服务器内使用。", ephemeral=True)
+        return
+
+    guild_kb = await knowledge_base.get_entries(guild.id)
+    if not (1 <= index <= len(guild_kb) and 1 <= new_index <= len(guild_kb)):
+        await interaction.response.send_message(f"❌ 无效的序号。请输入 1 到 {len(guild_kb)} 之间的数字。", ephemeral=True)
+        return
+
+    if not await knowledge_base.move_entry(guild.id, index - 1, new_index - 1):
+        await interaction.response.send_message("❌ 移动失败 (知识库可能刚被修改或数据库出错)，请用 /ai kb_list 确认后重试。", ephemeral=True)
+        return
+    ai_log.info("[AI KB] Guild %s: User %s moved entry #%s to #%s.", guild.id, interaction.user.id, index, new_index)
+    await interaction.response.send_message(f"✅ 已将第 **{index}** 条知识移动到第 **{new_index}** 条。", ephemeral=True)
+
 # --- Command: /ai kb_clear ---
 @ai_group.command(name="kb_clear", description="[管理员] 清空当前服务器的所有AI知识库条目")
 @app_commands.checks.has_permissions(manage_guild=True)
@@ -3026,10 +3301,11 @@ async def ai_kb_clear(interaction: discord.Interaction):
         await interaction.response.send_message("此命令只能在服务器内使用。", ephemeral=True)
         return
 
-    if guild.id in guild_knowledge_bases and guild_knowledge_bases[guild.id]:
-        count_cleared = len(guild_knowledge_bases[guild.id])
-        guild_knowledge_bases[guild.id] = [] 
-        print(f"[AI KB] Guild {guild.id}: User {interaction.user.id} cleared all {count_cleared} knowledge base entries.")
+    count_cleared = await knowledge_base.clear(guild.id)
+    if count_cleared is None:
+        await interaction.response.send_message("❌ 清空知识库时数据库出错，请稍后重试。", ephemeral=True)
+    elif count_cleared:
+        ai_log.info("[AI KB] Guild %s: User %s cleared all %s knowledge base entries.", guild.id, interaction.user.id, count_cleared)
         await interaction.response.send_message(f"✅ 已成功清空服务器AI知识库中的全部 **{count_cleared}** 条知识。", ephemeral=True)
     else:
         await interaction.response.send_message("ℹ️ 当前服务器的AI知识库已经是空的。", ephemeral=True)
@@ -3044,9 +3320,9 @@ async def ai_clear_dep_history(interaction: discord.Interaction):
     config = ai_dep_channels_config[channel_id]
     history_key = config.get("history_key")
 
-    if history_key and history_key in conversation_histories:
-        conversation_histories[history_key].clear()
-        print(f"[AI HISTORY] Cleared history for DEP channel {channel_id} (Key: {history_key}) by {interaction.user.id}")
+    if history_key:
+        await ai_conversations.clear(history_key) # 同时删除数据库中保存的最近几轮
+        ai_log.info("[AI HISTORY] Cleared history for DEP channel %s (Key: %s) by %s", channel_id, history_key, interaction.user.id)
         await interaction.response.send_message("✅ 当前 AI 对话频道的历史记录已清除。", ephemeral=False) 
     else:
         await interaction.response.send_message("ℹ️ 未找到此频道的历史记录或历史键配置错误。", ephemeral=True)
@@ -3076,11 +3352,12 @@ async def ai_create_private_chat(interaction: discord.Interaction,
                 await interaction.response.send_message(f"⚠️ 你已经有一个开启的AI私聊频道：{existing_channel.mention}。\n请先使用 `/ai close_private_chat` 关闭它。", ephemeral=True)
                 return
             else: 
-                print(f"[AI PRIVATE] Cleaning up stale private chat record for user {user.id}, channel ID {chat_info_val.get('channel_id')}")
-                if chat_info_val.get("history_key") in conversation_histories:
-                    del conversation_histories[chat_info_val.get("history_key")]
+                ai_log.info("[AI PRIVATE] Cleaning up stale private chat record for user %s, channel ID %s", user.id, chat_info_val.get('channel_id'))
+                if chat_info_val.get("history_key"):
+                    await ai_conversations.clear(chat_info_val.get("history_key"))
                 if chat_id_key in active_private_ai_chats: # chat_id_key is channel_id
                      del active_private_ai_chats[chat_id_key]
+                     persist_in_background(async_database.db_remove_private_ai_chat(chat_id_key), f"AI 私聊 {chat_id_key}")
 
 
     chosen_model_id = model_id.value if model_id else DEFAULT_AI_DIALOGUE_MODEL
@@ -3099,13 +3376,13 @@ async def ai_create_private_chat(interaction: discord.Interaction,
                 guild.default_role: everyone_perms_in_cat
             }
             category = await guild.create_category(category_name_config, overwrites=category_overwrites, reason="Category for AI Private Chats")
-            print(f"[AI PRIVATE] Created category '{category_name_config}' in guild {guild.id}")
+            ai_log.info("[AI PRIVATE] Created category '%s' in guild %s", category_name_config, guild.id)
         except discord.Forbidden:
-            print(f"[AI PRIVATE ERROR] Failed to create '{category_name_config}' category in {guild.id}: Bot lacks permissions.")
+            ai_log.warning("[AI PRIVATE] Failed to create '%s' category in %s: Bot lacks permissions.", category_name_config, guild.id)
             await interaction.followup.send("❌ 创建私聊频道失败：机器人无法创建所需分类。请检查机器人是否有“管理频道”权限。", ephemeral=True)
             return
         except Exception as e:
-            print(f"[AI PRIVATE ERROR] Error creating category: {e}")
+            ai_log.error("[AI PRIVATE] Error creating category: %s", e)
             await interaction.followup.send(f"❌ 创建私聊频道失败：{e}", ephemeral=True)
             return
 
@@ -3128,10 +3405,10 @@ async def ai_create_private_chat(interaction: discord.Interaction,
             "guild_id": guild.id,
             "channel_id": new_channel.id 
         }
-        if history_key_private not in conversation_histories:
-            conversation_histories[history_key_private] = deque(maxlen=MAX_AI_HISTORY_TURNS * 2)
+        persist_in_background(async_database.db_set_private_ai_chat(new_channel.id, guild.id, user.id, chosen_model_id, history_key_private),
+                              f"AI 私聊 {new_channel.id}")
 
-        print(f"[AI PRIVATE] Created private AI channel {new_channel.name} ({new_channel.id}) for user {user.id}. Model: {chosen_model_id}")
+        ai_log.info("[AI PRIVATE] Created private AI channel %s (%s) for user %s. Model: %s", new_channel.name, new_channel.id, user.id, chosen_model_id)
         
         initial_message_content = (
             f"你好 {user.mention}！这是一个你的专属AI私聊频道。\n"
@@ -3144,7 +3421,7 @@ async def ai_create_private_chat(interaction: discord.Interaction,
         await interaction.followup.send(f"✅ 你的AI私聊频道已创建：{new_channel.mention}", ephemeral=True)
 
         if initial_question: 
-            print(f"[AI PRIVATE] Sending initial question from {user.id} to {new_channel.id}: {initial_question}")
+            ai_log.info("[AI PRIVATE] Sending initial question from %s to %s: %s", user.id, new_channel.id, initial_question)
             # Simulate a message object for handle_ai_dialogue
             # This is a bit hacky, a cleaner way might be to directly call API and format
             class MinimalMessage:
@@ -3164,17 +3441,17 @@ async def ai_create_private_chat(interaction: discord.Interaction,
                 await handle_ai_dialogue(mock_message_obj, is_private_chat=True)
 
     except discord.Forbidden:
-        print(f"[AI PRIVATE ERROR] Failed to create private channel for {user.id}: Bot lacks permissions.")
+        ai_log.warning("[AI PRIVATE] Failed to create private channel for %s: Bot lacks permissions.", user.id)
         await interaction.followup.send("❌ 创建私聊频道失败：机器人权限不足。", ephemeral=True)
         if new_channel and new_channel.id in active_private_ai_chats: # Clean up if entry was made
             del active_private_ai_chats[new_channel.id]
+            persist_in_background(async_database.db_remove_private_ai_chat(new_channel.id), f"AI 私聊 {new_channel.id}")
     except Exception as e:
-        print(f"[AI PRIVATE ERROR] Error creating private channel: {e}")
-        import traceback
-        traceback.print_exc()
+        ai_log.exception("[AI PRIVATE] Error creating private channel: %s", e)
         await interaction.followup.send(f"❌ 创建私聊频道时发生未知错误: {type(e).__name__}", ephemeral=True)
         if new_channel and new_channel.id in active_private_ai_chats: # Clean up if entry was made
             del active_private_ai_chats[new_channel.id]
+            persist_in_background(async_database.db_remove_private_ai_chat(new_channel.id), f"AI 私聊 {new_channel.id}")
 
 
 # --- Command: /ai close_private_chat ---
@@ -3196,13 +3473,13 @@ async def ai_close_private_chat(interaction: discord.Interaction):
     # await interaction.response.send_message("⏳ 频道准备关闭...", ephemeral=True) # Ephemeral response
     
     history_key_to_clear = chat_info.get("history_key")
-    if history_key_to_clear and history_key_to_clear in conversation_histories:
-        del conversation_histories[history_key_to_clear]
-        print(f"[AI PRIVATE] Cleared history for private chat {channel.id} (Key: {history_key_to_clear}) during closure.")
+    if history_key_to_clear and await ai_conversations.clear(history_key_to_clear):
+        ai_log.info("[AI PRIVATE] Cleared history for private chat %s (Key: %s) during closure.", channel.id, history_key_to_clear)
     
     if channel.id in active_private_ai_chats:
         del active_private_ai_chats[channel.id]
-        print(f"[AI PRIVATE] Removed active private chat entry for channel {channel.id}")
+        persist_in_background(async_database.db_remove_private_ai_chat(channel.id), f"AI 私聊 {channel.id}")
+        ai_log.info("[AI PRIVATE] Removed active private chat entry for channel %s", channel.id)
 
     try:
         # Send confirmation in channel before deleting
@@ -3211,21 +3488,21 @@ async def ai_close_private_chat(interaction: discord.Interaction):
         await interaction.response.send_message("频道关闭请求已收到，将在几秒后删除。",ephemeral=True)
         await asyncio.sleep(5)
         await channel.delete(reason=f"AI Private Chat closed by owner {user.name}")
-        print(f"[AI PRIVATE] Successfully deleted private AI channel {channel.name} ({channel.id})")
+        ai_log.info("[AI PRIVATE] Successfully deleted private AI channel %s (%s)", channel.name, channel.id)
         try: # Attempt to DM user as a final confirmation
             await user.send(f"你创建的AI私聊频道 `#{channel.name}` 已成功关闭和删除。")
         except discord.Forbidden:
-            print(f"[AI PRIVATE] Could not DM user {user.id} about channel closure.")
+            ai_log.info("[AI PRIVATE] Could not DM user %s about channel closure.", user.id)
     except discord.NotFound:
-        print(f"[AI PRIVATE] Channel {channel.id} already deleted before final action.")
+        ai_log.info("[AI PRIVATE] Channel %s already deleted before final action.", channel.id)
         if not interaction.response.is_done(): # If we haven't responded yet
              await interaction.response.send_message("频道似乎已被删除。",ephemeral=True)
     except discord.Forbidden:
-        print(f"[AI PRIVATE ERROR] Bot lacks permission to delete channel {channel.id} or send messages in it.")
+        ai_log.warning("[AI PRIVATE] Bot lacks permission to delete channel %s or send messages in it.", channel.id)
         if not interaction.response.is_done():
              await interaction.response.send_message("❌ 关闭频道时出错：机器人权限不足。", ephemeral=True)
     except Exception as e:
-        print(f"[AI PRIVATE ERROR] Error closing private chat {channel.id}: {e}")
+        ai_log.error("[AI PRIVATE] Error closing private chat %s: %s", channel.id, e)
         if not interaction.response.is_done():
              await interaction.response.send_message(f"❌ 关闭频道时发生未知错误: {type(e).__name__}", ephemeral=True)
 
@@ -3278,7 +3555,8 @@ async def faq_add(interaction: discord.Interaction, keyword: str, answer: str):
         return
 
     guild_faqs[keyword] = answer.strip()
-    print(f"[FAQ] Guild {guild.id}: User {interaction.user.id} added FAQ for keyword '{keyword}'.")
+    persist_in_background(async_database.db_set_faq(guild.id, keyword, guild_faqs[keyword]), f"FAQ {guild.id}/{keyword}")
+    ai_log.info("[FAQ] Guild %s: User %s added FAQ for keyword '%s'.", guild.id, interaction.user.id, keyword)
     await interaction.response.send_message(f"✅ FAQ 条目已添加！\n关键词: **{keyword}**\n答案预览: ```{answer[:150]}{'...' if len(answer)>150 else ''}```", ephemeral=True)
 
 # --- Command: /faq remove ---
@@ -3299,11 +3577,12 @@ async def faq_remove(interaction: discord.Interaction, keyword: str):
         return
 
     removed_answer = guild_faqs.pop(keyword)
+    persist_in_background(async_database.db_remove_faq(guild.id, keyword), f"FAQ {guild.id}/{keyword}")
     if not guild_faqs: 
         if guild.id in server_faqs:
             del server_faqs[guild.id]
 
-    print(f"[FAQ] Guild {guild.id}: User {interaction.user.id} removed FAQ for keyword '{keyword}'.")
+    ai_log.info("[FAQ] Guild %s: User %s removed FAQ for keyword '%s'.", guild.id, interaction.user.id, keyword)
     await interaction.response.send_message(f"✅ 已成功移除关键词为 **'{keyword}'** 的FAQ条目。\n被移除答案预览: ```{removed_answer[:150]}{'...' if len(removed_answer)>150 else ''}```", ephemeral=True)
 
 # --- Command: /faq list ---
@@ -3447,13 +3726,13 @@ async def relay_msg_send(interaction: discord.Interaction, target_user: discord.
             "initiator_display_name": initiator.display_name # 用于在频道内显示谁发起了对某人的匿名消息
         }
         await interaction.followup.send(f"✅ 你的匿名消息已通过机器人发送给 {target_user.mention}。请等待对方在私信中回复。", ephemeral=True)
-        print(f"[RelayMsg] Initiator {initiator.id} sent message to Target {target_user.id} via DM {sent_dm_message.id}. Original channel: {interaction.channel_id}")
+        log.info("[RelayMsg] Initiator %s sent message to Target %s via DM %s. Original channel: %s", initiator.id, target_user.id, sent_dm_message.id, interaction.channel_id)
 
     except discord.Forbidden:
         await interaction.followup.send(f"❌ 无法向 {target_user.mention} 发送私信。对方可能关闭了私信或屏蔽了机器人。", ephemeral=True)
     except Exception as e:
         await interaction.followup.send(f"❌ 发送私信时发生错误: {e}", ephemeral=True)
-        print(f"[RelayMsg ERROR] Sending DM to {target_user.id}: {e}")
+        log.error("[RelayMsg] Sending DM to %s: %s", target_user.id, e)
 
 # 将新的指令组添加到 bot tree (这会在文件末尾统一做)
 
@@ -3507,7 +3786,7 @@ async def manage_ticket_setup(interaction: discord.Interaction, button_channel:
     set_setting(ticket_settings, guild_id, "category_id", ticket_category.id)
     set_setting(ticket_settings, guild_id, "staff_role_ids", parsed_role_ids)
     set_setting(ticket_settings, guild_id, "ticket_count", get_setting(ticket_settings, guild_id, "ticket_count") or 0)
-    print(f"[票据设置] 服务器 {guild_id}: 按钮频道={button_channel.id}, 分类={ticket_category.id}, 员工角色={parsed_role_ids}")
+    log.info("[票据设置] 服务器 %s: 按钮频道=%s, 分类=%s, 员工角色=%s", guild_id, button_channel.id, ticket_category.id, parsed_role_ids)
 
     embed = discord.Embed(
         title="🎫 GJ Team 服务台 - 认证申请 🎫",
@@ -3525,13 +3804,13 @@ async def manage_ticket_setup(interaction: discord.Interaction, button_channel:
              try:
                  old_msg = await button_channel.fetch_message(old_message_id)
                  await old_msg.delete()
-                 print(f"   - 已删除旧的票据按钮消息 ({old_message_id})")
+                 log.info("已删除旧的票据按钮消息 (%s)", old_message_id)
              except (discord.NotFound, discord.Forbidden): pass # Ignore if not found or no perm
-             except Exception as del_e: print(f"   - 删除旧票据按钮消息时出错：{del_e}")
+             except Exception as del_e: log.error("删除旧票据按钮消息时出错：%s", del_e)
 
         button_message = await button_channel.send(embed=embed, view=CreateTicketView())
         set_setting(ticket_settings, guild_id, "button_message_id", button_message.id)
-        print(f"   - 已在频道 #{button_channel.name} 发送新的票据按钮消息 ({button_message.id})")
+        log.info("已在频道 #%s 发送新的票据按钮消息 (%s)", button_channel.name, button_message.id)
 
         staff_role_mentions = [f"<@&{rid}>" for rid in parsed_role_ids]
         await interaction.followup.send(
@@ -3542,7 +3821,7 @@ async def manage_ticket_setup(interaction: discord.Interaction, button_channel:
             ephemeral=True
         )
     except discord.Forbidden: await interaction.followup.send(f"{warning_message}❌ 设置成功，但在频道 {button_channel.mention} 发送按钮消息失败：机器人权限不足。", ephemeral=True)
-    except Exception as e: await interaction.followup.send(f"{warning_message}❌ 设置成功，但在发送按钮消息时发生错误: {e}", ephemeral=True); print(f"发送票据按钮消息时出错: {e}")
+    except Exception as e: await interaction.followup.send(f"{warning_message}❌ 设置成功，但在发送按钮消息时发生错误: {e}", ephemeral=True); log.error("发送票据按钮消息时出错: %s", e)
 
 # --- Other Management Commands ---
 @manage_group.command(name="ai豁免-添加用户", description="将用户添加到 AI 内容检测的豁免列表 (管理员)。")
@@ -3555,8 +3834,9 @@ async def manage_ai_exempt_user_add(interaction: discord.Interaction, user: disc
     if user_id in exempt_users_from_ai_check: await interaction.followup.send(f"ℹ️ 用户 {user.mention} 已在 AI 检测豁免列表中。", ephemeral=True)
     else:
         exempt_users_from_ai_check.add(user_id)
+        persist_in_background(async_database.db_set_ai_check_exemption(database.AI_CHECK_EXEMPT_USER, user_id, True), f"AI 检测豁免 {user_id}")
         await interaction.followup.send(f"✅ 已将用户 {user.mention} 添加到 AI 内容检测豁免列表。", ephemeral=True)
-        print(f"[AI豁免] 管理员 {interaction.user} 添加了用户 {user.name}({user_id}) 到豁免列表。")
+        mod_log.info("[AI豁免] 管理员 %s 添加了用户 %s(%s) 到豁免列表。", interaction.user, user.name, user_id)
 
 @manage_group.command(name="ai豁免-移除用户", description="将用户从 AI 内容检测的豁免列表中移除 (管理员)。")
 @app_commands.describe(user="要从豁免列表中移除的用户。")
@@ -3566,8 +3846,9 @@ async def manage_ai_exempt_user_remove(interaction: discord.Interaction, user: d
     user_id = user.id
     if user_id in exempt_users_from_ai_check:
         exempt_users_from_ai_check.remove(user_id)
+        persist_in_background(async_database.db_set_ai_check_exemption(database.AI_CHECK_EXEMPT_USER, user_id, False), f"AI 检测豁免 {user_id}")
         await interaction.followup.send(f"✅ 已将用户 {user.mention} 从 AI 内容检测豁免列表中移除。", ephemeral=True)
-        print(f"[AI豁免] 管理员 {interaction.user} 从豁免列表移除了用户 {user.name}({user_id})。")
+        mod_log.info("[AI豁免] 管理员 %s 从豁免列表移除了用户 %s(%s)。", interaction.user, user.name, user_id)
     else: await interaction.followup.send(f"ℹ️ 用户 {user.mention} 不在 AI 检测豁免列表中。", ephemeral=True)
 
 @manage_group.command(name="ai豁免-添加频道", description="将频道添加到 AI 内容检测的豁免列表 (管理员)。")
@@ -3579,8 +3860,9 @@ async def manage_ai_exempt_channel_add(interaction: discord.Interaction, channel
     if channel_id in exempt_channels_from_ai_check: await interaction.followup.send(f"ℹ️ 频道 {channel.mention} 已在 AI 检测豁免列表中。", ephemeral=True)
     else:
         exempt_channels_from_ai_check.add(channel_id)
+        persist_in_background(async_database.db_set_ai_check_exemption(database.AI_CHECK_EXEMPT_CHANNEL, channel_id, True), f"AI 检测豁免 {channel_id}")
         await interaction.followup.send(f"✅ 已将频道 {channel.mention} 添加到 AI 内容检测豁免列表。", ephemeral=True)
-        print(f"[AI豁免] 管理员 {interaction.user} 添加了频道 #{channel.name}({channel_id}) 到豁免列表。")
+        mod_log.info("[AI豁免] 管理员 %s 添加了频道 #%s(%s) 到豁免列表。", interaction.user, channel.name, channel_id)
 
 @manage_group.command(name="ai豁免-移除频道", description="将频道从 AI 内容检测的豁免列表中移除 (管理员)。")
 @app_commands.describe(channel="要从豁免列表中移除的文字频道。")
@@ -3590,8 +3872,9 @@ async def manage_ai_exempt_channel_remove(interaction: discord.Interaction, chan
     channel_id = channel.id
     if channel_id in exempt_channels_from_ai_check:
         exempt_channels_from_ai_check.remove(channel_id)
+        persist_in_background(async_database.db_set_ai_check_exemption(database.AI_CHECK_EXEMPT_CHANNEL, channel_id, False), f"AI 检测豁免 {channel_id}")
         await interaction.followup.send(f"✅ 已将频道 {channel.mention} 从 AI 内容检测豁免列表中移除。", ephemeral=True)
-        print(f"[AI豁免] 管理员 {interaction.user} 从豁免列表移除了频道 #{channel.name}({channel_id})。")
+        mod_log.info("[AI豁免] 管理员 %s 从豁免列表移除了频道 #%s(%s)。", interaction.user, channel.name, channel_id)
     else: await interaction.followup.send(f"ℹ️ 频道 {channel.mention} 不在 AI 检测豁免列表中。", ephemeral=True)
 
 @manage_group.command(name="ai豁免-查看列表", description="查看当前 AI 内容检测的豁免用户和频道列表 (管理员)。")
@@ -3615,9 +3898,213 @@ async def manage_ai_exempt_list(interaction: discord.Interaction):
     channel_list_str = "\n".join(exempt_channel_mentions) if exempt_channel_mentions else "无"
     embed.add_field(name="豁免用户", value=user_list_str[:1024], inline=False) # Max field length 1024
     embed.add_field(name="豁免频道", value=channel_list_str[:1024], inline=False)
-    embed.set_footer(text="注意：此列表存储在内存中，机器人重启后会清空（除非使用数据库）。")
+    embed.set_footer(text="豁免列表已保存到数据库，机器人重启后仍然有效。")
     await interaction.followup.send(embed=embed, ephemeral=True)
 
+@manage_group.command(name="性能统计", description="查看机器人内部队列与数据库访问的运行统计 (管理员)。")
+@app_commands.checks.has_permissions(administrator=True)
+async def manage_perf_stats(interaction: discord.Interaction):
+    db_stats = async_database.get_stats()
+    embed = discord.Embed(title="📊 运行统计", color=discord.Color.dark_teal(), timestamp=discord.utils.utcnow())
+    db_lines = [
+        f"在途请求: {db_stats['in_flight']} / {db_stats['max_pending']} (峰值 {db_stats['max_in_flight']})",
+        f"读取线程: {db_stats['reader_threads']}，写入线程: 1",
+    ]
+    for kind, label in (("read", "读"), ("write", "写")):
+        kind_stats = db_stats[kind]
+        completed = kind_stats["completed"]
+        avg_ms = (kind_stats["exec_seconds"] / completed * 1000) if completed else 0.0
+        db_lines.append(
+            f"{label}: 提交 {kind_stats['submitted']} / 完成 {completed} / 失败 {kind_stats['failed']}，"
+            f"平均 {avg_ms:.2f}ms，背压等待 {kind_stats['backpressure_waits']} 次 ({kind_stats['wait_seconds']:.2f}s)"
+        )
+    embed.add_field(name="数据库", value="\n".join(db_lines)[:1024], inline=False)
+    cache_lines = [
+        f"{cache_name}: {cache_stats['size']}/{cache_stats['max_entries']}，命中 {cache_stats['hits']} / 未命中 {cache_stats['misses']} "
+        f"({cache_stats['hit_rate']:.0%})，淘汰 {cache_stats['evictions']}，失效 {cache_stats['invalidations']}"
+        for cache_name, cache_stats in database.get_cache_stats().items()
+    ]
+    embed.add_field(name="读缓存", value="\n".join(cache_lines)[:1024], inline=False)
+    earn_stats = chat_earn_accumulator.stats
+    embed.add_field(
+        name="聊天奖励写回",
+        value=(f"缓冲中: {chat_earn_accumulator.pending_entries} 条，累计奖励 {earn_stats['credits']} 次\n"
+               f"写回 {earn_stats['flushes']} 次 / {earn_stats['rows_written']} 行，失败 {earn_stats['failed_flushes']} 次"),
+        inline=False
+    )
+    prefilter_stats = moderation_prefilter.get_stats()
+    reason_text = "，".join(f"{reason} {count}" for reason, count in sorted(prefilter_stats["reasons"].items())) or "无"
+    embed.add_field(
+        name="AI 审核本地预过滤",
+        value=(f"检查 {prefilter_stats['total']} 条，本地处理 {prefilter_stats['local_rate']:.0%}，升级到 API {prefilter_stats['escalated']} 条\n"
+               f"{reason_text}"),
+        inline=False
+    )
+    word_stats = bad_word_filter.get_stats()
+    embed.add_field(
+        name="违禁词自动机",
+        value=(f"全局 {word_stats['global_words']} 个词，{word_stats['guilds_with_custom_words']} 个服务器共附加 {word_stats['custom_words']} 个词，"
+               f"已编译 {word_stats['rebuilds']} 次"),
+        inline=False
+    )
+    queue_stats = moderation_queue.get_stats()
+    embed.add_field(
+        name="AI 后台审核队列",
+        value=(f"排队 {queue_stats['depth']} 条 (峰值 {queue_stats['max_depth']}，最旧 {queue_stats['oldest_age_seconds']:.1f}s)，"
+               f"工作中 {queue_stats['busy_workers']}/{queue_stats['workers']}\n"
+               f"入队 {queue_stats['enqueued']}，完成 {queue_stats['processed']}，出错 {queue_stats['errors']}，"
+               f"满队丢弃 {queue_stats['dropped_full']}，超时丢弃 {queue_stats['dropped_stale']}\n"
+               f"排队等待 p50 ≤{queue_stats['wait_p50_ms']:.0f}ms，p99 ≤{queue_stats['wait_p99_ms']:.0f}ms，最大 {queue_stats['wait_max_ms']:.0f}ms"),
+        inline=False
+    )
+    batch_stats = moderation_batcher.get_stats()
+    embed.add_field(
+        name="AI 内容审核攒批",
+        value=(f"消息 {batch_stats['messages']} 条 → 请求 {batch_stats['batches']} 次 (平均每批 {batch_stats['avg_batch']:.1f} 条，最大 {batch_stats['max_batch']})\n"
+               f"按数量发出 {batch_stats['by_size']} 次 / 按等待时间发出 {batch_stats['by_timer']} 次，失败 {batch_stats['failed_batches']} 批，"
+               f"排队中 {batch_stats['pending']} 条"),
+        inline=False
+    )
+    cache_stats = moderation_verdict_cache.get_stats()
+    embed.add_field(
+        name="AI 审核判定缓存",
+        value=(f"{cache_stats['size']}/{cache_stats['max_entries']} 条，查询 {cache_stats['lookups']} 次，命中 {cache_stats['hits']}，"
+               f"合并并发 {cache_stats['coalesced']}，节省请求 {cache_stats['saved_calls']} 次 ({cache_stats['hit_rate']:.0%})，"
+               f"淘汰 {cache_stats['evictions']}，失败未缓存 {cache_stats['failures']}"),
+        inline=False
+    )
+    gateway_stats = deepseek_api_gateway.get_stats()
+    breaker_text = gateway_stats["state"]
+    if gateway_stats["state"] == deepseek_gateway.BREAKER_OPEN:
+        breaker_text += f" (约 {gateway_stats['retry_in_seconds']:.0f}s 后探测)"
+    purpose_text = "，".join(f"{purpose} {count}" for purpose, count in sorted(gateway_stats["purposes"].items())) or "无"
+    purpose_slot_text = "，".join(f"{purpose} 在途 {slots['in_flight']}/{slots['limit']} 排队 {slots['waiting']}"
+                                  for purpose, slots in gateway_stats["purpose_slots"].items()) or "无"
+    embed.add_field(
+        name="DeepSeek 网关",
+        value=(f"熔断器: {breaker_text}，连续失败 {gateway_stats['consecutive_failures']} 次，累计熔断 {gateway_stats['times_opened']} 次\n"
+               f"在途 {gateway_stats['in_flight']}/{gateway_stats['global_concurrency']}，排队 {gateway_stats['waiting']} (峰值 {gateway_stats['max_waiting_seen']})，"
+               f"活跃服务器 {gateway_stats['active_guilds']}，限速等待 {gateway_stats['throttled']} 次\n"
+               f"按用途: {purpose_slot_text}\n"
+               f"请求 {gateway_stats['requests']} ({purpose_text})，重试 {gateway_stats['retries']}，失败 {gateway_stats['failed']}，"
+               f"熔断拒绝 {gateway_stats['rejected_open']}，排队满拒绝 {gateway_stats['rejected_queue_full']}"),
+        inline=False
+    )
+    http_stats = http_client.get_stats()
+    embed.add_field(
+        name="出站 HTTP 连接池",
+        value=(f"{'已打开' if http_stats['open'] else '未打开'}，连接上限 {http_stats['pool_limit']} (单主机 {http_stats['pool_limit_per_host']})\n"
+               f"请求 {http_stats['requests']} 次 (出错 {http_stats['request_errors']})，新建连接 {http_stats['connections_created']}，"
+               f"复用 {http_stats['connections_reused']} ({http_stats['reuse_rate']:.0%})，会话创建 {http_stats['sessions_created']} 次"),
+        inline=False
+    )
+    first_output = ai_dialogue_first_output_latency.snapshot()
+    embed.add_field(
+        name="AI 对话首字延迟 (流式)",
+        value=(f"回复 {first_output['count']} 次，平均 {first_output['avg_ms']:.0f}ms，p50 ≤{first_output['p50_ms']:.0f}ms，"
+               f"p90 ≤{first_output['p90_ms']:.0f}ms，最大 {first_output['max_ms']:.0f}ms"),
+        inline=False
+    )
+    context_stats = dialogue_context_builder.get_stats()
+    kb_stats = knowledge_base.get_stats()
+    history_stats = ai_conversations.get_stats()
+    dialogue_queue_stats = ai_dialogue_scheduler.get_stats()
+    embed.add_field(
+        name="AI 对话排队",
+        value=(f"活跃对话 {dialogue_queue_stats['active_conversations']}，排队回合 {dialogue_queue_stats['queued_turns']}，"
+               f"生成中 {dialogue_queue_stats['running']} (每服务器上限 {dialogue_queue_stats['guild_concurrency']})\n"
+               f"消息 {dialogue_queue_stats['messages']} 条 → 回合 {dialogue_queue_stats['turns']} 个 (合并 {dialogue_queue_stats['merged']}，忙碌时排队 {dialogue_queue_stats['debounced']}，"
+               f"排队满丢弃 {dialogue_queue_stats['rejected']})，完成 {dialogue_queue_stats['completed']}，出错 {dialogue_queue_stats['errors']}\n"
+               f"排队等待 平均 {dialogue_queue_stats['wait_avg_ms']:.0f}ms，p50 ≤{dialogue_queue_stats['wait_p50_ms']:.0f}ms，"
+               f"p99 ≤{dialogue_queue_stats['wait_p99_ms']:.0f}ms，最大 {dialogue_queue_stats['wait_max_ms']:.0f}ms"),
+        inline=False
+    )
+    embed.add_field(
+        name="AI 对话上下文",
+        value=(f"组装 {context_stats['builds']} 次，平均 ~{context_stats['avg_prompt_tokens']:.0f} tokens (最大 ~{context_stats['max_prompt_tokens']})，"
+               f"耗时 {context_stats['avg_build_ms']:.2f}ms\n"
+               f"因预算丢弃历史 {context_stats['dropped_messages']} 条，生成摘要 {context_stats['summaries']} 次，"
+               f"知识库块缓存 {context_stats['cached_kb_blocks']} 个 (命中 {context_stats['kb_hits']}，渲染 {context_stats['kb_renders']})\n"
+               f"知识库检索 {context_stats['retrieval']['queries']} 次，平均选取 {context_stats['retrieval']['avg_selected']:.1f} 条，"
+               f"耗时 {context_stats['retrieval']['avg_query_ms']:.2f}ms，已建索引 {context_stats['retrieval']['indexed_guilds']} 个服务器\n"
+               f"知识库缓存 {kb_stats['cached_guilds']} 个服务器 / {kb_stats['cached_entries']} 条 (命中 {kb_stats['hits']}，"
+               f"从数据库加载 {kb_stats['loads']}，写入 {kb_stats['writes']}，失败 {kb_stats['write_failures']})"),
+        inline=False
+    )
+    embed.add_field(
+        name="AI 对话历史",
+        value=(f"内存中 {history_stats['conversations']}/{history_stats['max_conversations']} 个对话，"
+               f"{history_stats['total_chars']:,}/{history_stats['max_total_chars']:,} 字符 (命中 {history_stats['hits']}，"
+               f"从数据库恢复 {history_stats['loaded']}，闲置移出 {history_stats['evicted_idle']}，LRU 移出 {history_stats['evicted_lru']}，"
+               f"持久化 {history_stats['persist_writes']} 次 / 失败 {history_stats['persist_failures']})"),
+        inline=False
+    )
+    latency = ai_moderation.moderation_latency.snapshot()
+    outcome_text = "，".join(f"{outcome} {count}" for outcome, count in sorted(latency["outcomes"].items())) or "无"
+    bucket_text = " | ".join(f"{label} {count}" for label, count in latency["buckets"].items())
+    embed.add_field(
+        name="AI 内容审核延迟",
+        value=(f"调用 {latency['count']} 次，平均 {latency['avg_ms']:.0f}ms，p50 ≤{latency['p50_ms']:.0f}ms，"
+               f"p90 ≤{latency['p90_ms']:.0f}ms，p99 ≤{latency['p99_ms']:.0f}ms，最大 {latency['max_ms']:.0f}ms\n"
+               f"结果: {outcome_text}\n{bucket_text}")[:1024],
+        inline=False
+    )
+    log_level_lines = [f"{logger_name}: {level_name}" for logger_name, level_name in bot_logging.get_log_levels().items()]
+    log_level_lines.append(f"队列已满丢弃: {bot_logging.get_dropped_count()} 条")
+    embed.add_field(name="日志", value="\n".join(log_level_lines)[:1024], inline=False)
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@manage_group.command(name="日志级别", description="运行时调整机器人后台日志的输出级别 (管理员)。")
+@app_commands.describe(level="新的日志级别", logger_name="只调整某个模块 (如 db / ai / economy / moderation / music)，留空则调整全部")
+@app_commands.choices(level=[
+    app_commands.Choice(name="DEBUG (详细调试)", value="DEBUG"),
+    app_commands.Choice(name="INFO (默认)", value="INFO"),
+    app_commands.Choice(name="WARNING (仅警告和错误)", value="WARNING"),
+    app_commands.Choice(name="ERROR (仅错误)", value="ERROR"),
+])
+@app_commands.checks.has_permissions(administrator=True)
+async def manage_log_level(interaction: discord.Interaction, level: app_commands.Choice[str], logger_name: Optional[str] = None):
+    logger_name = logger_name.strip() if logger_name else None
+    effective_level = bot_logging.set_log_level(level.value, logger_name)
+    target_name = f"{bot_logging.LOGGER_ROOT_NAME}.{logger_name}" if logger_name else bot_logging.LOGGER_ROOT_NAME
+    log.warning("[日志] %s 将 %s 的日志级别调整为 %s。", interaction.user, target_name, effective_level)
+    await interaction.response.send_message(f"✅ `{target_name}` 的日志级别已调整为 **{effective_level}**。", ephemeral=True)
+
+@manage_group.command(name="违禁词", description="管理本服务器附加的违禁词 (在全局词表之外)。")
+@app_commands.describe(action="要执行的操作", word="要添加或移除的词 (列表操作无需填写)")
+@app_commands.choices(action=[
+    app_commands.Choice(name="添加", value="add"),
+    app_commands.Choice(name="移除", value="remove"),
+    app_commands.Choice(name="列表", value="list"),
+])
+@app_commands.checks.has_permissions(manage_guild=True)
+async def manage_bad_words(interaction: discord.Interaction, action: app_commands.Choice[str], word: Optional[str] = None):
+    guild_id = interaction.guild_id
+    guild_words = bad_word_filter.get_guild_words(guild_id)
+    if action.value == "list":
+        word_text = "、".join(f"`{w}`" for w in guild_words) if guild_words else "无"
+        await interaction.response.send_message(f"本服务器附加违禁词 ({len(guild_words)} 个): {word_text}"[:1900], ephemeral=True)
+        return
+    normalized_word = word_filter.normalize_text(word.strip()) if word else ""
+    if not normalized_word:
+        await interaction.response.send_message("❌ 请填写要添加或移除的词。", ephemeral=True); return
+    if action.value == "add":
+        if normalized_word in guild_words:
+            await interaction.response.send_message(f"ℹ️ `{normalized_word}` 已在本服务器的违禁词列表中。", ephemeral=True); return
+        guild_words.append(normalized_word)
+    else:
+        if normalized_word not in guild_words:
+            await interaction.response.send_message(f"❌ `{normalized_word}` 不在本服务器的附加违禁词列表中。", ephemeral=True); return
+        guild_words.remove(normalized_word)
+    bad_word_filter.set_guild_words(guild_id, guild_words)
+    persist_in_background(
+        async_database.db_set_guild_feature_setting(database.FEATURE_BAD_WORDS, guild_id, "words", guild_words),
+        f"服务器 {guild_id} 违禁词")
+    mod_log.info("[违禁词] %s %s服务器 %s 的附加违禁词 '%s' (现有 %s 个)。",
+                 interaction.user, "添加" if action.value == "add" else "移除", guild_id, normalized_word, len(guild_words))
+    await interaction.response.send_message(
+        f"✅ 已{action.name}违禁词 `{normalized_word}`，本服务器现有 {len(guild_words)} 个附加词。", ephemeral=True)
+
 @manage_group.command(name="删讯息", description="删除指定用户在当前频道的最近消息 (需要管理消息权限)。")
 @app_commands.describe(user="要删除其消息的目标用户。", amount="要检查并删除的最近消息数量 (1 到 100)。")
 @app_commands.checks.has_permissions(manage_messages=True)
@@ -3632,14 +4119,14 @@ async def manage_delete_user_messages(interaction: discord.Interaction, user: di
         deleted_messages = await channel.purge(limit=amount, check=lambda m: m.author == user, reason=f"由 {interaction.user} 执行 /管理 删讯息")
         deleted_count = len(deleted_messages)
         await interaction.followup.send(f"✅ 成功在频道 {channel.mention} 中删除了用户 {user.mention} 的 {deleted_count} 条消息。", ephemeral=True)
-        print(f"[审核操作] 用户 {interaction.user} 在频道 #{channel.name} 删除了用户 {user.name} 的 {deleted_count} 条消息。")
+        log.info("[审核操作] 用户 %s 在频道 #%s 删除了用户 %s 的 %s 条消息。", interaction.user, channel.name, user.name, deleted_count)
         log_embed = discord.Embed(title="🗑️ 用户消息删除", color=discord.Color.light_grey(), timestamp=discord.utils.utcnow())
         log_embed.add_field(name="执行者", value=interaction.user.mention, inline=True); log_embed.add_field(name="目标用户", value=user.mention, inline=True)
         log_embed.add_field(name="频道", value=channel.mention, inline=True); log_embed.add_field(name="删除数量", value=str(deleted_count), inline=True)
         log_embed.set_footer(text=f"执行者 ID: {interaction.user.id} | 目标用户 ID: {user.id}")
         await send_to_public_log(interaction.guild, log_embed, log_type="Delete User Messages")
     except discord.Forbidden: await interaction.followup.send(f"⚙️ 删除消息失败：机器人缺少在频道 {channel.mention} 中删除消息的权限。", ephemeral=True)
-    except Exception as e: print(f"执行 /管理 删讯息 时出错: {e}"); await interaction.followup.send(f"⚙️ 删除消息时发生未知错误: {e}", ephemeral=True)
+    except Exception as e: log.error("执行 /管理 删讯息 时出错: %s", e); await interaction.followup.send(f"⚙️ 删除消息时发生未知错误: {e}", ephemeral=True)
 
 @manage_group.command(name="频道名", description="修改当前频道的名称 (需要管理频道权限)。")
 @app_commands.describe(new_name="频道的新名称。")
@@ -3657,9 +4144,9 @@ async def manage_channel_name(interaction: discord.Interaction, new_name: str):
     try:
         await channel.edit(name=new_name, reason=f"由 {interaction.user} 修改")
         await interaction.followup.send(f"✅ 频道名称已从 `{old_name}` 修改为 `{new_name}`。", ephemeral=False)
-        print(f"[管理操作] 用户 {interaction.user} 将频道 #{old_name} ({channel.id}) 重命名为 '{new_name}'。")
+        log.info("[管理操作] 用户 %s 将频道 #%s (%s) 重命名为 '%s'。", interaction.user, old_name, channel.id, new_name)
     except discord.Forbidden: await interaction.followup.send(f"⚙️ 修改频道名称失败：机器人缺少管理频道 {channel.mention} 的权限。", ephemeral=True)
-    except Exception as e: print(f"执行 /管理 频道名 时出错: {e}"); await interaction.followup.send(f"⚙️ 修改频道名称时发生未知错误: {e}", ephemeral=True)
+    except Exception as e: log.error("执行 /管理 频道名 时出错: %s", e); await interaction.followup.send(f"⚙️ 修改频道名称时发生未知错误: {e}", ephemeral=True)
 
 @manage_group.command(name="禁言", description="暂时或永久禁言成员 (需要 '超时成员' 权限)。")
 @app_commands.describe(user="要禁言的目标用户。", duration_minutes="禁言的分钟数 (输入 0 表示永久禁言，即最长28天)。", reason="(可选) 禁言的原因。")
@@ -3696,8 +4183,8 @@ async def manage_mute(interaction: discord.Interaction, user: discord.Member, du
         try: await interaction.followup.send(response_msg, ephemeral=False)
         except discord.NotFound: # If original response gone, try editing deferral msg (less ideal)
             try: await interaction.edit_original_response(content=response_msg)
-            except: print(f"WARN: Could not send mute confirmation for {user.id}") # Log if edit fails too
-        print(f"[审核操作] 用户 {author} 禁言了用户 {user} {duration_text}。原因: {reason}")
+            except: log.warning("WARN: Could not send mute confirmation for %s", user.id) # Log if edit fails too
+        log.info("[审核操作] 用户 %s 禁言了用户 %s %s。原因: %s", author, user, duration_text, reason)
         log_embed = discord.Embed(title="🔇 用户禁言", color=discord.Color.dark_orange(), timestamp=discord.utils.utcnow())
         log_embed.add_field(name="执行者", value=author.mention, inline=True); log_embed.add_field(name="被禁言用户", value=user.mention, inline=True)
         log_embed.add_field(name="持续时间", value=duration_text, inline=False)
@@ -3706,7 +4193,7 @@ async def manage_mute(interaction: discord.Interaction, user: discord.Member, du
         log_embed.set_footer(text=f"执行者 ID: {author.id} | 用户 ID: {user.id}")
         await send_to_public_log(guild, log_embed, log_type="Mute Member")
     except discord.Forbidden: await interaction.followup.send(f"⚙️ 禁言用户 {user.mention} 失败：机器人权限不足或层级不够。", ephemeral=True)
-    except Exception as e: print(f"执行 /管理 禁言 时出错: {e}"); await interaction.followup.send(f"⚙️ 禁言用户 {user.mention} 时发生未知错误: {e}", ephemeral=True)
+    except Exception as e: log.error("执行 /管理 禁言 时出错: %s", e); await interaction.followup.send(f"⚙️ 禁言用户 {user.mention} 时发生未知错误: {e}", ephemeral=True)
 
 @manage_group.command(name="踢出", description="将成员踢出服务器 (需要 '踢出成员' 权限)。")
 @app_commands.describe(user="要踢出的目标用户。", reason="(可选) 踢出的原因。")
@@ -3727,18 +4214,18 @@ async def manage_kick(interaction: discord.Interaction, user: discord.Member, re
     dm_sent = False
     try:
         try: await user.send(f"你已被管理员 **{author.display_name}** 从服务器 **{guild.name}** 中踢出。\n原因: {reason}"); dm_sent = True
-        except Exception as dm_err: print(f"   - 发送踢出私信给 {user.name} 时发生错误: {dm_err}")
+        except Exception as dm_err: log.warning("发送踢出私信给 %s 时发生错误: %s", user.name, dm_err)
         await user.kick(reason=kick_reason_full)
         dm_status = "(已尝试私信通知)" if dm_sent else "(私信通知失败)"
         await interaction.followup.send(f"👢 用户 {user.mention} (`{user}`) 已被成功踢出服务器 {dm_status}。\n原因: {reason}", ephemeral=False)
-        print(f"[审核操作] 用户 {author} 踢出了用户 {user}。原因: {reason}")
+        log.info("[审核操作] 用户 %s 踢出了用户 %s。原因: %s", author, user, reason)
         log_embed = discord.Embed(title="👢 用户踢出", color=discord.Color.dark_orange(), timestamp=discord.utils.utcnow())
         log_embed.add_field(name="执行者", value=author.mention, inline=True); log_embed.add_field(name="被踢出用户", value=f"{user.mention} (`{user}`)", inline=True)
         log_embed.add_field(name="私信状态", value="成功" if dm_sent else "失败", inline=True); log_embed.add_field(name="原因", value=reason, inline=False)
         log_embed.set_footer(text=f"执行者 ID: {author.id} | 用户 ID: {user.id}")
         await send_to_public_log(guild, log_embed, log_type="Kick Member")
     except discord.Forbidden: await interaction.followup.send(f"⚙️ 踢出用户 {user.mention} 失败：机器人权限不足或层级不够。", ephemeral=True)
-    except Exception as e: print(f"执行 /管理 踢出 时出错: {e}"); await interaction.followup.send(f"⚙️ 踢出用户 {user.mention} 时发生未知错误: {e}", ephemeral=True)
+    except Exception as e: log.error("执行 /管理 踢出 时出错: %s", e); await interaction.followup.send(f"⚙️ 踢出用户 {user.mention} 时发生未知错误: {e}", ephemeral=True)
 
     # --- 新增：重启机器人指令 ---
 @manage_group.command(name="restart", description="[服主专用] 重启机器人 (需要密码)。")
@@ -3751,12 +4238,12 @@ async def manage_restart_bot(interaction: discord.Interaction, password: str):
 
     if not RESTART_PASSWORD:
         await interaction.response.send_message("⚙️ 重启功能未配置密码，无法执行。", ephemeral=True)
-        print("⚠️ /管理 restart: RESTART_PASSWORD 未设置，无法执行。")
+        log.warning("⚠️ /管理 restart: RESTART_PASSWORD 未设置，无法执行。")
         return
 
     if password == RESTART_PASSWORD:
         await interaction.response.send_message("✅ 收到重启指令。机器人将尝试关闭并等待外部进程重启...", ephemeral=True)
-        print(f"机器人重启由 {interaction.user.name} ({interaction.user.id}) 发起。")
+        log.info("机器人重启由 %s (%s) 发起。", interaction.user.name, interaction.user.id)
 
         # 准备日志 Embed
         log_embed_restart = discord.Embed(title="🤖 机器人重启中...",
@@ -3794,29 +4281,27 @@ async def manage_restart_bot(interaction: discord.Interaction, password: str):
                 if log_channel_for_restart_notice.permissions_for(bot_member_for_perms).send_messages and \
                    log_channel_for_restart_notice.permissions_for(bot_member_for_perms).embed_links:
                     await log_channel_for_restart_notice.send(embed=log_embed_restart)
-                    print(f"  - 已发送重启通知到频道 #{log_channel_for_restart_notice.name}")
+                    log.info("已发送重启通知到频道 #%s", log_channel_for_restart_notice.name)
                 else:
-                    print(f"  - 发送重启通知到频道 #{log_channel_for_restart_notice.name} 失败：缺少发送或嵌入权限。")
+                    log.warning("发送重启通知到频道 #%s 失败：缺少发送或嵌入权限。", log_channel_for_restart_notice.name)
             except discord.Forbidden:
-                print(f"  - 发送重启通知到频道 #{log_channel_for_restart_notice.name} 失败：权限不足。")
+                log.warning("发送重启通知到频道 #%s 失败：权限不足。", log_channel_for_restart_notice.name)
             except Exception as e_log_send:
-                print(f"  - 发送重启通知到频道时发生错误: {e_log_send}")
+                log.error("发送重启通知到频道时发生错误: %s", e_log_send)
         else:
-            print("  - 未找到合适的频道发送重启通知。")
+            log.warning("未找到合适的频道发送重启通知。")
 
 
         await bot.change_presence(status=discord.Status.invisible) # 可选：表示正在关闭
-        # 清理 aiohttp 会话 (如果存在)
-        if hasattr(bot, 'http_session') and bot.http_session and not bot.http_session.closed:
-            await bot.http_session.close()
-            print("  - aiohttp 会话已关闭。")
+        # 清理共享 aiohttp 会话 (如果存在)
+        await http_client.close()
         
         await bot.close() # 优雅地关闭与 Discord 的连接
-        print("机器人正在关闭以进行重启... 请确保你的托管服务 (如 systemd) 会自动重启脚本。")
-        sys.exit(0) # 0 表示成功退出，systemd (如果配置为 Restart=always) 会重启它
+        log.info("机器人正在关闭以进行重启... 请确保你的托管服务 (如 systemd) 会自动重启脚本。")
+        sys.exit(0) # 0 表示成功退出，systemd (如果配置为 Restart=always) 会重启它；剩余日志由 bot_logging 的 atexit 钩子写完
     else:
         await interaction.response.send_message("❌ 密码错误，重启取消。", ephemeral=True)
-        print(f"用户 {interaction.user.name} 尝试重启机器人但密码错误。")
+        log.info("用户 %s 尝试重启机器人但密码错误。", interaction.user.name)
 
 @manage_group.command(name="封禁", description="永久封禁成员 (需要 '封禁成员' 权限)。")
 @app_commands.describe(user_id="要封禁的用户 ID (使用 ID 防止误操作)。", delete_message_days="删除该用户过去多少天的消息 (0-7，可选，默认为0)。", reason="(可选) 封禁的原因。")
@@ -3837,7 +4322,7 @@ async def manage_ban(interaction: discord.Interaction, user_id: str, delete_mess
         ban_entry = await guild.fetch_ban(discord.Object(id=target_user_id))
         banned_user = ban_entry.user; banned_user_display = f"**{banned_user}** (ID: {target_user_id})"; is_already_banned = True
     except discord.NotFound: pass # Not banned
-    except Exception as fetch_err: print(f"检查用户 {target_user_id} 封禁状态时出错: {fetch_err}")
+    except Exception as fetch_err: log.error("检查用户 %s 封禁状态时出错: %s", target_user_id, fetch_err)
     if is_already_banned: await interaction.followup.send(f"ℹ️ 用户 {banned_user_display} 已经被封禁了。", ephemeral=True); return
 
     target_member = guild.get_member(target_user_id)
@@ -3856,7 +4341,7 @@ async def manage_ban(interaction: discord.Interaction, user_id: str, delete_mess
         await guild.ban(user_to_ban, reason=ban_reason_full, delete_message_days=delete_message_days)
         delete_days_text = f"并删除了其过去 {delete_message_days} 天的消息" if delete_message_days > 0 else ""
         await interaction.followup.send(f"🚫 用户 {banned_user_display} 已被成功永久封禁{delete_days_text}。\n原因: {reason}", ephemeral=False)
-        print(f"[审核操作] 用户 {author} 封禁了 {banned_user_display}。原因: {reason}")
+        log.info("[审核操作] 用户 %s 封禁了 %s。原因: %s", author, banned_user_display, reason)
         log_embed = discord.Embed(title="🚫 用户封禁", color=discord.Color.dark_red(), timestamp=discord.utils.utcnow())
         log_embed.add_field(name="执行者", value=author.mention, inline=True); log_embed.add_field(name="被封禁用户", value=banned_user_display, inline=True)
         log_embed.add_field(name="原因", value=reason, inline=False)
@@ -3865,7 +4350,7 @@ async def manage_ban(interaction: discord.Interaction, user_id: str, delete_mess
         await send_to_public_log(guild, log_embed, log_type="Ban Member")
     except discord.Forbidden: await interaction.followup.send(f"⚙️ 封禁用户 ID {target_user_id} 失败：机器人权限不足或层级不够。", ephemeral=True)
     except discord.NotFound: await interaction.followup.send(f"❓ 封禁失败：找不到用户 ID 为 {target_user_id} 的用户。", ephemeral=True)
-    except Exception as e: print(f"执行 /管理 封禁 时出错: {e}"); await interaction.followup.send(f"⚙️ 封禁用户 ID {target_user_id} 时发生未知错误: {e}", ephemeral=True)
+    except Exception as e: log.error("执行 /管理 封禁 时出错: %s", e); await interaction.followup.send(f"⚙️ 封禁用户 ID {target_user_id} 时发生未知错误: {e}", ephemeral=True)
 
 @manage_group.command(name="解封", description="解除对用户的封禁 (需要 '封禁成员' 权限)。")
 @app_commands.describe(user_id="要解除封禁的用户 ID。", reason="(可选) 解除封禁的原因。")
@@ -3884,20 +4369,20 @@ async def manage_unban(interaction: discord.Interaction, user_id: str, reason: s
         user_to_unban = ban_entry.user; user_display = f"**{user_to_unban}** (ID: {target_user_id})"
     except discord.NotFound: await interaction.followup.send(f"ℹ️ {user_display} 当前并未被此服务器封禁。", ephemeral=True); return
     except discord.Forbidden: await interaction.followup.send(f"⚙️ 检查封禁状态失败：机器人缺少查看封禁列表的权限。", ephemeral=True); return
-    except Exception as fetch_err: print(f"获取用户 {target_user_id} 封禁信息时出错: {fetch_err}"); await interaction.followup.send(f"⚙️ 获取封禁信息时出错: {fetch_err}", ephemeral=True); return
+    except Exception as fetch_err: log.error("获取用户 %s 封禁信息时出错: %s", target_user_id, fetch_err); await interaction.followup.send(f"⚙️ 获取封禁信息时出错: {fetch_err}", ephemeral=True); return
 
     unban_reason_full = f"由 {author.display_name} 解除封禁，原因: {reason}"
     try:
         await guild.unban(user_to_unban, reason=unban_reason_full)
         await interaction.followup.send(f"✅ 用户 {user_display} 已被成功解除封禁。\n原因: {reason}", ephemeral=False)
-        print(f"[审核操作] 用户 {author} 解除了对 {user_display} 的封禁。原因: {reason}")
+        log.info("[审核操作] 用户 %s 解除了对 %s 的封禁。原因: %s", author, user_display, reason)
         log_embed = discord.Embed(title="✅ 用户解封", color=discord.Color.green(), timestamp=discord.utils.utcnow())
         log_embed.add_field(name="执行者", value=author.mention, inline=True); log_embed.add_field(name="被解封用户", value=user_display, inline=True)
         log_embed.add_field(name="原因", value=reason, inline=False)
         log_embed.set_footer(text=f"执行者 ID: {author.id} | 用户 ID: {target_user_id}")
         await send_to_public_log(guild, log_embed, log_type="Unban Member")
     except discord.Forbidden: await interaction.followup.send(f"⚙️ 解封 {user_display} 失败：机器人权限不足。", ephemeral=True)
-    except Exception as e: print(f"执行 /管理 解封 时出错: {e}"); await interaction.followup.send(f"⚙️ 解封 {user_display} 时发生未知错误: {e}", ephemeral=True)
+    except Exception as e: log.error("执行 /管理 解封 时出错: %s", e); await interaction.followup.send(f"⚙️ 解封 {user_display} 时发生未知错误: {e}", ephemeral=True)
 
 @manage_group.command(name="人数频道", description="创建或更新一个显示服务器成员人数的语音频道。")
 @app_commands.describe(channel_name_template="(可选) 频道名称的模板，用 '{count}' 代表人数。")
@@ -3926,9 +4411,9 @@ async def manage_member_count_channel(interaction: discord.Interaction, channel_
             await existing_channel.edit(name=new_name, reason="更新服务器成员人数")
             set_setting(temp_vc_settings, guild.id, "member_count_template", channel_name_template)
             await interaction.followup.send(f"✅ 已更新人数频道 {existing_channel.mention} 为 `{new_name}`。", ephemeral=True)
-            print(f"[管理操作] 服务器 {guild.id} 人数频道 ({existing_channel_id}) 更新为 '{new_name}'。")
+            log.info("[管理操作] 服务器 %s 人数频道 (%s) 更新为 '%s'。", guild.id, existing_channel_id, new_name)
         except discord.Forbidden: await interaction.followup.send(f"⚙️ 更新频道 {existing_channel.mention} 失败：权限不足。", ephemeral=True)
-        except Exception as e: print(f"更新人数频道时出错: {e}"); await interaction.followup.send(f"⚙️ 更新频道时发生未知错误: {e}", ephemeral=True)
+        except Exception as e: log.error("更新人数频道时出错: %s", e); await interaction.followup.send(f"⚙️ 更新频道时发生未知错误: {e}", ephemeral=True)
     else: # Create new channel
         try:
             overwrites = {guild.default_role: discord.PermissionOverwrite(connect=False), guild.me: discord.PermissionOverwrite(connect=True, view_channel=True, manage_channels=True)}
@@ -3936,9 +4421,9 @@ async def manage_member_count_channel(interaction: discord.Interaction, channel_
             set_setting(temp_vc_settings, guild.id, "member_count_channel_id", new_channel.id)
             set_setting(temp_vc_settings, guild.id, "member_count_template", channel_name_template)
             await interaction.followup.send(f"✅ 已创建成员人数统计频道: {new_channel.mention}。", ephemeral=True)
-            print(f"[管理操作] 服务器 {guild.id} 创建了成员人数频道 '{new_name}' ({new_channel.id})。")
+            log.info("[管理操作] 服务器 %s 创建了成员人数频道 '%s' (%s)。", guild.id, new_name, new_channel.id)
         except discord.Forbidden: await interaction.followup.send(f"⚙️ 创建人数频道失败：权限不足。", ephemeral=True)
-        except Exception as e: print(f"创建人数频道时出错: {e}"); await interaction.followup.send(f"⚙️ 创建人数频道时发生未知错误: {e}", ephemeral=True)
+        except Exception as e: log.error("创建人数频道时出错: %s", e); await interaction.followup.send(f"⚙️ 创建人数频道时发生未知错误: {e}", ephemeral=True)
 
 # ... (你已有的 /管理 禁言, /管理 踢出, /管理 人数频道 等指令) ...
 
@@ -3983,12 +4468,12 @@ async def whitelist_add_cmd(interaction: discord.Interaction, bot_user_id: str):
                  bot.approved_bot_whitelist[guild_id].discard(target_bot_id)
                  return
         except discord.NotFound:
-            print(f"[Whitelist] Bot ID {target_bot_id} not found by fetch_user, but added to whitelist.")
+            log.warning("[Whitelist] Bot ID %s not found by fetch_user, but added to whitelist.", target_bot_id)
         except Exception as e:
-            print(f"[Whitelist] Error fetching bot user {target_bot_id}: {e}")
+            log.error("[Whitelist] Error fetching bot user %s: %s", target_bot_id, e)
 
         await interaction.response.send_message(f"✅ {bot_name_display} 已成功添加到机器人白名单。下次它加入时将被允许。", ephemeral=True)
-        print(f"[Whitelist] 服务器 {guild_id}: 所有者 {interaction.user.name} 添加了机器人ID {target_bot_id} 到白名单。")
+        log.info("[Whitelist] 服务器 %s: 所有者 %s 添加了机器人ID %s 到白名单。", guild_id, interaction.user.name, target_bot_id)
         save_bot_whitelist_to_file()
 
 @bot_whitelist_group.command(name="remove", description="[服主专用] 从白名单中移除一个机器人ID。")
@@ -4019,7 +4504,7 @@ async def whitelist_remove_cmd(interaction: discord.Interaction, bot_user_id: st
         except: pass
 
         await interaction.response.send_message(f"✅ {bot_name_display} 已成功从机器人白名单中移除。下次它加入时将被踢出（除非再次添加）。", ephemeral=True)
-        print(f"[Whitelist] 服务器 {guild_id}: 所有者 {interaction.user.name} 从白名单移除了机器人ID {target_bot_id}。")
+        log.info("[Whitelist] 服务器 %s: 所有者 %s 从白名单移除了机器人ID %s。", guild_id, interaction.user.name, target_bot_id)
         save_bot_whitelist_to_file()
 
 @bot_whitelist_group.command(name="list", description="[服主专用] 查看当前机器人白名单列表。")
@@ -4076,7 +4561,7 @@ async def voice_set_master(interaction: discord.Interaction, master_channel: dis
     set_setting(temp_vc_settings, guild_id, "category_id", target_category.id)
     cat_name_text = f" 在分类 **{target_category.name}** 下"
     await interaction.followup.send(f"✅ 临时语音频道的母频道已成功设置为 {master_channel.mention}{cat_name_text}。", ephemeral=True)
-    print(f"[临时语音] 服务器 {guild_id}: 母频道={master_channel.id}, 分类={target_category.id}")
+    log.info("[临时语音] 服务器 %s: 母频道=%s, 分类=%s", guild_id, master_channel.id, target_category.id)
 
 def is_temp_vc_owner(interaction: discord.Interaction) -> bool:
     if not interaction.user.voice or not interaction.user.voice.channel: return False
@@ -4104,9 +4589,9 @@ async def voice_set_perms(interaction: discord.Interaction, target: Union[discor
         await user_vc.set_permissions(target, overwrite=overwrites, reason=f"由房主 {interaction.user.name} 修改权限")
         target_mention = target.mention if isinstance(target, discord.Member) else f"`@ {target.name}`"
         await interaction.followup.send(f"✅ 已更新 **{target_mention}** 在频道 {user_vc.mention} 的权限：\n{', '.join(perms_changed)}", ephemeral=True)
-        print(f"[临时语音] 房主 {interaction.user} 修改了频道 {user_vc.id} 中 {target} 的权限: {', '.join(perms_changed)}")
+        log.info("[临时语音] 房主 %s 修改了频道 %s 中 %s 的权限: %s", interaction.user, user_vc.id, target, ', '.join(perms_changed))
     except discord.Forbidden: await interaction.followup.send(f"⚙️ 设置权限失败：机器人权限不足或层级不够。", ephemeral=True)
-    except Exception as e: print(f"执行 /语音 设定权限 时出错: {e}"); await interaction.followup.send(f"⚙️ 设置权限时发生未知错误: {e}", ephemeral=True)
+    except Exception as e: log.error("执行 /语音 设定权限 时出错: %s", e); await interaction.followup.send(f"⚙️ 设置权限时发生未知错误: {e}", ephemeral=True)
 
 @voice_group.command(name="转让", description="(房主专用) 将你创建的临时语音频道所有权转让给频道内的其他用户。")
 @app_commands.describe(new_owner="选择要接收所有权的新用户 (该用户必须在频道内)。")
@@ -4124,11 +4609,11 @@ async def voice_transfer(interaction: discord.Interaction, new_owner: discord.Me
         old_owner_overwrites = discord.PermissionOverwrite() # Clear old owner's special perms
         await user_vc.set_permissions(new_owner, overwrite=new_owner_overwrites, reason=f"所有权由 {user.name} 转让")
         await user_vc.set_permissions(user, overwrite=old_owner_overwrites, reason=f"所有权转让给 {new_owner.name}")
-        temp_vc_owners[user_vc.id] = new_owner.id
+        set_temp_vc_owner(interaction.guild.id, user_vc.id, new_owner.id)
         await interaction.followup.send(f"✅ 频道 {user_vc.mention} 的所有权已成功转让给 {new_owner.mention}！", ephemeral=False)
-        print(f"[临时语音] 频道 {user_vc.id} 所有权从 {user.id} 转让给 {new_owner.id}")
+        log.info("[临时语音] 频道 %s 所有权从 %s 转让给 %s", user_vc.id, user.id, new_owner.id)
     except discord.Forbidden: await interaction.followup.send(f"⚙️ 转让失败：机器人权限不足。", ephemeral=True)
-    except Exception as e: print(f"执行 /语音 转让 时出错: {e}"); await interaction.followup.send(f"⚙️ 转让时发生未知错误: {e}", ephemeral=True)
+    except Exception as e: log.error("执行 /语音 转让 时出错: %s", e); await interaction.followup.send(f"⚙️ 转让时发生未知错误: {e}", ephemeral=True)
 
 @voice_group.command(name="房主", description="(成员使用) 如果原房主已离开频道，尝试获取该临时语音频道的所有权。")
 async def voice_claim(interaction: discord.Interaction):
@@ -4151,12 +4636,12 @@ async def voice_claim(interaction: discord.Interaction):
         await user_vc.set_permissions(user, overwrite=new_owner_overwrites, reason=f"由 {user.name} 获取房主权限")
         if original_owner: # Reset old owner perms if they existed
              try: await user_vc.set_permissions(original_owner, overwrite=None, reason="原房主离开，重置权限")
-             except Exception as reset_e: print(f"   - 重置原房主 {original_owner.id} 权限时出错: {reset_e}")
-        temp_vc_owners[user_vc.id] = user.id
+             except Exception as reset_e: log.error("重置原房主 %s 权限时出错: %s", original_owner.id, reset_e)
+        set_temp_vc_owner(interaction.guild.id, user_vc.id, user.id)
         await interaction.followup.send(f"✅ 恭喜 {user.mention}！你已成功获取频道 {user_vc.mention} 的房主权限！", ephemeral=False)
-        print(f"[临时语音] 用户 {user.id} 获取了频道 {user_vc.id} 的房主权限 (原房主: {current_owner_id})")
+        log.info("[临时语音] 用户 %s 获取了频道 %s 的房主权限 (原房主: %s)", user.id, user_vc.id, current_owner_id)
     except discord.Forbidden: await interaction.followup.send(f"⚙️ 获取房主权限失败：机器人权限不足。", ephemeral=True)
-    except Exception as e: print(f"执行 /语音 房主 时出错: {e}"); await interaction.followup.send(f"⚙️ 获取房主权限时发生未知错误: {e}", ephemeral=True)
+    except Exception as e: log.error("执行 /语音 房主 时出错: %s", e); await interaction.followup.send(f"⚙️ 获取房主权限时发生未知错误: {e}", ephemeral=True)
 
 # --- 经济系统斜杠指令组 ---
 eco_group = app_commands.Group(name="eco", description=f"与{ECONOMY_CURRENCY_NAME}和商店相关的指令。")
@@ -4180,9 +4665,10 @@ async def eco_balance(interaction: discord.Interaction, user: Optional[discord.M
         return
 
     # 从数据库获取最新的余额
-    balance = database.db_get_user_balance(guild_id, target_user.id, ECONOMY_DEFAULT_BALANCE) 
+    balance = await async_database.db_get_user_balance(guild_id, target_user.id, ECONOMY_DEFAULT_BALANCE)
+    balance += chat_earn_accumulator.pending_amount(guild_id, target_user.id) # 加上尚未写回数据库的聊天奖励
     
-    print(f"[COMMAND /eco balance] Fetched balance for {target_user.id} in guild {guild_id}: {balance}") # 新增调试
+    eco_log.info("[COMMAND /eco balance] Fetched balance for %s in guild %s: %s", target_user.id, guild_id, balance) # 新增调试
 
     embed = discord.Embed(
         title=f"{ECONOMY_CURRENCY_SYMBOL} {target_user.display_name}的余额",
@@ -4217,7 +4703,7 @@ async def eco_transfer(interaction: discord.Interaction, receiver: discord.Membe
     if amount <= 0:
         await interaction.followup.send(f"❌ 转账金额必须大于0。", ephemeral=True); return
 
-    sender_balance = get_user_balance(guild_id, sender.id)
+    sender_balance = await async_database.db_get_user_balance(guild_id, sender.id, ECONOMY_DEFAULT_BALANCE)
     
     tax_amount = 0
     if ECONOMY_TRANSFER_TAX_PERCENT > 0:
@@ -4230,10 +4716,12 @@ async def eco_transfer(interaction: discord.Interaction, receiver: discord.Membe
         await interaction.followup.send(f"❌ 你的{ECONOMY_CURRENCY_NAME}不足以完成转账（需要 {total_deduction} {ECONOMY_CURRENCY_NAME}，包含手续费）。", ephemeral=True)
         return
 
-    if update_user_balance(guild_id, sender.id, -total_deduction) and \
-       update_user_balance(guild_id, receiver.id, amount):
-        save_economy_data() # 成功交易后保存
-        
+    # 扣款与入账在同一事务中执行，任何一方失败 (例如并发扣款导致余额不足) 都整体回滚
+    transfer_results = await async_database.db_apply_balance_deltas(
+        [(guild_id, sender.id, -total_deduction), (guild_id, receiver.id, amount)],
+        default_balance=ECONOMY_DEFAULT_BALANCE, all_or_nothing=True
+    )
+    if all(new_balance is not None for new_balance in transfer_results):
         response_msg = f"✅ 你已成功向 {receiver.mention} 转账 **{amount}** {ECONOMY_CURRENCY_NAME}。"
         if tax_amount > 0:
             response_msg += f"\n手续费: **{tax_amount}** {ECONOMY_CURRENCY_NAME}。"
@@ -4251,9 +4739,9 @@ async def eco_transfer(interaction: discord.Interaction, receiver: discord.Membe
         except discord.Forbidden:
             await interaction.followup.send(f"ℹ️ 已成功转账，但无法私信通知 {receiver.mention} (TA可能关闭了私信)。",ephemeral=True)
         except Exception as e:
-            print(f"[经济系统错误] 发送转账私信给 {receiver.id} 时出错: {e}")
+            eco_log.error("[经济系统错误] 发送转账私信给 %s 时出错: %s", receiver.id, e)
         
-        print(f"[经济系统] 转账: {sender.id} -> {receiver.id}, 金额: {amount}, 手续费: {tax_amount}, 服务器: {guild_id}")
+        eco_log.info("[经济系统] 转账: %s -> %s, 金额: %s, 手续费: %s, 服务器: %s", sender.id, receiver.id, amount, tax_amount, guild_id)
     else:
         await interaction.followup.send(f"❌ 转账失败，发生内部错误。请重试或联系管理员。", ephemeral=True)
 
@@ -4270,7 +4758,7 @@ async def eco_shop(interaction: discord.Interaction):
         return
 
     # guild_shop_items = shop_items.get(guild_id, {}) # 如果使用内存字典
-    guild_shop_items = database.db_get_shop_items(guild_id) # 如果使用数据库
+    guild_shop_items = await async_database.db_get_shop_items(guild_id) # 如果使用数据库
 
     if not guild_shop_items:
         await interaction.response.send_message(f"商店目前是空的。让管理员添加一些物品吧！", ephemeral=True)
@@ -4334,7 +4822,7 @@ async def eco_buy(interaction: discord.Interaction, item_identifier: str):
     if not guild_id:
         await interaction.followup.send("此命令只能在服务器中使用。", ephemeral=True); return
 
-    guild_shop_items = shop_items.get(guild_id, {})
+    guild_shop_items = await async_database.db_get_shop_items(guild_id)
     item_slug_to_buy = get_item_slug(item_identifier) # 首先尝试 slug
     item_to_buy_data = guild_shop_items.get(item_slug_to_buy)
 
@@ -4350,11 +4838,6 @@ async def eco_buy(interaction: discord.Interaction, item_identifier: str):
         return
 
     item_price = item_to_buy_data['price']
-    user_balance = get_user_balance(guild_id, user.id)
-
-    if user_balance < item_price:
-        await interaction.followup.send(f"❌ 你的{ECONOMY_CURRENCY_NAME}不足以购买 **{item_to_buy_data['name']}** (需要 {item_price}，你有 {user_balance})。", ephemeral=True)
-        return
 
     # 检查库存
     item_stock = item_to_buy_data.get("stock", -1)
@@ -4370,19 +4853,17 @@ async def eco_buy(interaction: discord.Interaction, item_identifier: str):
             return
 
 
-    if update_user_balance(guild_id, user.id, -item_price):
-        # 如果不是无限库存，则更新库存
-        if item_stock != -1:
-            shop_items[guild_id][item_slug_to_buy]["stock"] = item_stock - 1
-        
-        save_economy_data() # 成功购买并更新库存后保存
-
+    # 余额检查、扣库存和购买记录都在 db_purchase_item 的事务中完成
+    purchase_result = await async_database.db_purchase_item(
+        guild_id, user.id, item_slug_to_buy, item_price, default_balance=ECONOMY_DEFAULT_BALANCE
+    )
+    if purchase_result.success:
         await grant_item_purchase(interaction, user, item_to_buy_data) # 处理身份组授予和自定义消息
         
         await interaction.followup.send(f"🎉 恭喜！你已成功购买 **{item_to_buy_data['name']}**！", ephemeral=True)
-        print(f"[经济系统] 购买: 用户 {user.id} 在服务器 {guild_id} 以 {item_price} 购买了 '{item_to_buy_data['name']}'。")
+        eco_log.info("[经济系统] 购买: 用户 %s 在服务器 %s 以 %s 购买了 '%s'。", user.id, guild_id, item_price, item_to_buy_data['name'])
     else:
-        await interaction.followup.send(f"❌ 购买失败，发生内部错误。请重试或联系管理员。", ephemeral=True)
+        await interaction.followup.send(get_purchase_failure_message(purchase_result, item_to_buy_data), ephemeral=True)
 
 @eco_group.command(name="leaderboard", description=f"显示服务器中{ECONOMY_CURRENCY_NAME}排行榜。")
 async def eco_leaderboard(interaction: discord.Interaction):
@@ -4395,13 +4876,11 @@ async def eco_leaderboard(interaction: discord.Interaction):
         await interaction.response.send_message("此命令只能在服务器中使用。", ephemeral=True)
         return
 
-    guild_balances = user_balances.get(guild_id, {})
-    if not guild_balances:
+    # 数据库已按余额降序排序并限制条数，返回 [(user_id, balance), ...]
+    sorted_users = await async_database.db_get_leaderboard(guild_id, ECONOMY_MAX_LEADERBOARD_USERS)
+    if not sorted_users:
         await interaction.response.send_message(f"本服务器还没有人拥有{ECONOMY_CURRENCY_NAME}记录。", ephemeral=True)
         return
-
-    # 按余额降序排序用户。items() 返回 (user_id, balance)
-    sorted_users = sorted(guild_balances.items(), key=lambda item: item[1], reverse=True)
     
     embed = discord.Embed(
         title=f"{ECONOMY_CURRENCY_SYMBOL} {interaction.guild.name} {ECONOMY_CURRENCY_NAME}排行榜",
@@ -4425,6 +4904,38 @@ async def eco_leaderboard(interaction: discord.Interaction):
     embed.set_footer(text=f"显示前 {ECONOMY_MAX_LEADERBOARD_USERS} 名。")
     await interaction.response.send_message(embed=embed, ephemeral=False)
 
+@eco_group.command(name="rank", description=f"查看你或其他用户在本服务器{ECONOMY_CURRENCY_NAME}排行榜中的名次。")
+@app_commands.describe(user="(可选) 要查看名次的用户。")
+async def eco_rank(interaction: discord.Interaction, user: Optional[discord.Member] = None):
+    if not ECONOMY_ENABLED:
+        await interaction.response.send_message("经济系统当前未启用。", ephemeral=True)
+        return
+
+    guild_id = interaction.guild_id
+    if not guild_id:
+        await interaction.response.send_message("此命令只能在服务器中使用。", ephemeral=True)
+        return
+
+    target_user = user if user else interaction.user
+    if target_user.bot:
+        await interaction.response.send_message(f"🤖 机器人不参与{ECONOMY_CURRENCY_NAME}排行。", ephemeral=True)
+        return
+
+    # 前 K 名直接由内存给出，其余用户通过排行榜索引上的范围计数得到名次
+    rank_info = await async_database.db_get_user_rank(guild_id, target_user.id)
+    if rank_info is None:
+        await interaction.response.send_message(f"ℹ️ {target_user.mention} 还没有{ECONOMY_CURRENCY_NAME}记录，暂无名次。", ephemeral=True)
+        return
+
+    rank, balance = rank_info
+    embed = discord.Embed(
+        title=f"{ECONOMY_CURRENCY_SYMBOL} {target_user.display_name}的排名",
+        description=f"第 **{rank}** 名 · **{balance}** {ECONOMY_CURRENCY_NAME}",
+        color=discord.Color.gold()
+    )
+    embed.set_footer(text="尚未写回数据库的聊天奖励不计入排名。")
+    await interaction.response.send_message(embed=embed, ephemeral=True if user else False)
+
 
 # --- 管理员经济系统指令组 (/管理 的子指令组) ---
 eco_admin_group = app_commands.Group(name="eco_admin", description=f"管理员经济系统管理指令。", parent=manage_group)
@@ -4450,30 +4961,24 @@ async def eco_admin_give(interaction: discord.Interaction, user: discord.Member,
         await interaction.response.send_message(f"❌ 给予的金额必须大于0。", ephemeral=True)
         return
 
-    print(f"[COMMAND /eco_admin give] User {interaction.user.id} attempting to give {amount} to target_user {user.id} in guild {guild_id}")
+    eco_log.info("[COMMAND /eco_admin give] User %s attempting to give %s to target_user %s in guild %s", interaction.user.id, amount, user.id, guild_id)
 
-    # 调用数据库函数进行更新，is_delta=True 表示增加余额
-    # ECONOMY_DEFAULT_BALANCE 作为 db_get_user_balance (被 db_update_user_balance 调用) 的备用初始值
-    update_success = database.db_update_user_balance(
+    # 原子增量更新，直接返回新余额 (用户不存在时以 ECONOMY_DEFAULT_BALANCE 为初始值)
+    final_balance = await async_database.db_apply_balance_delta(
         guild_id, 
         user.id, 
         amount, 
-        is_delta=True, # 明确这是增量操作
         default_balance=ECONOMY_DEFAULT_BALANCE 
     )
 
-    if update_success:
-        # 更新成功后，我们再次从数据库获取余额以确认并显示给用户
-        final_balance = database.db_get_user_balance(guild_id, user.id, ECONOMY_DEFAULT_BALANCE) # 使用默认值以防万一
-        
-        print(f"[COMMAND /eco_admin give] db_update_user_balance returned success. Final balance for {user.id} is {final_balance}")
+    if final_balance is not None:
 
         await interaction.response.send_message(f"✅ 已成功给予 {user.mention} **{amount}** {ECONOMY_CURRENCY_NAME}。\n其新余额为: **{final_balance}** {ECONOMY_CURRENCY_NAME}。", ephemeral=False)
-        print(f"[经济系统管理员] {interaction.user.id} 在服务器 {guild_id} 成功给予了用户 {user.id} {amount} {ECONOMY_CURRENCY_NAME}。新数据库余额: {final_balance}")
+        eco_log.info("[经济系统管理员] %s 在服务器 %s 成功给予了用户 %s %s %s。新数据库余额: %s", interaction.user.id, guild_id, user.id, amount, ECONOMY_CURRENCY_NAME, final_balance)
     else:
-        # 如果 db_update_user_balance 返回 False，可能是因为尝试使余额为负（虽然这里是给予，不太可能）或数据库错误
+        # 返回 None 说明数据库错误 (给予操作不会使余额为负)
         await interaction.response.send_message(f"❌ 操作失败，无法在数据库中更新用户 {user.mention} 的余额。请检查日志。", ephemeral=True)
-        print(f"[经济系统管理员] 给予用户 {user.id} (guild: {guild_id}) {amount} {ECONOMY_CURRENCY_NAME} 失败 (db_update_user_balance 返回 False)。")
+        eco_log.error("[经济系统管理员] 给予用户 %s (guild: %s) %s %s 失败 (db_apply_balance_delta 返回 None)。", user.id, guild_id, amount, ECONOMY_CURRENCY_NAME)
 
 @eco_admin_group.command(name="take", description=f"从用户处移除指定数量的{ECONOMY_CURRENCY_NAME}。")
 @app_commands.describe(user="要移除其货币的用户。", amount=f"要移除的{ECONOMY_CURRENCY_NAME}数量。")
@@ -4483,17 +4988,15 @@ async def eco_admin_take(interaction: discord.Interaction, user: discord.Member,
     guild_id = interaction.guild_id
     if user.bot: await interaction.response.send_message(f"❌ 机器人没有{ECONOMY_CURRENCY_NAME}。", ephemeral=True); return
 
-    current_bal = get_user_balance(guild_id, user.id)
-    if current_bal < amount :
-        # 选项：只拿走他们拥有的？还是失败？为了明确，我们选择失败。
+    # 非负检查在数据库语句中完成：余额不足时返回 None
+    # 选项：只拿走他们拥有的？还是失败？为了明确，我们选择失败。
+    new_bal = await async_database.db_apply_balance_delta(guild_id, user.id, -amount, default_balance=ECONOMY_DEFAULT_BALANCE)
+    if new_bal is not None:
+        await interaction.response.send_message(f"✅ 已成功从 {user.mention} 处移除 **{amount}** {ECONOMY_CURRENCY_NAME}。\n其新余额为: {new_bal} {ECONOMY_CURRENCY_NAME}。", ephemeral=False)
+        eco_log.info("[经济系统管理员] %s 在服务器 %s 从 %s 处移除了 %s %s。", interaction.user.id, guild_id, user.id, amount, ECONOMY_CURRENCY_NAME)
+    else:
+        current_bal = await async_database.db_get_user_balance(guild_id, user.id, ECONOMY_DEFAULT_BALANCE)
         await interaction.response.send_message(f"❌ 用户 {user.mention} 只有 {current_bal} {ECONOMY_CURRENCY_NAME}，无法移除 {amount}。", ephemeral=True)
-        return
-
-    if update_user_balance(guild_id, user.id, -amount):
-        save_economy_data()
-        await interaction.response.send_message(f"✅ 已成功从 {user.mention} 处移除 **{amount}** {ECONOMY_CURRENCY_NAME}。\n其新余额为: {get_user_balance(guild_id, user.id)} {ECONOMY_CURRENCY_NAME}。", ephemeral=False)
-        print(f"[经济系统管理员] {interaction.user.id} 在服务器 {guild_id} 从 {user.id} 处移除了 {amount} {ECONOMY_CURRENCY_NAME}。")
-    else: await interaction.response.send_message(f"❌ 操作失败。", ephemeral=True)
 
 
 @eco_admin_group.command(name="set", description=f"设置用户{ECONOMY_CURRENCY_NAME}为指定数量。")
@@ -4513,12 +5016,12 @@ async def eco_admin_set(interaction: discord.Interaction, user: discord.Member,
         await interaction.response.send_message(f"❌ 机器人没有{ECONOMY_CURRENCY_NAME}。", ephemeral=True)
         return
 
-    print(f"[COMMAND /eco_admin set] User {interaction.user.id} attempting to set balance for target_user {user.id} to {amount} in guild {guild_id}")
+    eco_log.debug("[COMMAND /eco_admin set] User %s attempting to set balance for target_user %s to %s in guild %s", interaction.user.id, user.id, amount, guild_id)
 
     # 调用数据库函数进行更新，is_delta=False 表示直接设置值
     # ECONOMY_DEFAULT_BALANCE 在这里作为 db_get_user_balance (被 db_update_user_balance 调用) 的备用值，
     # 但由于 is_delta=False，它实际上不影响最终写入的 new_balance。
-    update_success = database.db_update_user_balance(
+    update_success = await async_database.db_update_user_balance(
         guild_id, 
         user.id, 
         amount, 
@@ -4530,20 +5033,20 @@ async def eco_admin_set(interaction: discord.Interaction, user: discord.Member,
         # 更新成功后，我们再次从数据库获取余额以确认并显示给用户
         # 确保这里的 default_balance 与 /eco balance 命令中使用的 default_balance 一致
         # 并且与购买逻辑中获取余额时使用的 default_balance 一致
-        final_balance = database.db_get_user_balance(guild_id, user.id, ECONOMY_DEFAULT_BALANCE)
+        final_balance = await async_database.db_get_user_balance(guild_id, user.id, ECONOMY_DEFAULT_BALANCE)
         
-        print(f"[COMMAND /eco_admin set] db_update_user_balance returned success. Attempting to display final_balance: {final_balance}")
+        eco_log.debug("[COMMAND /eco_admin set] db_update_user_balance returned success. Attempting to display final_balance: %s", final_balance)
 
         response_message = f"✅ 已成功将 {user.mention} 的余额设置为 **{final_balance}** {ECONOMY_CURRENCY_NAME}。"
         if final_balance != amount: # 如果读取到的最终余额和我们设置的不一样，添加一个警告
             response_message += f"\n⚠️ **注意：**设置值为 {amount}，但从数据库读取到的最终余额为 {final_balance}。请检查日志。"
-            print(f"🚨 [COMMAND /eco_admin set] BALANCE MISMATCH! Set to {amount}, but db_get_user_balance returned {final_balance} for user {user.id}")
+            eco_log.error("🚨 [COMMAND /eco_admin set] BALANCE MISMATCH! Set to %s, but db_get_user_balance returned %s for user %s", amount, final_balance, user.id)
 
         await interaction.response.send_message(response_message, ephemeral=False)
-        print(f"[经济系统管理员] {interaction.user.id} 在服务器 {guild_id} 尝试将用户 {user.id} 的余额设置为 {amount}。数据库最终确认余额为: {final_balance}")
+        eco_log.info("[经济系统管理员] %s 在服务器 %s 尝试将用户 %s 的余额设置为 %s。数据库最终确认余额为: %s", interaction.user.id, guild_id, user.id, amount, final_balance)
     else:
         await interaction.response.send_message(f"❌ 操作失败，无法在数据库中更新用户 {user.mention} 的余额。", ephemeral=True)
-        print(f"[经济系统管理员] 设置用户 {user.id} (guild: {guild_id}) 余额为 {amount} 失败 (db_update_user_balance 返回 False)。")
+        eco_log.error("[经济系统管理员] 设置用户 %s (guild: %s) 余额为 %s 失败 (db_update_user_balance 返回 False)。", user.id, guild_id, amount)
 
 @eco_admin_group.command(name="config_chat_earn", description="配置聊天获取货币的金额和冷却时间。")
 @app_commands.describe(
@@ -4555,11 +5058,9 @@ async def eco_admin_config_chat_earn(interaction: discord.Interaction, amount: a
     if not ECONOMY_ENABLED: await interaction.response.send_message("经济系统当前未启用。", ephemeral=True); return
     guild_id = interaction.guild_id
     
-    guild_economy_settings[guild_id] = {
-        "chat_earn_amount": amount,
-        "chat_earn_cooldown": cooldown_seconds
-    }
-    save_economy_data()
+    if not await async_database.db_set_guild_chat_earn_config(guild_id, amount, cooldown_seconds):
+        await interaction.response.send_message(f"❌ 保存聊天赚钱配置失败，请检查日志。", ephemeral=True)
+        return
     status = "启用" if amount > 0 else "禁用"
     await interaction.response.send_message(
         f"✅ 聊天赚取{ECONOMY_CURRENCY_NAME}已配置：\n"
@@ -4568,7 +5069,7 @@ async def eco_admin_config_chat_earn(interaction: discord.Interaction, amount: a
         f"- 冷却时间: **{cooldown_seconds}** 秒",
         ephemeral=True
     )
-    print(f"[经济系统管理员] 服务器 {guild_id} 聊天赚钱配置已由 {interaction.user.id} 更新：金额={amount}, 冷却={cooldown_seconds}")
+    eco_log.info("[经济系统管理员] 服务器 %s 聊天赚钱配置已由 %s 更新：金额=%s, 冷却=%s", guild_id, interaction.user.id, amount, cooldown_seconds)
 
 @eco_admin_group.command(name="add_shop_item", description="向商店添加新物品。")
 @app_commands.describe(
@@ -4601,12 +5102,12 @@ async def eco_admin_add_shop_item(
     item_slug = get_item_slug(name) # 生成物品的唯一ID/slug
 
     # 调试打印 (可选，但在调试时有用)
-    print(f"[COMMAND /eco_admin add_shop_item] Attempting to add: guild_id={guild_id}, slug='{item_slug}', name='{name}'")
+    eco_log.info("[COMMAND /eco_admin add_shop_item] Attempting to add: guild_id=%s, slug='%s', name='%s'", guild_id, item_slug, name)
 
     # 首先检查物品是否已存在于数据库中，避免重复添加导致 IntegrityError（虽然数据库层面会处理）
     # 这一步是可选的，因为 database.db_add_shop_item 内部也会处理 IntegrityError，
     # 但在这里先检查可以提供更友好的用户反馈。
-    existing_item_check = database.db_get_shop_item(guild_id, item_slug)
+    existing_item_check = await async_database.db_get_shop_item(guild_id, item_slug)
     if existing_item_check:
         await interaction.response.send_message(f"❌ 商店中已存在名为/ID为 **'{name}'** (`{item_slug}`) 的物品。", ephemeral=True)
         return
@@ -4614,7 +5115,7 @@ async def eco_admin_add_shop_item(
     # 调用数据库函数来添加物品
     # 假设 database.db_add_shop_item 返回一个元组 (success: bool, message: str)
     # 如果它只返回 bool，你需要相应调整下面的反馈逻辑
-    success, db_message = database.db_add_shop_item(
+    success, db_message = await async_database.db_add_shop_item(
         guild_id=guild_id,
         item_slug=item_slug,
         name=name, # 传递原始名称给数据库
@@ -4627,7 +5128,7 @@ async def eco_admin_add_shop_item(
 
     if success:
         await interaction.response.send_message(f"✅ 物品 **{name}** (`{item_slug}`) 已成功添加到商店！", ephemeral=True)
-        print(f"[经济系统管理员] 服务器 {guild_id} 物品已添加: {name} (Slug: {item_slug})，操作者: {interaction.user.id}")
+        eco_log.info("[经济系统管理员] 服务器 %s 物品已添加: %s (Slug: %s)，操作者: %s", guild_id, name, item_slug, interaction.user.id)
     else:
         # db_message 应该包含来自数据库函数的具体错误信息
         # 如果 db_add_shop_item 返回的 db_message 为空或不友好，你可能需要在这里构造一个更通用的错误消息
@@ -4640,7 +5141,7 @@ async def eco_admin_add_shop_item(
             error_feedback += " 可能发生数据库错误或物品已存在。"
         
         await interaction.response.send_message(error_feedback, ephemeral=True)
-        print(f"[经济系统管理员] 添加物品失败: {name} (Slug: {item_slug}), Guild: {guild_id}, Reason from DB: {db_message}")
+        eco_log.error("[经济系统管理员] 添加物品失败: %s (Slug: %s), Guild: %s, Reason from DB: %s", name, item_slug, guild_id, db_message)
 
 
 @eco_admin_group.command(name="remove_shop_item", description="从商店移除物品。")
@@ -4671,7 +5172,7 @@ async def eco_admin_remove_shop_item(interaction: discord.Interaction, item_iden
             del shop_items[guild_id]
         save_economy_data()
         await interaction.response.send_message(f"✅ 物品 **{item_removed_data['name']}** (`{item_slug_to_remove}`) 已成功从商店移除。", ephemeral=True)
-        print(f"[经济系统管理员] 服务器 {guild_id} 物品已移除: {item_removed_data['name']} (Slug: {item_slug_to_remove})，操作者: {interaction.user.id}")
+        eco_log.info("[经济系统管理员] 服务器 %s 物品已移除: %s (Slug: %s)，操作者: %s", guild_id, item_removed_data['name'], item_slug_to_remove, interaction.user.id)
     # else 情况已在上面的检查中处理
 
 @eco_admin_group.command(name="edit_shop_item", description="编辑商店中现有物品的属性。")
@@ -4735,7 +5236,7 @@ async def eco_admin_edit_shop_item(
     save_economy_data()
 
     await interaction.followup.send(f"✅ 物品 **{item_data['name']}** (`{item_slug_to_edit}`) 已更新以下属性：{', '.join(updated_fields)}。", ephemeral=True)
-    print(f"[经济系统管理员] 服务器 {guild_id} 物品 '{item_data['name']}' 已由 {interaction.user.id} 编辑。字段: {', '.join(updated_fields)}")
+    eco_log.info("[经济系统管理员] 服务器 %s 物品 '%s' 已由 %s 编辑。字段: %s", guild_id, item_data['name'], interaction.user.id, ', '.join(updated_fields))
 
 # --- (经济系统管理员指令结束) ---
 
@@ -4754,46 +5255,55 @@ bot.tree.add_command(eco_group) # 添加新的面向用户的经济系统指令
 
 # --- Run the Bot ---
 if __name__ == "__main__":
-    print("正在启动机器人...")
+    log.info("正在启动机器人...")
     if not BOT_TOKEN:
-        print("❌ 致命错误：无法启动，因为 DISCORD_BOT_TOKEN 未设置。")
-        exit()
+        log.error("❌ 致命错误：无法启动，因为 DISCORD_BOT_TOKEN 未设置。")
+        sys.exit(1)
 
-    if not DEEPSEEK_API_KEY: print("⚠️ 警告：DEEPSEEK_API_KEY 未设置，AI 内容审核功能将不可用。")
+    if not DEEPSEEK_API_KEY: log.warning("⚠️ 警告：DEEPSEEK_API_KEY 未设置，AI 内容审核功能将不可用。")
 
     async def main():
-        # Initialize aiohttp session within async context
-        if AIOHTTP_AVAILABLE:
-            bot.http_session = aiohttp.ClientSession()
-            print("已创建 aiohttp 会话。")
-        else:
-            bot.http_session = None # Indicate session is not available
+        # 在事件循环中预先创建共享会话 (之后所有出站请求都复用它)
+        http_client.get_session()
 
         try:
             await bot.start(BOT_TOKEN)
         except discord.LoginFailure:
-            print("❌ 致命错误：登录失败。提供的 DISCORD_BOT_TOKEN 无效。")
+            log.error("❌ 致命错误：登录失败。提供的 DISCORD_BOT_TOKEN 无效。")
         except discord.PrivilegedIntentsRequired:
-            print("❌ 致命错误：机器人缺少必要的特权 Intents (Members, Message Content, Guilds)。请在 Discord 开发者门户中启用它们！")
+            log.error("❌ 致命错误：机器人缺少必要的特权 Intents (Members, Message Content, Guilds)。请在 Discord 开发者门户中启用它们！")
         except Exception as e:
-            print(f"❌ 机器人启动过程中发生致命错误: {e}")
+            log.error("❌ 机器人启动过程中发生致命错误: %s", e)
         finally:
+            discarded_turns = await ai_dialogue_scheduler.stop()
+            if discarded_turns:
+                ai_log.info("[AI DIALOGUE] 关闭时丢弃 %s 个尚未执行的对话回合。", discarded_turns)
+            discarded_moderation = await moderation_queue.stop()
+            if discarded_moderation:
+                mod_log.info("[审核队列] 关闭时丢弃 %s 条尚未审核的消息。", discarded_moderation)
             if ECONOMY_ENABLED: # 添加此行
+                try:
+                    flushed_rows = await chat_earn_accumulator.stop() # 先写回缓冲中的聊天奖励，再关闭数据库
+                    log.info("[经济系统] 聊天奖励缓冲已写回数据库 (%s 条)。", flushed_rows)
+                except Exception as e_flush:
+                    log.error("[经济系统错误] 关闭时写回聊天奖励失败: %s", e_flush)
                 save_economy_data()
-                print("[经济系统] 数据已在关闭时保存。")
-            # 关闭机器人时清理会话
-            if hasattr(bot, 'http_session') and bot.http_session and not bot.http_session.closed: # 检查会话是否已关闭
-                await bot.http_session.close()
-                print("已关闭 aiohttp 会话。")
+                log.info("[经济系统] 数据已在关闭时保存。")
+            # 关闭机器人时清理共享会话 (在途的审核请求已随审核队列停止)
+            await http_client.close()
+            await wait_for_pending_state_writes() # 审核 / AI / 票据等状态的后台写回
+            async_database.shutdown() # 等待数据库线程池排空并关闭所有复用的连接
             # await bot.close() # bot.start() 退出或出错时通常会调用此方法，确保不要重复调用。
             # 如果你的框架在 bot.start() 结束或出错后没有自动处理 bot.close()，则取消注释此行。
-            print("机器人已关闭。") # 通用关闭消息
+            log.info("机器人已关闭。") # 通用关闭消息
 
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        print("\n收到退出信号，正在关闭机器人...")
+        log.info("收到退出信号，正在关闭机器人...")
     except Exception as main_err:
-        print(f"\n运行主程序时发生未捕获错误: {main_err}")
+        log.error("运行主程序时发生未捕获错误: %s", main_err)
+    finally:
+        bot_logging.shutdown_logging() # 写完队列中剩余的日志
 
 # --- End of Complete Code ---
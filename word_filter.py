@@ -0,0 +1,186 @@
+# word_filter.py
+# 违禁词匹配：Aho-Corasick 多模式自动机，一次扫描消息即可找出所有命中的违禁词。
+#
+# - 词表在启动时 (以及词表变更时) 编译一次；匹配耗时只与消息长度有关，与词表大小基本无关，
+#   取代原来 "for word in BAD_WORDS_LOWER: if word in content_lower" 的 O(词数 × 长度) 循环。
+# - 词和消息都先做同样的规范化：NFKC (全角字母 / 数字转半角)、去掉零宽字符、转小写，
+#   因此 "ｓｂ"、"s​b" 这类绕过写法也能命中。
+# - BadWordFilter 管理全局词表与各服务器的附加词表 (服务器自动机 = 全局词 + 附加词，只为有附加词的服务器构建)。
+
+import random
+import time
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# 零宽空格 / 连接符 / 方向标记 / BOM / 软连字符等，常被插在违禁词中间绕过检测
+_INVISIBLE_CHARS = dict.fromkeys(map(ord, "\u200b\u200c\u200d\u200e\u200f\u2060\u2061\u2062\u2063\u2064\ufeff\u00ad\u180e"))
+
+
+def normalize_text(text: str) -> str:
+    return unicodedata.normalize("NFKC", text).translate(_INVISIBLE_CHARS).lower()
+
+
+class AhoCorasickMatcher:
+    """编译后的多模式匹配自动机 (不可变；词表变化时创建新实例)。"""
+
+    def __init__(self, words: Iterable[str]):
+        self.words: Tuple[str, ...] = tuple(dict.fromkeys(normalize_text(word) for word in words if word and word.strip()))
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[Tuple[int, ...]] = [()]  # 每个状态结束的词 (包括沿失败链可达的词)，保存词的下标
+        for word_index, word in enumerate(self.words):
+            self._insert(word, word_index)
+        self._build_failure_links()
+
+    def _insert(self, word: str, word_index: int):
+        state = 0
+        for char in word:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            state = next_state
+        self._output[state] += (word_index,)
+
+    def _build_failure_links(self):
+        queue = list(self._goto[0].values()) # 第一层的失败链接指向根
+        for state in queue: # 广度优先：处理某状态时，其失败状态 (更浅) 已经处理完毕
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                fail_state = self._goto[fallback].get(char, 0)
+                self._fail[next_state] = fail_state
+                if self._output[fail_state]:
+                    self._output[next_state] += self._output[fail_state]
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def find_all(self, text: str, normalized: bool = False) -> List[str]:
+        """返回文本中命中的所有词 (去重，按首次出现的结束位置排序)。"""
+        if not self.words:
+            return []
+        if not normalized:
+            text = normalize_text(text)
+        goto, fail, output, words = self._goto, self._fail, self._output, self.words
+        found: Dict[int, None] = {}
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                for word_index in output[state]:
+                    found.setdefault(word_index)
+        return [words[word_index] for word_index in found]
+
+    def find_first(self, text: str, normalized: bool = False) -> Optional[str]:
+        hits = self.find_all(text, normalized)
+        return hits[0] if hits else None
+
+
+class BadWordFilter:
+    """全局违禁词 + 各服务器附加违禁词。词表变化时重新编译对应的自动机。"""
+
+    def __init__(self, global_words: Iterable[str] = ()):
+        self._global_words: Tuple[str, ...] = ()
+        self._global_matcher = AhoCorasickMatcher(())
+        self._guild_words: Dict[int, Tuple[str, ...]] = {}
+        self._guild_matchers: Dict[int, AhoCorasickMatcher] = {}
+        self.rebuilds = 0
+        self.set_global_words(global_words)
+
+    def set_global_words(self, words: Iterable[str]):
+        self._global_matcher = AhoCorasickMatcher(words)
+        self._global_words = self._global_matcher.words
+        self.rebuilds += 1
+        for guild_id in list(self._guild_matchers):
+            self._rebuild_guild(guild_id)
+
+    def set_guild_words(self, guild_id: int, words: Iterable[str]):
+        """设置某服务器的附加违禁词 (空列表表示只使用全局词表)。"""
+        guild_words = tuple(dict.fromkeys(normalize_text(word) for word in words if word and word.strip()))
+        if guild_words:
+            self._guild_words[guild_id] = guild_words
+            self._rebuild_guild(guild_id)
+        else:
+            self._guild_words.pop(guild_id, None)
+            self._guild_matchers.pop(guild_id, None)
+
+    def _rebuild_guild(self, guild_id: int):
+        self._guild_matchers[guild_id] = AhoCorasickMatcher(self._global_words + self._guild_words[guild_id])
+        self.rebuilds += 1
+
+    def get_guild_words(self, guild_id: int) -> List[str]:
+        return list(self._guild_words.get(guild_id, ()))
+
+    def find_all(self, text: str, guild_id: Optional[int] = None) -> List[str]:
+        """返回命中的所有违禁词 (规范化后的形式)；有附加词表的服务器使用合并后的自动机，仍然只扫描一遍。"""
+        matcher = self._guild_matchers.get(guild_id, self._global_matcher) if guild_id is not None else self._global_matcher
+        return matcher.find_all(text)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {"global_words": len(self._global_words), "guilds_with_custom_words": len(self._guild_words),
+                "custom_words": sum(len(words) for words in self._guild_words.values()), "rebuilds": self.rebuilds}
+
+
+# =========================================
+# == 性能基准 (python word_filter.py bench [词数 ...])
+# =========================================
+def _random_word(rng: random.Random) -> str:
+    alphabet = "abcdefghijklmnopqrstuvwxyz" if rng.random() < 0.4 else "的一是不了人我在有他这中大来上国个到说们为子和你地出道也时年得就那要下以生会自着去之怎"
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(2, 5)))
+
+
+def run_matcher_benchmark(word_counts: Tuple[int, ...] = (1000, 10000), messages: int = 2000, seed: int = 7) -> Dict[int, Dict[str, float]]:
+    """比较原来的逐词子串循环与 Aho-Corasick 自动机 (都找出全部命中)，并核对两者结果一致。"""
+    rng = random.Random(seed)
+    report: Dict[int, Dict[str, float]] = {}
+    for word_count in word_counts:
+        words = list(dict.fromkeys(_random_word(rng) for _ in range(word_count * 2)))[:word_count]
+        texts = []
+        for _ in range(messages):
+            text = "".join(rng.choice("今天天气很好我们一起去玩吧 hello world 哈哈 ") for _ in range(rng.randint(20, 120)))
+            if rng.random() < 0.2:
+                cut = rng.randint(0, len(text))
+                text = text[:cut] + rng.choice(words) + text[cut:]
+            texts.append(text)
+        words_lower = [word.lower() for word in words]
+
+        started = time.perf_counter()
+        loop_hits = []
+        for text in texts:
+            content_lower = text.lower()
+            loop_hits.append({word for word in words_lower if word in content_lower})
+        loop_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        matcher = AhoCorasickMatcher(words)
+        build_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        automaton_hits = [set(matcher.find_all(text)) for text in texts]
+        automaton_seconds = time.perf_counter() - started
+
+        report[word_count] = {
+            "loop_us_per_msg": loop_seconds / messages * 1e6,
+            "automaton_us_per_msg": automaton_seconds / messages * 1e6,
+            "speedup": loop_seconds / automaton_seconds if automaton_seconds else float("inf"),
+            "build_ms": build_seconds * 1000,
+            "mismatches": sum(1 for a, b in zip(loop_hits, automaton_hits) if a != b),
+        }
+    return report
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        bench_counts = tuple(int(arg) for arg in sys.argv[2:]) or (1000, 10000)
+        for bench_words, bench_values in run_matcher_benchmark(bench_counts).items():
+            print(f"{bench_words:>7} 个词: " + ", ".join(f"{key}={value:,.1f}" for key, value in bench_values.items()))
+    else:
+        print("用法: python word_filter.py bench [词数 ...]")